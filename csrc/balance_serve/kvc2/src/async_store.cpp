@@ -3,29 +3,44 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/stat.h>
 #include <unistd.h>
+#include <algorithm>
+#include <chrono>
+#include <condition_variable>
+#include <deque>
 #include <filesystem>
 #include <future>
 #include <iostream>
+#include <mutex>
 #include <nlohmann/json.hpp>
 #include <optional>
 #include <queue>
 #include <thread>
 #include <unordered_map>
 
+#ifdef USE_IO_URING
+#include <liburing.h>
+#endif
+
 #include "utils/lock_free_queue.hpp"
 
 #include "async_store.hh"
 
 namespace async_store {
 
+// Elements are stored at DeviceBlockSize aligned offsets, so elements of whole device blocks in page aligned buffers
+// (PageAlignedMemoryPool) are accessed with O_DIRECT. Other elements and file systems without O_DIRECT (tmpfs) go
+// through the page cache.
 struct ArrayStore {
   static const size_t DeviceBlockSize = 512;
 
   const size_t element_size;
   const size_t element_size_aligned;
 
-  size_t size;
+  size_t size = 0;
+  int fd = -1;
+  int buffered_fd = -1;
 
   size_t size_in_bytes() { return size * element_size_aligned; }
 
@@ -35,23 +50,85 @@ struct ArrayStore {
     if (to <= size) {
       return;
     }
-    //TODO: extend file
+    // sparse, blocks are allocated on first write
+    if (ftruncate(buffered_fd, to * element_size_aligned) != 0) {
+      SPDLOG_ERROR("Extend {} to {} elements failed: {}", data_path.c_str(), to, strerror(errno));
+      throw std::runtime_error("Extend store file failed");
+    }
     size = to;
-    //LOG_INFO("Extend file to `, size `", to, size_in_bytes());
   }
 
   ArrayStore(size_t element_size, size_t size, std::filesystem::path data_path)
       : element_size(element_size),
-        element_size_aligned((element_size + DeviceBlockSize - 1) / DeviceBlockSize),
+        element_size_aligned((element_size + DeviceBlockSize - 1) / DeviceBlockSize * DeviceBlockSize),
         data_path(data_path) {
-    //TODO: prefix cache
+    if (data_path.has_parent_path()) {
+      std::filesystem::create_directories(data_path.parent_path());
+    }
+    buffered_fd = open(data_path.c_str(), O_RDWR | O_CREAT, 0644);
+    if (buffered_fd < 0) {
+      SPDLOG_ERROR("Open store {} failed: {}", data_path.c_str(), strerror(errno));
+      throw std::runtime_error("Open store file failed");
+    }
+    fd = open(data_path.c_str(), O_RDWR | O_DIRECT);
+    if (fd < 0) {
+      SPDLOG_WARN("Store {} without O_DIRECT: {}", data_path.c_str(), strerror(errno));
+      fd = buffered_fd;
+    }
+    struct stat st;
+    fstat(buffered_fd, &st);
+    this->size = st.st_size / element_size_aligned;
+    extend(size);
+  }
+
+  ~ArrayStore() {
+    if (fd != buffered_fd) {
+      close(fd);
+    }
+    close(buffered_fd);
+  }
+
+  off_t offset(size_t index) { return index * element_size_aligned; }
+
+  // O_DIRECT needs the buffer, length and offset aligned to the device block
+  int fd_for(void* buffer) {
+    bool aligned = element_size % DeviceBlockSize == 0 && reinterpret_cast<uintptr_t>(buffer) % DeviceBlockSize == 0;
+    return aligned ? fd : buffered_fd;
   }
 
   void read(size_t index, void* buffer) {
-    //TODO: read from file
+    auto re = transfer(fd_for(buffer), buffer, element_size, offset(index), false);
+    if (re < 0) {
+      SPDLOG_ERROR("Read {}[{}] failed: {}", data_path.c_str(), index, strerror(-re));
+      throw std::runtime_error("Read store failed");
+    }
   }
   void write(size_t index, void* buffer) {
-    //TODO: write to file
+    auto re = transfer(fd_for(buffer), buffer, element_size, offset(index), true);
+    if (re < 0) {
+      SPDLOG_ERROR("Write {}[{}] failed: {}", data_path.c_str(), index, strerror(-re));
+      throw std::runtime_error("Write store failed");
+    }
+  }
+
+  // loops over short transfers, returns bytes done or -errno. Reads past the end of the file are zeros.
+  static ssize_t transfer(int fd, void* buffer, size_t bytes, off_t offset, bool write, size_t done = 0) {
+    while (done < bytes) {
+      auto re = write ? pwrite(fd, (char*)buffer + done, bytes - done, offset + done)
+                      : pread(fd, (char*)buffer + done, bytes - done, offset + done);
+      if (re < 0) {
+        if (errno == EINTR) {
+          continue;
+        }
+        return -errno;
+      }
+      if (re == 0) {
+        memset((char*)buffer + done, 0, bytes - done);
+        break;
+      }
+      done += re;
+    }
+    return bytes;
   }
 };
 
@@ -88,25 +165,240 @@ std::string request_to_string(IORequest* req) {
 }
 
 struct IODealerImpl {
+  // blocking pread/pwrite threads when io_uring is off or unavailable
+  static constexpr int MaxIOThreads = 32;
+  static constexpr auto PerfInterval = std::chrono::seconds(10);
+
   MPSCQueue<IORequest> ioQueue;
-  uint64_t io_cnt = 0;
-  size_t io_amount = 0;
+  std::atomic_uint64_t io_cnt = 0;
+  std::atomic_size_t io_amount = 0;
   bool use_io_uring;
   int IO_DEPTH;
 
-  bool stop = false;
-  IODealerImpl(bool use_io_uring, int IO_DEPTH) : use_io_uring(use_io_uring), IO_DEPTH(IO_DEPTH) {}
+  std::atomic_bool stop = false;
+  std::atomic_bool running = false;
+
+  // thread pool fallback
+  std::mutex pending_lock;
+  std::condition_variable pending_cv;
+  std::deque<std::shared_ptr<IORequest>> pending;
 
+  std::chrono::steady_clock::time_point last_perf = std::chrono::steady_clock::now();
+  uint64_t last_io_cnt = 0;
+  size_t last_io_amount = 0;
+
+  IODealerImpl(bool use_io_uring, int IO_DEPTH) : use_io_uring(use_io_uring), IO_DEPTH(std::max(IO_DEPTH, 1)) {}
+
+  void finish(IORequest* req, size_t bytes) {
+    io_cnt.fetch_add(1, std::memory_order_relaxed);
+    io_amount.fetch_add(bytes, std::memory_order_relaxed);
+    if (req->need_promise) {
+      req->promise->set();
+    }
+  }
+
+  void fail(IORequest* req, int err) {
+    SPDLOG_ERROR("{} failed: {}", request_to_string(req), strerror(err));
+    // waiters must not hang, the block is left as it is
+    if (req->need_promise) {
+      req->promise->set();
+    }
+  }
+
+  void sync_io(IORequest* req) {
+    auto store = req->store;
+    auto bytes = store->element_size;
+    auto re = ArrayStore::transfer(store->fd_for(req->data), req->data, bytes, store->offset(req->index), req->write);
+    if (re < 0) {
+      fail(req, -re);
+    } else {
+      finish(req, bytes);
+    }
+  }
+
+  // the only consumer of ioQueue in the thread pool mode, moves requests to the worker threads. Requests enqueued
+  // before stop are still done.
   void queue_consumer() {
-    //TODO:
+    size_t idle = 0;
+    while (true) {
+      size_t moved = 0;
+      while (auto req = ioQueue.dequeue()) {
+        std::lock_guard<std::mutex> lg(pending_lock);
+        pending.push_back(std::move(req));
+        moved++;
+      }
+      if (moved > 0) {
+        pending_cv.notify_all();
+        idle = 0;
+      } else if (stop) {
+        break;
+      } else {
+        wait_idle(idle);
+      }
+      io_perf();
+    }
+    std::lock_guard<std::mutex> lg(pending_lock);
+    pending_cv.notify_all();
+  }
+
+  void io_worker() {
+    while (true) {
+      std::shared_ptr<IORequest> req;
+      {
+        std::unique_lock<std::mutex> ul(pending_lock);
+        pending_cv.wait(ul, [this]() { return stop || pending.empty() == false; });
+        if (pending.empty()) {
+          return;
+        }
+        req = std::move(pending.front());
+        pending.pop_front();
+      }
+      sync_io(req.get());
+    }
+  }
+
+  void thread_pool_dealer() {
+    int thread_count = std::min(IO_DEPTH, MaxIOThreads);
+    SPDLOG_INFO("IO Dealer with {} pread/pwrite threads", thread_count);
+    std::vector<std::thread> workers;
+    for (int i = 0; i < thread_count; i++) {
+      workers.emplace_back([this]() { io_worker(); });
+    }
+    queue_consumer();
+    for (auto& worker : workers) {
+      worker.join();
+    }
+  }
+
+#ifdef USE_IO_URING
+  bool uring_dealer() {
+    io_uring ring;
+    auto re = io_uring_queue_init(IO_DEPTH, &ring, 0);
+    if (re < 0) {
+      SPDLOG_WARN("io_uring unavailable ({}), falling back to a thread pool", strerror(-re));
+      return false;
+    }
+    SPDLOG_INFO("IO Dealer with io_uring, depth {}", IO_DEPTH);
+    // requests in flight, kept alive until their completion
+    std::vector<std::shared_ptr<IORequest>> inflight(IO_DEPTH);
+    std::vector<int> free_slots;
+    for (int i = IO_DEPTH - 1; i >= 0; i--) {
+      free_slots.push_back(i);
+    }
+    size_t idle = 0;
+    while (true) {
+      int submitted = 0;
+      while (free_slots.empty() == false) {
+        auto req = ioQueue.dequeue();
+        if (req == nullptr) {
+          break;
+        }
+        auto sqe = io_uring_get_sqe(&ring);
+        if (sqe == nullptr) {
+          sync_io(req.get());
+          continue;
+        }
+        auto store = req->store;
+        auto fd = store->fd_for(req->data);
+        auto bytes = store->element_size;
+        if (req->write) {
+          io_uring_prep_write(sqe, fd, req->data, bytes, store->offset(req->index));
+        } else {
+          io_uring_prep_read(sqe, fd, req->data, bytes, store->offset(req->index));
+        }
+        int slot = free_slots.back();
+        free_slots.pop_back();
+        io_uring_sqe_set_data(sqe, reinterpret_cast<void*>(static_cast<uintptr_t>(slot)));
+        inflight[slot] = std::move(req);
+        submitted++;
+      }
+      if (submitted > 0) {
+        io_uring_submit(&ring);
+      }
+      if (free_slots.size() == (size_t)IO_DEPTH) {
+        if (stop) {
+          break;
+        }
+        wait_idle(idle);
+        io_perf();
+        continue;
+      }
+      idle = 0;
+
+      io_uring_cqe* cqe;
+      // block for a completion only when the queue gave nothing new to submit
+      re = submitted > 0 ? io_uring_peek_cqe(&ring, &cqe) : io_uring_wait_cqe(&ring, &cqe);
+      while (re == 0) {
+        int slot = static_cast<int>(reinterpret_cast<uintptr_t>(io_uring_cqe_get_data(cqe)));
+        auto req = std::move(inflight[slot]);
+        free_slots.push_back(slot);
+        auto bytes = req->store->element_size;
+        if (cqe->res < 0) {
+          fail(req.get(), -cqe->res);
+        } else if ((size_t)cqe->res < bytes) {
+          // short transfer, the rest synchronously
+          auto store = req->store;
+          auto done = ArrayStore::transfer(store->fd_for(req->data), req->data, bytes, store->offset(req->index),
+                                             req->write, cqe->res);
+          if (done < 0) {
+            fail(req.get(), -done);
+          } else {
+            finish(req.get(), bytes);
+          }
+        } else {
+          finish(req.get(), bytes);
+        }
+        io_uring_cqe_seen(&ring, cqe);
+        re = io_uring_peek_cqe(&ring, &cqe);
+      }
+      io_perf();
+    }
+    io_uring_queue_exit(&ring);
+    return true;
   }
+#endif
 
+  void wait_idle(size_t& idle) {
+    idle++;
+    if (idle < 1000) {
+      std::this_thread::yield();
+    } else {
+      std::this_thread::sleep_for(std::chrono::microseconds(100));
+    }
+  }
+
+  // IOPS and GB/s since the last report, logged every PerfInterval while there is io
   void io_perf() {
-    //TODO:
+    auto now = std::chrono::steady_clock::now();
+    if (now - last_perf < PerfInterval) {
+      return;
+    }
+    uint64_t cnt = io_cnt.load(std::memory_order_relaxed);
+    size_t amount = io_amount.load(std::memory_order_relaxed);
+    if (cnt != last_io_cnt) {
+      double seconds = std::chrono::duration<double>(now - last_perf).count();
+      SPDLOG_INFO("IO Dealer: {} requests, {:.0f} IOPS, {:.3f} GB/s, {} queued", cnt - last_io_cnt,
+                  (cnt - last_io_cnt) / seconds, (amount - last_io_amount) / seconds / 1e9,
+                  ioQueue.enqueue_count.load() - ioQueue.dequeue_count);
+    }
+    last_perf = now;
+    last_io_cnt = cnt;
+    last_io_amount = amount;
   }
 
   void io_dealer() {
-    //TODO:
+#ifdef USE_IO_URING
+    if (use_io_uring && uring_dealer()) {
+      running = false;
+      return;
+    }
+#else
+    if (use_io_uring) {
+      SPDLOG_INFO("Built without USE_IO_URING, using a thread pool");
+    }
+#endif
+    thread_pool_dealer();
+    running = false;
   }
 };
 
@@ -124,6 +416,7 @@ void IODealer::enqueue(std::shared_ptr<IORequest> req) {
 }
 
 std::thread IODealer::start_io_thread() {
+  io_impl->running = true;
   return std::thread([this]() { io_impl->io_dealer(); });
 }
 void IODealer::stop() {
@@ -132,6 +425,10 @@ void IODealer::stop() {
   }
   //LOG_INFO("Stopping IO Dealer");
   io_impl->stop = true;
+  // the io thread may be detached, it still uses io_impl until it returns
+  while (io_impl->running) {
+    std::this_thread::sleep_for(std::chrono::milliseconds(1));
+  }
 }
 
 }  // namespace async_store
@@ -267,6 +267,36 @@ void GPUPageCache::append_col_to_request(std::vector<std::shared_ptr<CudaStreamM
   // SPDLOG_DEBUG("GPU: Appended Vertical Handle to Request, count {}", reqs[0]->sizes.size());
 }
 
+size_t GPUPageCache::swap_col_bytes() {
+  size_t slices = config.full_kv_cache_on_each_gpu ? tp_size[0] : tp_offset.back() + tp_size.back();
+  return config.layer_count * ((size_t)config.k_cache_on + (size_t)config.v_cache_on) * slices;
+}
+
+void GPUPageCache::append_swap_col_to_request(std::vector<std::shared_ptr<CudaStreamManager::Request>>& reqs,
+                                              void* host, size_t at) {
+  bool to_host = reqs[0]->direction == cudaMemcpyDeviceToHost;
+  size_t slices = config.full_kv_cache_on_each_gpu ? tp_size[0] : tp_offset.back() + tp_size.back();
+  size_t offset = 0;
+  for (size_t layer = 0; layer < config.layer_count; layer++) {
+    for (auto* cache : {config.k_cache_on ? &k_cache : nullptr, config.v_cache_on ? &v_cache : nullptr}) {
+      if (cache == nullptr) {
+        continue;
+      }
+      for (size_t which_gpu = 0; which_gpu < config.gpu_devices_id.size(); which_gpu++) {
+        // a replicated cache is read from the first gpu and written to all of them
+        if (config.full_kv_cache_on_each_gpu && to_host && which_gpu > 0) {
+          break;
+        }
+        size_t tp = config.full_kv_cache_on_each_gpu ? 0 : tp_offset[which_gpu];
+        reqs[which_gpu]->sizes.push_back(tp_size[which_gpu]);
+        reqs[which_gpu]->host_mem_addresses.push_back(offset_by_bytes(host, offset + tp));
+        reqs[which_gpu]->device_mem_addresses.push_back((*cache)[which_gpu][layer][at].data_ptr());
+      }
+      offset += slices;
+    }
+  }
+}
+
 void GPUPageCache::debug() {
   size_t count = 0;
   for (size_t i = 0; i < config.total_kvcache_pages; i++) {
@@ -68,6 +68,11 @@ class GPUPageCache {
                              std::vector<std::vector<std::shared_ptr<CacheBlockEntry>>>& k_handles,
                              std::vector<std::vector<std::shared_ptr<CacheBlockEntry>>>& v_handles, size_t at);
 
+  // gpu only swap, a col is stored on host as [layer][k, v][gpu slices]
+  size_t swap_col_bytes();
+  void append_swap_col_to_request(std::vector<std::shared_ptr<CudaStreamManager::Request>>& reqs, void* host,
+                                  size_t at);
+
   void debug();
 };
 }  // namespace kvc2
@@ -40,6 +40,8 @@ struct KVC2Config {
   std::optional<GPUPageCacheConfig> gpu_cache_config = std::nullopt;
   size_t metrics_port;
   double recompute_ratio = 0.2;
+  // pinned host pool the gpu only pages of preempted queries are swapped out to, 0 turns swapping off
+  size_t swap_pool_size = 0;
 };
 
 class DoubleCacheHandleInterface;
@@ -132,6 +134,17 @@ class DoubleCacheHandleInterface {
 
   virtual void append_tokens(Token* tokens, TokenLength length) = 0;  // update generated tokens
 
+  /*
+  Swap out / Swap in (gpu only mode)
+  swap_out_async copies the pages holding the first length tokens to the swap pool and gives all gpu pages of the
+  handle back once the copy is done, swap_in_async allocates new gpu pages and copies the swapped pages back, so
+  get_gpu_block_idx changes. call_back(false) leaves the handle as it was: swapping is off, the swap pool is full
+  or there are not enough free gpu pages.
+  */
+  virtual void swap_out_async(TokenLength length, std::function<void(bool)> call_back) = 0;
+  virtual void swap_in_async(std::function<void(bool)> call_back) = 0;
+  virtual bool swapped() = 0;
+
   virtual void debug() = 0;
 };
 
@@ -45,6 +45,9 @@ struct PageAlignedMemoryPool {
   size_t page_count();
   size_t page_padded_size(size_t size);
 
+  void* base() { return data; }
+  size_t bytes() { return total_size; }
+
   void* alloc(size_t size);
   std::vector<void*> alloc_multiple(size_t size, size_t count);
   void free(void* data, size_t size);
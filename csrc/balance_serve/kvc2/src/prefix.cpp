@@ -674,6 +674,8 @@ struct DoubleCacheHandle : public DoubleCacheHandleInterface {
   std::unique_ptr<CacheBlockEntryCollector> cpu_releaser = nullptr, gpu_releaser = nullptr;
 
   std::vector<size_t> gpu_only_block_idx;
+  // gpu only swap, one swap pool page per swapped col
+  std::vector<void*> swap_host_pages;
 
   virtual ~DoubleCacheHandle();
   // interface
@@ -733,6 +735,10 @@ struct DoubleCacheHandle : public DoubleCacheHandleInterface {
 
   void append_tokens(Token* tokens, TokenLength length) override;
 
+  void swap_out_async(TokenLength length, std::function<void(bool)> call_back) override;
+  void swap_in_async(std::function<void(bool)> call_back) override;
+  bool swapped() override { return swap_host_pages.empty() == false; }
+
   void debug() override {}
 
   void set_cache_info(ModelName model_name, QuantType quant_type, bool turn_on_k_cache, bool turn_on_v_cache) {
@@ -1078,6 +1084,7 @@ struct KVC2 : KVC2Interface {
   std::unique_ptr<async_store::IODealer> io_dealer;
 
   std::shared_ptr<GPUPageCache> gpu_cache;
+  std::shared_ptr<PageAlignedMemoryPool> swap_pool;
 
  public:
   void load() override {
@@ -1326,7 +1333,12 @@ struct KVC2 : KVC2Interface {
     tree->debug();
   }
 
-  virtual ~KVC2() { flush_back(); };
+  virtual ~KVC2() {
+    flush_back();
+    if (swap_pool != nullptr) {
+      cudaHostUnregister(swap_pool->base());
+    }
+  };
 
   KVC2(KVC2Config config) : config(config) {
     SPDLOG_INFO("Creating KVC2 using these config");
@@ -1374,7 +1386,8 @@ struct KVC2 : KVC2Interface {
           new CacheEntryManager(CacheEntryManagerConfig{.evict_count = config.evict_count, .kvc2_top = this}));
       cache_manager->pool = memory_pool;
 
-      io_dealer = std::make_unique<async_store::IODealer>();
+      // io_uring when built with USE_IO_URING and the kernel allows it, a thread pool otherwise
+      io_dealer = std::make_unique<async_store::IODealer>(true);
       io_dealer->start_io_thread().detach();
 
       tree->met = met;
@@ -1387,6 +1400,16 @@ struct KVC2 : KVC2Interface {
     } else {
       SPDLOG_CRITICAL("GPU ONLY MODE, NO PREFIX CACHE");
       gpu_cache = std::make_shared<GPUPageCache>(config.gpu_cache_config.value());
+      if (config.swap_pool_size > 0) {
+        swap_pool = std::make_shared<PageAlignedMemoryPool>(config.swap_pool_size);
+        // pinned, so the copies of the stream manager are asynchronous
+        cudaError_t err = cudaHostRegister(swap_pool->base(), swap_pool->bytes(), cudaHostRegisterDefault);
+        if (err != cudaSuccess) {
+          SPDLOG_WARN("Cannot pin swap pool: {}, swapping will be synchronous", cudaGetErrorString(err));
+        }
+        SPDLOG_INFO("    Swap Pool: {}, {} cols", readable_number(swap_pool->bytes()),
+                    swap_pool->bytes() / gpu_cache->swap_col_bytes());
+      }
     }
   }
 };
@@ -1401,6 +1424,9 @@ std::shared_ptr<KVC2Interface> create_kvc2(KVC2Config config) {
 DoubleCacheHandle::~DoubleCacheHandle() {
   if (kvc2_top->config.gpu_only) {
     kvc2_top->gpu_cache->gpu_only_free_cols(gpu_only_block_idx);
+    for (auto page : swap_host_pages) {
+      kvc2_top->swap_pool->free(page, kvc2_top->gpu_cache->swap_col_bytes());
+    }
   } else {
     for_all_cache_block_entry([](std::shared_ptr<CacheBlockEntry>& block_entry) {
       block_entry->lock_guard();
@@ -1627,6 +1653,74 @@ void DoubleCacheHandle::append_tokens(Token* all_tokens, TokenLength length) {
   // kvc2_top->block_cache->debug();
 }
 
+void DoubleCacheHandle::swap_out_async(TokenLength length, std::function<void(bool)> call_back) {
+  auto gpu_cache = kvc2_top->gpu_cache.get();
+  auto pool = kvc2_top->swap_pool.get();
+  if (kvc2_top->config.gpu_only == false || pool == nullptr || swapped() || gpu_only_block_idx.empty()) {
+    call_back(false);
+    return;
+  }
+  size_t col_count = std::min(div_up(length, NumTokenPerBlock), gpu_only_block_idx.size());
+  auto pages = pool->alloc_multiple(gpu_cache->swap_col_bytes(), col_count);
+  if (pages.size() != col_count) {
+    SPDLOG_WARN("Swap pool cannot hold {} cols", col_count);
+    call_back(false);
+    return;
+  }
+
+  // the handle gives its cols up now, they go back to the gpu cache when the copy is done
+  auto cols = std::move(gpu_only_block_idx);
+  gpu_only_block_idx.clear();
+  swap_host_pages = pages;
+
+  auto pending = std::make_shared<std::atomic_size_t>(gpu_cache->config.gpu_devices_id.size());
+  auto reqs = gpu_cache->basic_request(cudaMemcpyDeviceToHost, [pending, gpu_cache, cols, call_back]() {
+    if (pending->fetch_sub(1) == 1) {
+      gpu_cache->gpu_only_free_cols(cols);
+      call_back(true);
+    }
+  });
+  for (size_t i = 0; i < col_count; i++) {
+    gpu_cache->append_swap_col_to_request(reqs, pages[i], cols[i]);
+  }
+  SPDLOG_DEBUG("Swap out {} cols", col_count);
+  gpu_cache->submit_requests(reqs);
+}
+
+void DoubleCacheHandle::swap_in_async(std::function<void(bool)> call_back) {
+  auto gpu_cache = kvc2_top->gpu_cache.get();
+  auto pool = kvc2_top->swap_pool.get();
+  if (swapped() == false) {
+    call_back(false);
+    return;
+  }
+  auto cols = gpu_cache->gpu_only_alloc_col(div_up(estimated_length, NumTokenPerBlock));
+  if (cols.empty()) {
+    call_back(false);
+    return;
+  }
+
+  gpu_only_block_idx = cols;
+  auto pages = std::move(swap_host_pages);
+  swap_host_pages.clear();
+
+  auto pending = std::make_shared<std::atomic_size_t>(gpu_cache->config.gpu_devices_id.size());
+  size_t page_bytes = gpu_cache->swap_col_bytes();
+  auto reqs = gpu_cache->basic_request(cudaMemcpyHostToDevice, [pending, pool, pages, page_bytes, call_back]() {
+    if (pending->fetch_sub(1) == 1) {
+      for (auto page : pages) {
+        pool->free(page, page_bytes);
+      }
+      call_back(true);
+    }
+  });
+  for (size_t i = 0; i < pages.size(); i++) {
+    gpu_cache->append_swap_col_to_request(reqs, pages[i], cols[i]);
+  }
+  SPDLOG_DEBUG("Swap in {} cols", pages.size());
+  gpu_cache->submit_requests(reqs);
+}
+
 void CacheBlockEntry::flush_back_async(IO_Helper<CacheBlockEntry>& helper,
                                        std::vector<std::atomic_bool*>& dirty_flags) {
   auto kvc2_top = manager->config.kvc2_top;
@@ -0,0 +1,113 @@
+// Round trip of the async_store IODealer against a local directory (tmpfs or ext4), both with page aligned buffers
+// (O_DIRECT where the file system allows it) and unaligned ones.
+//   async_store_test [dir=/tmp/kvc2_async_store_test] [element_count=4096] [use_io_uring=1] [io_depth=128]
+#include <chrono>
+#include <cstdlib>
+#include <cstring>
+#include <filesystem>
+#include <iostream>
+#include <random>
+#include <thread>
+#include <vector>
+
+#include "async_store.hh"
+
+using namespace async_store;
+
+constexpr size_t ElementSize = 576 * 2 * 256;  // one 256 token page of the DeepSeek k cache in bf16
+
+double run(IODealer& dealer, ArrayStore* store, std::vector<void*>& buffers, bool write) {
+  auto start = std::chrono::high_resolution_clock::now();
+  BatchPromise promise(1);
+  for (size_t i = 0; i < buffers.size(); i++) {
+    auto req = std::make_shared<IORequest>();
+    req->store = store;
+    req->write = write;
+    req->data = buffers[i];
+    req->index = i;
+    req->need_promise = true;
+    req->promise = &promise;
+    promise.inc();
+    dealer.enqueue(std::move(req));
+  }
+  promise.set();
+  promise.get_shared_fut().wait();
+  auto end = std::chrono::high_resolution_clock::now();
+  double seconds = std::chrono::duration<double>(end - start).count();
+  printf("%s %zu elements: %.0f IOPS, %.3f GB/s\n", write ? "write" : "read ", buffers.size(),
+         buffers.size() / seconds, buffers.size() * ElementSize / seconds / 1e9);
+  return seconds;
+}
+
+bool round_trip(IODealer& dealer, std::filesystem::path path, size_t count, bool aligned) {
+  std::filesystem::remove(path);
+  auto store = create_or_open_store(ElementSize, 16, path);
+  extend(store, count);
+  std::mt19937_64 gen(count);
+  std::vector<void*> src(count), dst(count);
+  size_t shift = aligned ? 0 : 8;
+  for (size_t i = 0; i < count; i++) {
+    src[i] = (char*)aligned_alloc(4096, ElementSize + 4096) + shift;
+    dst[i] = (char*)aligned_alloc(4096, ElementSize + 4096) + shift;
+    for (size_t j = 0; j < ElementSize / sizeof(uint64_t); j++) {
+      ((uint64_t*)src[i])[j] = gen();
+    }
+    memset(dst[i], 0, ElementSize);
+  }
+  run(dealer, store, src, true);
+  run(dealer, store, dst, false);
+  bool ok = true;
+  for (size_t i = 0; i < count; i++) {
+    if (memcmp(src[i], dst[i], ElementSize) != 0) {
+      printf("element %zu differs\n", i);
+      ok = false;
+      break;
+    }
+  }
+  // reopened, the store keeps its size and data
+  close_store(store);
+  store = create_or_open_store(ElementSize, 16, path);
+  if (capacity(store) != count) {
+    printf("reopened store has %zu elements, expected %zu\n", capacity(store), count);
+    ok = false;
+  }
+  memset(dst[count - 1], 0, ElementSize);
+  BatchPromise promise(1);
+  auto req = std::make_shared<IORequest>();
+  req->store = store;
+  req->data = dst[count - 1];
+  req->index = count - 1;
+  req->write = false;
+  req->need_promise = true;
+  req->promise = &promise;
+  dealer.enqueue(std::move(req));
+  promise.get_shared_fut().wait();
+  if (memcmp(src[count - 1], dst[count - 1], ElementSize) != 0) {
+    printf("reopened store lost element %zu\n", count - 1);
+    ok = false;
+  }
+  close_store(store);
+  for (size_t i = 0; i < count; i++) {
+    free((char*)src[i] - shift);
+    free((char*)dst[i] - shift);
+  }
+  printf("%s buffers: %s\n", aligned ? "aligned" : "unaligned", ok ? "ok" : "FAILED");
+  return ok;
+}
+
+int main(int argc, char* argv[]) {
+  std::filesystem::path dir = argc > 1 ? argv[1] : "/tmp/kvc2_async_store_test";
+  size_t count = argc > 2 ? std::stoul(argv[2]) : 4096;
+  bool use_io_uring = argc > 3 ? std::stoi(argv[3]) != 0 : true;
+  int io_depth = argc > 4 ? std::stoi(argv[4]) : 128;
+  std::filesystem::create_directories(dir);
+
+  IODealer dealer(use_io_uring, io_depth);
+  auto io = dealer.start_io_thread();
+  bool ok = round_trip(dealer, dir / "aligned.kvc", count, true);
+  ok = round_trip(dealer, dir / "unaligned.kvc", count / 16 + 1, false) && ok;
+  dealer.stop();
+  io.join();
+  std::filesystem::remove_all(dir);
+  return ok ? 0 : 1;
+}
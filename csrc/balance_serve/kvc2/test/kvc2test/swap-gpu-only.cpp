@@ -0,0 +1,64 @@
+#include <future>
+#include "common.hpp"
+
+bool wait_swap(std::function<void(std::function<void(bool)>)> f) {
+  std::promise<bool> p;
+  f([&p](bool ok) { p.set_value(ok); });
+  return p.get_future().get();
+}
+
+int main(int argc, char* argv[]) {
+  init(argc, argv);
+  spdlog::set_level(spdlog::level::debug);
+  config.gpu_only = true;
+  config.gpu_cache_config->gpu_only = true;
+  config.swap_pool_size = 2e9;
+  auto kvc2 = kvc2::create_kvc2(config);
+  size_t total_pages = config.gpu_cache_config->total_kvcache_pages;
+
+  std::mt19937 gen(123);
+  auto ids1 = random_ids(4 * config.num_token_per_page, gen);
+  auto h = kvc2->lookup_to_gpu(test_model_name, test_quant_type, ids1.data(), ids1.size(), ids1.size());
+  assert(h != nullptr);
+
+  auto [kcache, vcache] = kvc2->get_kvcache();
+  auto old_idx = h->get_gpu_block_idx();
+  std::vector<torch::Tensor> saved_k, saved_v;
+  for (size_t i = 0; i < kcache.size(); i++) {
+    auto idx = torch::tensor(std::vector<int64_t>(old_idx.begin(), old_idx.end()), torch::kInt64).to(kcache[i].device());
+    kcache[i].index_copy_(1, idx, torch::randn_like(kcache[i].index_select(1, idx)));
+    vcache[i].index_copy_(1, idx, torch::randn_like(vcache[i].index_select(1, idx)));
+    saved_k.push_back(kcache[i].index_select(1, idx).cpu());
+    saved_v.push_back(vcache[i].index_select(1, idx).cpu());
+  }
+
+  bool ok = wait_swap([&h](auto cb) { h->swap_out_async(4 * config.num_token_per_page, cb); });
+  assert(ok);
+  assert(h->swapped());
+  assert(h->get_gpu_block_idx().empty());
+
+  // all gpu pages are free again
+  {
+    auto full_ids = random_ids(total_pages * config.num_token_per_page, gen);
+    auto full = kvc2->lookup_to_gpu(test_model_name, test_quant_type, full_ids.data(), full_ids.size(), full_ids.size());
+    assert(full != nullptr);
+    // nothing left to swap in to
+    ok = wait_swap([&h](auto cb) { h->swap_in_async(cb); });
+    assert(ok == false);
+    assert(h->swapped());
+  }
+
+  ok = wait_swap([&h](auto cb) { h->swap_in_async(cb); });
+  assert(ok);
+  assert(h->swapped() == false);
+  auto new_idx = h->get_gpu_block_idx();
+  assert(new_idx.size() == old_idx.size());
+  for (size_t i = 0; i < kcache.size(); i++) {
+    auto idx = torch::tensor(std::vector<int64_t>(new_idx.begin(), new_idx.end()), torch::kInt64).to(kcache[i].device());
+    assert(torch::equal(kcache[i].index_select(1, idx).cpu(), saved_k[i]));
+    assert(torch::equal(vcache[i].index_select(1, idx).cpu(), saved_v[i]));
+  }
+
+  SPDLOG_CRITICAL("All Test Passed: {}", argv[0]);
+  return 0;
+}
@@ -43,16 +43,29 @@ PYBIND11_MODULE(sched_ext, m) {
     .def(py::init<>())
     .def_readwrite("temperature", &scheduler::SampleOptions::temperature)
     .def_readwrite("top_p", &scheduler::SampleOptions::top_p)  // 确保 top_p 也能被访问
+    .def_readwrite("top_k", &scheduler::SampleOptions::top_k)
+    .def_readwrite("min_p", &scheduler::SampleOptions::min_p)
+    .def_readwrite("repetition_penalty", &scheduler::SampleOptions::repetition_penalty)
+    .def_readwrite("frequency_penalty", &scheduler::SampleOptions::frequency_penalty)
+    .def_readwrite("presence_penalty", &scheduler::SampleOptions::presence_penalty)
+    .def_readwrite("seed", &scheduler::SampleOptions::seed)
     .def(py::pickle(
         [](const scheduler::SampleOptions& self) {
-            return py::make_tuple(self.temperature, self.top_p);  // 序列化 temperature 和 top_p
+            return py::make_tuple(self.temperature, self.top_p, self.top_k, self.min_p, self.repetition_penalty,
+                                  self.frequency_penalty, self.presence_penalty, self.seed);
         },
         [](py::tuple t) {
-            if (t.size() != 2)  // 确保解包时参数数量匹配
+            if (t.size() != 8)  // 确保解包时参数数量匹配
                 throw std::runtime_error("Invalid state! t.size() = " + std::to_string(t.size()));
             scheduler::SampleOptions so;
             so.temperature = t[0].cast<double>();
             so.top_p = t[1].cast<double>();  // 反序列化 top_p
+            so.top_k = t[2].cast<int>();
+            so.min_p = t[3].cast<double>();
+            so.repetition_penalty = t[4].cast<double>();
+            so.frequency_penalty = t[5].cast<double>();
+            so.presence_penalty = t[6].cast<double>();
+            so.seed = t[7].cast<int64_t>();
             return so;
         }
     ));
@@ -80,6 +93,7 @@ PYBIND11_MODULE(sched_ext, m) {
       .def_readwrite("kvc2_config_path", &scheduler::Settings::kvc2_config_path)
       .def_readwrite("kvc2_root_path", &scheduler::Settings::kvc2_root_path)
       .def_readwrite("memory_pool_size_GB", &scheduler::Settings::memory_pool_size_GB)
+      .def_readwrite("swap_pool_size_GB", &scheduler::Settings::swap_pool_size_GB)
       .def_readwrite("evict_count", &scheduler::Settings::evict_count)
       .def_readwrite("strategy_name", &scheduler::Settings::strategy_name)
       .def_readwrite("kvc2_metrics_port", &scheduler::Settings::kvc2_metrics_port)
@@ -6,9 +6,12 @@
 #include <optional>
 #include "scheduler.h"
 
+#include <algorithm>
 #include <atomic>
 #include <cassert>
+#include <chrono>
 #include <future>
+#include <limits>
 #include <memory>
 #include <queue>
 #include "arithmetic.hpp"
@@ -100,6 +103,12 @@ bool BatchQueryTodo::empty() {
 
 struct QueryMaintainer;
 
+using Clock = std::chrono::steady_clock;
+
+inline double ms_between(Clock::time_point from, Clock::time_point to) {
+  return std::chrono::duration<double, std::milli>(to - from).count();
+}
+
 struct Query {
   QueryID id;
   torch::Tensor query_token;
@@ -115,6 +124,9 @@ struct Query {
 
   std::vector<std::vector<int>> stop_criteria;
 
+  Clock::time_point arrival_time = Clock::now();
+  std::optional<Clock::time_point> last_token_time = std::nullopt;
+
   // status
   // Query status changed by this order
   enum Status { Received, Preparing, Ready, Prefill, Decode, Done };
@@ -136,6 +148,7 @@ struct Query {
   } ctx;
 
   void after_load(bool ok);
+  void update_block_index();
 
   void to_status(Status to);
 
@@ -168,6 +181,45 @@ struct Query {
 
   Token& token_at(size_t idx) { return reinterpret_cast<Token*>(query_token.data_ptr())[idx]; }
 
+  void record_token() {
+    auto now = Clock::now();
+    if (last_token_time.has_value()) {
+      ctx.met->TBT_ms->Observe(ms_between(last_token_time.value(), now));
+    } else {
+      ctx.met->TTFT_ms->Observe(ms_between(arrival_time, now));
+    }
+    last_token_time = now;
+  }
+
+  // prompt tokens whose kvcache is still to be computed, in plan
+  TokenLength remaining_prefill() const {
+    switch (plan_status) {
+      case Prefill:
+        return prompt_length - plan_position;
+      case Decode:
+      case Done:
+        return 0;
+      case Ready:
+        return prompt_length - no_kvcache_from;
+      default:
+        return prompt_length;
+    }
+  }
+
+  // the first token is due SLO_TTFT_ms after arrival, every next one SLO_TBT_ms after the previous,
+  // a query without SLO keeps its arrival order
+  Clock::time_point deadline() const {
+    int ttft = SLO_TTFT_ms.value_or(MAX_SLO_TIME);
+    int tbt = SLO_TBT_ms.value_or(MAX_SLO_TIME);
+    if (last_token_time.has_value() && tbt < MAX_SLO_TIME) {
+      return last_token_time.value() + std::chrono::milliseconds(tbt);
+    }
+    if (last_token_time.has_value() == false && ttft < MAX_SLO_TIME) {
+      return arrival_time + std::chrono::milliseconds(ttft);
+    }
+    return arrival_time + std::chrono::milliseconds(MAX_SLO_TIME);
+  }
+
   void absorb_update(const QueryUpdate& update) {
     SPDLOG_DEBUG("{}", update.debug());
     active_position = update.active_position;
@@ -176,10 +228,12 @@ struct Query {
       if (active_position == prompt_length) {
         token_at(active_position) = update.generated_token;
         ctx.met->generated_tokens->Increment(1);
+        record_token();
       }
     } else {
       token_at(active_position) = update.generated_token;
       ctx.met->generated_tokens->Increment(1);
+      record_token();
     }
 
     if (update.decode_done || active_position == estimated_length - 1) {
@@ -286,6 +340,7 @@ struct KVC2_Maintainer {
         .evict_count = settings.evict_count,
         .gpu_cache_config = gpu_cache_config,
         .metrics_port = settings.kvc2_metrics_port,
+        .swap_pool_size = size_t(settings.swap_pool_size_GB * 1e9),
     };
     kvc2_interface = kvc2::create_kvc2(kvc2_config);
     if (settings.load_from_disk)
@@ -300,6 +355,9 @@ struct KVC2_Maintainer {
 };
 
 using EventAddQuery = std::pair<QueryAdd, std::promise<QueryID>*>;
+struct EventCancelQuery {
+  QueryID query_id;
+};
 using EventUpdateQuery = BatchQueryUpdate;
 using EventTakenBatch = std::shared_ptr<BatchQueryTodo>;
 struct EventPrepare {
@@ -315,10 +373,15 @@ struct EventQueryStatus{
   QueryID query_id;
   Query::Status now_status;
 };
+struct EventSwapped {
+  QueryID query_id;
+  bool out;  // swapped out to, or in from, the kvc2 swap pool
+  bool ok;
+};
 struct EventSchedule {};
 
-using Event = std::variant<EventAddQuery, EventUpdateQuery, EventTakenBatch, EventPrepare, EventPrepared,
-                           EventQueryStatus, EventSchedule>;
+using Event = std::variant<EventAddQuery, EventCancelQuery, EventUpdateQuery, EventTakenBatch, EventPrepare,
+                           EventPrepared, EventQueryStatus, EventSwapped, EventSchedule>;
 
 template <typename T>
 std::string event_name(const T& event);
@@ -328,6 +391,11 @@ std::string event_name(const EventAddQuery&) {
   return "EventAddQuery";
 }
 
+template <>
+std::string event_name(const EventCancelQuery&) {
+  return "EventCancelQuery";
+}
+
 template <>
 std::string event_name(const EventUpdateQuery&) {
   return "EventUpdateQuery";
@@ -352,6 +420,11 @@ std::string event_name(const EventQueryStatus&) {
   return "EventQueryStatus";
 }
 
+template <>
+std::string event_name(const EventSwapped&) {
+  return "EventSwapped";
+}
+
 template <>
 std::string event_name(const EventSchedule&) {
   return "EventSchedule";
@@ -383,12 +456,21 @@ struct QueryMaintainer : public Scheduler {
 
   QueryMaintainer() = default;
 
-  void gen_batch_query_todo(BatchQueryTodo* re, const std::set<Q>& queries) {
+  // prefill tokens a batch takes next to its decodes, two prefills or a nearly full batch halve it
+  size_t prefill_token_budget(size_t prefill_num, size_t decode_num) {
+    if (prefill_num >= 2 || (prefill_num == 1 && settings.max_batch_size - 2 < decode_num)) {
+      return settings.recommended_chunk_prefill_token_count * std::max<size_t>(prefill_num, 1);
+    }
+    return settings.recommended_chunk_prefill_token_count * 2;
+  }
+
+  // prefill_lengths overrides the even split of the budget for the queries it lists
+  void gen_batch_query_todo(BatchQueryTodo* re, const std::set<Q>& queries,
+                            const std::map<QueryID, size_t>& prefill_lengths = {}) {
     std::vector<std::vector<QueryID>> d_batch(2);
     size_t last_decode_batch = 0;
     size_t prefill_num = 0;
     size_t decode_num = 0;
-    size_t preill_length = 0;
     for (auto& q : queries) {
       if (q->plan_status == Query::Prefill) {
         prefill_num += 1;
@@ -397,18 +479,14 @@ struct QueryMaintainer : public Scheduler {
         decode_num += 1;
       }
     }
-    if (prefill_num >= 2 || (prefill_num ==1 && settings.max_batch_size - 2 < decode_num)) {
-        preill_length = settings.recommended_chunk_prefill_token_count;
-    }
-    else {
-      preill_length = settings.recommended_chunk_prefill_token_count * 2;
-    }
+    size_t preill_length = prefill_token_budget(prefill_num, decode_num) / std::max<size_t>(prefill_num, 1);
     for (auto& q : queries) {
       re->query_ids.push_back(q->id);
       re->query_tokens.push_back(q->query_token);
       re->query_lengths.push_back(q->prompt_length);
       if (q->plan_status == Query::Prefill) {
-        re->prefill_mini_batches.push_back(q->get_prefill_task(preill_length));
+        auto it = prefill_lengths.find(q->id);
+        re->prefill_mini_batches.push_back(q->get_prefill_task(it == prefill_lengths.end() ? preill_length : it->second));
         assert(re->prefill_mini_batches.size() <= 2);
       }
       if (q->plan_status == Query::Decode) {
@@ -460,6 +538,7 @@ struct QueryMaintainer : public Scheduler {
         "  kvc2_config_path: {}\n"
         "  kvc2_root_path: {}\n"
         "  memory_pool_size_GB: {}\n"
+        "  swap_pool_size_GB: {}\n"
         "  evict_count: {}\n"
         "  kvc2_metrics_port: {}\n"
         "  load_from_disk: {}\n"
@@ -474,8 +553,8 @@ struct QueryMaintainer : public Scheduler {
         settings.page_size, format_vector(settings.gpu_device_id), readable_number(settings.gpu_memory_size),
         settings.memory_utilization_percentage, settings.max_batch_size, settings.recommended_chunk_prefill_token_count,
         settings.sched_metrics_port, settings.kvc2_config_path, settings.kvc2_root_path, settings.memory_pool_size_GB,
-        settings.evict_count, settings.kvc2_metrics_port, settings.load_from_disk, settings.save_to_disk,
-        settings.strategy_name, settings.gpu_device_count);
+        settings.swap_pool_size_GB, settings.evict_count, settings.kvc2_metrics_port, settings.load_from_disk,
+        settings.save_to_disk, settings.strategy_name, settings.gpu_device_count);
 
     this->settings = settings;
     kvc2_maintainer = std::shared_ptr<KVC2_Maintainer>(new KVC2_Maintainer(settings));
@@ -508,16 +587,8 @@ struct QueryMaintainer : public Scheduler {
     return p.get_future().get();
   }
 
-  void cancel_query(QueryID id) override {
-    SPDLOG_INFO("Cancel Query");
-    SPDLOG_INFO("sched:{} Cancel Query", fmt::ptr(this));
-    auto it = query_map.find(id);
-    if (it == query_map.end()) {
-      SPDLOG_ERROR("Query {} is not found", id);
-      return;
-    }
-    query_map.erase(it);
-  }
+  // called from the rpc worker threads, query_map belongs to the event loop
+  void cancel_query(QueryID id) override { event_loop_queue.enqueue(EventCancelQuery{id}); }
 
   // Here this function update last batch results and get the next batch
   // in most cases, the batch is ready,
@@ -557,6 +628,7 @@ struct QueryMaintainer : public Scheduler {
   virtual void strategy_prepare(const EventPrepare& prepare) = 0;
   virtual void strategy_prepared(const EventPrepared& prepared) = 0;
   virtual void strategy_query_status(const EventQueryStatus& query_status) = 0;
+  virtual void strategy_swapped(const EventSwapped& swapped) = 0;
   virtual void strategy_schedule(const EventSchedule& event, BatchQueryTodo* new_batch) = 0;
 
   void tackle_event(EventAddQuery& event) {
@@ -570,6 +642,16 @@ struct QueryMaintainer : public Scheduler {
     strategy_add_query(new_query);
   }
 
+  void tackle_event(const EventCancelQuery& event) {
+    SPDLOG_INFO("sched:{} Cancel Query {}", fmt::ptr(this), event.query_id);
+    auto it = query_map.find(event.query_id);
+    if (it == query_map.end()) {
+      SPDLOG_ERROR("Query {} is not found", event.query_id);
+      return;
+    }
+    query_map.erase(it);
+  }
+
   void tackle_event(const EventUpdateQuery& update) {
     // SPDLOG_INFO("Tackle Update Query");
     for (auto& u : update) {
@@ -607,6 +689,7 @@ struct QueryMaintainer : public Scheduler {
   void tackle_event(const EventPrepare& event) { strategy_prepare(event); }
   void tackle_event(const EventPrepared& event) { strategy_prepared(event); }
   void tackle_event(const EventQueryStatus& event) { strategy_query_status(event); }
+  void tackle_event(const EventSwapped& event) { strategy_swapped(event); }
 
   void tackle_event(const EventSchedule& event) {
     // SPDLOG_INFO("Tackle Schedule Event");
@@ -642,6 +725,8 @@ struct QueryMaintainer : public Scheduler {
               // SPDLOG_INFO("Event Loop: {}", typeid(T).name());
               if constexpr (std::is_same_v<T, EventAddQuery>) {
                 tackle_event(event);
+              } else if constexpr (std::is_same_v<T, EventCancelQuery>) {
+                tackle_event(event);
               } else if constexpr (std::is_same_v<T, EventUpdateQuery>) {
                 tackle_event(event);
               } else if constexpr (std::is_same_v<T, EventTakenBatch>) {
@@ -652,6 +737,8 @@ struct QueryMaintainer : public Scheduler {
                 tackle_event(event);
               } else if constexpr (std::is_same_v<T, EventQueryStatus>) {
                 tackle_event(event);
+              } else if constexpr (std::is_same_v<T, EventSwapped>) {
+                tackle_event(event);
               } else if constexpr (std::is_same_v<T, EventSchedule>) {
                 tackle_event(event);
               } else {
@@ -732,17 +819,21 @@ void Query::to_status(Status to) {
   export_metrics();
 }
 
+void Query::update_block_index() {
+  size_t page_count = div_up(estimated_length, ctx.query_maintainer->settings.page_size);
+  std::vector<int64_t> shape;
+  shape.push_back(page_count);
+  block_index = torch::zeros(shape, torch::TensorOptions().dtype(torch::kInt32)).contiguous();
+  auto ptr = reinterpret_cast<int32_t*>(block_index.data_ptr());
+  auto vec_idx = kvc2_handle->get_gpu_block_idx();
+  for (size_t i = 0; i < vec_idx.size(); i++) {
+    ptr[i] = vec_idx[i];
+  }
+}
+
 void Query::after_load(bool ok) {
   if (ok) {
-    size_t page_count = div_up(estimated_length, ctx.query_maintainer->settings.page_size);
-    std::vector<int64_t> shape;
-    shape.push_back(page_count);
-    block_index = torch::zeros(shape, torch::TensorOptions().dtype(torch::kInt32)).contiguous();
-    auto ptr = reinterpret_cast<int32_t*>(block_index.data_ptr());
-    auto vec_idx = kvc2_handle->get_gpu_block_idx();
-    for (size_t i = 0; i < vec_idx.size(); i++) {
-      ptr[i] = vec_idx[i];
-    }
+    update_block_index();
     no_kvcache_from = kvc2_handle->matched_length();
   }
   if (ok) {
@@ -829,6 +920,8 @@ struct FCFS_single_prefill : public QueryMaintainer {
 
   }
 
+  void strategy_swapped([[maybe_unused]] const EventSwapped& swapped) override { assert(false); }
+
   void strategy_schedule([[maybe_unused]] const EventSchedule& event, BatchQueryTodo* new_batch) override {
     bool have_prefill = false;
     for (auto& q : active_query) {
@@ -884,6 +977,429 @@ struct FCFS : public FCFS_single_prefill {
   }
 };
 
+// Base of the strategies that rank queries instead of serving them in arrival order.
+// Every schedule ranks the active, paused and ready queries by priority (lower runs first), runs the best
+// max_batch_size of them with at most max_prefill_count prefills, and pauses the active ones that fell out.
+// A paused query keeps its kvc2 handle and plan position, so preempting and resuming it costs nothing but the
+// steps it sits out.
+// With a kvc2 swap pool, a prepare blocked on gpu pages swaps out the lowest priority decode ranked below the
+// blocked query, and swapped queries come back, best first, once no prepare is blocked. One swap is in flight
+// at a time.
+struct PriorityStrategy : public FCFS_single_prefill {
+  const size_t max_prefill_count = 2;
+
+  std::vector<Q> waiting;  // received, prepared one at a time in priority order
+  std::vector<Q> ready;    // prepared, prefill not started
+  std::set<Q> paused;      // preempted during prefill or decode
+
+  std::set<Q> idle;      // paused and left out of a batch taken since, so no batch in flight holds them
+  std::set<Q> draining;  // paused to be swapped out, not resumed meanwhile
+  std::set<Q> swapped;   // gpu pages in the kvc2 swap pool
+  std::optional<Q> swapping = std::nullopt;
+  // set by a failed swap, cleared when a finished query gives pages back
+  bool swap_pool_full = false;
+  bool gpu_pages_full = false;
+
+  Clock::time_point now = Clock::now();
+  std::optional<Clock::time_point> last_update_time = std::nullopt;
+  double step_ms = 0;  // moving average of the time between two batch updates
+  size_t schedule_steps = 0;
+  std::map<QueryID, size_t> active_since;  // schedule step a query was last started or resumed at
+
+  virtual double priority(const Q& q) = 0;
+  // subtracted from the priority of active queries, so near ties do not preempt back and forth
+  virtual double stickiness([[maybe_unused]] const Q& q) { return 0; }
+  // prefill tokens of the batch, the chosen queries are in priority order
+  virtual size_t prefill_budget([[maybe_unused]] const std::vector<Q>& chosen, size_t prefill_num, size_t decode_num) {
+    return prefill_token_budget(prefill_num, decode_num);
+  }
+
+  Q pop_best(std::vector<Q>& queries) {
+    auto best = std::min_element(queries.begin(), queries.end(), [this](const Q& a, const Q& b) {
+      return std::make_pair(priority(a), a->id) < std::make_pair(priority(b), b->id);
+    });
+    Q re = *best;
+    queries.erase(best);
+    return re;
+  }
+
+  void prepare_next() {
+    if (waiting.empty()) {
+      has_query_preparing = false;
+      return;
+    }
+    now = Clock::now();
+    has_query_preparing = true;
+    event_loop_queue.enqueue(EventPrepare{pop_best(waiting)->id, true});
+  }
+
+  void strategy_add_query(Q new_query) override {
+    waiting.push_back(new_query);
+    if (has_query_preparing == false) {
+      prepare_next();
+    }
+  }
+
+  void strategy_prepared(const EventPrepared& prepared) override {
+    assert(prepared.ok);
+    ready.push_back(query_map[prepared.query_id]);
+    prepare_next();
+  }
+
+  void strategy_update_query(const EventUpdateQuery& update) override {
+    auto t = Clock::now();
+    if (last_update_time.has_value()) {
+      double ms = ms_between(last_update_time.value(), t);
+      step_ms = step_ms == 0 ? ms : 0.9 * step_ms + 0.1 * ms;
+    }
+    last_update_time = t;
+    for (auto u : update) {
+      auto& q = query_map[u.id];
+      if (q->plan_status == Query::Done) {
+        active_query.erase(q);
+        paused.erase(q);
+        idle.erase(q);
+        draining.erase(q);
+        active_since.erase(q->id);
+        swap_pool_full = false;
+        gpu_pages_full = false;
+      }
+    }
+  }
+
+  void strategy_taken_batch(const EventTakenBatch& batch) override {
+    std::set<QueryID> in_batch(batch->query_ids.begin(), batch->query_ids.end());
+    for (auto& id : batch->query_ids) {
+      auto& q = query_map[id];
+      // a batch built before q was preempted still runs it once, q stays paused after that
+      if (q->plan_status != Query::Done && paused.count(q) == 0) {
+        active_query.insert(q);
+      }
+    }
+    // batches are taken in the order they are built, every later one is built without the paused queries
+    for (auto& q : paused) {
+      if (in_batch.count(q->id) == 0) {
+        idle.insert(q);
+      }
+    }
+  }
+
+  bool swap_enabled() { return settings.gpu_only && settings.swap_pool_size_GB > 0; }
+
+  // the kvcache of q is written by no batch in flight, its gpu pages can move
+  bool can_swap_out(const Q& q) {
+    return q->plan_status == Query::Decode && idle.count(q) && q->active_position == q->plan_position;
+  }
+
+  void swap_out(Q q) {
+    SPDLOG_INFO("Swap out Query {}", q->id);
+    swapping = q;
+    q->kvc2_handle->swap_out_async(q->active_position, [this, id = q->id](bool ok) {
+      event_loop_queue.enqueue(EventSwapped{.query_id = id, .out = true, .ok = ok});
+    });
+  }
+
+  void swap_in(Q q) {
+    SPDLOG_INFO("Swap in Query {}", q->id);
+    swapping = q;
+    q->kvc2_handle->swap_in_async([this, id = q->id](bool ok) {
+      event_loop_queue.enqueue(EventSwapped{.query_id = id, .out = false, .ok = ok});
+    });
+  }
+
+  void balance_swap() {
+    if (swap_enabled() == false || swapping.has_value()) {
+      return;
+    }
+    for (auto& q : draining) {
+      if (can_swap_out(q)) {
+        swap_out(q);
+        return;
+      }
+    }
+    std::optional<double> blocked = std::nullopt;
+    if (wait_done_prepare.has_value()) {
+      blocked = priority(query_map.at(wait_done_prepare->query_id));
+    }
+
+    if (blocked.has_value() && draining.empty() && swap_pool_full == false) {
+      std::optional<Q> victim = std::nullopt;
+      for (auto* queries : {&active_query, &paused}) {
+        for (auto& q : *queries) {
+          if (q->plan_status == Query::Decode && priority(q) > blocked.value() &&
+              (victim.has_value() == false || priority(q) > priority(victim.value()))) {
+            victim = q;
+          }
+        }
+      }
+      if (victim.has_value()) {
+        auto q = victim.value();
+        if (active_query.erase(q) > 0) {
+          SPDLOG_DEBUG("Preempt Query {}", q->id);
+          met->query_count("Preempted")->Increment(1);
+          paused.insert(q);
+        }
+        draining.insert(q);
+      }
+      return;
+    }
+
+    if (swapped.empty() == false && gpu_pages_full == false) {
+      auto best = std::min_element(swapped.begin(), swapped.end(), [this](const Q& a, const Q& b) {
+        return std::make_pair(priority(a), a->id) < std::make_pair(priority(b), b->id);
+      });
+      if (blocked.has_value() == false || priority(*best) < blocked.value()) {
+        swap_in(*best);
+      }
+    }
+  }
+
+  void strategy_swapped(const EventSwapped& event) override {
+    auto q = query_map.at(event.query_id);
+    swapping = std::nullopt;
+    if (event.out) {
+      draining.erase(q);
+      if (event.ok == false) {
+        SPDLOG_WARN("Swap out Query {} failed", q->id);
+        swap_pool_full = true;
+        return;
+      }
+      met->query_count("SwappedOut")->Increment(1);
+      paused.erase(q);
+      idle.erase(q);
+      swapped.insert(q);
+      if (wait_done_prepare.has_value()) {
+        event_loop_queue.enqueue(wait_done_prepare.value());
+        wait_done_prepare = std::nullopt;
+      }
+    } else {
+      if (event.ok == false) {
+        SPDLOG_DEBUG("Swap in Query {} waits for gpu pages", q->id);
+        gpu_pages_full = true;
+        return;
+      }
+      met->query_count("SwappedIn")->Increment(1);
+      swap_pool_full = false;
+      q->update_block_index();
+      swapped.erase(q);
+      paused.insert(q);
+      idle.insert(q);
+    }
+  }
+
+  // greedy split in priority order, every prefill keeps a share so none gets an empty task
+  virtual std::map<QueryID, size_t> split_prefill_budget(const std::vector<Q>& prefills, size_t budget) {
+    std::map<QueryID, size_t> re;
+    if (prefills.empty()) {
+      return re;
+    }
+    size_t floor_share = std::max<size_t>(budget / (2 * prefills.size()), 1);
+    size_t left = budget;
+    for (size_t i = 0; i < prefills.size(); i++) {
+      size_t reserve = floor_share * (prefills.size() - i - 1);
+      size_t length = std::min<size_t>(prefills[i]->remaining_prefill(), left - reserve);
+      length = std::max(length, floor_share);
+      re[prefills[i]->id] = length;
+      left -= std::min(left, length);
+    }
+    return re;
+  }
+
+  void strategy_schedule([[maybe_unused]] const EventSchedule& event, BatchQueryTodo* new_batch) override {
+    now = Clock::now();
+    schedule_steps += 1;
+    std::vector<std::tuple<double, QueryID, Q>> ranked;
+    for (auto& q : active_query) {
+      if (q->plan_status == Query::Prefill || q->plan_status == Query::Decode) {
+        ranked.push_back({priority(q) - stickiness(q), q->id, q});
+      }
+    }
+    for (auto& q : paused) {
+      if (draining.count(q) == 0) {
+        ranked.push_back({priority(q), q->id, q});
+      }
+    }
+    for (auto& q : ready) {
+      ranked.push_back({priority(q), q->id, q});
+    }
+    std::sort(ranked.begin(), ranked.end(),
+              [](const auto& a, const auto& b) { return std::tie(std::get<0>(a), std::get<1>(a)) <
+                                                        std::tie(std::get<0>(b), std::get<1>(b)); });
+
+    std::vector<Q> chosen, prefills;
+    size_t decode_num = 0;
+    for (auto& [p, id, q] : ranked) {
+      if (chosen.size() >= settings.max_batch_size) {
+        break;
+      }
+      bool is_prefill = q->plan_status != Query::Decode;
+      if (is_prefill && prefills.size() >= max_prefill_count) {
+        continue;
+      }
+      chosen.push_back(q);
+      if (is_prefill) {
+        prefills.push_back(q);
+      } else {
+        decode_num += 1;
+      }
+    }
+
+    std::set<Q> chosen_set(chosen.begin(), chosen.end());
+    for (auto it = active_query.begin(); it != active_query.end();) {
+      if (chosen_set.count(*it) == 0) {
+        SPDLOG_DEBUG("Preempt Query {}", (*it)->id);
+        met->query_count("Preempted")->Increment(1);
+        paused.insert(*it);
+        it = active_query.erase(it);
+      } else {
+        ++it;
+      }
+    }
+    for (auto& q : chosen) {
+      if (paused.erase(q) > 0) {
+        idle.erase(q);
+        SPDLOG_DEBUG("Resume Query {}", q->id);
+        met->query_count("Resumed")->Increment(1);
+      } else if (q->plan_status == Query::Ready) {
+        ready.erase(std::find(ready.begin(), ready.end(), q));
+        SPDLOG_INFO("Active query {}", q->id);
+        q->to_status(Query::Prefill);
+      }
+      if (active_query.insert(q).second) {
+        active_since[q->id] = schedule_steps;
+      }
+    }
+    balance_swap();
+    if (active_query.empty() == false) {
+      SPDLOG_DEBUG("Active Query Size {}, Paused {}, Swapped {}, Ready {}", active_query.size(), paused.size(),
+                   swapped.size(), ready.size());
+    }
+    for (auto& q : active_query) {
+      q->debug();
+    }
+
+    size_t budget = prefill_budget(chosen, prefills.size(), decode_num);
+    gen_batch_query_todo(new_batch, active_query, split_prefill_budget(prefills, budget));
+  }
+};
+
+// Shortest remaining prefill first. Decodes have nothing left to prefill and always run, a shorter prompt
+// preempts a longer prefill. Waiting shrinks the remaining prefill a query is ranked by, by half after
+// aging_half_ms, so long prompts are not starved. The credit never exceeds the prompt itself, so however long
+// the queue gets short prompts still overtake long ones that have waited as long.
+struct SRPF : public PriorityStrategy {
+  const double aging_half_ms = 10000;
+
+  double priority(const Q& q) override {
+    return double(q->remaining_prefill()) * aging_half_ms / (aging_half_ms + ms_between(q->arrival_time, now));
+  }
+
+  double stickiness([[maybe_unused]] const Q& q) override {
+    return double(settings.recommended_chunk_prefill_token_count);
+  }
+};
+
+// Earliest deadline first on the TTFT deadline of prefills and the TBT deadline of decodes. A decode with slack
+// sits out steps for a prefill about to miss its TTFT, and while some decode has less slack than a step takes,
+// the prefill chunk is halved to keep the step short.
+// A running decode is only preempted once it has run min_run_steps and while its slack covers
+// preempt_slack_steps steps, so a pause always lasts several steps and decodes do not flap in and out of the
+// batch on every step.
+struct EDF : public PriorityStrategy {
+  const double preempt_slack_steps = 4;
+  const size_t min_run_steps = 4;
+
+  double priority(const Q& q) override { return ms_between(now, q->deadline()); }
+
+  double stickiness(const Q& q) override {
+    if (q->plan_status == Query::Decode) {
+      auto it = active_since.find(q->id);
+      bool just_resumed = it != active_since.end() && schedule_steps - it->second < min_run_steps;
+      if (just_resumed || priority(q) < preempt_slack_steps * step_ms) {
+        return std::numeric_limits<double>::infinity();
+      }
+    }
+    return step_ms;
+  }
+
+  size_t prefill_budget(const std::vector<Q>& chosen, size_t prefill_num, size_t decode_num) override {
+    size_t budget = prefill_token_budget(prefill_num, decode_num);
+    for (auto& q : chosen) {
+      if (q->plan_status == Query::Decode && q->last_token_time.has_value() && priority(q) < step_ms) {
+        return std::min(budget, settings.recommended_chunk_prefill_token_count);
+      }
+    }
+    return budget;
+  }
+};
+
+// Per user fair share of tokens. Each user is charged for the prefill and decode tokens of its queries, the
+// queries of the least served user run first. A user arriving, or coming back, starts from the least served
+// active user, so idle time is not banked as credit.
+struct FairShare : public PriorityStrategy {
+  std::map<UserID, double> served_tokens;
+
+  double& served(UserID user) {
+    auto it = served_tokens.find(user);
+    if (it == served_tokens.end()) {
+      double floor = 0;
+      bool first = true;
+      for (auto& q : active_query) {
+        auto served_it = served_tokens.find(q->user_id);
+        if (served_it != served_tokens.end() && (first || served_it->second < floor)) {
+          floor = served_it->second;
+          first = false;
+        }
+      }
+      it = served_tokens.emplace(user, floor).first;
+    }
+    return it->second;
+  }
+
+  double priority(const Q& q) override { return served(q->user_id); }
+
+  double stickiness([[maybe_unused]] const Q& q) override {
+    return double(settings.recommended_chunk_prefill_token_count);
+  }
+
+  // the even split, a user's share comes from preemption, not from the chunk size
+  std::map<QueryID, size_t> split_prefill_budget([[maybe_unused]] const std::vector<Q>& prefills,
+                                                 [[maybe_unused]] size_t budget) override {
+    return {};
+  }
+
+  void strategy_taken_batch(const EventTakenBatch& batch) override {
+    for (auto& [id, s, l] : batch->prefill_mini_batches) {
+      served(query_map.at(id)->user_id) += l;
+    }
+    for (auto& mini_batch : batch->decode_mini_batches) {
+      for (auto& id : mini_batch) {
+        served(query_map.at(id)->user_id) += 1;
+      }
+    }
+    PriorityStrategy::strategy_taken_batch(batch);
+  }
+
+  void strategy_query_status(const EventQueryStatus& query_status) override {
+    PriorityStrategy::strategy_query_status(query_status);
+    // forget users with nothing left, they start again from the floor when they come back
+    std::set<UserID> users;
+    for (auto* queries : {&waiting, &ready}) {
+      for (auto& q : *queries) {
+        users.insert(q->user_id);
+      }
+    }
+    for (auto* queries : {&active_query, &paused, &swapped}) {
+      for (auto& q : *queries) {
+        users.insert(q->user_id);
+      }
+    }
+    for (auto it = served_tokens.begin(); it != served_tokens.end();) {
+      it = users.count(it->first) ? std::next(it) : served_tokens.erase(it);
+    }
+  }
+};
+
 std::shared_ptr<Scheduler> create_scheduler(Settings settings) {
   spdlog::set_level(spdlog::level::debug);
   std::shared_ptr<Scheduler> re;
@@ -892,6 +1408,12 @@ std::shared_ptr<Scheduler> create_scheduler(Settings settings) {
     re = std::shared_ptr<Scheduler>(new FCFS_single_prefill());
   } else if (settings.strategy_name == "FCFS") {
     re = std::shared_ptr<Scheduler>(new FCFS());
+  } else if (settings.strategy_name == "SRPF") {
+    re = std::shared_ptr<Scheduler>(new SRPF());
+  } else if (settings.strategy_name == "EDF") {
+    re = std::shared_ptr<Scheduler>(new EDF());
+  } else if (settings.strategy_name == "FairShare") {
+    re = std::shared_ptr<Scheduler>(new FairShare());
   } else {
     SPDLOG_ERROR("Unknown strategy {}", settings.strategy_name);
   }
@@ -899,7 +1421,8 @@ std::shared_ptr<Scheduler> create_scheduler(Settings settings) {
   return re;
 }
 
-NLOHMANN_DEFINE_TYPE_NON_INTRUSIVE(SampleOptions, temperature, top_p);
+NLOHMANN_DEFINE_TYPE_NON_INTRUSIVE(SampleOptions, temperature, top_p, top_k, min_p, repetition_penalty,
+                                   frequency_penalty, presence_penalty, seed);
 NLOHMANN_DEFINE_TYPE_NON_INTRUSIVE(QueryAdd, query_token, query_length, estimated_length, sample_options, user_id,
                                    SLO_TTFT_ms, SLO_TBT_ms);
 
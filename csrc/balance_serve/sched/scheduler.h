@@ -34,6 +34,12 @@ struct ModelSettings {
 struct SampleOptions {
   double temperature = 1.0;
   double top_p = 1.0;
+  int top_k = -1;  // -1: model default, 0: disabled
+  double min_p = 0.0;
+  double repetition_penalty = 1.0;
+  double frequency_penalty = 0.0;
+  double presence_penalty = 0.0;
+  int64_t seed = -1;  // -1: not seeded
 };
 
 struct Settings {
@@ -64,12 +70,13 @@ struct Settings {
   std::string kvc2_config_path;
   std::string kvc2_root_path;
   double memory_pool_size_GB = 100;
+  double swap_pool_size_GB = 0;  // pinned host memory preempted decodes are swapped out to, gpu_only only
   size_t evict_count = 20;
   size_t kvc2_metrics_port;
   bool load_from_disk = false;
   bool save_to_disk = false;
 
-  // for strategy
+  // for strategy: FCFS, FCFS-single-prefill, SRPF, EDF or FairShare
   std::string strategy_name;
 
   // derived
@@ -136,7 +143,7 @@ struct QueryAdd {
 
   SampleOptions sample_options;
 
-  UserID user_id;
+  UserID user_id = NoUser;
   int SLO_TTFT_ms = MAX_SLO_TIME;
   int SLO_TBT_ms = MAX_SLO_TIME;
 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  :  CPU kvcache of a long-context model per kv_type: host memory per token and decode attention
+                latency at 128k/512k/1M tokens, dense and with the sparse block retrieval of the 1M rule.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import os, sys
+import time
+sys.path.append(os.path.dirname(__file__) + '/../build')
+import cpuinfer_ext
+import torch
+
+# InternLM2.5-7B-Chat-1M, only a few layers are filled, memory is reported per layer
+layer_num = 2
+kv_head_num = 8
+q_head_num = 32
+head_dim = 128
+block_len = 128
+anchor_num = 1
+topk = 16
+local_windows_len = 4096
+max_seqlen = 1024 * 1024
+max_thread_num = 64
+CPUInfer = cpuinfer_ext.CPUInfer(max_thread_num)
+warm_up_iter = 10
+test_iter = 100
+
+kv_types = {
+    "FP16": cpuinfer_ext.kvcache.ggml_type.FP16,
+    "Q8_0": cpuinfer_ext.kvcache.ggml_type.Q8_0,
+    "Q4_0": cpuinfer_ext.kvcache.ggml_type.Q4_0,
+}
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def decode_latency(local_kvcache, layer_idx, max_block_num, block_table, cache_seqlens, pick_block_num):
+    input = (torch.randn((1, 1, q_head_num, head_dim), dtype=torch.float16) / 100).contiguous()
+    output = torch.empty((1, 1, q_head_num, head_dim), dtype=torch.float16).contiguous()
+    attn_lse = torch.empty((1, 1, q_head_num), dtype=torch.float32).contiguous()
+    local_block_num = local_windows_len // block_len if pick_block_num > 0 else -1
+    init_block_num = 1 if pick_block_num > 0 else -1
+
+    def step(i):
+        CPUInfer.submit(
+            local_kvcache.attn(input.data_ptr(), output.data_ptr(), attn_lse.data_ptr(), layer_idx, i, 1, 1,
+                               max_block_num, block_table.data_ptr(), cache_seqlens.data_ptr(),
+                               pick_block_num, init_block_num, local_block_num)
+        )
+        CPUInfer.sync()
+
+    for i in range(warm_up_iter):
+        step(i)
+    start = time.perf_counter()
+    for i in range(test_iter):
+        step(i)
+    return (time.perf_counter() - start) / test_iter * 1000000
+
+def bench_kvcache_long_context(kv_type_name: str, cache_seqlen: int):
+    with torch.inference_mode(mode=True):
+        max_block_num = (cache_seqlen + block_len - 1) // block_len
+        config = cpuinfer_ext.kvcache.KVCacheConfig(
+            layer_num, kv_head_num, q_head_num, head_dim, block_len, anchor_num,
+            cpuinfer_ext.kvcache.AnchorType.DYNAMIC, kv_types[kv_type_name],
+            cpuinfer_ext.kvcache.RetrievalType.LAYER, 1, 1, 0, max_block_num, 1, max_thread_num,
+        )
+        rss_before = rss_bytes()
+        local_kvcache = cpuinfer_ext.kvcache.KVCache(config)
+        block_table = torch.arange(max_block_num, dtype=torch.int32).contiguous().view(1, -1)
+
+        # stored the way a prefill swap stores it, quantized on the way in
+        k_in = k_staging[:, :max_block_num * block_len]
+        v_in = v_staging[:, :max_block_num * block_len]
+        past_len_cpu = torch.zeros((1,), dtype=torch.int32)
+        for layer_idx in range(layer_num):
+            CPUInfer.submit(
+                local_kvcache.get_and_update_kvcache_fp16(
+                    k_in.data_ptr(), v_in.data_ptr(), layer_idx, block_table.data_ptr(),
+                    1, max_block_num, past_len_cpu.data_ptr(), cache_seqlen,
+                )
+            )
+            CPUInfer.sync()
+        cache_seqlens = torch.tensor([cache_seqlen], dtype=torch.int32)
+        CPUInfer.submit(
+            local_kvcache.calc_anchor_all_layers(block_table.data_ptr(), cache_seqlens.data_ptr(), 1, max_block_num)
+        )
+        CPUInfer.sync()
+        bytes_per_token = (rss_bytes() - rss_before) / cache_seqlen / layer_num
+
+        dense_us = decode_latency(local_kvcache, 0, max_block_num, block_table, cache_seqlens, -1)
+        sparse_us = decode_latency(local_kvcache, 0, max_block_num, block_table, cache_seqlens, topk)
+        print('kv_type: ', kv_type_name, 'cache sequence length: ', cache_seqlen)
+        print('Memory(KB) per token per layer: ', bytes_per_token / 1024)
+        print('Memory(GB) of 32 layers: ', bytes_per_token * 32 * cache_seqlen / 1024 ** 3)
+        print('Dense decode attention time(us) per layer: ', dense_us)
+        print('Sparse decode attention time(us) per layer: ', sparse_us)
+        print('')
+        del local_kvcache
+
+# fp16 staging of the whole sequence like the GPU scratch of a swap, allocated before any cache is measured
+k_staging = torch.randn((1, max_seqlen, kv_head_num, head_dim), dtype=torch.float16).contiguous()
+v_staging = torch.randn((1, max_seqlen, kv_head_num, head_dim), dtype=torch.float16).contiguous()
+
+for cache_seqlen in [128 * 1024, 512 * 1024, max_seqlen]:
+    for kv_type_name in kv_types:
+        bench_kvcache_long_context(kv_type_name, cache_seqlen)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  :  KLinearQ8 (int8 x int8 -> int32 GEMM with per group scales) against KLinearTorch and the former
+                Q8 path, which dequantized the whole weight to fp32 on every call before the matmul.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import os, sys
+import time
+sys.path.append(os.path.dirname(__file__) + '/../../..')
+import torch
+from torch import nn
+from ktransformers.operators.linear import KLinearTorch, KLinearQ8
+
+input_size = 7168
+output_size = 2048
+layer_num = 10
+group_size = 256
+warm_up_iter = 20
+test_iter = 100
+
+class DequantQ8:
+    # the former KLinearQ8 forward: int8 weight with a scale per input column, dequantized on every call
+    def __init__(self, weight: torch.Tensor):
+        scales = weight.abs().amax(dim=0).clamp(min=1e-10) / 127
+        self.weight = torch.round(weight / scales).to(torch.int8)
+        self.weight_scale = scales
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        weight_dequant = self.weight.to(torch.float32) * self.weight_scale.view(1, -1)
+        return (x.to(torch.float32) @ weight_dequant.T).to(x.dtype)
+
+def bench_linear(op_name: str, qlen: int):
+    with torch.inference_mode(mode=True):
+        ops = []
+        refs = []
+        for _ in range(layer_num):
+            weight = torch.randn((output_size, input_size), dtype=torch.float32) * 0.02
+            refs.append(weight)
+            if op_name == "torch_fp32" or op_name == "torch_bf16":
+                op = KLinearTorch("bench", None, None, nn.Linear(input_size, output_size, device="meta"), device="cpu")
+                op.dtype = torch.float32 if op_name == "torch_fp32" else torch.bfloat16
+                op.load(nn.Parameter(weight))
+            elif op_name == "q8_dequant":
+                op = DequantQ8(weight)
+            elif op_name == "q8_int8":
+                op = KLinearQ8("bench", None, None, nn.Linear(input_size, output_size, device="meta"), device="cpu",
+                               group_size=group_size)
+                op.load(nn.Parameter(weight))
+            else:
+                assert(False)
+            ops.append(op)
+        input = torch.randn((layer_num, qlen, input_size), dtype=torch.bfloat16).contiguous()
+
+        # warm up
+        for i in range(warm_up_iter):
+            ops[i % layer_num].forward(input[i % layer_num])
+
+        # test
+        start = time.perf_counter()
+        for i in range(test_iter):
+            ops[i % layer_num].forward(input[i % layer_num])
+        end = time.perf_counter()
+        total_time = end - start
+        output = ops[0].forward(input[0]).to(torch.float32)
+        ref = input[0].to(torch.float32) @ refs[0].T
+        print('Op: ', op_name, ' qlen: ', qlen)
+        print('Time(us) per iteration: ', total_time / test_iter * 1000000)
+        print('TFLOPS: ', 2 * qlen * input_size * output_size * test_iter / total_time / 1e12)
+        print('Relative error: ', ((output - ref).norm() / ref.norm()).item())
+        print('')
+
+for qlen in [1, 32, 512]:
+    bench_linear("torch_fp32", qlen)
+    bench_linear("torch_bf16", qlen)
+    bench_linear("q8_dequant", qlen)
+    bench_linear("q8_int8", qlen)
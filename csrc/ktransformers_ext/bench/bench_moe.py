@@ -28,7 +28,8 @@ CPUInfer = cpuinfer_ext.CPUInfer(64)
 warm_up_iter = 1000
 test_iter = 10000
 
-def bench_moe(quant_mode: str):
+# numa_partition only changes anything in a USE_NUMA build
+def bench_moe(quant_mode: str, numa_partition: bool = False):
     with torch.inference_mode(mode=True):
         hidden_type = 30 # ggml_type::GGML_TYPE_BF16
         if quant_mode == "fp32":
@@ -99,6 +100,7 @@ def bench_moe(quant_mode: str):
             up_proj = torch.randn((expert_num, intermediate_size, hidden_size), dtype=torch.float32, device = "cuda").to("cpu").contiguous()
             down_proj = torch.randn((expert_num, hidden_size, intermediate_size), dtype=torch.float32, device = "cuda").to("cpu").contiguous()
             config = cpuinfer_ext.moe.MOEConfig(expert_num, n_routed_experts, hidden_size, intermediate_size, stride, group_min_len, group_max_len, gate_proj.data_ptr(), up_proj.data_ptr(), down_proj.data_ptr(), gate_type, up_type, down_type, hidden_type)
+            config.numa_partition = numa_partition
             moe = cpuinfer_ext.moe.MOE(config)
             gate_projs.append(gate_proj)
             up_projs.append(up_proj)
@@ -140,21 +142,25 @@ def bench_moe(quant_mode: str):
         end = time.perf_counter()
         total_time = end - start
         print('Quant mode: ', quant_mode)
+        print('NUMA partition: ', numa_partition)
+        print('Weight memory(GB): ', sum(moe.weight_bytes() for moe in moes) / 1024 / 1024 / 1024)
         print('Time(s): ', total_time)
         print('Iteration: ', test_iter) 
         print('Time(us) per iteration: ', total_time / test_iter * 1000000)
         print('Bandwidth: ', hidden_size * intermediate_size * 3 * n_routed_experts * bytes_per_elem * test_iter / total_time / 1000 / 1000 / 1000, 'GB/s')
+        print('Tokens/s: ', qlen * test_iter / total_time)
         print('')
 
-bench_moe("fp32")
-bench_moe("fp16")
-bench_moe("bf16")
-bench_moe("q8_0")
-bench_moe("q6_k")
-bench_moe("q5_k_m")
-bench_moe("q4_k_m")
-bench_moe("q3_k_m")
-bench_moe("q2_k")
+for numa_partition in [False, True]:
+    bench_moe("fp32", numa_partition)
+    bench_moe("fp16", numa_partition)
+    bench_moe("bf16", numa_partition)
+    bench_moe("q8_0", numa_partition)
+    bench_moe("q6_k", numa_partition)
+    bench_moe("q5_k_m", numa_partition)
+    bench_moe("q4_k_m", numa_partition)
+    bench_moe("q3_k_m", numa_partition)
+    bench_moe("q2_k", numa_partition)
 # Not supported on __x86_64__
 # bench_linear("iq3_xs")
 # bench_linear("iq2_xxs")
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  :  Submission overhead of small CPU tasks launched from a CUDA stream, per step of layer_num tasks:
+                host callbacks building each task at every step against a captured CUDA graph replaying task graphs.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import os, sys
+import time
+sys.path.append(os.path.dirname(__file__) + '/../build')
+import cpuinfer_ext
+import torch
+
+input_size = 256
+output_size = 256
+stride = 16
+group_max_len = 1024
+layer_num = 60
+qlen = 1
+CPUInfer = cpuinfer_ext.CPUInfer(64)
+warm_up_iter = 100
+test_iter = 1000
+
+def print_times(name, times):
+    count = max(times.count, 1)
+    print(name, 'tasks:', times.count, 'wait(us) avg:', times.wait_ns / count / 1000, 'max:', times.max_wait_ns / 1000,
+          'exec(us) avg:', times.exec_ns / count / 1000, 'max:', times.max_exec_ns / 1000)
+
+def bench_task_graph():
+    with torch.inference_mode(mode=True):
+        hidden_type = 30 # ggml_type::GGML_TYPE_BF16
+        proj_type = 1 # ggml_type::GGML_TYPE_F16
+        linears = []
+        projs = []
+        for _ in range(layer_num):
+            proj = torch.randn((output_size, input_size), dtype=torch.float32).contiguous()
+            config = cpuinfer_ext.linear.LinearConfig(input_size, output_size, stride, group_max_len, proj.data_ptr(), proj_type, hidden_type)
+            linears.append(cpuinfer_ext.linear.Linear(config))
+            projs.append(proj)
+        input = torch.randn((layer_num, qlen, input_size), dtype=torch.bfloat16).contiguous()
+        output = torch.empty((layer_num, qlen, output_size), dtype=torch.bfloat16).contiguous()
+        stream = torch.cuda.Stream()
+
+        def step():
+            for i in range(layer_num):
+                CPUInfer.submit_with_cuda_stream(stream.cuda_stream, linears[i].forward(qlen, input[i].data_ptr(), output[i].data_ptr()))
+                CPUInfer.sync_with_cuda_stream(stream.cuda_stream)
+
+        # callbacks built at every step
+        with torch.cuda.stream(stream):
+            for _ in range(warm_up_iter):
+                step()
+            torch.cuda.synchronize()
+            CPUInfer.reset_stats()
+            start = time.perf_counter()
+            for _ in range(test_iter):
+                step()
+            torch.cuda.synchronize()
+        eager_time = time.perf_counter() - start
+        print('eager, time(us) per step: ', eager_time / test_iter * 1000000)
+        print_times('eager', CPUInfer.stats())
+
+        # captured once, replayed
+        graph = torch.cuda.CUDAGraph()
+        graph_id = CPUInfer.begin_graph()
+        with torch.cuda.graph(graph, stream=stream):
+            step()
+        CPUInfer.end_graph()
+        for _ in range(warm_up_iter):
+            graph.replay()
+        torch.cuda.synchronize()
+        CPUInfer.reset_stats()
+        start = time.perf_counter()
+        for _ in range(test_iter):
+            graph.replay()
+        torch.cuda.synchronize()
+        graph_time = time.perf_counter() - start
+        print('graph, time(us) per step: ', graph_time / test_iter * 1000000)
+        print_times('graph', CPUInfer.stats())
+        print('tasks per replay: ', len(CPUInfer.graph_stats(graph_id)))
+        print('')
+
+bench_task_graph()
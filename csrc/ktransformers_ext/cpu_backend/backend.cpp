@@ -54,6 +54,13 @@ std::atomic_bool* Backend::shlock = nullptr;
 
 Backend::Backend(int max_thread_num) {
     max_thread_num_ = max_thread_num;
+    // before any thread is pinned, the placement is computed from the cpus this process may use
+    init_core_info(max_thread_num);
+    for (int i = 0; i < max_thread_num; i = thread_id_to_steal_to[i]) {
+        node_thread_begin_.push_back(i);
+    }
+    node_thread_begin_.push_back(max_thread_num);
+    steal_ = false;
 
 #if use_epoll || use_poll
     for (int i = 1; i < max_thread_num; ++i) {
@@ -146,6 +153,58 @@ void Backend::do_work_stealing_job(int task_num,
                                    std::function<void(int)> init_func,
                                    std::function<void(int)> compute_func,
                                    std::function<void(int)> finalize_func) {
+    init_func_ = init_func;
+    compute_func_ = compute_func;
+    finalize_func_ = finalize_func;
+#ifdef USE_NUMA
+    // numa node location will be calculated based on the number of threads
+    thread_num_ = max_thread_num_;
+#else
+    thread_num_ = std::min(max_thread_num_, task_num);
+#endif
+    int base = task_num / thread_num_;
+    int remain = task_num % thread_num_;
+    thread_state_[0].begin = 0;
+    thread_state_[0].end = base + (0 < remain);
+    for (int i = 1; i < thread_num_; i++) {
+        thread_state_[i].begin = thread_state_[i - 1].end;
+        thread_state_[i].end = thread_state_[i - 1].end + base + (i < remain);
+    }
+    steal_ = false;
+    run_job();
+}
+
+void Backend::do_numa_work_stealing_job(const std::vector<int>& node_task_begin,
+                                        std::function<void(int)> init_func,
+                                        std::function<void(int)> compute_func,
+                                        std::function<void(int)> finalize_func) {
+    if (node_task_begin.size() != node_thread_begin_.size()) {
+        // split for another thread layout, the tasks are still right wherever they run
+        do_work_stealing_job(node_task_begin.back(), init_func, compute_func, finalize_func);
+        return;
+    }
+    init_func_ = init_func;
+    compute_func_ = compute_func;
+    finalize_func_ = finalize_func;
+    thread_num_ = max_thread_num_;
+    for (size_t n = 0; n + 1 < node_thread_begin_.size(); n++) {
+        int thread_begin = node_thread_begin_[n];
+        int node_thread_num = node_thread_begin_[n + 1] - thread_begin;
+        int task_num = node_task_begin[n + 1] - node_task_begin[n];
+        int base = task_num / node_thread_num;
+        int remain = task_num % node_thread_num;
+        int begin = node_task_begin[n];
+        for (int i = 0; i < node_thread_num; i++) {
+            thread_state_[thread_begin + i].begin = begin;
+            begin += base + (i < remain);
+            thread_state_[thread_begin + i].end = begin;
+        }
+    }
+    steal_ = true;
+    run_job();
+}
+
+void Backend::run_job() {
 #if use_shlock
     if (unlikely(shlock == nullptr)) {
         bool is_new = access(KT_LOCK, F_OK) != 0;
@@ -166,19 +225,6 @@ fflush(stdout);
     }
 #endif
 
-    init_func_ = init_func;
-    compute_func_ = compute_func;
-    finalize_func_ = finalize_func;
-#ifdef USE_NUMA
-    // numa node location will be calculated based on the number of threads
-    thread_num_ = max_thread_num_;
-#else
-    thread_num_ = std::min(max_thread_num_, task_num);
-#endif
-    int base = task_num / thread_num_;
-    int remain = task_num % thread_num_;
-    thread_state_[0].end = base + (0 < remain);
-
     // 为主线程设置 thread_local_id
     thread_local_id = 0;
 
@@ -190,9 +236,8 @@ fflush(stdout);
 #endif
 
     for (int i = 1; i < thread_num_; i++) {
-        thread_state_[i].curr->store(thread_state_[i - 1].end,
+        thread_state_[i].curr->store(thread_state_[i].begin,
                                      std::memory_order_relaxed);
-        thread_state_[i].end = thread_state_[i - 1].end + base + (i < remain);
         thread_state_[i].status->store(ThreadStatus::WORKING,
                                        std::memory_order_release);
     }
@@ -204,7 +249,7 @@ fflush(stdout);
     }
 #endif
 
-    thread_state_[0].curr->store(0, std::memory_order_relaxed);
+    thread_state_[0].curr->store(thread_state_[0].begin, std::memory_order_relaxed);
     thread_state_[0].status->store(ThreadStatus::WORKING,
                                    std::memory_order_release);
     process_tasks(0);
@@ -219,6 +264,22 @@ fflush(stdout);
 #endif
 }
 
+// runs what is left of the range of thread t_i
+void Backend::steal(int t_i) {
+    if (thread_state_[t_i].status->load(std::memory_order_acquire) !=
+        ThreadStatus::WORKING) {
+        return;
+    }
+    while (true) {
+        int task_id = thread_state_[t_i].curr->fetch_add(
+            1, std::memory_order_acq_rel);
+        if (task_id >= thread_state_[t_i].end) {
+            break;
+        }
+        compute_func_(task_id);
+    }
+}
+
 void Backend::process_tasks(int thread_id) {
     
     if(unlikely(numa_node == -1)){
@@ -264,6 +325,19 @@ fflush(stdout);
         }
         compute_func_(task_id);
     }
+    if (steal_) {
+        // node-local weights first: the other threads of this node, then the other nodes
+        for (int t_i = steal_from; t_i < steal_to; t_i++) {
+            if (t_i != thread_id) {
+                steal(t_i);
+            }
+        }
+        for (int t_i = 0; t_i < thread_num_; t_i++) {
+            if (t_i < steal_from || t_i >= steal_to) {
+                steal(t_i);
+            }
+        }
+    }
 #if 0
     int steal_total = steal_to - steal_from;
     for (int t_offset = 1; t_offset < steal_total; t_offset++) {
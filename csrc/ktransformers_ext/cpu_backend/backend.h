@@ -57,12 +57,14 @@ struct ThreadState {
 
     std::atomic<ThreadStatus>* status;
     std::atomic<int>*          curr;
+    int begin;
     int end;
 };
 #else
 struct ThreadState {
     std::unique_ptr<std::atomic<ThreadStatus>> status;
     std::unique_ptr<std::atomic<int>> curr;
+    int begin;
     int end;
 };
 #endif
@@ -75,6 +77,12 @@ class Backend {
     void do_work_stealing_job(int, std::function<void(int)>,
                               std::function<void(int)>,
                               std::function<void(int)>);
+    // Tasks [node_task_begin[n], node_task_begin[n + 1]) run on the threads of numa node numa_node_ids[n], a thread
+    // out of work steals from the threads of its node first and from the other nodes last
+    void do_numa_work_stealing_job(const std::vector<int>& node_task_begin,
+                                   std::function<void(int)>,
+                                   std::function<void(int)>,
+                                   std::function<void(int)>);
     static thread_local int numa_node;
     static thread_local int steal_from;
     static thread_local int steal_to;
@@ -97,7 +105,11 @@ class Backend {
     std::function<void(int)> compute_func_;
     std::function<void(int)> finalize_func_;
     std::vector<std::thread> workers_;
+    std::vector<int> node_thread_begin_; // [numa_num + 1]
+    bool steal_;
 
+    void run_job();
+    void steal(int);
     void process_tasks(int);
     void worker_thread(int);
 };
@@ -0,0 +1,109 @@
+/**
+ * @Description  : Thread to core and NUMA node placement of the CPUInfer backend threads.
+ * @Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+ **/
+#ifndef _GNU_SOURCE
+#define _GNU_SOURCE
+#endif // _GNU_SOURCE
+
+#include "core_info.h"
+
+#include <sched.h>
+#include <algorithm>
+#include <cstdio>
+#include <fstream>
+#include <map>
+#include <sstream>
+#include <string>
+#include <utility>
+#ifdef USE_NUMA
+#include <numa.h>
+#endif
+
+std::vector<int> thread_id_to_numa;
+std::vector<int> thread_id_to_core;
+std::vector<int> thread_id_to_steal_from;
+std::vector<int> thread_id_to_steal_to;
+std::vector<int> numa_node_ids;
+
+// cpus of a sysfs cpu list such as "0-3,8,10-11"
+static std::vector<int> parse_cpu_list(const std::string& list) {
+    std::vector<int> cpus;
+    std::stringstream ss(list);
+    std::string range;
+    while (std::getline(ss, range, ',')) {
+        size_t dash = range.find('-');
+        int first = std::stoi(range.substr(0, dash));
+        int last = dash == std::string::npos ? first : std::stoi(range.substr(dash + 1));
+        for (int cpu = first; cpu <= last; cpu++) {
+            cpus.push_back(cpu);
+        }
+    }
+    return cpus;
+}
+
+// 0 for the first hyperthread of a core, 1 for the second...
+static int sibling_rank(int cpu) {
+    std::ifstream file("/sys/devices/system/cpu/cpu" + std::to_string(cpu) + "/topology/thread_siblings_list");
+    std::string list;
+    if (!(file >> list)) {
+        return 0;
+    }
+    std::vector<int> siblings = parse_cpu_list(list);
+    return std::count_if(siblings.begin(), siblings.end(), [cpu](int sibling) { return sibling < cpu; });
+}
+
+static int node_of_cpu(int cpu) {
+#ifdef USE_NUMA
+    if (numa_available() >= 0) {
+        return std::max(numa_node_of_cpu(cpu), 0);
+    }
+#endif
+    return 0;
+}
+
+void init_core_info(int thread_num) {
+    cpu_set_t allowed;
+    CPU_ZERO(&allowed);
+    sched_getaffinity(0, sizeof(allowed), &allowed);
+
+    // node -> cpus, physical cores first
+    std::map<int, std::vector<std::pair<int, int>>> node_cpus;
+    for (int cpu = 0; cpu < CPU_SETSIZE; cpu++) {
+        if (CPU_ISSET(cpu, &allowed)) {
+            node_cpus[node_of_cpu(cpu)].push_back({sibling_rank(cpu), cpu});
+        }
+    }
+    if (node_cpus.empty()) {
+        node_cpus[0].push_back({0, 0});
+    }
+    std::vector<int> nodes;
+    for (auto& [node, cpus] : node_cpus) {
+        std::sort(cpus.begin(), cpus.end());
+        nodes.push_back(node);
+    }
+
+    thread_id_to_numa.resize(thread_num);
+    thread_id_to_core.resize(thread_num);
+    thread_id_to_steal_from.resize(thread_num);
+    thread_id_to_steal_to.resize(thread_num);
+    numa_node_ids.clear();
+    int node_num = nodes.size();
+    for (int n = 0; n < node_num; n++) {
+        int begin = (long)thread_num * n / node_num;
+        int end = (long)thread_num * (n + 1) / node_num;
+        auto& cpus = node_cpus[nodes[n]];
+        if (begin < end) {
+            numa_node_ids.push_back(nodes[n]);
+        }
+        for (int i = begin; i < end; i++) {
+            thread_id_to_numa[i] = nodes[n];
+            thread_id_to_core[i] = cpus[(i - begin) % cpus.size()].second;
+            thread_id_to_steal_from[i] = begin;
+            thread_id_to_steal_to[i] = end;
+        }
+        if (end - begin > (int)cpus.size()) {
+            printf("warning: %d threads on numa node %d, which has %zu cpus\n", end - begin, nodes[n], cpus.size());
+        }
+    }
+}
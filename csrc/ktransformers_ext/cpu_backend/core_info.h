@@ -1,34 +1,20 @@
 #ifndef _CORE_INFO_H_
 #define _CORE_INFO_H_
 
-static long worker_thread_idle_threshold = 410000000; // cpu Hz / 10
-
-static int thread_id_to_numa[] = {
-/* 0  1  2  3  4  5  6  7  8  9  10 11 12 13 14 15 16 17 18 19 20 */
-   0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-/* 21 22 23 24 25 26 27 28 29 30 31 32 33 34 35 36 37 38 39 40 41 42 43 44 */
-   1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1
-};
+#include <vector>
 
-static int thread_id_to_core[] = {
-/* 0  1  2  3  4  5  6  7  8  9  10 11 12 13 14 15 16 17 18 19 20 */
-   0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10,11,12,13,14,15,16,17,18,19,20,
-/* 21 22 23 24 25 26 27 28 29 30 31 32 33 34 35 36 37 38 39 40 41 42 43 44 */
-   24,25,26,27,28,29,30,31,32,33,34,35,36,37,38,39,40,41,42,43,44,45,46,47
-};
+static long worker_thread_idle_threshold = 410000000; // cpu Hz / 10
 
-static int thread_id_to_steal_from[] = {
-/* 0  1  2  3  4  5  6  7  8  9  10 11 12 13 14 15 16 17 18 19 20 */
-   0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-/* 21 22 23 24 25 26 27 28 29 30 31 32 33 34 35 36 37 38 39 40 41 42 43 44 */
-   21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21
-};
+// Placement of the backend threads, filled by init_core_info from the cpus the process may run on: the threads are
+// split into one contiguous block per NUMA node, each block pinned to distinct physical cores of its node before
+// hyperthread siblings are used. steal_from / steal_to bound the block of the thread.
+extern std::vector<int> thread_id_to_numa;
+extern std::vector<int> thread_id_to_core;
+extern std::vector<int> thread_id_to_steal_from;
+extern std::vector<int> thread_id_to_steal_to;
+// nodes that got threads, in thread order: block n of the threads runs on numa_node_ids[n]
+extern std::vector<int> numa_node_ids;
 
-static int thread_id_to_steal_to[] = {
-/* 0  1  2  3  4  5  6  7  8  9  10 11 12 13 14 15 16 17 18 19 20 */
-   21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,
-/* 21 22 23 24 25 26 27 28 29 30 31 32 33 34 35 36 37 38 39 40 41 42 43 44 */
-   45,45,45,45,45,45,45,45,45,45,45,45,45,45,45,45,45,45,45,45,45,45,45,45
-};
+void init_core_info(int thread_num);
 
 #endif // _CORE_INFO_H_
@@ -12,7 +12,9 @@
  
  #include <atomic>
  #include <condition_variable>
+ #include <deque>
  #include <functional>
+ #include <memory>
  #include <mutex>
  #include <queue>
  #include <thread>
@@ -32,6 +34,22 @@
  
  #include "llama.cpp/ggml-impl.h"
  
+ // CPU tasks submitted while a CUDA graph is captured. Each task is built once at capture and handed to the queue by
+ // pointer when the graph replays, so a replayed decode step allocates nothing and copies no closure.
+ struct TaskGraph {
+     struct Node {
+         TaskQueue* queue;
+         std::function<void()> task;
+         TaskStats stats;
+     };
+     std::deque<Node> nodes;  // stable addresses, the captured host nodes point into it
+ 
+     static void release_(void* node_ptr) {
+         Node* node = (Node*)node_ptr;
+         node->queue->enqueue(&node->task, &node->stats);
+     }
+ };
+ 
  class CPUInfer {
     public:
      CPUInfer(int thread_num) {
@@ -49,9 +67,16 @@
  
      template <typename Func, typename Obj, typename... Args>
      void enqueue(Func f, Obj* obj, Args... args) {
-         task_queue_->enqueue([=]() {
+         std::function<void()> task = [=]() {
              std::invoke(f, *obj, args..., backend_);
-         });
+         };
+         if (recording_ != nullptr) {
+             TaskGraph::Node& node = recording_->nodes.emplace_back();
+             node.queue = task_queue_;
+             node.task = std::move(task);
+             return;
+         }
+         task_queue_->enqueue(std::move(task));
      }
  
      void submit(std::pair<intptr_t, intptr_t> params) {
@@ -69,12 +94,59 @@
          void (*func)(void*) = (void (*)(void*))params.first;
          void* args = (void*)params.second;
          *((CPUInfer**)args) = this;
-         cudaLaunchHostFunc((cudaStream_t)user_cuda_stream, (cudaHostFn_t)func, args);
+         if (capturing_ == nullptr) {
+             cudaLaunchHostFunc((cudaStream_t)user_cuda_stream, (cudaHostFn_t)func, args);
+             return;
+         }
+         size_t first = capturing_->nodes.size();
+         recording_ = capturing_;
+         func(args);
+         recording_ = nullptr;
+         for (size_t i = first; i < capturing_->nodes.size(); i++) {
+             cudaLaunchHostFunc((cudaStream_t)user_cuda_stream, (cudaHostFn_t)&TaskGraph::release_, &capturing_->nodes[i]);
+         }
+     }
+ 
+     // submit_with_cuda_stream records its tasks into a new task graph until end_graph, to be used around a CUDA
+     // graph capture. Returns the id of the graph for graph_stats.
+     int begin_graph() {
+         graphs_.push_back(std::make_unique<TaskGraph>());
+         capturing_ = graphs_.back().get();
+         return graphs_.size() - 1;
+     }
+ 
+     void end_graph() {
+         capturing_ = nullptr;
+     }
+ 
+     int graph_count() {
+         return graphs_.size();
+     }
+ 
+     TaskTimes stats() {
+         return task_queue_->stats();
+     }
+ 
+     std::vector<TaskTimes> graph_stats(int graph_id) {
+         std::vector<TaskTimes> times;
+         for (auto& node : graphs_.at(graph_id)->nodes) {
+             times.push_back(node.stats.get());
+         }
+         return times;
+     }
+ 
+     void reset_stats() {
+         task_queue_->reset_stats();
+         for (auto& graph : graphs_) {
+             for (auto& node : graph->nodes) {
+                 node.stats.reset();
+             }
+         }
      }
  
      static void sync_(void* cpu_infer_ptr) {
          CPUInfer* cpuinfer = (CPUInfer*)cpu_infer_ptr;
-         cpuinfer->sync();
+         cpuinfer->task_queue_->wait();
      }
  
      void sync_with_cuda_stream(intptr_t user_cuda_stream) {
@@ -84,6 +156,12 @@
     public:
      Backend* backend_;
      TaskQueue* task_queue_;
+ 
+    private:
+     // graphs live as long as the CUDA graphs replaying them, i.e. as long as this CPUInfer
+     std::vector<std::unique_ptr<TaskGraph>> graphs_;
+     TaskGraph* capturing_ = nullptr;
+     static inline thread_local TaskGraph* recording_ = nullptr;
  };
  
  #endif
\ No newline at end of file
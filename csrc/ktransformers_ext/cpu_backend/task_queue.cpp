@@ -9,10 +9,46 @@
  **/
 #include "task_queue.h"
 
-TaskQueue::TaskQueue() {
-    worker = std::thread(&TaskQueue::processTasks, this);
-    sync_flag.store(true, std::memory_order_seq_cst);
+void TaskStats::add(uint64_t wait, uint64_t exec) {
+    count.store(count.load(std::memory_order_relaxed) + 1, std::memory_order_relaxed);
+    wait_ns.store(wait_ns.load(std::memory_order_relaxed) + wait, std::memory_order_relaxed);
+    exec_ns.store(exec_ns.load(std::memory_order_relaxed) + exec, std::memory_order_relaxed);
+    if (wait > max_wait_ns.load(std::memory_order_relaxed)) {
+        max_wait_ns.store(wait, std::memory_order_relaxed);
+    }
+    if (exec > max_exec_ns.load(std::memory_order_relaxed)) {
+        max_exec_ns.store(exec, std::memory_order_relaxed);
+    }
+}
+
+TaskTimes TaskStats::get() const {
+    TaskTimes times;
+    times.count = count.load(std::memory_order_relaxed);
+    times.wait_ns = wait_ns.load(std::memory_order_relaxed);
+    times.exec_ns = exec_ns.load(std::memory_order_relaxed);
+    times.max_wait_ns = max_wait_ns.load(std::memory_order_relaxed);
+    times.max_exec_ns = max_exec_ns.load(std::memory_order_relaxed);
+    return times;
+}
+
+void TaskStats::reset() {
+    count.store(0, std::memory_order_relaxed);
+    wait_ns.store(0, std::memory_order_relaxed);
+    exec_ns.store(0, std::memory_order_relaxed);
+    max_wait_ns.store(0, std::memory_order_relaxed);
+    max_exec_ns.store(0, std::memory_order_relaxed);
+}
+
+TaskQueue::TaskQueue() : ring(capacity) {
+    for (size_t i = 0; i < capacity; i++) {
+        ring[i].seq.store(i, std::memory_order_relaxed);
+    }
+    head.store(0, std::memory_order_relaxed);
+    tail = 0;
+    pending.store(0, std::memory_order_relaxed);
+    sleeping.store(false, std::memory_order_relaxed);
     exit_flag.store(false, std::memory_order_seq_cst);
+    worker = std::thread(&TaskQueue::processTasks, this);
 }
 
 TaskQueue::~TaskQueue() {
@@ -27,41 +63,128 @@ TaskQueue::~TaskQueue() {
     }
 }
 
-void TaskQueue::enqueue(std::function<void()> task) {
-    {
+template <typename Fill>
+void TaskQueue::push(Fill fill) {
+    pending.fetch_add(1, std::memory_order_seq_cst);
+    uint64_t pos = head.load(std::memory_order_relaxed);
+    Slot* slot;
+    while (true) {
+        slot = &ring[pos % capacity];
+        int64_t diff = (int64_t)slot->seq.load(std::memory_order_acquire) - (int64_t)pos;
+        if (diff == 0) {
+            if (head.compare_exchange_weak(pos, pos + 1, std::memory_order_relaxed)) {
+                break;
+            }
+        } else if (diff < 0) {
+            // full, the worker frees a slot once it starts the oldest task
+            std::this_thread::yield();
+            pos = head.load(std::memory_order_relaxed);
+        } else {
+            pos = head.load(std::memory_order_relaxed);
+        }
+    }
+    fill(*slot);
+    slot->enqueue_time = std::chrono::steady_clock::now();
+    slot->seq.store(pos + 1, std::memory_order_release);
+    // pairs with the fence of a worker going to sleep: either it sees this task or we see it asleep
+    std::atomic_thread_fence(std::memory_order_seq_cst);
+    if (sleeping.load(std::memory_order_relaxed)) {
         mutex.lock();
-        tasks.push(task);
-        sync_flag.store(false, std::memory_order_seq_cst);
         mutex.unlock();
+        cv.notify_one();
     }
-    cv.notify_one();
 }
 
-void TaskQueue::sync() {
-    while (!sync_flag.load(std::memory_order_seq_cst))
+void TaskQueue::enqueue(std::function<void()> task) {
+    push([&](Slot& slot) {
+        slot.owned = std::move(task);
+        slot.task = nullptr;
+        slot.stats = nullptr;
+    });
+}
+
+void TaskQueue::enqueue(const std::function<void()>* task, TaskStats* stats) {
+    push([&](Slot& slot) {
+        slot.task = task;
+        slot.stats = stats;
+    });
+}
+
+void TaskQueue::wait() {
+    while (pending.load(std::memory_order_seq_cst) != 0)
         ;
 }
 
+void TaskQueue::sync() {
+    wait();
+    std::exception_ptr e;
+    mutex.lock();
+    std::swap(e, error);
+    mutex.unlock();
+    if (e) {
+        std::rethrow_exception(e);
+    }
+}
+
+TaskTimes TaskQueue::stats() const {
+    return stats_.get();
+}
+
+void TaskQueue::reset_stats() {
+    stats_.reset();
+}
+
+bool TaskQueue::ready() const {
+    return ring[tail % capacity].seq.load(std::memory_order_acquire) == tail + 1;
+}
+
 void TaskQueue::processTasks() {
+    auto idle_since = std::chrono::steady_clock::now();
     while (true) {
-        std::function<void()> task;
-        {
-            mutex.lock();
-            cv.wait(mutex, [this]() { return !tasks.empty() || exit_flag.load(std::memory_order_seq_cst); });
-            if (exit_flag.load(std::memory_order_seq_cst) && tasks.empty()) {
-                return;
+        if (ready()) {
+            Slot& slot = ring[tail % capacity];
+            std::function<void()> owned = std::move(slot.owned);
+            slot.owned = nullptr;
+            const std::function<void()>* task = slot.task != nullptr ? slot.task : &owned;
+            TaskStats* stats = slot.stats;
+            auto enqueue_time = slot.enqueue_time;
+            slot.seq.store(tail + capacity, std::memory_order_release);
+            tail++;
+
+            auto start = std::chrono::steady_clock::now();
+            try {
+                (*task)();
+            } catch (...) {
+                mutex.lock();
+                if (!error) {
+                    error = std::current_exception();
+                }
+                mutex.unlock();
             }
-            task = tasks.front();
-            tasks.pop();
-            mutex.unlock();
-        }
-        task();
-        {
-            mutex.lock();
-            if (tasks.empty()) {
-                sync_flag.store(true, std::memory_order_seq_cst);
+            auto end = std::chrono::steady_clock::now();
+            uint64_t wait = std::chrono::duration_cast<std::chrono::nanoseconds>(start - enqueue_time).count();
+            uint64_t exec = std::chrono::duration_cast<std::chrono::nanoseconds>(end - start).count();
+            stats_.add(wait, exec);
+            if (stats != nullptr) {
+                stats->add(wait, exec);
             }
-            mutex.unlock();
+            pending.fetch_sub(1, std::memory_order_seq_cst);
+            idle_since = end;
+            continue;
         }
+        if (exit_flag.load(std::memory_order_seq_cst)) {
+            return;
+        }
+        if (std::chrono::steady_clock::now() - idle_since < spin_time) {
+            cpu_relax();
+            continue;
+        }
+        mutex.lock();
+        sleeping.store(true, std::memory_order_relaxed);
+        std::atomic_thread_fence(std::memory_order_seq_cst);
+        cv.wait(mutex, [this]() { return ready() || exit_flag.load(std::memory_order_seq_cst); });
+        sleeping.store(false, std::memory_order_relaxed);
+        mutex.unlock();
+        idle_since = std::chrono::steady_clock::now();
     }
-}
\ No newline at end of file
+}
@@ -11,7 +11,10 @@
 #define CPUINFER_TASKQUEUE_H
 
 #include <atomic>
+#include <chrono>
 #include <condition_variable>
+#include <cstdint>
+#include <exception>
 #include <functional>
 #include <mutex>
 #include <queue>
@@ -20,6 +23,17 @@
 #ifdef _WIN32
 #include <windows.h>
 #endif
+#if defined(__x86_64__) || defined(_M_X64) || defined(__i386__)
+#include <immintrin.h>
+#endif
+
+static inline void cpu_relax() {
+#if defined(__x86_64__) || defined(_M_X64) || defined(__i386__)
+    _mm_pause();
+#elif defined(__aarch64__)
+    asm volatile("yield" ::: "memory");
+#endif
+}
 
 class custom_mutex {
    private:
@@ -116,6 +130,31 @@ class custom_condition_variable {
     }
 };
 
+// Queue wait (enqueue to start) and execute time of the tasks run by a TaskQueue, written by its worker only
+struct TaskTimes {
+    uint64_t count = 0;
+    uint64_t wait_ns = 0;
+    uint64_t exec_ns = 0;
+    uint64_t max_wait_ns = 0;
+    uint64_t max_exec_ns = 0;
+};
+
+struct TaskStats {
+    std::atomic<uint64_t> count{0};
+    std::atomic<uint64_t> wait_ns{0};
+    std::atomic<uint64_t> exec_ns{0};
+    std::atomic<uint64_t> max_wait_ns{0};
+    std::atomic<uint64_t> max_exec_ns{0};
+
+    void add(uint64_t wait, uint64_t exec);
+    TaskTimes get() const;
+    void reset();
+};
+
+// Tasks run one after the other on a worker thread. Submission goes through a bounded lock-free ring: producers
+// claim a slot with one CAS (uncontended when, as for CUDA graph replay, a single stream callback thread submits)
+// and the worker spins on the ring for a while before it falls asleep, so the steady state has no lock and no
+// wake-up syscall.
 class TaskQueue {
    public:
     TaskQueue();
@@ -123,16 +162,47 @@ class TaskQueue {
 
     void enqueue(std::function<void()>);
 
+    // task is borrowed and must outlive its run, stats (may be null) get its times on top of the queue totals
+    void enqueue(const std::function<void()>* task, TaskStats* stats);
+
+    // waits for the queued tasks and rethrows the first exception one of them threw since the last sync
     void sync();
 
+    // waits without rethrowing, for callers that cannot throw (CUDA host functions); a task's error stays for sync
+    void wait();
+
+    TaskTimes stats() const;
+
+    void reset_stats();
+
    private:
+    static constexpr size_t capacity = 1024;
+    // how long the worker keeps polling the ring after its last task
+    static constexpr std::chrono::microseconds spin_time{5000};
+
+    struct Slot {
+        std::atomic<uint64_t> seq;
+        std::function<void()> owned;
+        const std::function<void()>* task;
+        TaskStats* stats;
+        std::chrono::steady_clock::time_point enqueue_time;
+    };
+
+    template <typename Fill>
+    void push(Fill fill);
+    bool ready() const;
     void processTasks();
 
-    std::queue<std::function<void()>> tasks;
+    std::vector<Slot> ring;
+    alignas(64) std::atomic<uint64_t> head;
+    alignas(64) uint64_t tail;
+    alignas(64) std::atomic<uint64_t> pending;
+    std::atomic<bool> sleeping;
+    std::atomic<bool> exit_flag;
     custom_mutex mutex;
     custom_condition_variable cv;
+    TaskStats stats_;
+    std::exception_ptr error;  // guarded by mutex
     std::thread worker;
-    std::atomic<bool> sync_flag;
-    std::atomic<bool> exit_flag;
 };
-#endif
\ No newline at end of file
+#endif
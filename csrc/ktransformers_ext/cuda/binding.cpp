@@ -62,6 +62,27 @@ PYBIND11_MODULE(KTransformersOps, m) {
         }, "Function to dequantize iq4_xs data.",
         py::arg("data"), py::arg("num_bytes"), py::arg("blk_size"), py::arg("ele_per_blk"), py::arg("device"), py::arg("target_dtype"));
 
+    m.def("dequantize_q8_0_into", &dequantize_q8_0_into, "Dequantize q8_0 blocks already on the device into output on the current stream.",
+        py::arg("data"), py::arg("output"), py::arg("blk_size"), py::arg("ele_per_blk"));
+
+    m.def("dequantize_q6_k_into", &dequantize_q6_k_into, "Dequantize q6_k blocks already on the device into output on the current stream.",
+        py::arg("data"), py::arg("output"), py::arg("blk_size"), py::arg("ele_per_blk"));
+
+    m.def("dequantize_q5_k_into", &dequantize_q5_k_into, "Dequantize q5_k blocks already on the device into output on the current stream.",
+        py::arg("data"), py::arg("output"), py::arg("blk_size"), py::arg("ele_per_blk"));
+
+    m.def("dequantize_q4_k_into", &dequantize_q4_k_into, "Dequantize q4_k blocks already on the device into output on the current stream.",
+        py::arg("data"), py::arg("output"), py::arg("blk_size"), py::arg("ele_per_blk"));
+
+    m.def("dequantize_q3_k_into", &dequantize_q3_k_into, "Dequantize q3_k blocks already on the device into output on the current stream.",
+        py::arg("data"), py::arg("output"), py::arg("blk_size"), py::arg("ele_per_blk"));
+
+    m.def("dequantize_q2_k_into", &dequantize_q2_k_into, "Dequantize q2_k blocks already on the device into output on the current stream.",
+        py::arg("data"), py::arg("output"), py::arg("blk_size"), py::arg("ele_per_blk"));
+
+    m.def("dequantize_iq4_xs_into", &dequantize_iq4_xs_into, "Dequantize iq4_xs blocks already on the device into output on the current stream.",
+        py::arg("data"), py::arg("output"), py::arg("blk_size"), py::arg("ele_per_blk"));
+
 #ifdef KTRANSFORMERS_USE_CUDA
     m.def("gptq_marlin_gemm", &gptq_marlin_gemm, "Function to perform GEMM using Marlin quantization.",
         py::arg("a"), py::arg("b_q_weight"), py::arg("b_scales"), py::arg("g_idx"),
@@ -15,6 +15,7 @@
 #include <torch/torch.h>
 #include <cstdint>
 #include <c10/cuda/CUDAGuard.h>
+#include <ATen/cuda/CUDAContext.h>
 
 #ifdef __HIP_PLATFORM_AMD__
 typedef hip_bfloat16 nv_bfloat16;
@@ -879,4 +880,37 @@ torch::Tensor dequantize_iq4_xs(const int8_t* data, const int num_bytes, const i
     }
     cudaDeviceSynchronize();
     return output;
-}
\ No newline at end of file
+}
+// Variants used by the pipelined GGUF loader: the raw blocks are already on the device and the kernels are
+// launched on the current stream into a preallocated output, so H2D copies of the next chunk can overlap.
+#define DEFINE_DEQUANTIZE_INTO(name)                                                                                  \
+void dequantize_##name##_into(const torch::Tensor& data, torch::Tensor& output, const int blk_size, const int ele_per_blk) { \
+    TORCH_CHECK(data.is_cuda() && data.is_contiguous(), #name " data must be a contiguous cuda tensor");              \
+    TORCH_CHECK(output.is_contiguous() && output.device() == data.device(), #name " output must be contiguous on the data device"); \
+    int num_blocks = data.numel() / blk_size;                                                                         \
+    TORCH_CHECK(output.numel() == (int64_t)num_blocks * ele_per_blk, #name " output size mismatch");                  \
+    const at::cuda::OptionalCUDAGuard device_guard(data.device());                                                   \
+    cudaStream_t stream = at::cuda::getCurrentCUDAStream();                                                           \
+    const int8_t* src = data.data_ptr<int8_t>();                                                                      \
+    switch (output.scalar_type()) {                                                                                   \
+        case torch::kFloat16:                                                                                         \
+            dequantize_##name##_fp16_kernel<<<512, 256, 0, stream>>>(src, (__half*)output.data_ptr(), blk_size, ele_per_blk, num_blocks); \
+            break;                                                                                                    \
+        case torch::kBFloat16:                                                                                        \
+            dequantize_##name##_bf16_kernel<<<512, 256, 0, stream>>>(src, (nv_bfloat16*)output.data_ptr(), blk_size, ele_per_blk, num_blocks); \
+            break;                                                                                                    \
+        case torch::kFloat32:                                                                                         \
+            dequantize_##name##_fp32_kernel<<<512, 256, 0, stream>>>(src, output.data_ptr<float>(), blk_size, ele_per_blk, num_blocks); \
+            break;                                                                                                    \
+        default:                                                                                                      \
+            TORCH_CHECK(false, "target type not support");                                                           \
+    }                                                                                                                 \
+}
+
+DEFINE_DEQUANTIZE_INTO(q8_0)
+DEFINE_DEQUANTIZE_INTO(q6_k)
+DEFINE_DEQUANTIZE_INTO(q5_k)
+DEFINE_DEQUANTIZE_INTO(q4_k)
+DEFINE_DEQUANTIZE_INTO(q3_k)
+DEFINE_DEQUANTIZE_INTO(q2_k)
+DEFINE_DEQUANTIZE_INTO(iq4_xs)
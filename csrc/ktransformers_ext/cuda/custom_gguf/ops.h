@@ -19,4 +19,11 @@ torch::Tensor dequantize_q5_k(const int8_t* data, const int num_bytes, const int
 torch::Tensor dequantize_q4_k(const int8_t* data, const int num_bytes, const int blk_size, const int ele_per_blk, const torch::Device device, const torch::Dtype target_dtype);
 torch::Tensor dequantize_q3_k(const int8_t* data, const int num_bytes, const int blk_size, const int ele_per_blk, const torch::Device device, const torch::Dtype target_dtype);
 torch::Tensor dequantize_q2_k(const int8_t* data, const int num_bytes, const int blk_size, const int ele_per_blk, const torch::Device device, const torch::Dtype target_dtype);
-torch::Tensor dequantize_iq4_xs(const int8_t* data, const int num_bytes, const int blk_size, const int ele_per_blk, const torch::Device device, const torch::Dtype target_dtype);
\ No newline at end of file
+torch::Tensor dequantize_iq4_xs(const int8_t* data, const int num_bytes, const int blk_size, const int ele_per_blk, const torch::Device device, const torch::Dtype target_dtype);
+void dequantize_q8_0_into(const torch::Tensor& data, torch::Tensor& output, const int blk_size, const int ele_per_blk);
+void dequantize_q6_k_into(const torch::Tensor& data, torch::Tensor& output, const int blk_size, const int ele_per_blk);
+void dequantize_q5_k_into(const torch::Tensor& data, torch::Tensor& output, const int blk_size, const int ele_per_blk);
+void dequantize_q4_k_into(const torch::Tensor& data, torch::Tensor& output, const int blk_size, const int ele_per_blk);
+void dequantize_q3_k_into(const torch::Tensor& data, torch::Tensor& output, const int blk_size, const int ele_per_blk);
+void dequantize_q2_k_into(const torch::Tensor& data, torch::Tensor& output, const int blk_size, const int ele_per_blk);
+void dequantize_iq4_xs_into(const torch::Tensor& data, torch::Tensor& output, const int blk_size, const int ele_per_blk);
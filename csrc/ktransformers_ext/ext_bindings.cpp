@@ -562,12 +562,25 @@ class MOEBindings {
 };
 
 PYBIND11_MODULE(cpuinfer_ext, m) {
+    py::class_<TaskTimes>(m, "TaskTimes")
+        .def_readonly("count", &TaskTimes::count)
+        .def_readonly("wait_ns", &TaskTimes::wait_ns)
+        .def_readonly("exec_ns", &TaskTimes::exec_ns)
+        .def_readonly("max_wait_ns", &TaskTimes::max_wait_ns)
+        .def_readonly("max_exec_ns", &TaskTimes::max_exec_ns);
+
     py::class_<CPUInfer>(m, "CPUInfer")
         .def(py::init<int>())
         .def("submit", &CPUInfer::submit)
         .def("submit_with_cuda_stream", &CPUInfer::submit_with_cuda_stream)
         .def("sync", &CPUInfer::sync)
-        .def("sync_with_cuda_stream", &CPUInfer::sync_with_cuda_stream);
+        .def("sync_with_cuda_stream", &CPUInfer::sync_with_cuda_stream)
+        .def("begin_graph", &CPUInfer::begin_graph)
+        .def("end_graph", &CPUInfer::end_graph)
+        .def("graph_count", &CPUInfer::graph_count)
+        .def("stats", &CPUInfer::stats)
+        .def("graph_stats", &CPUInfer::graph_stats)
+        .def("reset_stats", &CPUInfer::reset_stats);
 
     auto linear_module = m.def_submodule("linear");
     py::class_<LinearConfig>(linear_module, "LinearConfig")
@@ -613,11 +626,13 @@ PYBIND11_MODULE(cpuinfer_ext, m) {
                              (void *)down_proj, (ggml_type)gate_type,
                              (ggml_type)up_type, (ggml_type)down_type,
                              (ggml_type)hidden_type);
-        }));
+        }))
+        .def_readwrite("numa_partition", &MOEConfig::numa_partition);
     py::class_<MOE>(moe_module, "MOE")
         .def(py::init<MOEConfig>())
         .def("warm_up", &MOEBindings::WarmUpBindinds::cpuinfer_interface)
-        .def("forward", &MOEBindings::ForwardBindings::cpuinfer_interface);
+        .def("forward", &MOEBindings::ForwardBindings::cpuinfer_interface)
+        .def("weight_bytes", &MOE::weight_bytes);
 
     auto kvcache_module = m.def_submodule("kvcache");
 
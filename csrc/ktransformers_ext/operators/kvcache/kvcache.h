@@ -400,6 +400,12 @@ class KVCache {
                                    ggml_fp16_t *v_in, Backend *backend);
 
   private:
+    // Snapshot layout of load_kvcache / dump_kvcache
+    size_t snapshot_block_bytes();
+    size_t snapshot_bytes(int past_block_num);
+    void copy_snapshot(char *data, int past_block_num, int *block_table,
+                       bool to_file, Backend *backend);
+
     // Persistent data
     KVCacheConfig config_;
     int n_gqa_;                            // q_head_num / kv_head_num
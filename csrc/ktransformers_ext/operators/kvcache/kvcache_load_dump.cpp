@@ -10,55 +10,154 @@
 
 #include "kvcache.h"
 
+#include <cerrno>
 #include <chrono>
 
+#ifndef _WIN32
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#endif
+
+// A snapshot is cache_total_len, anchor_, then for every layer the k and v
+// blocks of each kv head followed by the importance of its blocks. Every
+// section has a fixed size, so the file is memory-mapped and the layers and
+// heads are copied in parallel.
+
+size_t KVCache::snapshot_block_bytes() {
+    if (config_.kv_type == GGML_TYPE_F16) {
+        return config_.block_len * config_.head_dim * sizeof(ggml_fp16_t);
+    } else if (config_.kv_type == GGML_TYPE_Q4_0) {
+        return config_.block_len * config_.head_dim / 32 * sizeof(block_q4_0);
+    } else if (config_.kv_type == GGML_TYPE_Q8_0) {
+        return config_.block_len * config_.head_dim / 32 * sizeof(block_q8_0);
+    }
+    throw std::runtime_error("kvcache snapshots support FP16, Q4_0 and Q8_0");
+}
+
+size_t KVCache::snapshot_bytes(int past_block_num) {
+    size_t importance_bytes =
+        config_.block_len * config_.q_head_num * sizeof(ggml_fp16_t);
+    size_t layer_bytes = (size_t)past_block_num *
+                         (config_.kv_head_num * 2 * snapshot_block_bytes() +
+                          importance_bytes);
+    return sizeof(int) + anchor_.size() * sizeof(ggml_fp16_t) +
+           config_.layer_num * layer_bytes;
+}
+
+void KVCache::copy_snapshot(char *data, int past_block_num, int *block_table,
+                            bool to_file, Backend *backend) {
+    size_t block_bytes = snapshot_block_bytes();
+    size_t row_bytes = config_.q_head_num * sizeof(ggml_fp16_t);
+    size_t head_bytes = (size_t)past_block_num * 2 * block_bytes;
+    size_t layer_bytes = config_.kv_head_num * head_bytes +
+                         (size_t)past_block_num * config_.block_len * row_bytes;
+    char *layers = data + sizeof(int) + anchor_.size() * sizeof(ggml_fp16_t);
+    auto copy = [&](char *file, void *cache, size_t bytes) {
+        if (to_file) {
+            memcpy(file, cache, bytes);
+        } else {
+            memcpy(cache, file, bytes);
+        }
+    };
+    // one task per (layer, kv head), plus one per layer for the importance
+    backend->do_work_stealing_job(
+        config_.layer_num * (config_.kv_head_num + 1), nullptr,
+        [&](int task_id) {
+            int layer_id = task_id / (config_.kv_head_num + 1);
+            int head_id = task_id % (config_.kv_head_num + 1);
+            char *layer = layers + layer_id * layer_bytes;
+            if (head_id == config_.kv_head_num) {
+                char *file = layer + config_.kv_head_num * head_bytes;
+                for (int k = 0; k < past_block_num; k++) {
+                    int block_idx = block_table ? block_table[k] : k;
+                    for (int l = 0; l < config_.block_len; l++) {
+                        copy(file, importance_[layer_id][block_idx][l].data(),
+                             row_bytes);
+                        file += row_bytes;
+                    }
+                }
+                return;
+            }
+            char *file = layer + head_id * head_bytes;
+            for (int k = 0; k < past_block_num; k++) {
+                int block_idx = block_table ? block_table[k] : k;
+                void *k_block, *v_block;
+                if (config_.kv_type == GGML_TYPE_F16) {
+                    k_block = k_cache_fp16_[layer_id][head_id][block_idx].data();
+                    v_block = v_cache_fp16_[layer_id][head_id][block_idx].data();
+                } else if (config_.kv_type == GGML_TYPE_Q4_0) {
+                    k_block = k_cache_q4[layer_id][head_id][block_idx].data();
+                    v_block = v_cache_q4[layer_id][head_id][block_idx].data();
+                } else {
+                    k_block = k_cache_q8[layer_id][head_id][block_idx].data();
+                    v_block = v_cache_q8[layer_id][head_id][block_idx].data();
+                }
+                copy(file, k_block, block_bytes);
+                copy(file + block_bytes, v_block, block_bytes);
+                file += 2 * block_bytes;
+            }
+        },
+        nullptr);
+}
+
 void KVCache::load_kvcache(std::string tensor_file_path, Backend *backend) {
     // Timer start
     auto start = std::chrono::high_resolution_clock::now();
-    std::ifstream ifs_tensor(tensor_file_path, std::ios::binary);
+#ifndef _WIN32
+    int fd = open(tensor_file_path.c_str(), O_RDONLY);
+    if (fd < 0) {
+        throw std::runtime_error("Failed to open tensor file");
+    }
+    struct stat st;
+    fstat(fd, &st);
+    size_t file_bytes = st.st_size;
+    char *data = nullptr;
+    if (file_bytes >= sizeof(int)) {
+        data = (char *)mmap(nullptr, file_bytes, PROT_READ, MAP_PRIVATE, fd, 0);
+    }
+    close(fd);
+    if (data == nullptr || data == MAP_FAILED) {
+        throw std::runtime_error("Failed to map tensor file");
+    }
+    madvise(data, file_bytes, MADV_WILLNEED);
+#else
+    std::ifstream ifs_tensor(tensor_file_path,
+                             std::ios::binary | std::ios::ate);
     if (!ifs_tensor) {
         throw std::runtime_error("Failed to open tensor file");
     }
-    ifs_tensor.read(reinterpret_cast<char *>(&cache_total_len_),
-                    sizeof(cache_total_len_));
+    size_t file_bytes = ifs_tensor.tellg();
+    std::vector<char> buffer(file_bytes);
+    ifs_tensor.seekg(0);
+    ifs_tensor.read(buffer.data(), file_bytes);
+    char *data = buffer.data();
+#endif
+    int cache_total_len;
+    memcpy(&cache_total_len, data, sizeof(cache_total_len));
     int past_block_num =
-        (cache_total_len_ + config_.block_len - 1) / config_.block_len;
-    printf("cache_total_len: %d, past_block_num: %d\n", cache_total_len_,
-           past_block_num);
-    for (int i = 0; i < config_.layer_num; ++i) {
-        past_block_num_[i] = past_block_num;
-    }
-    ifs_tensor.read(reinterpret_cast<char *>(anchor_.data()),
-                    anchor_.size() * sizeof(ggml_fp16_t));
-    for (int i = 0; i < config_.layer_num; ++i) {
-        for (int j = 0; j < config_.kv_head_num; ++j) {
-            for (int k = 0; k < past_block_num_[i]; ++k) {
-                if (config_.kv_type == GGML_TYPE_F16) {
-                    ifs_tensor.read(
-                        reinterpret_cast<char *>(k_cache_fp16_[i][j][k].data()),
-                        k_cache_fp16_[i][j][k].size() * sizeof(ggml_fp16_t));
-                    ifs_tensor.read(
-                        reinterpret_cast<char *>(v_cache_fp16_[i][j][k].data()),
-                        v_cache_fp16_[i][j][k].size() * sizeof(ggml_fp16_t));
-                } else if (config_.kv_type == GGML_TYPE_Q4_0) {
-                    ifs_tensor.read(
-                        reinterpret_cast<char *>(k_cache_q4[i][j][k].data()),
-                        k_cache_q4[i][j][k].size() * sizeof(block_q4_0));
-                    ifs_tensor.read(
-                        reinterpret_cast<char *>(v_cache_q4[i][j][k].data()),
-                        v_cache_q4[i][j][k].size() * sizeof(block_q4_0));
-                }
-            }
-        }
-        for (int k = 0; k < past_block_num_[i]; ++k) {
-            for (int l = 0; l < config_.block_len; l++) {
-                ifs_tensor.read(
-                    reinterpret_cast<char *>(importance_[i][k][l].data()),
-                    importance_[i][k][l].size() * sizeof(ggml_fp16_t));
-            }
+        (cache_total_len + config_.block_len - 1) / config_.block_len;
+    bool valid = cache_total_len >= 0 && past_block_num <= config_.max_block_num &&
+                 file_bytes == snapshot_bytes(past_block_num);
+    if (valid) {
+        cache_total_len_ = cache_total_len;
+        printf("cache_total_len: %d, past_block_num: %d\n", cache_total_len_,
+               past_block_num);
+        for (int i = 0; i < config_.layer_num; ++i) {
+            past_block_num_[i] = past_block_num;
         }
+        memcpy(anchor_.data(), data + sizeof(int),
+               anchor_.size() * sizeof(ggml_fp16_t));
+        copy_snapshot(data, past_block_num, nullptr, false, backend);
+    }
+#ifndef _WIN32
+    munmap(data, file_bytes);
+#endif
+    if (!valid) {
+        throw std::runtime_error(
+            "Tensor file does not match the kvcache config or is truncated");
     }
-    ifs_tensor.close();
     // Timer end
     auto end = std::chrono::high_resolution_clock::now();
     std::chrono::duration<double> diff = end - start;
@@ -68,59 +167,59 @@ void KVCache::dump_kvcache(int *block_table, int cache_total_len,
                            std::string tensor_file_path, Backend *backend) {
     // Timer start
     auto start = std::chrono::high_resolution_clock::now();
-    std::ofstream ofs(tensor_file_path, std::ios::binary);
     printf("dump_kvcache: %s\n", tensor_file_path.c_str());
-    if (!ofs.is_open()) {
-        std::cerr << "Cannot open file " << tensor_file_path << std::endl;
-        return;
-    }
-    ofs.write(reinterpret_cast<const char *>(&cache_total_len),
-              sizeof(cache_total_len));
     int past_block_num =
         (cache_total_len + config_.block_len - 1) / config_.block_len;
     printf("cache_total_len: %d, past_block_num: %d\n", cache_total_len,
            past_block_num);
-    ofs.write(reinterpret_cast<const char *>(anchor_.data()),
-              anchor_.size() * sizeof(ggml_fp16_t));
-    for (int i = 0; i < config_.layer_num; ++i) {
-        for (int j = 0; j < config_.kv_head_num; ++j) {
-            for (int k = 0; k < past_block_num; ++k) {
-                int block_idx = block_table[k];
-                if (config_.kv_type == GGML_TYPE_F16) {
-                    ofs.write(reinterpret_cast<const char *>(
-                                  k_cache_fp16_[i][j][block_idx].data()),
-                              k_cache_fp16_[i][j][block_idx].size() *
-                                  sizeof(ggml_fp16_t));
-                    ofs.write(reinterpret_cast<const char *>(
-                                  v_cache_fp16_[i][j][block_idx].data()),
-                              v_cache_fp16_[i][j][block_idx].size() *
-                                  sizeof(ggml_fp16_t));
-
-                } else if (config_.kv_type == GGML_TYPE_Q4_0) {
-                    ofs.write(reinterpret_cast<const char *>(
-                                  k_cache_q4[i][j][block_idx].data()),
-                              k_cache_q4[i][j][block_idx].size() *
-                                  sizeof(block_q4_0));
-                    ofs.write(reinterpret_cast<const char *>(
-                                  v_cache_q4[i][j][block_idx].data()),
-                              v_cache_q4[i][j][block_idx].size() *
-                                  sizeof(block_q4_0));
-                }
-            }
-        }
-        for (int k = 0; k < past_block_num; ++k) {
-            int block_idx = block_table[k];
-            for (int l = 0; l < config_.block_len; l++) {
-                ofs.write(reinterpret_cast<const char *>(
-                              importance_[i][block_idx][l].data()),
-                          importance_[i][block_idx][l].size() *
-                              sizeof(ggml_fp16_t));
-            }
+    size_t file_bytes = snapshot_bytes(past_block_num);
+#ifndef _WIN32
+    int fd = open(tensor_file_path.c_str(), O_RDWR | O_CREAT | O_TRUNC, 0644);
+    if (fd < 0) {
+        throw std::runtime_error("Failed to open tensor file " +
+                                 tensor_file_path + ": " + strerror(errno));
+    }
+    // Reserve the blocks up front: a sparse file written through the mapping
+    // raises SIGBUS instead of an error once the disk is full.
+    int err = file_bytes > 0 ? posix_fallocate(fd, 0, file_bytes) : 0;
+    char *data = (char *)MAP_FAILED;
+    if (err == 0) {
+        data = (char *)mmap(nullptr, file_bytes, PROT_READ | PROT_WRITE,
+                            MAP_SHARED, fd, 0);
+        if (data == MAP_FAILED) {
+            err = errno;
         }
     }
-    ofs.close();
+    close(fd);
+    if (data == MAP_FAILED) {
+        unlink(tensor_file_path.c_str());
+        throw std::runtime_error("Failed to allocate tensor file " +
+                                 tensor_file_path + ": " + strerror(err));
+    }
+#else
+    std::vector<char> buffer(file_bytes);
+    char *data = buffer.data();
+#endif
+    memcpy(data, &cache_total_len, sizeof(cache_total_len));
+    memcpy(data + sizeof(int), anchor_.data(),
+           anchor_.size() * sizeof(ggml_fp16_t));
+    copy_snapshot(data, past_block_num, block_table, true, backend);
+#ifndef _WIN32
+    munmap(data, file_bytes);
+#else
+    std::ofstream ofs(tensor_file_path, std::ios::binary);
+    if (ofs.is_open()) {
+        ofs.write(data, file_bytes);
+        ofs.close();
+    }
+    if (!ofs) {
+        std::remove(tensor_file_path.c_str());
+        throw std::runtime_error("Failed to write tensor file " +
+                                 tensor_file_path);
+    }
+#endif
     // Timer end
     auto end = std::chrono::high_resolution_clock::now();
     std::chrono::duration<double> diff = end - start;
     printf("time of dump: %f s\n", diff.count());
-}
\ No newline at end of file
+}
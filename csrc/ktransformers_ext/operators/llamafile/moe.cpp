@@ -11,6 +11,8 @@
 #include <iostream>
 #include <cstdint>
 
+#include "../../cpu_backend/core_info.h"
+
 #include <numa.h>
 #include <numaif.h>
 
@@ -131,44 +133,82 @@ fflush(stdout);
 
 MOE::MOE(MOEConfig config) {
     config_ = config;
+    gate_expert_bytes_ = (size_t)config.intermediate_size * config.hidden_size * ggml_type_size(config.gate_type) / ggml_blck_size(config.gate_type);
+    up_expert_bytes_ = (size_t)config.intermediate_size * config.hidden_size * ggml_type_size(config.up_type) / ggml_blck_size(config.up_type);
+    down_expert_bytes_ = (size_t)config.hidden_size * config.intermediate_size * ggml_type_size(config.down_type) / ggml_blck_size(config.down_type);
 
     #ifdef USE_NUMA
     gate_proj_ = config_.gate_proj;
     up_proj_ = config_.up_proj;
     down_proj_ = config_.down_proj;
     
-    int numa_nodes = numa_num_configured_nodes();
-    gate_proj_numa_.resize(numa_nodes);
-    up_proj_numa_.resize(numa_nodes);
-    down_proj_numa_.resize(numa_nodes);
-    size_t exp_inter_hidden_mul_ = (size_t)config.expert_num * config.intermediate_size * config.hidden_size;
     struct kt_mem_alloc_info alloc_info;
-    for (int i = 0; i < numa_nodes; i++) {
-        gate_proj_numa_[i] = _numa_alloc_onnode(exp_inter_hidden_mul_* ggml_type_size(config.gate_type) / ggml_blck_size(config.gate_type), i, &alloc_info);
-        up_proj_numa_[i] = _numa_alloc_onnode(exp_inter_hidden_mul_* ggml_type_size(config.up_type) / ggml_blck_size(config.up_type), i, &alloc_info);
-        down_proj_numa_[i] = _numa_alloc_onnode(exp_inter_hidden_mul_* ggml_type_size(config.down_type) / ggml_blck_size(config.down_type), i, &alloc_info);
-        if (!gate_proj_numa_[i]) {
-            std::cout << "Memory allocation failed for gate_proj_numa_ on node " << i << std::endl;
+    if (config_.numa_partition) {
+        // contiguous blocks of experts on the nodes the backend threads run on, read by the threads of that node
+        std::vector<int> nodes = numa_node_ids.empty() ? std::vector<int>{0} : numa_node_ids;
+        int node_num = nodes.size();
+        gate_proj_numa_.resize(node_num);
+        up_proj_numa_.resize(node_num);
+        down_proj_numa_.resize(node_num);
+        expert_begin_.resize(node_num + 1);
+        expert_node_.resize(config.expert_num);
+        for (int n = 0; n <= node_num; n++) {
+            expert_begin_[n] = (long)config.expert_num * n / node_num;
         }
-        if (!up_proj_numa_[i]) {
-            std::cout << "Memory allocation failed for up_proj_numa_ on node " << i << std::endl;
-        }
-        if (!down_proj_numa_[i]) {
-            std::cout << "Memory allocation failed for down_proj_numa_ on node " << i << std::endl;
+        for (int n = 0; n < node_num; n++) {
+            int begin = expert_begin_[n];
+            int expert_count = expert_begin_[n + 1] - begin;
+            for (int e = begin; e < expert_begin_[n + 1]; e++) {
+                expert_node_[e] = n;
+            }
+            gate_proj_numa_[n] = _numa_alloc_onnode(expert_count * gate_expert_bytes_, nodes[n], &alloc_info);
+            up_proj_numa_[n] = _numa_alloc_onnode(expert_count * up_expert_bytes_, nodes[n], &alloc_info);
+            down_proj_numa_[n] = _numa_alloc_onnode(expert_count * down_expert_bytes_, nodes[n], &alloc_info);
+            if (!gate_proj_numa_[n] || !up_proj_numa_[n] || !down_proj_numa_[n]) {
+                std::cout << "Memory allocation failed for experts " << begin << " to " << expert_begin_[n + 1] << " on node " << nodes[n] << std::endl;
+            }
+            if (alloc_info.is_new_mem) {
+std::cout << "copying experts " << begin << " to " << expert_begin_[n + 1] << " from disk to hugepages on numa" << nodes[n] << std::endl;
+                memcpy(gate_proj_numa_[n], (uint8_t*)config_.gate_proj + begin * gate_expert_bytes_, expert_count * gate_expert_bytes_);
+                memcpy(up_proj_numa_[n], (uint8_t*)config_.up_proj + begin * up_expert_bytes_, expert_count * up_expert_bytes_);
+                memcpy(down_proj_numa_[n], (uint8_t*)config_.down_proj + begin * down_expert_bytes_, expert_count * down_expert_bytes_);
+            }
         }
-        if (alloc_info.is_new_mem) {
+        s_expert_order_.resize(config.routed_expert_num);
+        node_task_begin_.resize(node_num + 1);
+    } else {
+        int numa_nodes = numa_num_configured_nodes();
+        gate_proj_numa_.resize(numa_nodes);
+        up_proj_numa_.resize(numa_nodes);
+        down_proj_numa_.resize(numa_nodes);
+        size_t exp_inter_hidden_mul_ = (size_t)config.expert_num * config.intermediate_size * config.hidden_size;
+        for (int i = 0; i < numa_nodes; i++) {
+            gate_proj_numa_[i] = _numa_alloc_onnode(exp_inter_hidden_mul_* ggml_type_size(config.gate_type) / ggml_blck_size(config.gate_type), i, &alloc_info);
+            up_proj_numa_[i] = _numa_alloc_onnode(exp_inter_hidden_mul_* ggml_type_size(config.up_type) / ggml_blck_size(config.up_type), i, &alloc_info);
+            down_proj_numa_[i] = _numa_alloc_onnode(exp_inter_hidden_mul_* ggml_type_size(config.down_type) / ggml_blck_size(config.down_type), i, &alloc_info);
+            if (!gate_proj_numa_[i]) {
+                std::cout << "Memory allocation failed for gate_proj_numa_ on node " << i << std::endl;
+            }
+            if (!up_proj_numa_[i]) {
+                std::cout << "Memory allocation failed for up_proj_numa_ on node " << i << std::endl;
+            }
+            if (!down_proj_numa_[i]) {
+                std::cout << "Memory allocation failed for down_proj_numa_ on node " << i << std::endl;
+            }
+            if (alloc_info.is_new_mem) {
 if (i == 0) {
 std::cout << "copying from disk to hugepages on numa" << i << std::endl;
 } else {
 std::cout << "copying from hugepages on numa " << (i - 1) << " to numa" << i << std::endl;
 }
-        memcpy(gate_proj_numa_[i], gate_proj_, exp_inter_hidden_mul_* ggml_type_size(config.gate_type) / ggml_blck_size(config.gate_type));
-        memcpy(up_proj_numa_[i], up_proj_, exp_inter_hidden_mul_* ggml_type_size(config.up_type) / ggml_blck_size(config.up_type));
-        memcpy(down_proj_numa_[i], down_proj_, exp_inter_hidden_mul_* ggml_type_size(config.down_type) / ggml_blck_size(config.down_type));
+            memcpy(gate_proj_numa_[i], gate_proj_, exp_inter_hidden_mul_* ggml_type_size(config.gate_type) / ggml_blck_size(config.gate_type));
+            memcpy(up_proj_numa_[i], up_proj_, exp_inter_hidden_mul_* ggml_type_size(config.up_type) / ggml_blck_size(config.up_type));
+            memcpy(down_proj_numa_[i], down_proj_, exp_inter_hidden_mul_* ggml_type_size(config.down_type) / ggml_blck_size(config.down_type));
+            }
+            gate_proj_ = gate_proj_numa_[i];
+            up_proj_ = up_proj_numa_[i];
+            down_proj_ = down_proj_numa_[i];
         }
-        gate_proj_ = gate_proj_numa_[i];
-        up_proj_ = up_proj_numa_[i];
-        down_proj_ = down_proj_numa_[i];
     }
     #else
     size_t exp_inter_hidden_mul_ = (size_t)config.expert_num * config.intermediate_size * config.hidden_size;
@@ -243,6 +283,68 @@ MOE::~MOE() {
     shared_mem_buffer.dealloc(this);
 }
 
+size_t MOE::weight_bytes() {
+    size_t expert_bytes = gate_expert_bytes_ + up_expert_bytes_ + down_expert_bytes_;
+    #ifdef USE_NUMA
+    if (!config_.numa_partition) {
+        return gate_proj_numa_.size() * config_.expert_num * expert_bytes;
+    }
+    #endif
+    return config_.expert_num * expert_bytes;
+}
+
+#ifdef USE_NUMA
+// the weights of expert_id read by the calling thread: the copy of its node, or the one of the expert's home node
+uint8_t* MOE::numa_expert_proj(const std::vector<void*>& proj_numa, uint64_t expert_id, size_t expert_bytes) {
+    if (config_.numa_partition) {
+        int n = expert_node_[expert_id];
+        return (uint8_t*)proj_numa[n] + (expert_id - expert_begin_[n]) * expert_bytes;
+    }
+    return (uint8_t*)proj_numa[Backend::numa_node] + expert_id * expert_bytes;
+}
+#endif
+
+// nth tasks for each of the k selected experts, compute(expert_idx, ith); partitioned weights are read by the
+// threads of the expert's home node and out of range ids are skipped
+void MOE::selected_experts_job(int nth, int k, const uint64_t* expert_ids, Backend* backend, const std::function<void(int, int)>& compute) {
+    #ifdef USE_NUMA
+    if (config_.numa_partition) {
+        int node_num = expert_begin_.size() - 1;
+        int count = 0;
+        for (int n = 0; n < node_num; n++) {
+            node_task_begin_[n] = count * nth;
+            for (int i = 0; i < k; i++) {
+                if (expert_ids[i] < config_.expert_num && expert_node_[expert_ids[i]] == n) {
+                    s_expert_order_[count++] = i;
+                }
+            }
+        }
+        node_task_begin_[node_num] = count * nth;
+        backend->do_numa_work_stealing_job(node_task_begin_, nullptr, [&](int task_id) {
+            compute(s_expert_order_[task_id / nth], task_id % nth);
+        }, nullptr);
+        return;
+    }
+    #endif
+    backend->do_work_stealing_job(nth * k, nullptr, [&](int task_id) {
+        compute(task_id / nth, task_id % nth);
+    }, nullptr);
+}
+
+// nth tasks for each expert, expert-major
+void MOE::all_experts_job(int nth, Backend* backend, const std::function<void(int)>& compute) {
+    #ifdef USE_NUMA
+    if (config_.numa_partition) {
+        for (size_t n = 0; n < expert_begin_.size(); n++) {
+            node_task_begin_[n] = expert_begin_[n] * nth;
+        }
+        backend->do_numa_work_stealing_job(node_task_begin_, nullptr, compute, nullptr);
+        return;
+    }
+    #endif
+    backend->do_work_stealing_job(nth * config_.expert_num, nullptr, compute, nullptr);
+}
+
 void MOE::warm_up(Backend* backend) {
     std::vector<float> input_fp32(config_.hidden_size);
     std::vector<uint8_t> input(config_.hidden_size * ggml_type_size(config_.hidden_type) / ggml_blck_size(config_.hidden_type));
@@ -288,13 +390,15 @@ void MOE::forward_one(int k, const uint64_t* expert_ids, const float* weights, c
         }
     }
     int nth = config_.intermediate_size / config_.stride;
-    backend->do_work_stealing_job(nth * k, nullptr, [&](int task_id) {
-        int expert_idx = task_id / nth;
+    selected_experts_job(nth, k, expert_ids, backend, [&](int expert_idx, int ith) {
         uint64_t expert_id = expert_ids[expert_idx];
-        int ith = task_id % nth;
+        if (expert_id >= config_.expert_num) {
+            // out of range ids (e.g. -1) mark experts computed elsewhere, they contribute nothing here
+            return;
+        }
         
         #ifdef USE_NUMA
-        void* gate_proj_ptr = (uint8_t*)gate_proj_numa_[Backend::numa_node] + (expert_id * config_.intermediate_size + ith * config_.stride) * config_.hidden_size * ggml_type_size(config_.gate_type) / ggml_blck_size(config_.gate_type);
+        void* gate_proj_ptr = numa_expert_proj(gate_proj_numa_, expert_id, gate_expert_bytes_) + ith * config_.stride * config_.hidden_size * ggml_type_size(config_.gate_type) / ggml_blck_size(config_.gate_type);
         #else
         void* gate_proj_ptr = (uint8_t*)gate_proj_ + (expert_id * config_.intermediate_size + ith * config_.stride) * config_.hidden_size * ggml_type_size(config_.gate_type) / ggml_blck_size(config_.gate_type);
         #endif
@@ -303,7 +407,7 @@ void MOE::forward_one(int k, const uint64_t* expert_ids, const float* weights, c
         llamafile_sgemm(config_.stride, 1, config_.hidden_size / ggml_blck_size(config_.gate_type), gate_proj_ptr, config_.hidden_size / ggml_blck_size(config_.gate_type), gate_input_ptr, config_.hidden_size / ggml_blck_size(config_.gate_type), gate_output_ptr, config_.stride, 0, 1, GGML_TASK_TYPE_COMPUTE, config_.gate_type, ggml_internal_get_type_traits(config_.gate_type).vec_dot_type, GGML_TYPE_F32, GGML_PREC_DEFAULT);
 
         #ifdef USE_NUMA
-        void* up_proj_ptr = (uint8_t*)up_proj_numa_[Backend::numa_node] + (expert_id * config_.intermediate_size + ith * config_.stride) * config_.hidden_size * ggml_type_size(config_.up_type) / ggml_blck_size(config_.up_type);
+        void* up_proj_ptr = numa_expert_proj(up_proj_numa_, expert_id, up_expert_bytes_) + ith * config_.stride * config_.hidden_size * ggml_type_size(config_.up_type) / ggml_blck_size(config_.up_type);
         #else
         void* up_proj_ptr = (uint8_t*)up_proj_ + (expert_id * config_.intermediate_size + ith * config_.stride) * config_.hidden_size * ggml_type_size(config_.up_type) / ggml_blck_size(config_.up_type);
         #endif
@@ -318,13 +422,46 @@ void MOE::forward_one(int k, const uint64_t* expert_ids, const float* weights, c
             void* down_input_ptr = s_down_input_[expert_idx] + ith * config_.stride * ggml_type_size(ggml_internal_get_type_traits(config_.down_type).vec_dot_type) / ggml_blck_size(ggml_internal_get_type_traits(config_.down_type).vec_dot_type);
             from_float(intermediate_fp32_ptr, down_input_ptr, config_.stride, ggml_internal_get_type_traits(config_.down_type).vec_dot_type);
         }
-    }, nullptr);
+    });
     if (config_.stride % ggml_blck_size(ggml_internal_get_type_traits(config_.down_type).vec_dot_type) != 0) {
         for (int i = 0; i < k; i++) {
             from_float(s_intermediate_fp32_[i], s_down_input_[i], config_.intermediate_size, ggml_internal_get_type_traits(config_.down_type).vec_dot_type);
         }
     }
     nth = config_.hidden_size / config_.stride;
+    #ifdef USE_NUMA
+    if (config_.numa_partition) {
+        // down projection of each expert on its home node, then the weighted sum
+        selected_experts_job(nth, k, expert_ids, backend, [&](int expert_idx, int ith) {
+            void* down_proj_ptr = numa_expert_proj(down_proj_numa_, expert_ids[expert_idx], down_expert_bytes_) + ith * config_.stride * config_.intermediate_size * ggml_type_size(config_.down_type) / ggml_blck_size(config_.down_type);
+            float* down_output_ptr = s_down_output_[expert_idx] + ith * config_.stride;
+            llamafile_sgemm(config_.stride, 1, config_.intermediate_size / ggml_blck_size(config_.down_type), down_proj_ptr, config_.intermediate_size / ggml_blck_size(config_.down_type), s_down_input_[expert_idx], config_.intermediate_size / ggml_blck_size(config_.down_type), down_output_ptr, config_.stride, 0, 1, GGML_TASK_TYPE_COMPUTE, config_.down_type, ggml_internal_get_type_traits(config_.down_type).vec_dot_type, GGML_TYPE_F32, GGML_PREC_DEFAULT);
+        });
+        backend->do_work_stealing_job(nth, nullptr, [&](int task_id) {
+            int ith = task_id;
+            for (int i = ith * config_.stride; i < (ith + 1) * config_.stride; i++) {
+                s_output_fp32_[i] = 0;
+            }
+            for (int expert_idx = 0; expert_idx < k; expert_idx++) {
+                if (expert_ids[expert_idx] >= config_.expert_num) {
+                    continue;
+                }
+                for (int i = ith * config_.stride; i < (ith + 1) * config_.stride; i++) {
+                    s_output_fp32_[i] += s_down_output_[expert_idx][i] * weights[expert_idx];
+                }
+            }
+            if (config_.stride % ggml_blck_size(config_.hidden_type) == 0) {
+                float* output_fp32_ptr = s_output_fp32_ + ith * config_.stride;
+                void* output_ptr = (uint8_t*)output + ith * config_.stride * ggml_type_size(config_.hidden_type) / ggml_blck_size(config_.hidden_type);
+                from_float(output_fp32_ptr, output_ptr, config_.stride, config_.hidden_type);
+            }
+        }, nullptr);
+        if (config_.stride % ggml_blck_size(config_.hidden_type) != 0) {
+            from_float(s_output_fp32_, output, config_.hidden_size, config_.hidden_type);
+        }
+        return;
+    }
+    #endif
     backend->do_work_stealing_job(nth, nullptr, [&](int task_id) {
         int ith = task_id;
         for (int i = ith * config_.stride; i < (ith + 1) * config_.stride; i++) {
@@ -332,9 +469,12 @@ void MOE::forward_one(int k, const uint64_t* expert_ids, const float* weights, c
         }
         for (int expert_idx = 0; expert_idx < k; expert_idx++) {
             uint64_t expert_id = expert_ids[expert_idx];
+            if (expert_id >= config_.expert_num) {
+                continue;
+            }
 
             #ifdef USE_NUMA
-            void* down_proj_ptr = (uint8_t*)down_proj_numa_[Backend::numa_node] + (expert_id * config_.hidden_size + ith * config_.stride) * config_.intermediate_size * ggml_type_size(config_.down_type) / ggml_blck_size(config_.down_type);
+            void* down_proj_ptr = numa_expert_proj(down_proj_numa_, expert_id, down_expert_bytes_) + ith * config_.stride * config_.intermediate_size * ggml_type_size(config_.down_type) / ggml_blck_size(config_.down_type);
             #else
             void* down_proj_ptr = (uint8_t*)down_proj_ + (expert_id * config_.hidden_size + ith * config_.stride) * config_.intermediate_size * ggml_type_size(config_.down_type) / ggml_blck_size(config_.down_type);
             #endif
@@ -362,6 +502,9 @@ void MOE::forward_many(int qlen, int k, const uint64_t* expert_ids, const float*
     }
     for (int i = 0; i < qlen; i++) {
         for (int j = 0; j < k; j++) {
+            if (expert_ids[i * k + j] >= config_.expert_num) {
+                continue;
+            }
             m_local_pos_[i][j] = m_local_num_[expert_ids[i * k + j]]++;
         }
     }
@@ -402,19 +545,22 @@ void MOE::forward_many(int qlen, int k, const uint64_t* expert_ids, const float*
             }
         }
         for (int j = 0; j < k; j++) {
+            if (expert_ids[i * k + j] >= config_.expert_num) {
+                continue;
+            }
             memcpy(m_local_gate_input_ptr_[expert_ids[i * k + j]] + m_local_pos_[i][j] * config_.hidden_size * ggml_type_size(ggml_internal_get_type_traits(config_.gate_type).vec_dot_type) / ggml_blck_size(ggml_internal_get_type_traits(config_.gate_type).vec_dot_type), gate_input_ptr, config_.hidden_size * ggml_type_size(ggml_internal_get_type_traits(config_.gate_type).vec_dot_type) / ggml_blck_size(ggml_internal_get_type_traits(config_.gate_type).vec_dot_type));
             memcpy(m_local_up_input_ptr_[expert_ids[i * k + j]] + m_local_pos_[i][j] * config_.hidden_size * ggml_type_size(ggml_internal_get_type_traits(config_.up_type).vec_dot_type) / ggml_blck_size(ggml_internal_get_type_traits(config_.up_type).vec_dot_type), up_input_ptr, config_.hidden_size * ggml_type_size(ggml_internal_get_type_traits(config_.up_type).vec_dot_type) / ggml_blck_size(ggml_internal_get_type_traits(config_.up_type).vec_dot_type));
         }
     }, nullptr);
     int stride = QK_K;
     int nth = config_.intermediate_size / stride;
-    backend->do_work_stealing_job(nth * config_.expert_num, nullptr, [&](int task_id) {
+    all_experts_job(nth, backend, [&](int task_id) {
         uint64_t expert_idx = task_id / nth;
         int ith = task_id % nth;
         void* gate_input_ptr = m_local_gate_input_ptr_[expert_idx];
 
         #ifdef USE_NUMA
-        void* gate_proj_ptr = (uint8_t*)gate_proj_numa_[Backend::numa_node] + (expert_idx * config_.intermediate_size + ith * stride) * config_.hidden_size * ggml_type_size(config_.gate_type) / ggml_blck_size(config_.gate_type);
+        void* gate_proj_ptr = numa_expert_proj(gate_proj_numa_, expert_idx, gate_expert_bytes_) + ith * stride * config_.hidden_size * ggml_type_size(config_.gate_type) / ggml_blck_size(config_.gate_type);
         #else
         void* gate_proj_ptr = (uint8_t*)gate_proj_ + (expert_idx * config_.intermediate_size + ith * stride) * config_.hidden_size * ggml_type_size(config_.gate_type) / ggml_blck_size(config_.gate_type);
         #endif
@@ -424,7 +570,7 @@ void MOE::forward_many(int qlen, int k, const uint64_t* expert_ids, const float*
         void* up_input_ptr = m_local_up_input_ptr_[expert_idx];
 
         #ifdef USE_NUMA
-        void* up_proj_ptr = (uint8_t*)up_proj_numa_[Backend::numa_node] + (expert_idx * config_.intermediate_size + ith * stride) * config_.hidden_size * ggml_type_size(config_.up_type) / ggml_blck_size(config_.up_type);
+        void* up_proj_ptr = numa_expert_proj(up_proj_numa_, expert_idx, up_expert_bytes_) + ith * stride * config_.hidden_size * ggml_type_size(config_.up_type) / ggml_blck_size(config_.up_type);
         #else
         void* up_proj_ptr = (uint8_t*)up_proj_ + (expert_idx * config_.intermediate_size + ith * stride) * config_.hidden_size * ggml_type_size(config_.up_type) / ggml_blck_size(config_.up_type);
         #endif
@@ -439,28 +585,31 @@ void MOE::forward_many(int qlen, int k, const uint64_t* expert_ids, const float*
             void* down_input_ptr = m_local_down_input_ptr_[expert_idx] + i * config_.intermediate_size * ggml_type_size(ggml_internal_get_type_traits(config_.down_type).vec_dot_type) / ggml_blck_size(ggml_internal_get_type_traits(config_.down_type).vec_dot_type) + ith * stride * ggml_type_size(ggml_internal_get_type_traits(config_.down_type).vec_dot_type) / ggml_blck_size(ggml_internal_get_type_traits(config_.down_type).vec_dot_type);
             from_float(intermediate_fp32_ptr, down_input_ptr, stride, ggml_internal_get_type_traits(config_.down_type).vec_dot_type);
         }
-    }, nullptr);
+    });
     stride = QK_K;
     nth = config_.hidden_size / stride;
-    backend->do_work_stealing_job(nth * config_.expert_num, nullptr, [&](int task_id) {
+    all_experts_job(nth, backend, [&](int task_id) {
         uint64_t expert_idx = task_id / nth;
         int ith = task_id % nth;
         void* down_input_ptr = m_local_down_input_ptr_[expert_idx];
         
         #ifdef USE_NUMA
-        void* down_proj_ptr = (uint8_t*)down_proj_numa_[Backend::numa_node] + (expert_idx * config_.hidden_size + ith * stride) * config_.intermediate_size * ggml_type_size(config_.down_type) / ggml_blck_size(config_.down_type);
+        void* down_proj_ptr = numa_expert_proj(down_proj_numa_, expert_idx, down_expert_bytes_) + ith * stride * config_.intermediate_size * ggml_type_size(config_.down_type) / ggml_blck_size(config_.down_type);
         #else
         void* down_proj_ptr = (uint8_t*)down_proj_ + (expert_idx * config_.hidden_size + ith * stride) * config_.intermediate_size * ggml_type_size(config_.down_type) / ggml_blck_size(config_.down_type);
         #endif
 
         float* down_output_ptr = m_local_down_output_ptr_[expert_idx] + ith * stride;
         llamafile_sgemm(stride, m_local_num_[expert_idx], config_.intermediate_size / ggml_blck_size(config_.down_type), down_proj_ptr, config_.intermediate_size / ggml_blck_size(config_.down_type), down_input_ptr, config_.intermediate_size / ggml_blck_size(config_.down_type), down_output_ptr, config_.hidden_size, 0, 1, GGML_TASK_TYPE_COMPUTE, config_.down_type, ggml_internal_get_type_traits(config_.down_type).vec_dot_type, GGML_TYPE_F32, GGML_PREC_DEFAULT);
-    }, nullptr);
+    });
     backend->do_work_stealing_job(qlen, nullptr, [&](int i) {
         for (int e = 0; e < config_.hidden_size; e++) {
             m_output_fp32_[i][e] = 0;
         }
         for (int j = 0; j < k; j++) {
+            if (expert_ids[i * k + j] >= config_.expert_num) {
+                continue;
+            }
             for (int e = 0; e < config_.hidden_size; e++) {
                 m_output_fp32_[i][e] += m_local_down_output_ptr_[expert_ids[i * k + j]][m_local_pos_[i][j] * config_.hidden_size + e] * weights[i * k + j];
             }
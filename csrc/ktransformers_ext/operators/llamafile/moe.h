@@ -39,6 +39,8 @@ struct MOEConfig {
     ggml_type up_type;
     ggml_type down_type;
     ggml_type hidden_type;
+    // under USE_NUMA, each expert on one numa node instead of a copy of all of them on every node
+    bool numa_partition = false;
 
     MOEConfig() {}
 
@@ -54,6 +56,7 @@ class MOE {
     void forward_one(int k, const uint64_t* expert_ids, const float* weights, const void* input, void* output, Backend* backend);
     void forward_many(int qlen, int k, const uint64_t* expert_ids, const float* weights, const void* input, void* output, Backend* backend);
     void forward(int qlen, int k, const uint64_t* expert_ids, const float* weights, const void* input, void* output, int* batch_size_tensor, Backend* backend);
+    size_t weight_bytes();
 
    private:
     MOEConfig config_;
@@ -61,12 +64,27 @@ class MOE {
     void* up_proj_;    // [expert_num * intermediate_size * hidden_size ( /32 if quantized)]
     void* down_proj_;  // [expert_num * hidden_size * intermediate_size ( /32 if quantized)]
 
+    size_t gate_expert_bytes_;
+    size_t up_expert_bytes_;
+    size_t down_expert_bytes_;
+
     #ifdef USE_NUMA
+    // replicated: by numa node, all the experts
+    // partitioned: by numa_node_ids index n, experts [expert_begin_[n], expert_begin_[n + 1]) only
     std::vector<void*> gate_proj_numa_;  // [numa_num, expert_num * intermediate_size * hidden_size ( /32 if quantized)]
     std::vector<void*> up_proj_numa_;    // [numa_num, expert_num * intermediate_size * hidden_size ( /32 if quantized)]
     std::vector<void*> down_proj_numa_;  // [numa_num, expert_num * hidden_size * intermediate_size ( /32 if quantized)]
+    std::vector<int> expert_begin_;      // [numa_num + 1]
+    std::vector<int> expert_node_;       // [expert_num]
+    std::vector<int> s_expert_order_;    // [routed_expert_num], selected experts grouped by home node
+    std::vector<int> node_task_begin_;   // [numa_num + 1]
+
+    uint8_t* numa_expert_proj(const std::vector<void*>& proj_numa, uint64_t expert_id, size_t expert_bytes);
     #endif
 
+    void selected_experts_job(int nth, int k, const uint64_t* expert_ids, Backend* backend, const std::function<void(int, int)>& compute);
+    void all_experts_job(int nth, Backend* backend, const std::function<void(int)>& compute);
+
     float* s_input_fp32_;                      // [hidden_size]
     uint8_t* s_gate_input_;                    // [hidden_size * ggml_type_size(ggml_internal_get_type_traits(gate_type).vec_dot_type) / ggml_blck_size(ggml_internal_get_type_traits(gate_type).vec_dot_type)]
     uint8_t* s_up_input_;                      // [hidden_size * ggml_type_size(ggml_internal_get_type_traits(up_type).vec_dot_type) / ggml_blck_size(ggml_internal_get_type_traits(up_type).vec_dot_type)]
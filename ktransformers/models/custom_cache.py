@@ -55,12 +55,16 @@ class StaticCache(transformers.StaticCache):
             # TODO: for deepseek, cache_shape is different whether using Absorbed MLA, check it automatically
             self.page_size = 64
             self.max_pages = (self.max_cache_len + self.page_size - 1) // self.page_size
-            latent_shape = (self.max_pages, self.page_size, 1, config.kv_lora_rank + config.qk_rope_head_dim)
+            # every batch slot owns max_pages consecutive pages, matching the rows of the page table below
+            latent_shape = (max_batch_size * self.max_pages, self.page_size, 1, config.kv_lora_rank + config.qk_rope_head_dim)
             self.kv_lora_rank = config.kv_lora_rank
             self.qk_rope_head_dim = config.qk_rope_head_dim
             # TODO: support real page table
             self.page_table_map = dict()
             self.page_table_list = []
+            # page table of a batched decode step, row i holds the pages of the slot decoded in row i
+            self.batch_page_table_map = dict()
+            self.batch_page_table_list = []
             for idx in range(config.num_hidden_layers):
                 if isinstance(device, dict):
                     target_device = device[f"blk.{idx}.self_attn"]["generate_device"]
@@ -72,8 +76,10 @@ class StaticCache(transformers.StaticCache):
                     for seq_id in range(max_batch_size):
                         page_table[seq_id, :] = torch.arange(seq_id * self.max_pages, seq_id * self.max_pages + self.max_pages, dtype=torch.int32, device=target_device)
                     self.page_table_map[target_device] = page_table
+                    self.batch_page_table_map[target_device] = page_table.clone()
                     
                 self.page_table_list.append(self.page_table_map[target_device])
+                self.batch_page_table_list.append(self.batch_page_table_map[target_device])
                     
             self.is_MLA = True
             self.is_page = True
@@ -82,8 +88,12 @@ class StaticCache(transformers.StaticCache):
             value_shape = cache_shape
             self.is_MLA = False
 
-        self.past_tokens = []
         self.num_hidden_layers = config.num_hidden_layers
+        # seen tokens per slot and layer, past_tokens is the list of the slot single sequence forwards run on
+        self.slot_past_tokens = [[0] * self.num_hidden_layers for _ in range(max_batch_size)]
+        self.active_slot = 0
+        self.past_tokens = self.slot_past_tokens[0]
+        self.batch_decoding = False
         for idx in range(self.num_hidden_layers):
             # Note: `mark_static_address` is used to tag the cache as an fixed data pointer, preventing cuda graph
             # breaks when updating the cache.
@@ -104,7 +114,6 @@ class StaticCache(transformers.StaticCache):
                 
             self.key_cache.append(new_layer_key_cache)
             self.value_cache.append(new_layer_value_cache)
-            self.past_tokens.append(0)
 
     def update(
         self,
@@ -137,12 +146,22 @@ class StaticCache(transformers.StaticCache):
         self.past_tokens[layer_idx] += cache_position.size(0)
         #print(cache_position)
         if self.is_MLA:
-            page_idx = cache_position // self.page_size
+            if self.batch_decoding:
+                # one token per row, cache_position holds the position of each row inside its own slot
+                page_table = self.batch_page_table_list[layer_idx]
+                rows = torch.arange(cache_position.size(0), device=page_table.device)
+                page_idx = page_table[rows, cache_position // self.page_size]
+                page_offset = cache_position % self.page_size
+                k_out[page_idx, page_offset, :, :self.kv_lora_rank] = key_states.reshape(-1, 1, self.kv_lora_rank)
+                k_out[page_idx, page_offset, :, self.kv_lora_rank:] = value_states.reshape(-1, 1, self.qk_rope_head_dim)
+                return k_out, page_table
+            page_idx = cache_position // self.page_size + self.active_slot * self.max_pages
             page_offset = cache_position % self.page_size
-            # key shape (self.max_pages, self.page_size, 1, config.kv_lora_rank + config.qk_rope_head_dim)
+            # key shape (max_batch_size * self.max_pages, self.page_size, 1, config.kv_lora_rank + config.qk_rope_head_dim)
             k_out[page_idx, page_offset, :, :self.kv_lora_rank] = key_states
             k_out[page_idx, page_offset, :, self.kv_lora_rank:] = value_states
-            return k_out, self.page_table_list[layer_idx]
+            # single sequence attention indexes pages from 0, hand it the pages of the active slot only
+            return self.slot_pages(k_out), self.page_table_list[layer_idx]
         else:
             k_out[:, :, cache_position] = key_states
             v_out[:, :, cache_position] = value_states
@@ -174,13 +193,67 @@ class StaticCache(transformers.StaticCache):
             self.key_cache[layer_idx].zero_()
             if self.value_cache[layer_idx] is not None:
                 self.value_cache[layer_idx].zero_()
-            self.past_tokens[layer_idx] = 0
+        for past_tokens in self.slot_past_tokens:
+            past_tokens[:] = [0] * self.num_hidden_layers
+
+    def slot_pages(self, k_cache: torch.Tensor) -> torch.Tensor:
+        """View of the latent pages owned by the active slot."""
+        return k_cache[self.active_slot * self.max_pages:(self.active_slot + 1) * self.max_pages]
+
+    def set_active_slot(self, slot: int):
+        """Route single sequence forwards (prefill, batch size 1 decode) and the seq length bookkeeping to one slot."""
+        assert 0 <= slot < self.max_batch_size
+        self.active_slot = slot
+        self.past_tokens = self.slot_past_tokens[slot]
+
+    def begin_batch_decode(self, slots: List[int]):
+        """Decode one token for each of slots, row i of the batch reads and writes the pages of slots[i]."""
+        assert self.is_MLA, "batched decode needs the paged MLA cache"
+        for device, page_table in self.page_table_map.items():
+            index = torch.tensor(slots, dtype=torch.long, device=device)
+            self.batch_page_table_map[device][:len(slots)] = page_table[index]
+        self.batch_decoding = True
+        # park the single sequence counters, a captured step may add to and take from them
+        self.past_tokens = [0] * self.num_hidden_layers
+
+    def end_batch_decode(self, slots: List[int]):
+        self.batch_decoding = False
+        for slot in set(slots):
+            past_tokens = self.slot_past_tokens[slot]
+            for layer_idx in range(self.num_hidden_layers):
+                past_tokens[layer_idx] += 1
+        self.past_tokens = self.slot_past_tokens[self.active_slot]
+
+    def read_tokens(self, begin: int, end: int) -> List[torch.Tensor]:
+        """KV of positions [begin, end) of the active slot, one tensor per layer with positions on dim 0."""
+        tokens = []
+        for layer_idx in range(self.num_hidden_layers):
+            if self.is_MLA:
+                k_cache = self.slot_pages(self.key_cache[layer_idx])
+                tokens.append(k_cache.view(-1, k_cache.shape[-1])[begin:end])
+            else:
+                k = self.key_cache[layer_idx][self.active_slot, :, begin:end]
+                v = self.value_cache[layer_idx][self.active_slot, :, begin:end]
+                tokens.append(torch.stack([k, v], dim=1).transpose(0, 2))
+        return tokens
+
+    def write_tokens(self, begin: int, tokens: List[torch.Tensor]):
+        """Inverse of read_tokens, positions from begin of the active slot are overwritten."""
+        for layer_idx, layer_tokens in enumerate(tokens):
+            end = begin + layer_tokens.shape[0]
+            if self.is_MLA:
+                k_cache = self.slot_pages(self.key_cache[layer_idx])
+                k_cache.view(-1, k_cache.shape[-1])[begin:end].copy_(layer_tokens, non_blocking=True)
+            else:
+                kv = layer_tokens.transpose(0, 2)
+                self.key_cache[layer_idx][self.active_slot, :, begin:end].copy_(kv[:, 0], non_blocking=True)
+                self.value_cache[layer_idx][self.active_slot, :, begin:end].copy_(kv[:, 1], non_blocking=True)
 
     def remove_suffix(self, start_pos):
         for layer_idx in range(len(self.key_cache)):
             # In-place ops prevent breaking the static address
             if self.is_MLA:
-                k_cache = self.key_cache[layer_idx]
+                k_cache = self.slot_pages(self.key_cache[layer_idx])
                 k_cache.view(-1, k_cache.shape[-1])[start_pos:].zero_()
             else:
                 self.key_cache[layer_idx][..., start_pos:, :].zero_()
@@ -56,9 +56,10 @@ class KDeepseekV2ForCausalLM(DeepseekV2PreTrainedModel):
     def batch_embeddings(self, batch: ForwardBatchInput, device="cuda:0"):
         features = []
         for i in range(batch.batch_size):
-            tokens = batch.minibatch.tokens.contiguous()
+            # host copy of the tokens avoids a device->host sync before every step
+            tokens = batch.minibatch.tokens_cpu.contiguous()
             feature = (
-                self.model.embed_tokens(tokens.to(torch.device('cpu')))
+                self.model.embed_tokens(tokens)
                 .to(torch.bfloat16)
                 .to(device=device)
             )
@@ -609,7 +609,9 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
                 **kwargs,
             )
         else:
-            if flashinfer_enabled:
+            # the flashinfer wrapper is planned for a single sequence, batched decode goes through the triton kernel
+            # which reads one page table row per sequence
+            if flashinfer_enabled and not getattr(past_key_value, "batch_decoding", False):
                 return self.forward_linux_flashinfer(
                     hidden_states,
                     attention_mask,
@@ -17,6 +17,7 @@ LastEditTime : 2024-08-26 23:25:24
 Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
 """
 import sys, os
+from contextlib import contextmanager
 from typing import Any
 import torch
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "ktransformers_ext", "build"))
@@ -749,3 +750,90 @@ class CPUInfer:
 
 
         
+
+    @classmethod
+    @contextmanager
+    def task_graph(cls):
+        """
+        Wrap a CUDA graph capture: the CPU tasks submitted with submit_with_cuda_stream inside are built once and
+        replayed by pointer through the task queue, instead of being rebuilt by a host callback at every replay.
+        """
+        if cls.cpuinfer is None:
+            yield None
+            return
+        graph_id = cls.cpuinfer.begin_graph()
+        try:
+            yield graph_id
+        finally:
+            cls.cpuinfer.end_graph()
+
+    @classmethod
+    def reset_stats(cls):
+        if cls.cpuinfer is not None:
+            cls.cpuinfer.reset_stats()
+
+    @classmethod
+    def report_string(cls) -> str:
+        """Queue wait (submit to start) and execute time of the CPU tasks, in total and per captured task graph."""
+        if cls.cpuinfer is None:
+            return "cpuinfer not started"
+
+        def line(name, times):
+            count = max(times.count, 1)
+            return (f"{name}: {times.count} tasks, wait avg {times.wait_ns / count / 1000:.1f}us "
+                    f"max {times.max_wait_ns / 1000:.1f}us, exec avg {times.exec_ns / count / 1000:.1f}us "
+                    f"max {times.max_exec_ns / 1000:.1f}us")
+
+        lines = [line("all", cls.cpuinfer.stats())]
+        for graph_id in range(cls.cpuinfer.graph_count()):
+            nodes = cls.cpuinfer.graph_stats(graph_id)
+            replays = min((times.count for times in nodes), default=0)
+            wait = sum(times.wait_ns for times in nodes) / max(replays, 1) / 1000
+            execute = sum(times.exec_ns for times in nodes) / max(replays, 1) / 1000
+            lines.append(f"graph {graph_id}: {len(nodes)} tasks, {replays} replays, "
+                         f"per replay wait {wait:.1f}us exec {execute:.1f}us")
+        return "\n".join(lines)
+
+
+class PinnedBufferPool:
+    """
+    Pinned host buffers in power-of-two size classes, shared by the operators that stage tensors for CPUInfer tasks.
+    A buffer goes back to its class once the copy out of it is enqueued; the event recorded then makes the stream of
+    the next user wait for that copy, so the reuse is safe across streams and devices.
+    Requests are limited to max_buffer_bytes, callers stage larger tensors in pieces, and at most max_cached_bytes
+    are kept for reuse, released buffers past that are dropped.
+    """
+    def __init__(self, max_buffer_bytes: int = 256 << 20, max_cached_bytes: int = 1 << 30):
+        self.max_buffer_bytes = max_buffer_bytes
+        self.max_cached_bytes = max_cached_bytes
+        self.cached_bytes = 0
+        self.free = {}  # size class in bytes -> [(uint8 buffer, event or None)]
+
+    def acquire(self, nbytes: int, device: torch.device | None = None) -> torch.Tensor:
+        assert nbytes <= self.max_buffer_bytes, f"{nbytes} bytes requested, pinned buffers are at most {self.max_buffer_bytes}"
+        size_class = 1 << (max(nbytes, 1) - 1).bit_length()
+        buffers = self.free.get(size_class)
+        if not buffers:
+            return torch.empty(size_class, dtype=torch.uint8, pin_memory=True)
+        self.cached_bytes -= size_class
+        buf, event = buffers.pop()
+        if event is not None and device is not None and device.type == "cuda":
+            torch.cuda.current_stream(device).wait_event(event)
+        elif event is not None:
+            event.synchronize()
+        return buf
+
+    def release(self, buf: torch.Tensor, device: torch.device | None = None):
+        if self.cached_bytes + buf.numel() > self.max_cached_bytes:
+            # pending copies out of a dropped buffer are tracked by the pinned allocator
+            return
+        self.cached_bytes += buf.numel()
+        event = None
+        if device is not None and device.type == "cuda":
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(device))
+        self.free.setdefault(buf.numel(), []).append((buf, event))
+
+    def clear(self):
+        self.free.clear()
+        self.cached_bytes = 0
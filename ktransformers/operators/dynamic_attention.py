@@ -174,6 +174,18 @@ class DynamicScaledDotProductAttention:
             (1, 1, self.q_head_num), device="cpu", dtype=torch.float32, pin_memory=True
         )
 
+        # pinned host staging of the kv swap and the importance upload, grown by reserve_staging and reused
+        self.staging_block_num = 0
+        self.k_cache_cpu = None
+        self.v_cache_cpu = None
+        self.importance_cache_cpu = None
+        self.past_len_cpu = torch.empty(
+            (1,), device="cpu", dtype=torch.int32, pin_memory=True
+        )
+        # the swap of a layer runs on its own stream, overlapping the attention of that layer and the next ones
+        self.swap_stream = torch.cuda.Stream(device)
+        self.swap_event = None
+
         if preselect_block == True:
             self.preselect_block_table = torch.zeros(
                 self.layer_num,
@@ -343,9 +355,7 @@ class DynamicScaledDotProductAttention:
             importance_cache = self.cache_importance.narrow(
                 0, 0, max_block_num * batch_size
             ).view(batch_size, max_block_num * self.block_size, self.q_head_num)
-            importance_cache_cpu = torch.empty_like(
-                importance_cache, device="cpu", pin_memory=True
-            )
+            importance_cache_cpu = self.staged_importance(importance_cache)
 
             importance_cache_cpu.copy_(importance_cache)
 
@@ -440,9 +450,7 @@ class DynamicScaledDotProductAttention:
         importance_cache = self.cache_importance.narrow(
             0, 0, max_block_num * batch_size
         ).view(batch_size, max_block_num * self.block_size, self.q_head_num)
-        importance_cache_cpu = torch.empty_like(
-            importance_cache, device="cpu", pin_memory=True
-        )
+        importance_cache_cpu = self.staged_importance(importance_cache)
 
         importance_cache_cpu.copy_(importance_cache)
 
@@ -462,21 +470,79 @@ class DynamicScaledDotProductAttention:
         self.cpu_infer.sync()
         importance_cache.zero_()
 
+    def reserve_staging(self, max_block_num: int):
+        """
+        Grow the pinned staging buffers to max_block_num blocks. They double up to block_num, so a long
+        chunked prefill pins host memory a handful of times instead of on every swap.
+        """
+        if max_block_num <= self.staging_block_num:
+            return
+        max_block_num = min(self.block_num, max(max_block_num, 2 * self.staging_block_num))
+        # the swap in flight still reads the old buffers
+        self.wait_swap()
+        tokens = max_block_num * self.block_size
+        self.k_cache_cpu = torch.empty(
+            (tokens, self.kv_head_num, self.head_dim),
+            device="cpu",
+            dtype=torch.float16,
+            pin_memory=True,
+        )
+        self.v_cache_cpu = torch.empty_like(self.k_cache_cpu, pin_memory=True)
+        self.importance_cache_cpu = torch.empty(
+            (tokens, self.q_head_num), device="cpu", dtype=torch.float16, pin_memory=True
+        )
+        self.staging_block_num = max_block_num
+
+    def staged_importance(self, importance_cache: torch.Tensor):
+        batch_size, tokens = importance_cache.size(0), importance_cache.size(1)
+        self.reserve_staging(batch_size * tokens // self.block_size)
+        return self.importance_cache_cpu.narrow(0, 0, batch_size * tokens).view(
+            importance_cache.shape
+        )
+
+    def wait_swap(self):
+        """Block until the swaps issued so far have reached the CPU kvcache."""
+        if self.swap_event is not None:
+            self.swap_event.synchronize()
+
     # key: [bsz, q_len, head_num, head_dim] float16
     # value: [bsz, q_len, head_num, head_dim] float16
-    def swap_in_and_swap_out(self, layer_idx, past_len, q_len, key, value):
+    def swap_in_and_swap_out(
+        self, layer_idx, past_len, q_len, key, value, past_len_host: int | None = None
+    ):
+        """
+        Store the new key/value into the CPU kvcache and return the GPU scratch holding the whole sequence.
+        Nothing blocks the host: the copies and the CPU task are ordered on swap_stream. Only a chunk with
+        past tokens waits for the swap, since it reads them back; otherwise the swap overlaps the attention,
+        and the next swap waits for it before reusing the scratch.
+        """
         batch_size = 1
-        max_seqs_len = past_len.max().item() + q_len
+        if past_len_host is None:
+            past_len_host = past_len.max()
+        # a cuda scalar waits for the current stream only, the swap stream keeps running
+        past_len_host = int(past_len_host)
+        max_seqs_len = past_len_host + q_len
         max_block_num = (max_seqs_len + self.block_size - 1) // self.block_size
+        self.reserve_staging(max_block_num * batch_size)
         k_cache = self.cache_key_states.narrow(0, 0, max_block_num * batch_size).view(
             batch_size, max_block_num * self.block_size, self.kv_head_num, self.head_dim
         )
         v_cache = self.cache_value_states.narrow(0, 0, max_block_num * batch_size).view(
             batch_size, max_block_num * self.block_size, self.kv_head_num, self.head_dim
         )
-
+        k_cache_cpu = self.k_cache_cpu.narrow(
+            0, 0, max_block_num * batch_size * self.block_size
+        ).view(k_cache.shape)
+        v_cache_cpu = self.v_cache_cpu.narrow(
+            0, 0, max_block_num * batch_size * self.block_size
+        ).view(v_cache.shape)
+
+        stream = torch.cuda.current_stream(self.device)
+        if self.swap_event is not None:
+            stream.wait_event(self.swap_event)
+        self.past_len_cpu.copy_(past_len, non_blocking=True)
         for batch_idx in range(batch_size):
-            offset = past_len[batch_idx]
+            offset = past_len_host
             width = q_len
             k_cache[batch_idx][offset : offset + width].copy_(
                 key[batch_idx].view(-1, self.kv_head_num, self.head_dim)
@@ -484,38 +550,39 @@ class DynamicScaledDotProductAttention:
             v_cache[batch_idx][offset : offset + width].copy_(
                 value[batch_idx].view(-1, self.kv_head_num, self.head_dim)
             )
-
-        k_cache_cpu = torch.empty_like(k_cache, device="cpu", pin_memory=True)
-        v_cache_cpu = torch.empty_like(v_cache, device="cpu", pin_memory=True)
-
-        k_cache_cpu.copy_(k_cache)
-        v_cache_cpu.copy_(v_cache)
-
-        cur_block_num = (
-            q_len + past_len[0].item() + self.block_size - 1
-        ) // self.block_size
-        block_table_cpu = self.prefix_block_table[:, :cur_block_num].to("cpu")
-        past_len_cpu = past_len.contiguous().to("cpu")
-
-        self.cpu_infer.submit(
-            self.local_thread.get_and_update_kvcache_fp16(
-                k_cache_cpu,
-                v_cache_cpu,
-                layer_idx,
-                block_table_cpu,
-                max_block_num,
-                past_len_cpu,
-                q_len,
+        ready = torch.cuda.Event()
+        ready.record(stream)
+
+        block_table_cpu = self.prefix_block_table[:, :max_block_num]
+        with torch.cuda.stream(self.swap_stream):
+            self.swap_stream.wait_event(ready)
+            k_cache_cpu.copy_(k_cache, non_blocking=True)
+            v_cache_cpu.copy_(v_cache, non_blocking=True)
+            self.cpu_infer.submit_with_cuda_stream(
+                self.swap_stream.cuda_stream,
+                self.local_thread.get_and_update_kvcache_fp16(
+                    k_cache_cpu,
+                    v_cache_cpu,
+                    layer_idx,
+                    block_table_cpu,
+                    max_block_num,
+                    self.past_len_cpu,
+                    q_len,
+                ),
             )
-        )
-
-        self.cpu_infer.sync()
-        k_cache.copy_(k_cache_cpu)
-        v_cache.copy_(v_cache_cpu)
+            self.cpu_infer.sync_with_cuda_stream(self.swap_stream.cuda_stream)
+            if past_len_host > 0:
+                k_cache.copy_(k_cache_cpu, non_blocking=True)
+                v_cache.copy_(v_cache_cpu, non_blocking=True)
+            self.swap_event = torch.cuda.Event()
+            self.swap_event.record(self.swap_stream)
+        if past_len_host > 0:
+            stream.wait_event(self.swap_event)
 
         return k_cache, v_cache
 
     def calc_anchor(self, cache_seqlens: int):
+        self.wait_swap()
         cur_block_num = (cache_seqlens + self.block_size - 1) // self.block_size
         block_table_cpu = self.prefix_block_table[:, :cur_block_num].to("cpu")
         cache_seqlens_cpu = torch.tensor(
@@ -547,6 +614,7 @@ class DynamicScaledDotProductAttention:
         self.cpu_infer.sync()
 
     def clear_kvcache(self, cache_seqlens: int):
+        self.wait_swap()
         cur_block_num = (cache_seqlens + self.block_size - 1) // self.block_size
         block_table_cpu = self.prefix_block_table[:, :cur_block_num].to("cpu")
         cache_seqlens_cpu = torch.tensor(
@@ -645,6 +713,7 @@ class DynamicScaledDotProductAttention:
                 q_len,
                 key_states,
                 value_states,
+                past_len_host=past_len,
             )
 
             if last_chunk and (self.anchor_type == "DYNAMIC" or self.preselect_block):
@@ -667,6 +736,9 @@ class DynamicScaledDotProductAttention:
 
         elif mode == "generate":
             assert self.generate_token_idx >= 0
+            if self.swap_event is not None:
+                # the attention reads what the prefill swaps stored into the CPU kvcache
+                torch.cuda.current_stream("cuda").wait_event(self.swap_event)
             self.q_in_cpu.copy_(query_states, non_blocking=True)
             self.k_in_cpu.copy_(key_states, non_blocking=True)
             self.v_in_cpu.copy_(value_states, non_blocking=True)
@@ -760,6 +832,7 @@ class DynamicScaledDotProductAttention:
             return self.output_cuda.transpose(1, 2)
 
     def save(self, path: str, length: int):
+        self.wait_swap()
         cur_block_num = (length + self.block_size - 1) // self.block_size
         block_table_cpu = self.prefix_block_table[0, :cur_block_num].to("cpu")
         cache_seqlens_cpu = torch.tensor([length], device="cpu", dtype=torch.int32)
@@ -773,6 +846,7 @@ class DynamicScaledDotProductAttention:
         self.cpu_infer.sync()
 
     def load(self, path: str, length: int):
+        self.wait_swap()
         self.cpu_infer.submit(
             self.local_thread.load_kvcache(
                 path,
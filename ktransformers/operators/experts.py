@@ -28,6 +28,7 @@ from cpuinfer_ext.moe import MOEConfig, MOE
 import ctypes
 from ktransformers.util.custom_gguf import GGUFLoader
 from ktransformers.util.utils import InferenceState
+from ktransformers.util.expert_stats import EXPERT_STATS, configure_expert_stats
 from ktransformers.server.config.config import Config
 from transformers.activations import ACT2FN
 from transformers.configuration_utils import PretrainedConfig
@@ -41,6 +42,13 @@ def deduplicate_and_sort(lst):
     return sorted(set(lst))
 #cuda_graphs = [Config().chunk_size] 
 cuda_graphs = deduplicate_and_sort([1, 2, 3, Config().max_batch_size, 64, Config().chunk_size])
+configure_expert_stats(Config().expert_stats, Config().expert_stats_path)
+
+def record_routing(moe, topk_idx, bsz_tensor=None):
+    # counted under the key of the experts module, the key KExpertsHybrid looks its layer up with
+    if EXPERT_STATS.enabled:
+        EXPERT_STATS.record(getattr(moe.experts, "key", moe.key), topk_idx, moe.config.n_routed_experts, bsz_tensor)
+
 # class Base(BaseInjectedModule, ABC):
 class KExpertsBase(ABC):
     def __init__(self, key: str, gguf_loader: GGUFLoader, config: PretrainedConfig, orig_module: nn.Module, device: str = "cuda", **kwargs):
@@ -123,6 +131,7 @@ class KExpertsCPU(KExpertsBase):
     weights_cpu:Tensor = None
     output_cpu:Tensor = None
     output_gpu_map:dict = {} # Manage output tensor buffer on different gpu
+    prefill_buffers:dict = {} # pinned staging of the micro-batches of a pipelined prefill, by slot
     #stream_map:dict = {} # Manage cuda stream on different gpu
     # @TODO add yaml
     CPU_INFER = CPUInfer(Config().cpu_infer)
@@ -180,6 +189,7 @@ class KExpertsCPU(KExpertsBase):
             self.down_type,
             30, # TODO: get from model.dtype
         )
+        moe_config.numa_partition = Config().numa_partition
         # print(n_routed_experts, hidden_size, moe_intermediate_size)
         num_experts_per_tok = self.config.num_experts_per_tok
         self.moe = MOE(moe_config)
@@ -233,11 +243,57 @@ class KExpertsCPU(KExpertsBase):
             KExpertsCPU.output_gpu_map[self.out_device].copy_(KExpertsCPU.output_cpu, non_blocking=True)
             return KExpertsCPU.output_gpu_map[self.out_device]
 
-    def forward(self, input_tensor, expert_ids, weights, bsz_tensor=None, cuda_graph_idx=0):
+    def prefill_buffer(self, slot, num_tokens, dtype, device):
+        buf = KExpertsCPU.prefill_buffers.get(slot)
+        if buf is None or buf["input"].size(0) < num_tokens or buf["input"].dtype != dtype:
+            if buf is not None:
+                # the cpu may still read the old buffers from a host function the allocator does not track
+                torch.cuda.current_stream(device).synchronize()
+            capacity = 1 << (num_tokens - 1).bit_length()
+            num_experts_per_tok = self.config.num_experts_per_tok
+            buf = {
+                "input": torch.empty((capacity, self.config.hidden_size), dtype=dtype, pin_memory=True),
+                "expert_ids": torch.empty((capacity, num_experts_per_tok), dtype=torch.long, pin_memory=True),
+                "weights": torch.empty((capacity, num_experts_per_tok), dtype=torch.float32, pin_memory=True),
+                "output": torch.empty((capacity, self.config.hidden_size), dtype=dtype, pin_memory=True),
+                "bsz": torch.empty((1,), dtype=torch.int32, pin_memory=True),
+            }
+            KExpertsCPU.prefill_buffers[slot] = buf
+        return buf
+
+    def submit_prefill(self, input_tensor, expert_ids, weights, slot=0):
+        """
+        Stream ordered forward of the prefill micro-batch in slot, the cpu starts once the staging copies are done and
+        the host thread does not wait. sync_prefill(slot) must come before the next submission.
+        """
+        num_tokens = input_tensor.size(0)
+        buf = self.prefill_buffer(slot, num_tokens, input_tensor.dtype, input_tensor.device)
+        buf["input"][:num_tokens].copy_(input_tensor, non_blocking=True)
+        buf["expert_ids"][:num_tokens].copy_(expert_ids, non_blocking=True)
+        buf["weights"][:num_tokens].copy_(weights, non_blocking=True)
+        # through the stream as well, the cpu may still be reading bsz for the previous submission of slot
+        buf["bsz"].copy_(torch.full((1,), num_tokens, dtype=torch.int32, device=input_tensor.device), non_blocking=True)
+        self.cpu_infer.submit_with_cuda_stream(torch.cuda.current_stream(input_tensor.device).cuda_stream, self.moe.forward(num_tokens, expert_ids.size(-1), buf["expert_ids"].data_ptr(), buf["weights"].data_ptr(), buf["input"].data_ptr(), buf["output"].data_ptr(), buf["bsz"].data_ptr()))
+        return num_tokens
+
+    def sync_prefill(self, num_tokens, slot=0):
+        stream = torch.cuda.current_stream(self.out_device)
+        self.cpu_infer.sync_with_cuda_stream(stream.cuda_stream)
+        output = KExpertsCPU.prefill_buffers[slot]["output"][:num_tokens]
+        return output.to(self.out_device, non_blocking=True)
+
+    def forward(self, input_tensor, expert_ids, weights, bsz_tensor=None, cuda_graph_idx=None):
         # generate, capture and run cuda graph
         # print(expert_ids)
         if bsz_tensor is None:
             bsz_tensor = torch.tensor([input_tensor.size(0)], device=input_tensor.device, dtype=torch.int32)
+        if cuda_graph_idx is None:
+            # callers without their own graph bookkeeping capture one graph per batch size, use the staging
+            # buffers sized for it
+            if isinstance(cuda_graphs, list) and torch.cuda.is_current_stream_capturing():
+                cuda_graph_idx = cuda_graphs.index(input_tensor.size(0))
+            else:
+                cuda_graph_idx = 0
         if torch.cuda.is_current_stream_capturing():
             if cuda_graph_idx != -1:
                 KExpertsCPU.input_tensor_cpu[cuda_graph_idx].copy_(input_tensor, non_blocking=True)
@@ -507,10 +563,10 @@ class KExpertsTorch(KExpertsBase):
         return 
 
     def unload(self):
-        if self.gate is not None:
-            self.gate = None
-            self.up = None
-            self.down = None
+        # back to per expert slots, load() fills them again
+        self.gate = [None for _ in range(self.expert_num)]
+        self.up = [None for _ in range(self.expert_num)]
+        self.down = [None for _ in range(self.expert_num)]
 
     def load_weights(self, override_key: str | None = None):
         res = {}
@@ -569,10 +625,203 @@ class KExpertsTorch(KExpertsBase):
 
         return final_hidden_states.to(dtype=org_dtype, device=org_device)
 
+class KExpertsHybrid(KExpertsBase):
+    """
+    CPU experts with the hottest experts of the layer also kept on the GPU in Marlin format. Tokens routed to a hot
+    expert are computed on the GPU while the CPU MOE runs the rest, the CPU skips the routes handed to the GPU.
+    Every refresh_interval eager forwards the hot set follows the expert statistics of the layer, swapping at most
+    max_swaps_per_refresh experts so a refresh does not stall a forward for long. The number of hot experts is
+    hot_experts, or as many as fit in vram_budget_gb.
+    Routing is data dependent, so forwards captured in a CUDA graph run all experts on the CPU.
+    """
+    expert_num: int
+    slot_experts: list[int]
+    def __init__(
+        self,
+        key: str,
+        gguf_loader: GGUFLoader,
+        config: PretrainedConfig,
+        n_routed_experts: int,
+        orig_module: nn.Module = None,
+        device: str = "cpu",
+        out_device: str = "cuda",
+        hot_experts: int | None = None,
+        vram_budget_gb: float = 1.0,
+        refresh_interval: int = 64,
+        max_swaps_per_refresh: int = 2,
+        score_decay: float = 0.5,
+        **kwargs
+    ):
+        super().__init__(key, gguf_loader, config, orig_module, device, **kwargs)
+        self.cpu = KExpertsCPU(key, gguf_loader, config, n_routed_experts, orig_module, device, out_device=out_device, **kwargs)
+        self.expert_num = n_routed_experts
+        self.out_device = out_device
+        self.act_fn = ACT2FN[config.hidden_act]
+        self.elements_per_tensor = config.moe_intermediate_size * config.hidden_size
+        self.refresh_interval = refresh_interval
+        self.max_swaps_per_refresh = max_swaps_per_refresh
+        self.score_decay = score_decay
+        # the hot set follows the statistics, record them whatever the config says
+        EXPERT_STATS.enabled = True
+
+        if hot_experts is None:
+            # 4 bit Marlin weights with an fp16 scale per group of 64, for gate, up and down
+            bytes_per_expert = 3 * self.elements_per_tensor * (4 / 8 + 2 / 64)
+            hot_experts = int(vram_budget_gb * 2**30 // bytes_per_expert)
+        self.num_slots = max(0, min(hot_experts, n_routed_experts))
+        self.up_projs = [KLinearMarlin(key+ "." + "ffn_up_exps", gguf_loader, config, device=out_device) for i in range(self.num_slots)]
+        self.gate_projs = [KLinearMarlin(key+ "." + "ffn_gate_exps", gguf_loader, config, device=out_device) for i in range(self.num_slots)]
+        self.down_projs = [KLinearMarlin(key+ "." + "ffn_down_exps", gguf_loader, config, device=out_device) for i in range(self.num_slots)]
+        # expert held by each slot (-1 for none), kept across unload so load brings the same hot set back
+        self.slot_experts = [-1] * self.num_slots
+        self.slot_map = None
+        self.loaded = False
+        self.scores = torch.zeros(n_routed_experts, dtype=torch.float64)
+        self.last_counts = None
+        self.forwards = 0
+        self.pending_gpu = {}
+        self.routed_gpu = 0
+        self.routed_total = 0
+
+    def load(self, w: dict | nn.Parameter | tuple | None = None, device: str | None = None, warmup: bool = False):
+        self.cpu.load(w, device, warmup=warmup)
+        assert self.key + ".ffn_up_exps.weight" in self.gguf_loader.tensor_info, "KExpertsHybrid needs the experts in gguf"
+        if self.last_counts is None:
+            # counts of an earlier run pick the first hot set
+            self.refresh(max_swaps=self.num_slots)
+        for slot, expert in enumerate(self.slot_experts):
+            if expert >= 0:
+                self.load_slot(slot, expert)
+        self.loaded = True
+        self.update_slot_map()
+
+    def unload(self):
+        self.cpu.unload()
+        for slot in range(self.num_slots):
+            self.up_projs[slot].unload()
+            self.gate_projs[slot].unload()
+            self.down_projs[slot].unload()
+        self.loaded = False
+        self.slot_map = None
+
+    def load_slot(self, slot: int, expert: int):
+        for proj, linears, data in [("up", self.up_projs, self.cpu.up), ("gate", self.gate_projs, self.cpu.gate), ("down", self.down_projs, self.cpu.down)]:
+            weight = self.gguf_loader.load_expert_tensor(f"{self.key}.ffn_{proj}_exps.weight", data, expert, self.elements_per_tensor, device=self.out_device)
+            linears[slot].unload()
+            linears[slot].load(nn.Parameter(weight), device=self.out_device)
+
+    def update_slot_map(self):
+        slot_map = [-1] * self.expert_num
+        for slot, expert in enumerate(self.slot_experts):
+            if expert >= 0:
+                slot_map[expert] = slot
+        self.slot_map = torch.tensor(slot_map, dtype=torch.long, device=self.out_device) if max(slot_map) >= 0 else None
+
+    def refresh(self, max_swaps: int | None = None):
+        """Moves the hot set towards the experts with the highest decayed hit counts."""
+        if self.num_slots == 0:
+            return
+        counts = EXPERT_STATS.get(self.key)
+        if counts is not None:
+            delta = counts if self.last_counts is None else counts - self.last_counts
+            self.last_counts = counts
+            self.scores = self.scores * self.score_decay + delta.double()
+        values, experts = self.scores.topk(self.num_slots)
+        wanted = [e for v, e in zip(values.tolist(), experts.tolist()) if v > 0]
+        missing = [e for e in wanted if e not in self.slot_experts]
+        # free slots first, then the coldest experts that left the hot set
+        victims = [slot for slot in range(self.num_slots) if self.slot_experts[slot] not in wanted]
+        victims.sort(key=lambda slot: -1.0 if self.slot_experts[slot] < 0 else self.scores[self.slot_experts[slot]].item())
+        max_swaps = self.max_swaps_per_refresh if max_swaps is None else max_swaps
+        for expert, slot in list(zip(missing, victims))[:max_swaps]:
+            if self.loaded:
+                self.load_slot(slot, expert)
+            self.slot_experts[slot] = expert
+        if self.loaded:
+            self.update_slot_map()
+
+    def tick(self):
+        self.forwards += 1
+        if self.forwards % self.refresh_interval == 0:
+            self.refresh()
+
+    def submit_for_one_decode(self, input_tensor, expert_ids, weights, bsz_tensor=None, cuda_graph_idx=0):
+        self.cpu.submit_for_one_decode(input_tensor, expert_ids, weights, bsz_tensor, cuda_graph_idx)
+
+    def sync_for_one_decode(self, cuda_graph_idx=0):
+        return self.cpu.sync_for_one_decode(cuda_graph_idx)
+
+    def submit_prefill(self, input_tensor, expert_ids, weights, slot=0):
+        """Submits the cold routes to the CPU and computes the hot ones on the GPU meanwhile, see sync_prefill."""
+        self.tick()
+        return self.submit_split(input_tensor, expert_ids, weights, slot)
+
+    def submit_split(self, input_tensor, expert_ids, weights, slot=0):
+        if self.slot_map is None:
+            self.pending_gpu[slot] = None
+            return self.cpu.submit_prefill(input_tensor, expert_ids, weights, slot)
+        hot_slots = self.slot_map[expert_ids]
+        num_tokens = self.cpu.submit_prefill(input_tensor, expert_ids.masked_fill(hot_slots >= 0, -1), weights, slot)
+        self.pending_gpu[slot] = self.forward_gpu(input_tensor, hot_slots, weights)
+        return num_tokens
+
+    def sync_prefill(self, num_tokens, slot=0):
+        output = self.cpu.sync_prefill(num_tokens, slot)
+        output_gpu = self.pending_gpu.pop(slot, None)
+        if output_gpu is not None:
+            output += output_gpu
+        return output
+
+    def forward_gpu(self, input_tensor: torch.Tensor, hot_slots: torch.Tensor, weights: torch.Tensor) -> torch.Tensor:
+        # hot_slots [num_tokens, k] holds the slot of each route, -1 for the routes left to the CPU
+        k = hot_slots.size(-1)
+        hot_slots = hot_slots.flatten()
+        # the only host sync, after the CPU submission so the CPU is already busy
+        routes_per_slot = torch.bincount(hot_slots + 1, minlength=self.num_slots + 1).tolist()
+        self.routed_total += hot_slots.numel()
+        self.routed_gpu += hot_slots.numel() - routes_per_slot[0]
+        order = hot_slots.argsort()
+        weights = weights.flatten().to(input_tensor.dtype)
+        output = torch.zeros_like(input_tensor)
+        begin = routes_per_slot[0]
+        for slot, count in enumerate(routes_per_slot[1:]):
+            if count == 0:
+                continue
+            routes = order[begin:begin + count]
+            begin += count
+            tokens = routes // k
+            current_state = input_tensor[tokens]
+            G = self.gate_projs[slot].forward(current_state)
+            A = self.act_fn(G)
+            U = self.up_projs[slot].forward(current_state)
+            H = A * U  # Element-wise multiplication
+            output.index_add_(0, tokens, self.down_projs[slot].forward(H) * weights[routes, None])
+        return output
+
+    def forward(self, input_tensor, expert_ids, weights, bsz_tensor=None, cuda_graph_idx=None):
+        if torch.cuda.is_current_stream_capturing():
+            return self.cpu.forward(input_tensor, expert_ids, weights, bsz_tensor, cuda_graph_idx)
+        self.tick()
+        if self.slot_map is None:
+            return self.cpu.forward(input_tensor, expert_ids, weights, bsz_tensor, cuda_graph_idx)
+        rows = input_tensor.size(0)
+        num_tokens = rows if bsz_tensor is None else int(bsz_tensor.item())
+        num_tokens = self.submit_split(input_tensor[:num_tokens].contiguous(), expert_ids[:num_tokens], weights[:num_tokens])
+        output = self.sync_prefill(num_tokens)
+        if num_tokens < rows:
+            output = F.pad(output, (0, 0, 0, rows - num_tokens))
+        return output
+
+    def report_string(self) -> str:
+        hit_rate = self.routed_gpu / self.routed_total if self.routed_total else 0.0
+        hot = sum(expert >= 0 for expert in self.slot_experts)
+        return f"{self.key}: {hot}/{self.num_slots} hot experts, {hit_rate * 100:.1f}% of routes on gpu"
+
 EXPERTS_MAP = {
     "KExpertsCPU": KExpertsCPU,
     "KExpertsTorch": KExpertsTorch,
     "KExpertsMarlin": KExpertsMarlin,
+    "KExpertsHybrid": KExpertsHybrid,
 }
 
 class KTransformersExperts(BaseInjectedModule, KExpertsBase):
@@ -765,9 +1014,10 @@ class KDeepseekV2MoE(BaseInjectedModule, DeepseekV2MoE):
         orig_shape = hidden_states.shape
         sequence_length = orig_shape[1]
         topk_idx, topk_weight, aux_loss = self.gate(hidden_states)
+        record_routing(self, topk_idx)
         hidden_states = hidden_states.view(-1, hidden_states.shape[-1])
         
-        if sequence_length == 1 and hasattr(self.experts.generate_experts, "submit_for_one_decode") and torch.cuda.is_current_stream_capturing():
+        if orig_shape[0] == 1 and sequence_length == 1 and hasattr(self.experts.generate_experts, "submit_for_one_decode") and torch.cuda.is_current_stream_capturing():
             self.experts.generate_experts.submit_for_one_decode(hidden_states[0], topk_idx[0], topk_weight[0])
             if self.config.n_shared_experts is not None:
                 y_ = self.shared_experts(identity).squeeze(0)
@@ -799,6 +1049,25 @@ class KDeepseekV2MoE(BaseInjectedModule, DeepseekV2MoE):
             y += y_
         return y
 
+    def can_pipeline_prefill(self) -> bool:
+        return (isinstance(self.experts, KTransformersExperts) and self.experts.mode == InferenceState.GENERATE
+                and hasattr(self.experts.generate_experts, "submit_prefill"))
+
+    def submit_prefill(self, hidden_states, slot=0):
+        """Routes a prefill micro-batch to the cpu experts and runs the shared experts meanwhile, see sync_prefill."""
+        topk_idx, topk_weight, aux_loss = self.gate(hidden_states)
+        record_routing(self, topk_idx)
+        num_tokens = self.experts.generate_experts.submit_prefill(hidden_states.view(-1, hidden_states.shape[-1]), topk_idx, topk_weight, slot)
+        y_ = self.shared_experts(hidden_states) if self.config.n_shared_experts is not None else None
+        return hidden_states.shape, num_tokens, y_
+
+    def sync_prefill(self, pending, slot=0):
+        orig_shape, num_tokens, y_ = pending
+        y = self.experts.generate_experts.sync_prefill(num_tokens, slot).view(*orig_shape)
+        if y_ is not None:
+            y += y_
+        return y
+
     @torch.no_grad()
     def moe_kexperts(self, x: torch.Tensor, topk_ids: torch.Tensor, topk_weight: torch.Tensor) -> torch.Tensor:
         outs = self.experts(x, topk_ids, topk_weight)
@@ -864,10 +1133,11 @@ class KDeepseekV3MoE(BaseInjectedModule, DeepseekV3MoE):
         orig_shape = hidden_states.shape
         sequence_length = orig_shape[1]
         topk_idx, topk_weight = self.gate(hidden_states)
+        record_routing(self, topk_idx)
         hidden_states = hidden_states.view(-1, hidden_states.shape[-1])
         
         # only for generate phase
-        if sequence_length == 1 and hasattr(self.experts.generate_experts, "submit_for_one_decode") and torch.cuda.is_current_stream_capturing():
+        if orig_shape[0] == 1 and sequence_length == 1 and hasattr(self.experts.generate_experts, "submit_for_one_decode") and torch.cuda.is_current_stream_capturing():
             self.experts.generate_experts.submit_for_one_decode(hidden_states[0], topk_idx[0], topk_weight[0])
             if self.config.n_shared_experts is not None:
                 y_ = self.shared_experts(identity).squeeze(0)
@@ -901,6 +1171,25 @@ class KDeepseekV3MoE(BaseInjectedModule, DeepseekV3MoE):
 
 
 
+    def can_pipeline_prefill(self) -> bool:
+        return (isinstance(self.experts, KTransformersExperts) and self.experts.mode == InferenceState.GENERATE
+                and hasattr(self.experts.generate_experts, "submit_prefill"))
+
+    def submit_prefill(self, hidden_states, slot=0):
+        """Routes a prefill micro-batch to the cpu experts and runs the shared experts meanwhile, see sync_prefill."""
+        topk_idx, topk_weight = self.gate(hidden_states)
+        record_routing(self, topk_idx)
+        num_tokens = self.experts.generate_experts.submit_prefill(hidden_states.view(-1, hidden_states.shape[-1]), topk_idx, topk_weight, slot)
+        y_ = self.shared_experts(hidden_states) if self.config.n_shared_experts is not None else None
+        return hidden_states.shape, num_tokens, y_
+
+    def sync_prefill(self, pending, slot=0):
+        orig_shape, num_tokens, y_ = pending
+        y = self.experts.generate_experts.sync_prefill(num_tokens, slot).view(*orig_shape)
+        if y_ is not None:
+            y += y_
+        return y
+
     @torch.no_grad()
     def moe_kexperts(self, x: torch.Tensor, topk_ids: torch.Tensor, topk_weight: torch.Tensor) -> torch.Tensor:
         outs = self.experts(x, topk_ids, topk_weight)
@@ -1063,6 +1352,7 @@ class KDeepseekV3MoEV2(BaseInjectedModule, DeepseekV3MoE):
         orig_shape = hidden_states.shape
         sequence_length = orig_shape[1]
         topk_idx, topk_weight = self.gate(hidden_states)
+        record_routing(self, topk_idx, bsz_tensor)
         hidden_states = hidden_states.view(-1, hidden_states.shape[-1])
         
 
@@ -31,11 +31,12 @@ from transformers.configuration_utils import PretrainedConfig
 from ktransformers.ktransformers_ext.triton.fp8gemm import fp8_gemm, act_quant, weight_dequant
 from abc import ABC, abstractmethod
 import sys, os
+import math
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "ktransformers_ext", "build"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "ktransformers_ext", "build", "Release"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "ktransformers_ext", "build", "Debug"))
 import cpuinfer_ext
-from ktransformers.operators.cpuinfer import CPUInfer
+from ktransformers.operators.cpuinfer import CPUInfer, PinnedBufferPool
 from ktransformers.server.config.config import Config
 from typing import Dict, Tuple, Optional, Union
 import numpy as np
@@ -113,6 +114,30 @@ class KLinearBase(ABC):
             tensors[k] = self.gguf_loader.load_gguf_tensor(key + "." + k, device=device)
         return tensors
 
+    # bump when the tensors an operator keeps in the weight cache change
+    WEIGHT_LAYOUT_VERSION = 1
+
+    def weight_cache_params(self) -> dict:
+        return {}
+
+    def weight_cache_digest(self) -> str | None:
+        cache = self.gguf_loader.weight_cache
+        if cache is None or self.gguf_loader.safetensor_loader is not None:
+            return None
+        names = [self.key + "." + k for k in ["weight", "bias"] if self.key + "." + k in self.gguf_loader.tensor_info]
+        if not names:
+            return None
+        return cache.digest(self.gguf_loader, self.key, names, type(self), self.WEIGHT_LAYOUT_VERSION, self.weight_cache_params())
+
+    def load_cached_weights(self, digest: str | None, device: str) -> dict | None:
+        if digest is None:
+            return None
+        return self.gguf_loader.weight_cache.load(self.key, type(self), digest, device)
+
+    def store_cached_weights(self, digest: str | None, tensors: dict):
+        if digest is not None:
+            self.gguf_loader.weight_cache.store(self.key, type(self), digest, tensors)
+
     @abstractmethod
     def load(self, w: dict | nn.Parameter | tuple | None = None, device: str|None = "cuda"):
         pass
@@ -181,8 +206,27 @@ class KLinearTorch(KLinearBase):
             self.weight = None
         if self.has_bias:
             self.bias = None
+        self.loaded = False
+
+_int_mm_devices: Dict[str, bool] = {}
+
+def int_mm_supported(device) -> bool:
+    # torch._int_mm runs on CPU only from torch 2.4 on, probe once per device
+    device = str(torch.device(device))
+    if device not in _int_mm_devices:
+        try:
+            a = torch.zeros((32, 32), dtype=torch.int8, device=device)
+            torch._int_mm(a, a.t())
+            _int_mm_devices[device] = True
+        except (AttributeError, RuntimeError, NotImplementedError):
+            _int_mm_devices[device] = False
+    return _int_mm_devices[device]
+
 
 class KLinearQ8(KLinearBase):
+    # int8 weights with a scale per output channel and group of group_size input channels. Below dequant_rows
+    # tokens activations are quantized per token and group on the fly and every group is an int8 x int8 -> int32
+    # GEMM (torch._int_mm); larger batches are compute bound, they dequantize the weight to bf16 once per call.
     def __init__(
         self,
         key: str,
@@ -190,124 +234,107 @@ class KLinearQ8(KLinearBase):
         config: PretrainedConfig,
         orig_module: nn.Module = None,
         device: str = "cuda",
+        group_size: int = 256,
+        dequant_rows: int = 128,
         **kwargs,
     ):
         super().__init__(key, gguf_loader, config, orig_module, device, **kwargs)
         self.has_bias = False
         self.compute_dtype = torch.float32
+        # one group per row if the input channels don't split evenly
+        if group_size <= 0 or self.in_features % group_size != 0:
+            group_size = self.in_features
+        self.group_size = group_size
+        self.num_groups = self.in_features // group_size
+        self.dequant_rows = dequant_rows
         self.weight = None
         self.weight_scale = None
-        self.weight_zero_point = None
         self.bias = None
         self.loaded = False
     
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, **kwargs) -> torch.Tensor:
         orig_dtype = x.dtype
         out_device = x.device
+        out_shape = x.shape[:-1] + (self.out_features,)
         
-        x = x.to(device=self.device, dtype=self.compute_dtype)
-        
-        # 使用原始权重做矩阵乘法，模拟原始行为
-
-        # 反量化权重进行矩阵乘法
-        weight_dequant = self._dequantize_weight(self.weight, self.weight_scale, bits=8)
-        out = x @ weight_dequant.T
+        x = x.to(device=self.device).reshape(-1, self.in_features)
+        if x.shape[0] >= self.dequant_rows:
+            out = x.to(torch.bfloat16) @ self._dequantize_weight(torch.bfloat16).t()
+        else:
+            out = self._int8_matmul(x.to(self.compute_dtype))
         
         if self.has_bias:
             out = out + self.bias
         
-        return out.to(dtype=orig_dtype, device=out_device)
-    
-    def _dequantize_weight(self, q_matrix, scales, bits=8):
+        return out.view(out_shape).to(dtype=orig_dtype, device=out_device)
+
+    def _int8_matmul(self, x: torch.Tensor) -> torch.Tensor:
+        rows = x.shape[0]
+        if x.is_cuda and rows <= 16:
+            # the cuBLASLt int8 GEMM wants more than 16 rows
+            x = torch.cat([x, x.new_zeros(17 - rows, self.in_features)])
+        x_q, x_scale = self._quantize_activation(x)
+        
+        int_mm = int_mm_supported(x.device)
+        out = None
+        for g in range(self.num_groups):
+            if int_mm:
+                acc = torch._int_mm(x_q[g], self.weight[g].t())
+            else:
+                # exact in fp32 as long as group_size * 127 * 127 < 2 ** 24
+                acc = x_q[g].to(torch.float32) @ self.weight[g].to(torch.float32).t()
+            scale = x_scale[g] * self.weight_scale[g]
+            if out is None:
+                out = acc * scale
+            else:
+                out.addcmul_(acc, scale)
+        return out[:rows]
+
+    def _dequantize_weight(self, dtype: torch.dtype) -> torch.Tensor:
         """
-        Dequantize a low-precision matrix back to floating-point
+        Dequantize the int8 weight back to a dense [out_features, in_features] matrix
         
         Args:
-            q_matrix (torch.Tensor): Quantized int matrix
-            scales (torch.Tensor): Scale factors for each column
-            bits (int): Quantization bits used (8 or 4)
+            dtype (torch.dtype): dtype of the result
         
         Returns:
-            torch.Tensor: Dequantized floating-point matrix
+            torch.Tensor: Dequantized weight
         """
-        # Ensure inputs are torch tensors
-        if not isinstance(q_matrix, torch.Tensor):
-            q_matrix = torch.tensor(q_matrix, dtype=torch.int8)
-        if not isinstance(scales, torch.Tensor):
-            scales = torch.tensor(scales, dtype=torch.float32)
-        
-        # Convert to correct dtype if needed
-        if q_matrix.dtype != torch.int8:
-            q_matrix = q_matrix.to(torch.int8)
-        if scales.dtype != torch.float32:
-            scales = scales.to(torch.float32)
-        
-        # For Q4, ensure the values stay within 4-bit range
-        if bits == 4:
-            q_matrix = torch.clamp(q_matrix, -7, 7)
-        rows, cols = q_matrix.shape
-        dequant_matrix = q_matrix.to(torch.float32)
-        scales_broadcast = scales.view(1, cols)
-        # Apply dequantization to all columns at once using matrix multiplication
-        dequant_matrix = dequant_matrix * scales_broadcast
-        
-        return dequant_matrix
+        weight = self.weight.to(dtype) * self.weight_scale.to(dtype).unsqueeze(-1)
+        return weight.transpose(0, 1).reshape(self.out_features, self.in_features)
 
-    
-    def _quantize_weight(self, matrix, bits=8):
+    def _quantize_activation(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         """
-        Quantize a floating-point matrix to lower precision (Q8 or Q4)
+        Symmetric int8 quantization of activations per token and group
         
         Args:
-            matrix (torch.Tensor): Input matrix in floating-point format
-            bits (int): Quantization bits, either 8 or 4
+            x (torch.Tensor): [rows, in_features] float32 activations
         
         Returns:
-            tuple: (quantized int matrix, scale factors for each column)
+            tuple: ([num_groups, rows, group_size] int8, [num_groups, rows, 1] float32 scales)
         """
-        if not isinstance(matrix, torch.Tensor):
-            matrix = torch.tensor(matrix, dtype=torch.float32)
-        
-        # Convert to float32 if needed
-        if matrix.dtype != torch.float32:
-            matrix = matrix.to(torch.float32)
-        
-        # Get matrix shape
-        rows, cols = matrix.shape
-        
-        # Determine quantization parameters based on bits
-        if bits == 8:
-            max_int = 127
-            qtype = torch.int8
-        elif bits == 4:
-            max_int = 7
-            qtype = torch.int8  # We'll still use int8 storage but limit to 4-bit range, wait for native support
-        else:
-            raise ValueError("Quantization bits must be either 8 or 4")
-       
-        scales = torch.zeros(cols, dtype=torch.float32, device=matrix.device)
-        
-        # Calculate max absolute value for each column
-        max_abs_vals, _ = torch.max(torch.abs(matrix), dim=0)
-        
-        # Handle zero columns (avoid division by zero)
-        zero_cols = max_abs_vals == 0
-        max_abs_vals[zero_cols] = 1.0
-        
-        # Calculate scale factors for all columns at once
-        scales = max_abs_vals / max_int
-        
-        # Prepare the scales for broadcasting [1, cols]
-        scales_broadcast = scales.view(1, cols)
-        
-        # Apply quantization to the entire matrix at once
-        q_matrix = torch.round(matrix / scales_broadcast).to(qtype)
+        groups = x.view(x.shape[0], self.num_groups, self.group_size).transpose(0, 1)
+        max_abs = groups.abs().amax(dim=-1, keepdim=True).clamp_(min=1e-10)
+        x_q = (groups * (127.0 / max_abs)).round_().to(torch.int8).contiguous()
+        return x_q, max_abs / 127.0
+    
+    def _quantize_weight(self, matrix: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Symmetric int8 quantization of a weight matrix per output channel and group of input channels
         
-        # For Q4, clamp values to ensure they stay within 4-bit range
-        if bits == 4:
-            q_matrix = torch.clamp(q_matrix, -max_int, max_int)
+        Args:
+            matrix (torch.Tensor): [out_features, in_features] weight
         
-        return q_matrix, scales
+        Returns:
+            tuple: ([num_groups, out_features, group_size] int8, [num_groups, out_features] float32 scales)
+        """
+        matrix = matrix.to(torch.float32).reshape(self.out_features, self.num_groups, self.group_size)
+        max_abs = matrix.abs().amax(dim=-1, keepdim=True)
+        # all zero groups keep a scale of 1 and quantize to 0
+        max_abs[max_abs == 0] = 127.0
+        q_matrix = torch.round(matrix * (127.0 / max_abs)).to(torch.int8)
+        scales = (max_abs / 127.0).squeeze(-1)
+        return q_matrix.transpose(0, 1).contiguous(), scales.t().contiguous()
     
     def load(self, w: Union[Dict, nn.Parameter, Tuple, None] = None, device: Optional[str] = None):
         if self.loaded: return
@@ -315,36 +342,25 @@ class KLinearQ8(KLinearBase):
         if w is None: w = self.load_weight(device=device)
         
         if isinstance(w, nn.Parameter):
-            try:
-                weight = w.to(dtype=self.compute_dtype).view(self.out_features, self.in_features)
-            except:
-                weight = w.to(dtype=self.compute_dtype)
+            weight = w
             self.has_bias = False
         elif isinstance(w, tuple):
-            try:
-                weight = w[0].to(dtype=self.compute_dtype).view(self.out_features, self.in_features)
-            except:
-                weight = w[0].to(dtype=self.compute_dtype)
+            weight = w[0]
             self.bias = w[1].to(dtype=self.compute_dtype).to(device)
             self.has_bias = True
         else:
             raise ValueError("Invalid weight type")
         
-        self.weight, self.weight_scale = self._quantize_weight(weight, bits=8)
+        self.weight, self.weight_scale = self._quantize_weight(weight.detach())
         
         self.weight = self.weight.to(device)
         self.weight_scale = self.weight_scale.to(device)
-        
-        if self.has_bias:
-            self.bias = self.bias.to(device)
             
         self.loaded = True
     
     def unload(self):
         self.weight = None
         self.weight_scale = None
-        self.weight_zero_point = None
-        self._orig_weight = None
         
         if self.has_bias:
             self.bias = None
@@ -446,6 +462,14 @@ class VLinearMarlin(KLinearBase):
         if device is None: device = self.device
         assert device.lower() != "cpu", "Marlin quantized linear only supports GPU device"
         
+        cache_digest = None
+        if w is None:
+            cache_digest = self.weight_cache_digest()
+            cached = self.load_cached_weights(cache_digest, device)
+            if cached is not None:
+                self.load_marlin(cached, device)
+                return
+
         #if self.in_features * self.out_features:
         if w is None: 
             w = self.load_weight(device=device) 
@@ -475,17 +499,31 @@ class VLinearMarlin(KLinearBase):
         marlin_q_w, marlin_s, g_idx, sort_indices, _ = marlin_quantize(
             weight, self.num_bits, self.group_size, self.act_order
         )
+        marlin = {"marlin_q_w": marlin_q_w, "marlin_s": marlin_s, "g_idx": g_idx, "sort_indices": sort_indices}
+        if self.has_bias:
+            marlin["bias"] = self.bias
+        self.store_cached_weights(cache_digest, marlin)
+        self.load_marlin(marlin, device)
+
+    def weight_cache_params(self) -> dict:
+        return {"num_bits": self.num_bits, "group_size": self.group_size, "act_order": self.act_order,
+                "in_features": self.in_features, "out_features": self.out_features}
+
+    def load_marlin(self, marlin: dict, device: str):
         self.workspace = MarlinWorkspace(
             self.out_features, GPTQ_MARLIN_MIN_THREAD_N, GPTQ_MARLIN_MAX_PARALLEL,self.device
         )
-        self.weight = marlin_q_w
-        self.marlin_q_w = marlin_q_w
-        self.marlin_s = marlin_s
-        self.g_idx = g_idx
-        self.sort_indices = sort_indices
-        self.k = weight.shape[0]
-        self.n = weight.shape[1]
-        # self.shape_buffer = torch.tensor([60], dtype=torch.int32, device=self.device)
+        self.marlin_q_w = marlin["marlin_q_w"].to(device)
+        self.weight = self.marlin_q_w # modeling_xxx.py may use linear.weight
+        self.marlin_s = marlin["marlin_s"].to(device)
+        self.g_idx = marlin["g_idx"].to(device)
+        self.sort_indices = marlin["sort_indices"].to(device)
+        self.has_bias = "bias" in marlin
+        if self.has_bias:
+            self.bias = marlin["bias"].to(device)
+        # the packed weight is (in_features, out_features) after padding
+        self.k = self.in_features
+        self.n = self.out_features
         self.loaded = True
 
 
@@ -589,6 +627,14 @@ class KLinearMarlin(KLinearBase):
         if device is None: device = self.device
         assert device.lower() != "cpu", "Marlin quantized linear only supports GPU device"
         
+        cache_digest = None
+        if w is None:
+            cache_digest = self.weight_cache_digest()
+            cached = self.load_cached_weights(cache_digest, device)
+            if cached is not None:
+                self.load_marlin(cached, device)
+                return
+
         #if self.in_features * self.out_features:
         if w is None: 
             w = self.load_weight(device=device) 
@@ -618,16 +664,31 @@ class KLinearMarlin(KLinearBase):
         marlin_q_w, marlin_s, g_idx, sort_indices, _ = marlin_quantize(
             weight, self.num_bits, self.group_size, self.act_order
         )
+        marlin = {"marlin_q_w": marlin_q_w, "marlin_s": marlin_s, "g_idx": g_idx, "sort_indices": sort_indices}
+        if self.has_bias:
+            marlin["bias"] = self.bias
+        self.store_cached_weights(cache_digest, marlin)
+        self.load_marlin(marlin, device)
+
+    def weight_cache_params(self) -> dict:
+        return {"num_bits": self.num_bits, "group_size": self.group_size, "act_order": self.act_order,
+                "in_features": self.in_features, "out_features": self.out_features}
+
+    def load_marlin(self, marlin: dict, device: str):
         self.workspace = MarlinWorkspace(
             self.out_features, GPTQ_MARLIN_MIN_THREAD_N, GPTQ_MARLIN_MAX_PARALLEL,self.device
         )
-        self.weight = marlin_q_w # modeling_xxx.py may use linear.weight
-        self.marlin_q_w = marlin_q_w
-        self.marlin_s = marlin_s
-        self.g_idx = g_idx
-        self.sort_indices = sort_indices
-        self.k = weight.shape[0]
-        self.n = weight.shape[1]
+        self.marlin_q_w = marlin["marlin_q_w"].to(device)
+        self.weight = self.marlin_q_w # modeling_xxx.py may use linear.weight
+        self.marlin_s = marlin["marlin_s"].to(device)
+        self.g_idx = marlin["g_idx"].to(device)
+        self.sort_indices = marlin["sort_indices"].to(device)
+        self.has_bias = "bias" in marlin
+        if self.has_bias:
+            self.bias = marlin["bias"].to(device)
+        # the packed weight is (in_features, out_features) after padding
+        self.k = self.in_features
+        self.n = self.out_features
         self.loaded = True
 
     def forward(self, x: torch.Tensor, bsz_tensor: torch.Tensor=None, **kwargs) -> torch.Tensor:
@@ -673,9 +734,12 @@ class KLinearMarlin(KLinearBase):
         self.g_idx = None
         self.sort_indices = None
         self.workspace = None
+        self.loaded = False
 
 class KLinearCPUInfer(KLinearBase):
     CPU_INFER = None
+    # staging buffers of the prefill and batched decode forwards, shared by all layers
+    PINNED_POOL = PinnedBufferPool()
     def __init__(
         self,
         key: str,
@@ -695,48 +759,99 @@ class KLinearCPUInfer(KLinearBase):
         self.dtype = torch.get_default_dtype()
         self.w = None
         self.has_bias = False
-        self.stride = stride
+        # every task computes stride output rows, rows past the last full stride would be skipped
+        self.stride = math.gcd(stride, self.out_features)
         self.group_max_len = group_max_len
         self.out_device = out_device
+        self.graph_buffers = {}  # num_tokens -> (input_cpu, output_cpu, output_gpu) captured in a CUDA graph
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        origin_shape = x.shape # [batch_size, q_len, hidden_size]
-        if origin_shape[1] == 1 and torch.cuda.is_current_stream_capturing():
-            out_device = x.device
-            self.input_tensor_cpu.copy_(x, non_blocking=True)
-            qlen = origin_shape[1]
-            KLinearCPUInfer.CPU_INFER.submit_with_cuda_stream(
-                torch.cuda.current_stream().cuda_stream,
-                self.linear.forward(
-                    qlen, 
-                    self.input_tensor_cpu.data_ptr(), 
-                    self.output_cpu.data_ptr()
-                )
-            )
-            KLinearCPUInfer.CPU_INFER.sync_with_cuda_stream(torch.cuda.current_stream().cuda_stream)
-            self.output_gpu.copy_(self.output_cpu, non_blocking=True)
-            if self.has_bias:
-                self.output_gpu += self.bias
-            return self.output_gpu
-        else:
-            dtype = x.dtype
-            out_device = x.device
-            x = x.to(device=self.device)
-            qlen = origin_shape[1]
-            output_shape = (*origin_shape[:-1], self.out_features)
-            output = torch.empty(output_shape, device=x.device, dtype=x.dtype)
-            KLinearCPUInfer.CPU_INFER.submit(
-                self.linear.forward(
-                    qlen, 
-                    x.data_ptr(), 
-                    output.data_ptr()
+    def forward(self, x: torch.Tensor, bsz_tensor: torch.Tensor = None) -> torch.Tensor:
+        if x.is_cuda and torch.cuda.is_current_stream_capturing():
+            return self.forward_graph(x)
+        if x.is_cuda:
+            num_tokens = x.numel() // self.in_features
+            piece = self.max_staged_tokens()
+            if num_tokens <= piece:
+                return self.sync_forward(self.submit_forward(x))
+            # a long prefill chunk is staged in pieces, so the pinned pool never holds a buffer of the whole output
+            x_tokens = x.reshape(num_tokens, self.in_features)
+            output = torch.cat([self.sync_forward(self.submit_forward(x_tokens[begin:begin + piece]))
+                                for begin in range(0, num_tokens, piece)])
+            return output.view(*x.shape[:-1], self.out_features)
+        shape, dtype = x.shape, x.dtype
+        num_tokens = x.numel() // self.in_features
+        x = x.reshape(num_tokens, self.in_features).to(torch.bfloat16).contiguous()
+        output = torch.empty((num_tokens, self.out_features), dtype=torch.bfloat16)
+        KLinearCPUInfer.CPU_INFER.submit(self.linear.forward(num_tokens, x.data_ptr(), output.data_ptr()))
+        KLinearCPUInfer.CPU_INFER.sync()
+        if self.has_bias:
+            output = output + self.bias
+        return output.view(*shape[:-1], self.out_features).to(dtype)
+
+    def alloc_graph_buffers(self, sizes: list[int], device):
+        # the buffers of a captured graph live as long as the graph, one set per batch size. They are allocated
+        # before any capture, pinned host memory can't be allocated while a stream is capturing; empty ones, a
+        # fill would end up in the graph
+        for num_tokens in sizes:
+            if num_tokens not in self.graph_buffers:
+                self.graph_buffers[num_tokens] = (
+                    torch.empty((num_tokens, self.in_features), dtype=torch.bfloat16, pin_memory=True),
+                    torch.empty((num_tokens, self.out_features), dtype=torch.bfloat16, pin_memory=True),
+                    torch.empty((num_tokens, self.out_features), dtype=torch.bfloat16, device=device),
                 )
+
+    def forward_graph(self, x: torch.Tensor) -> torch.Tensor:
+        num_tokens = x.numel() // self.in_features
+        assert num_tokens in self.graph_buffers, \
+            f"{self.key}: no graph buffers for {num_tokens} tokens, graphs can be captured for {sorted(self.graph_buffers)}"
+        input_cpu, output_cpu, output_gpu = self.graph_buffers[num_tokens]
+        stream = torch.cuda.current_stream(x.device).cuda_stream
+        input_cpu.copy_(x.view(num_tokens, self.in_features), non_blocking=True)
+        KLinearCPUInfer.CPU_INFER.submit_with_cuda_stream(
+            stream, self.linear.forward(num_tokens, input_cpu.data_ptr(), output_cpu.data_ptr())
+        )
+        KLinearCPUInfer.CPU_INFER.sync_with_cuda_stream(stream)
+        output_gpu.copy_(output_cpu, non_blocking=True)
+        output = output_gpu
+        if self.has_bias:
+            output = output + self.bias_gpu
+        return output.view(*x.shape[:-1], self.out_features).to(x.dtype)
+
+    def max_staged_tokens(self) -> int:
+        return max(1, KLinearCPUInfer.PINNED_POOL.max_buffer_bytes // (2 * max(self.in_features, self.out_features)))
+
+    def submit_forward(self, x: torch.Tensor):
+        """
+        Stream ordered forward of a GPU tensor of any number of tokens, the host thread does not wait. The tokens are
+        staged and computed in groups of group_max_len so that the upload of a group overlaps the CPU GEMM of the
+        previous one, and GPU work enqueued before sync_forward(pending) overlaps all of it.
+        """
+        num_tokens = x.numel() // self.in_features
+        input_bytes = num_tokens * self.in_features * 2
+        output_bytes = num_tokens * self.out_features * 2
+        input_buf = KLinearCPUInfer.PINNED_POOL.acquire(input_bytes, x.device)
+        output_buf = KLinearCPUInfer.PINNED_POOL.acquire(output_bytes, x.device)
+        input_cpu = input_buf[:input_bytes].view(torch.bfloat16).view(num_tokens, self.in_features)
+        output_cpu = output_buf[:output_bytes].view(torch.bfloat16).view(num_tokens, self.out_features)
+        stream = torch.cuda.current_stream(x.device).cuda_stream
+        x_bf16 = x.reshape(num_tokens, self.in_features).to(torch.bfloat16)
+        for begin in range(0, num_tokens, self.group_max_len):
+            end = min(begin + self.group_max_len, num_tokens)
+            input_cpu[begin:end].copy_(x_bf16[begin:end], non_blocking=True)
+            KLinearCPUInfer.CPU_INFER.submit_with_cuda_stream(
+                stream, self.linear.forward(end - begin, input_cpu[begin].data_ptr(), output_cpu[begin].data_ptr())
             )
-            KLinearCPUInfer.CPU_INFER.sync()
-            if self.has_bias:
-                output = output + self.bias
-            output = output.to(dtype=dtype, device=out_device)
-            return output
+        return x.shape, x.dtype, x.device, input_buf, output_buf, output_cpu
+
+    def sync_forward(self, pending) -> torch.Tensor:
+        shape, dtype, device, input_buf, output_buf, output_cpu = pending
+        KLinearCPUInfer.CPU_INFER.sync_with_cuda_stream(torch.cuda.current_stream(device).cuda_stream)
+        output = output_cpu.to(device, non_blocking=True)
+        KLinearCPUInfer.PINNED_POOL.release(input_buf, device)
+        KLinearCPUInfer.PINNED_POOL.release(output_buf, device)
+        if self.has_bias:
+            output = output + self.bias_gpu
+        return output.view(*shape[:-1], self.out_features).to(dtype)
 
     def load(self, w: dict | nn.Parameter | tuple | None = None, device: str|None = None, warmup:bool = True):
         print(f"loading {self.key} to {self.device} using CPUInfer")
@@ -745,6 +860,8 @@ class KLinearCPUInfer(KLinearBase):
         if self.bias is not None:
             self.has_bias = True
             self.bias = self.bias.to(device)
+            if "cuda" in str(self.out_device):
+                self.bias_gpu = self.bias.to(self.out_device)
             
         weight_ptr = ctypes.addressof(
             ctypes.cast(self.weight.ctypes.data, ctypes.POINTER(ctypes.c_uint64)).contents
@@ -755,9 +872,10 @@ class KLinearCPUInfer(KLinearBase):
         if warmup:
             KLinearCPUInfer.CPU_INFER.submit(self.linear.warm_up())
             KLinearCPUInfer.CPU_INFER.sync()
-        self.input_tensor_cpu = torch.zeros((1, 1, self.in_features), device="cpu", pin_memory=True)
-        self.output_cpu = torch.zeros((1, 1, self.out_features), device="cpu", pin_memory=True, dtype=torch.bfloat16)
-        self.output_gpu = torch.zeros((1, 1, self.out_features), device=self.out_device)
+        if "cuda" in str(self.out_device):
+            # every token count a graph is captured for, the decode and batched decode graphs pad to these
+            from ktransformers.operators.experts import cuda_graphs
+            self.alloc_graph_buffers(cuda_graphs, self.out_device)
 
     def load_weights(self, w: dict | nn.Parameter | tuple | None = None, device: str = "cpu"):
         if self.key + ".weight" in self.gguf_loader.tensor_info:
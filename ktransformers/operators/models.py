@@ -59,6 +59,10 @@ from ktransformers.models.configuration_llama import LlamaConfig
 from ktransformers.operators.base_operator import BaseInjectedModule
 from ktransformers.util.utils import InferenceState, get_compute_capability
 from ktransformers.util.custom_gguf import GGUFLoader
+from ktransformers.util.layer_stream import LayerStreamer
+from ktransformers.operators.flashinfer_wrapper import flashinfer_enabled
+if flashinfer_enabled:
+    from ktransformers.operators.flashinfer_wrapper import MLAWrapperSingleton
 from transformers.configuration_utils import PretrainedConfig
 from ktransformers.models.modeling_llama import (
     LlamaDecoderLayer,
@@ -543,6 +547,8 @@ class KDeepseekV2Model(BaseInjectedModule):
         device: str = "cuda",
         per_layer_prefill_intput_threshold: int = 30000,  # if None, no per-layer prefill
         transfer_map: dict = None,
+        prefill_micro_batches: int | None = None,  # if None, from the server config, 1 turns pipelining off
+        min_micro_batch_tokens: int = 32,
         **kwargs,
     ):
         BaseInjectedModule.__init__(
@@ -551,6 +557,9 @@ class KDeepseekV2Model(BaseInjectedModule):
         self.per_layer_prefill_intput_threshold = per_layer_prefill_intput_threshold
         self.transfer_map = transfer_map
         self.stream_device_map = dict()
+        self.layer_streamer = None
+        self.prefill_micro_batches = Config().prefill_micro_batches if prefill_micro_batches is None else prefill_micro_batches
+        self.min_micro_batch_tokens = min_micro_batch_tokens
 
     @add_start_docstrings_to_model_forward(DeepseekV2_INPUTS_DOCSTRING)
     def forward(
@@ -582,7 +591,15 @@ class KDeepseekV2Model(BaseInjectedModule):
             per_layer_prefill_flag = True
             for layer in self.layers:
                 self.load_layer_to(layer, InferenceState.UNLOAD)
+            # hand the generate weights back once, layers are then streamed through two reused slots
             torch.cuda.empty_cache()
+            if self.layer_streamer is None:
+                self.layer_streamer = LayerStreamer(
+                    self.layers,
+                    lambda layer: self.load_layer_to(layer, InferenceState.PREFILL),
+                    lambda layer: self.load_layer_to(layer, InferenceState.UNLOAD),
+                )
+            self.layer_streamer.begin()
         else:
             pass
         output_attentions = (
@@ -673,7 +690,17 @@ class KDeepseekV2Model(BaseInjectedModule):
         t_cpu = 0
         t_f = 0
 
-        for i, decoder_layer in enumerate(self.layers):
+        micro_batches = min(self.prefill_micro_batches, seq_length // self.min_micro_batch_tokens)
+        if (micro_batches > 1 and batch_size == 1 and not per_layer_prefill_flag and self.transfer_map is None
+                and causal_mask is None and use_cache and not output_attentions and not output_hidden_states
+                and not torch.cuda.is_current_stream_capturing()):
+            hidden_states = self.pipelined_prefill(hidden_states, position_ids, past_key_values, cache_position, micro_batches)
+            next_decoder_cache = past_key_values
+            layers = []
+        else:
+            layers = self.layers
+
+        for i, decoder_layer in enumerate(layers):
             # print(f"@@@@@@@@@@@@@@@@@layer {i}@@@@@@@@@@@@@@@@@@@@ \n")
             if self.transfer_map is not None and i in self.transfer_map:
                 prev_stream = torch.cuda.current_stream()
@@ -720,9 +747,8 @@ class KDeepseekV2Model(BaseInjectedModule):
             else:
                 t3 = time.time()
                 if per_layer_prefill_flag:
-                    # print(f"to gpu")
-                    self.load_layer_to(decoder_layer, InferenceState.PREFILL)
-                    torch.cuda.empty_cache()
+                    # waits for layer i, which was loaded while layer i-1 computed, and starts loading layer i+1
+                    self.layer_streamer.acquire(i)
                 t4 = time.time()
                 # with open("log.txt", "a") as f:
                 #     f.write(f"@@@@@@@@@@@@@@@@@layer {i}@@@@@@@@@@@@@@@@@@@@ \n")
@@ -737,9 +763,7 @@ class KDeepseekV2Model(BaseInjectedModule):
                 )
                 t5 = time.time()
                 if per_layer_prefill_flag:
-                    # print(f"to cpu")
-                    self.load_layer_to(decoder_layer, InferenceState.UNLOAD)
-                    torch.cuda.empty_cache()
+                    self.layer_streamer.release(i)
                 t6 = time.time()
             t_gpu += t4 - t3
             t_cpu += t6 - t5
@@ -761,17 +785,20 @@ class KDeepseekV2Model(BaseInjectedModule):
         #     f.write(f"hidden_states.shape={hidden_states.shape}\n")
 
         if per_layer_prefill_flag:
+            stream_stats = self.layer_streamer.end()
             t6 = time.time()
             # print(f"restore")
             per_layer_prefill_flag = False
             for layer in self.layers:
                 self.load_layer_to(layer, InferenceState.GENERATE)
+            # the streaming slots are cached on the loader stream, give them back to the generate weights
             torch.cuda.empty_cache()
             t7 = time.time()
 
             print(
                 f"total time: {t7-t3}, \n layer num{len(self.layers)}, gpu time: {t_gpu}, cpu time: {t_cpu}, forward time: {t_f}, restore time: {t7-t6}"
             )
+            print(stream_stats.report_string())
 
         # add hidden states from the last decoder layer
         if output_hidden_states:
@@ -797,6 +824,54 @@ class KDeepseekV2Model(BaseInjectedModule):
             attentions=all_self_attns,
         )
 
+    def pipelined_prefill(self, hidden_states, position_ids, past_key_values, cache_position, micro_batches: int):
+        """
+        Runs the decoder layers over micro-batches of the chunk, software pipelined: the cpu experts of a micro-batch
+        run while the gpu does the attention and shared experts of the next one. A micro-batch attends to the kv the
+        ones before it wrote in the same layer, so every layer takes its micro-batches in order. CPUInfer can only
+        wait for its whole queue, so a pending cpu forward is synced right before the next one is submitted, all of
+        it ordered on the current stream without blocking the host.
+        """
+        base, extra = divmod(hidden_states.size(1), micro_batches)
+        sizes = [base + (j < extra) for j in range(micro_batches)]
+        hidden_states = list(hidden_states.split(sizes, dim=1))
+        position_ids = position_ids.split(sizes, dim=1)
+        cache_position = cache_position.split(sizes)
+        pending = None
+
+        def finish():
+            j, mlp, residual, state = pending
+            hidden_states[j] = residual + mlp.sync_prefill(state, slot=j)
+
+        for layer in self.layers:
+            mlp = layer.mlp if hasattr(layer.mlp, "can_pipeline_prefill") and layer.mlp.can_pipeline_prefill() else None
+            for j in range(len(sizes)):
+                residual = hidden_states[j]
+                h = layer.input_layernorm(residual)
+                if flashinfer_enabled:
+                    # planned for the q and kv length of this micro-batch
+                    MLAWrapperSingleton.need_plan_all()
+                h = layer.self_attn(
+                    h,
+                    attention_mask=None,
+                    position_ids=position_ids[j],
+                    past_key_value=past_key_values,
+                    use_cache=True,
+                    cache_position=cache_position[j],
+                )[0]
+                residual = residual + h
+                h = layer.post_attention_layernorm(residual)
+                if pending is not None:
+                    finish()
+                    pending = None
+                if mlp is None:
+                    hidden_states[j] = residual + layer.mlp(h)
+                else:
+                    pending = (j, mlp, residual, mlp.submit_prefill(h, slot=j))
+        if pending is not None:
+            finish()
+        return torch.cat(hidden_states, dim=1)
+
     def load_layer_to(self, layer: DeepseekV2DecoderLayer, target: InferenceState):
         assert isinstance(
             layer, DeepseekV2DecoderLayer
@@ -966,6 +1041,7 @@ class KLlamaModel(BaseInjectedModule):
         device: str = "cuda",
         per_layer_prefill_intput_threshold: int = 30000,  # if None, no per-layer prefill
         transfer_map: dict = None,
+        kv_type: str = None,  # CPU kvcache type, overrides long_context.kv_type of the config
         **kwargs,
     ):
 
@@ -992,7 +1068,7 @@ class KLlamaModel(BaseInjectedModule):
             topk=self.long_context_config["second_select_num"],
             threads_num=self.ext_config["cpu_infer"],
             anchor_type=self.long_context_config["anchor_type"],
-            kv_type=self.long_context_config["kv_type"],
+            kv_type=kv_type if kv_type is not None else self.long_context_config["kv_type"],
             dense_layer_num=self.long_context_config["dense_layer_num"],
             anchor_num=self.long_context_config["anchor_num"],
             preselect_block=self.long_context_config["preselect_block"],
@@ -5,19 +5,60 @@ Version      : 0.1.0
 Copyright (c) 2024 by KVCache.AI, All Rights Reserved. 
 '''
 from typing import Mapping, List
+import functools
+import hashlib
+import marshal
+import os
+import sys
+import time
+import warnings
 import torch
 import yaml
 import re
 from torch import nn
+import transformers
 from transformers import AutoConfig
 from transformers.configuration_utils import PretrainedConfig
 # from operators import BaseInjectedModule
 from ktransformers.util.custom_gguf import GGUFLoader, translate_name_to_gguf
+from ktransformers.util.weight_cache import CACHE_DIR_NAME
 from ktransformers.util.utils import set_module, load_weights
+from ktransformers.server.config.config import Config
+import ktransformers
 import itertools
 import copy
 
+# bump when the layout of a serialized injection plan or the way it is generated changes
+INJECTION_PLAN_VERSION = 1
+INJECTION_PLAN_DIR_NAME = "injection_plans"
+
+@functools.lru_cache(maxsize=None)
+def import_class(class_path: str) -> type:
+    import_path = class_path.split(".")
+    return getattr(__import__(".".join(import_path[:-1]), fromlist=[""]), import_path[-1])
+
+class CompiledRule:
+    # a rule of the yaml file with its match class resolved (on first use) and its name pattern compiled
+    def __init__(self, rule: dict):
+        match_meta = rule["match"]
+        if "class" not in match_meta and "name" not in match_meta:
+            raise Exception("match must have at least one of \"class\" and \"name\"")
+        self.rule = rule
+        self.class_path = match_meta.get("class")
+        self.name_pattern = re.compile(match_meta["name"]) if "name" in match_meta else None
+
+    def matches(self, module: nn.Module, module_name: str) -> bool:
+        if self.class_path is not None and not isinstance(module, import_class(self.class_path)):
+            return False
+        if self.name_pattern is not None and self.name_pattern.search(module_name) is None:
+            return False
+        return True
+
+def compile_rules(rule_list: List) -> List[CompiledRule]:
+    return [rule if isinstance(rule, CompiledRule) else CompiledRule(rule) for rule in rule_list]
+
 def inject(module, local_optimization_dict, model_config:AutoConfig ,gguf_loader:GGUFLoader, prefix=''):
+    # keys are full module names, so the whole dict is handed down instead of a filtered copy per level
     for name, child in module._modules.items():
         if child is not None:
             child_prefix = prefix + name
@@ -28,7 +69,7 @@ def inject(module, local_optimization_dict, model_config:AutoConfig ,gguf_loader
                     import_module_name = ".".join(import_path[:-1])
                     gguf_loader.tensor_device_map[inject_module_meta["key"]] = inject_module_meta["kwargs"] if "kwargs" in inject_module_meta else dict()
                     import_class_name = import_path[-1]
-                    module_cls=getattr(__import__(import_module_name, fromlist=[""]), import_class_name)
+                    module_cls=import_class(inject_module_meta["class"])
                     print(f"Injecting {child_prefix} as", import_module_name, ".", import_class_name)
                     inject_module=module_cls(key = inject_module_meta["key"], gguf_loader = gguf_loader, config = model_config, orig_module=child, **inject_module_meta["kwargs"])
                     set_module(module, name, inject_module)
@@ -38,8 +79,7 @@ def inject(module, local_optimization_dict, model_config:AutoConfig ,gguf_loader
                 else:
                     raise Exception("inject_module_meta[\"class\"] must be \"default\" or a class path")
                 child_prefix += "."
-                child_optimization_dict = {k: v for k, v in local_optimization_dict.items() if k.startswith(child_prefix)}
-                inject(child, child_optimization_dict, model_config, gguf_loader, child_prefix)
+                inject(child, local_optimization_dict, model_config, gguf_loader, child_prefix)
 
 def del_meta(module:nn.Module):
     #print("default loading weights", prefix)
@@ -53,24 +93,16 @@ def del_meta(module:nn.Module):
         del_meta(child)
 
 def gen_optimize_config(module: nn.Module, out_data: Mapping, rule_list: List, prefix: str="", default_device: str = "cuda:0"):
+    # the rules are compiled once at the root and handed down compiled
+    rule_list = compile_rules(rule_list)
     module_name = prefix[:-1]
     translated_name = translate_name_to_gguf(prefix)[:-1]
     #print("gen_optimize_config", prefix, module_name, translated_name)
     recursive = True
-    for rule in rule_list:
-        match_meta = rule["match"]
-        if "class" not in match_meta and "name" not in match_meta:
-            raise Exception("match must have at least one of \"class\" and \"name\"")
-        if "class" in match_meta:
-            import_path = match_meta["class"].split(".")
-            import_module_name = ".".join(import_path[:-1])
-            import_class_name = import_path[-1]
-            module_cls=getattr(__import__(import_module_name, fromlist=[""]), import_class_name)
-            if not isinstance(module, module_cls):
-                continue
-        if "name" in match_meta:
-            if re.search(match_meta["name"], module_name) is None:
-                continue
+    for compiled_rule in rule_list:
+        if not compiled_rule.matches(module, module_name):
+            continue
+        rule = compiled_rule.rule
         if "replace" not in rule:
             raise Exception("replace must be in rule")
         if "replace" in rule:
@@ -103,7 +135,7 @@ def gen_optimize_config(module: nn.Module, out_data: Mapping, rule_list: List, p
         for name, child in module._modules.items():
             if child is not None:
                 child_prefix = prefix + name + "."
-                gen_optimize_config(child, out_data, rule_list, child_prefix)
+                gen_optimize_config(child, out_data, rule_list, child_prefix, default_device)
     
 
 def translate_model_config(model_config: PretrainedConfig):
@@ -114,21 +146,96 @@ def translate_model_config(model_config: PretrainedConfig):
     return model_config
 
 
-def optimize_and_load_gguf(module: nn.Module, rule_file: str, gguf_path: str, model_config: PretrainedConfig, default_device: str = "cuda:0"):
+def injection_plan_digest(module: nn.Module, rule_text: str, model_config: PretrainedConfig, default_device: str) -> str:
+    # the module tree follows from the model class and its config, the plan from that tree and the rules
+    digest = hashlib.sha256()
+    for part in [
+        str(INJECTION_PLAN_VERSION),
+        sys.version,
+        ktransformers.__version__,
+        transformers.__version__,
+        f"{type(module).__module__}.{type(module).__qualname__}",
+        model_config.to_json_string(use_diff=False),
+        rule_text,
+        default_device,
+    ]:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def save_injection_plan(path: str, digest: str, optimize_config: Mapping):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    # marshal keeps the plain types of the yaml rules as they are (json would turn the int keys of transfer_map into
+    # strings) and loads far faster than the rules can be matched
+    try:
+        with open(tmp_path, "wb") as f:
+            marshal.dump({"version": INJECTION_PLAN_VERSION, "digest": digest, "plan": optimize_config}, f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_injection_plan(path: str, digest: str) -> dict | None:
+    try:
+        with open(path, "rb") as f:
+            data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    if data.get("version") != INJECTION_PLAN_VERSION or data.get("digest") != digest:
+        return None
+    return data["plan"]
+
+def gen_injection_plan(module: nn.Module, rule_file: str, model_config: PretrainedConfig, default_device: str = "cuda:0",
+                       plan_dir: str | None = None) -> dict:
+    """
+    The optimize config of module under rule_file, loaded from plan_dir when an earlier start already matched the same
+    model, config and rules, otherwise generated and saved there.
+    """
+    begin = time.perf_counter()
     with open(rule_file, 'r', encoding='utf-8') as f:
-        rule_list = yaml.load(f.read(), Loader=yaml.FullLoader)
-    
+        rule_text = f.read()
+    path = None
+    if plan_dir is not None:
+        digest = injection_plan_digest(module, rule_text, model_config, default_device)
+        path = os.path.join(plan_dir, digest[:32] + ".plan")
+        optimize_config = load_injection_plan(path, digest)
+        if optimize_config is not None:
+            print(f"Injection plan of {len(optimize_config)} modules loaded from {path} in {time.perf_counter() - begin:.3f}s")
+            return optimize_config
+    rule_list = yaml.load(rule_text, Loader=yaml.FullLoader)
     optimize_config = dict()
     gen_optimize_config(module, optimize_config, rule_list, default_device = default_device)
+    print(f"Injection plan of {len(optimize_config)} modules matched in {time.perf_counter() - begin:.3f}s")
+    if path is not None:
+        try:
+            save_injection_plan(path, digest, optimize_config)
+        except (OSError, ValueError) as e:
+            warnings.warn(f"injection plan not saved to {path}: {e}")
+    return optimize_config
+
+def optimize_and_load_gguf(module: nn.Module, rule_file: str, gguf_path: str, model_config: PretrainedConfig, default_device: str = "cuda:0"):
+    plan_dir = None
+    if Config().injection_plan_cache:
+        plan_dir = os.path.join(Config().weight_cache_dir or os.path.join(gguf_path, CACHE_DIR_NAME), INJECTION_PLAN_DIR_NAME)
+    optimize_config = gen_injection_plan(module, rule_file, model_config, default_device, plan_dir)
     
     model_config = translate_model_config(model_config)
 
     gguf_loader=GGUFLoader(gguf_path)
     with torch.device("meta"):
         inject(module, optimize_config, model_config, gguf_loader)
+    if Config().weight_cache:
+        gguf_loader.enable_weight_cache(Config().weight_cache_dir)
+    gguf_loader.enable_pipeline()
     # pre load lm_head because its big inter result
     load_weights(module.lm_head, gguf_loader, "lm_head.")
     load_weights(module, gguf_loader)
+    gguf_loader.disable_pipeline()
+    if gguf_loader.weight_cache is not None:
+        print(gguf_loader.weight_cache.report_string())
     module.gguf_loader = gguf_loader
     del_meta(module)
     torch.cuda.empty_cache()
@@ -2,6 +2,7 @@ from fastapi import APIRouter
 
 from .assistants import router as assistants_router,create_default_assistant
 from .endpoints.chat import router as chat_router
+from .endpoints.sessions import router as sessions_router
 from .legacy import router as legacy_router
 
 router = APIRouter(prefix='/v1')
@@ -9,6 +10,7 @@ router = APIRouter(prefix='/v1')
 
 router.include_router(assistants_router)
 router.include_router(chat_router)
+router.include_router(sessions_router)
 router.include_router(legacy_router)
 
 def post_db_creation_operations():
@@ -9,6 +9,7 @@ from ktransformers.server.schemas.endpoints.chat import ChatCompletionCreate
 from ktransformers.server.schemas.endpoints.chat import RawUsage
 from ktransformers.server.backend.base import BackendInterfaceBase
 from ktransformers.server.config.config import Config
+from ktransformers.server.exceptions import not_found, not_implemented
 
 from ktransformers.server.schemas.endpoints.chat import ChatCompletionChunk
 from openai.types.chat import ChatCompletion
@@ -33,6 +34,14 @@ async def chat_completion(request:Request,create:ChatCompletionCreate):
 
     if Config().api_key != '':
         assert request.headers.get('Authorization', '').split()[-1] == Config().api_key
+    # the other backends sample and schedule with the server wide settings
+    backend_params = {**create.sampling_params(), **create.scheduling_params()} if Config().backend_type == "balance_serve" else {}
+    if create.session_id is not None:
+        if getattr(interface, "sessions", None) is None:
+            raise not_implemented("Sessions of this backend")
+        if create.session_id not in interface.sessions:
+            raise not_found(f"Session {create.session_id}")
+        backend_params["session_id"] = create.session_id
 
     if create.stream:
         from openai.types.chat.chat_completion_chunk import Choice, ChoiceDelta
@@ -46,7 +55,7 @@ async def chat_completion(request:Request,create:ChatCompletionCreate):
                 model = Config().model_name,
             )
             
-            async for res in interface.inference(input_message,id, create.temperature, create.top_p):
+            async for res in interface.inference(input_message,id, create.temperature, create.top_p, **backend_params):
                 if isinstance(res, RawUsage):
                     # at the end of inference, interface.inference() will return the usage of inference
                     raw_usage = res
@@ -77,7 +86,7 @@ async def chat_completion(request:Request,create:ChatCompletionCreate):
 
         content = ""
         finish_reason = None
-        async for res in interface.inference(input_message,id,create.temperature,create.top_p):
+        async for res in interface.inference(input_message,id,create.temperature,create.top_p,**backend_params):
             if isinstance(res, RawUsage):
                 raw_usage = res
                 usage = CompletionUsage(
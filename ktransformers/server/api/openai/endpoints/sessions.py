@@ -0,0 +1,60 @@
+import json
+from uuid import uuid4
+from fastapi import APIRouter
+from fastapi.requests import Request
+from ktransformers.server.utils.create_interface import get_interface
+from ktransformers.server.schemas.base import DeleteResponse
+from ktransformers.server.schemas.endpoints.sessions import SessionCreate, SessionObject
+from ktransformers.server.config.config import Config
+from ktransformers.server.exceptions import internal_server_error, not_found, not_implemented, request_error
+from ktransformers.util.kv_snapshot import KVSnapshotStore
+
+router = APIRouter(prefix='/sessions')
+
+
+def get_sessions(request: Request):
+    if Config().api_key != '':
+        assert request.headers.get('Authorization', '').split()[-1] == Config().api_key
+    interface = get_interface()
+    if getattr(interface, "sessions", None) is None:
+        raise not_implemented("Sessions of this backend")
+    return interface
+
+
+@router.post('/', tags=['openai'], response_model=SessionObject)
+async def create_session(request: Request, create: SessionCreate):
+    interface = get_sessions(request)
+    session_id = create.session_id or str(uuid4())
+    try:
+        KVSnapshotStore.check_id(session_id)
+    except ValueError as e:
+        raise request_error(str(e))
+    messages = [json.loads(m.model_dump_json()) for m in create.messages]
+    try:
+        snapshot = await interface.create_session(session_id, messages)
+    except (OSError, RuntimeError) as e:
+        raise internal_server_error(f"Can't snapshot session {session_id}: {e}")
+    return SessionObject.from_snapshot(snapshot)
+
+
+@router.get('/', tags=['openai'], response_model=list[SessionObject])
+async def list_sessions(request: Request):
+    interface = get_sessions(request)
+    return [SessionObject.from_snapshot(snapshot) for snapshot in interface.sessions.list()]
+
+
+@router.get('/{session_id}', tags=['openai'], response_model=SessionObject)
+async def retrieve_session(request: Request, session_id: str):
+    interface = get_sessions(request)
+    snapshot = interface.sessions.get(session_id)
+    if snapshot is None:
+        raise not_found(f"Session {session_id}")
+    return SessionObject.from_snapshot(snapshot)
+
+
+@router.delete('/{session_id}', tags=['openai'], response_model=DeleteResponse)
+async def delete_session(request: Request, session_id: str):
+    interface = get_sessions(request)
+    if not interface.sessions.remove(session_id):
+        raise not_found(f"Session {session_id}")
+    return DeleteResponse(id=session_id, object="session.deleted")
@@ -7,6 +7,7 @@ from ktransformers.server.utils.create_interface import get_interface
 from ktransformers.server.schemas.assistants.streaming import stream_response
 from ktransformers.server.schemas.legacy.completions import CompletionCreate,CompletionObject
 from ktransformers.server.schemas.endpoints.chat import RawUsage
+from ktransformers.server.config.config import Config
 
 router = APIRouter()
 
@@ -16,11 +17,12 @@ async def create_completion(request:Request,create:CompletionCreate):
 
     interface = get_interface()
     print(f'COMPLETION INPUT:----\n{create.prompt}\n----')
+    backend_params = {**create.sampling_params(), **create.scheduling_params()} if Config().backend_type == "balance_serve" else {}
 
    
     if create.stream:
         async def inner():
-            async for res in interface.inference(create.prompt,id,create.temperature,create.top_p):     
+            async for res in interface.inference(create.prompt,id,create.temperature,create.top_p,**backend_params):     
                 if isinstance(res, RawUsage):
                     raw_usage = res
                 else: 
@@ -32,7 +34,7 @@ async def create_completion(request:Request,create:CompletionCreate):
         return stream_response(request,inner())
     else:
         comp = CompletionObject(id=id,object='text_completion',created=int(time()))
-        async for res in interface.inference(create.prompt,id,create.temperature,create.top_p):     
+        async for res in interface.inference(create.prompt,id,create.temperature,create.top_p,**backend_params):     
             if isinstance(res, RawUsage):
                 raw_usage = res
             else: 
@@ -23,6 +23,7 @@ class ArgumentParser:
         parser.add_argument("--gguf_path", type=str, default=self.cfg.gguf_path)
         parser.add_argument("--optimize_config_path", default=None, type=str, required=False)
         parser.add_argument("--cpu_infer", type=int, default=self.cfg.cpu_infer)
+        parser.add_argument("--numa_partition", type=bool, default=self.cfg.numa_partition)
         parser.add_argument("--backend_type", type=str, default=self.cfg.backend_type)
         parser.add_argument("--chunk_size", type=int, default=self.cfg.chunk_size)
 
@@ -102,7 +103,10 @@ class ArgumentParser:
 
 
         # async server
-        parser.add_argument("--sched_strategy", type=str, default=self.cfg.sched_strategy)
+        parser.add_argument("--sched_strategy", type=str, default=self.cfg.sched_strategy,
+                            choices=["FCFS", "FCFS-single-prefill", "SRPF", "EDF", "FairShare"])
+        parser.add_argument("--slo_ttft_ms", type=int, default=self.cfg.slo_ttft_ms)
+        parser.add_argument("--slo_tbt_ms", type=int, default=self.cfg.slo_tbt_ms)
         # parser.add_argument("--sched_port", type=int, default=self.cfg.sched_port)
         # parser.add_argument("--sched_metrics_port", type=int, default=self.cfg.sched_metrics_port)
         # parser.add_argument("--kvc2_metrics_port", type=int, default=self.cfg.kvc2_metrics_port)
@@ -110,6 +114,8 @@ class ArgumentParser:
         parser.add_argument("--memory_gpu_only", type=str, default=self.cfg.memory_gpu_only)
         parser.add_argument("--utilization_percentage", type=str, default=self.cfg.utilization_percentage)
         parser.add_argument("--cpu_memory_size_GB", type=str, default=self.cfg.cpu_memory_size_GB)
+        parser.add_argument("--swap_pool_size_GB", type=float, default=self.cfg.swap_pool_size_GB,
+                            help="pinned host memory the pages of preempted decodes are swapped out to, 0 turns it off")
 
 
         args = parser.parse_args()
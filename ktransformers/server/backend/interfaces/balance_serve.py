@@ -23,19 +23,23 @@ from ktransformers.optimize.optimize import optimize_and_load_gguf
 from ktransformers.models.custom_modeling_deepseek_v3 import KDeepseekV3ForCausalLM
 from ktransformers.models.custom_modeling_deepseek_v2 import KDeepseekV2ForCausalLM
 from ktransformers.server.balance_serve.inference.model_runner import ModelRunner 
-from ktransformers.server.balance_serve.inference.sampling.sampler import Sampler, SamplingOptions
+from ktransformers.server.balance_serve.inference.sampling.sampler import BatchSampler
 from ktransformers.server.balance_serve.inference.query_manager import QueryManager
 from ktransformers.server.balance_serve.inference.forward_batch import ForwardBatchInput, ForwardBatchOutput
 from ktransformers.server.balance_serve.sched_rpc import SchedulerClient
+from ktransformers.server.balance_serve.kv_broker import KVBrokerClient
+from ktransformers.server.balance_serve import sched_wire
 from ktransformers.server.balance_serve.settings import sched_ext
 from torch.multiprocessing import Queue
 import torch.multiprocessing as mp
 from ktransformers.server.schemas.endpoints.chat import RawUsage
 from ktransformers.server.utils.multi_timer import Profiler
 import zmq
+import zmq.asyncio
 import time
 import queue
 import tempfile
+import hashlib
 import asyncio
 import threading
 from contextlib import asynccontextmanager
@@ -52,32 +56,36 @@ default_optimize_rules = {
     "Qwen2MoeForCausalLM": ktransformer_rules_dir + "Qwen2-57B-A14B-Instruct-serve.yaml",
 }
 
-async def chat_stream(queue: asyncio.Queue, tokenizer: AutoTokenizer):
-    streamer = TextStreamer(tokenizer)
+# how often the engine logs the scheduler rpc latency histograms
+SCHED_LATENCY_REPORT_STEPS = 1000
+# persistent sampling parameter / penalty slots per row of a mini batch
+SAMPLING_SLOTS_PER_BATCH_ROW = 4
+
+
+def user_id_of(user: str) -> int:
+    # stable non negative int64 id of an api user name, -1 is the scheduler's NoUser
+    return int.from_bytes(hashlib.blake2b(user.encode(), digest_size=8).digest(), "little") >> 1
+
+async def chat_stream(queue: asyncio.Queue):
+    # the queue proxy already detokenized the stream, one text piece per generated token
     while True:
-        token = await queue.get()
-        #print(f"Got token: {token}")
-        if token is None:
-            # str = f'{token}\n\n'
-            # str = model.tokenizer.decode(token)
-            s = streamer.end()
-            if s is not None:
-                yield s
+        text = await queue.get()
+        if text is None:
             break
+        yield text
 
-        # str = model.tokenizer.decode(token)
-        yield streamer.put(token)
-        
 
 
 def fill_generated_tokens(query_updates: list[sched_ext.QueryUpdate], generated_tokens: torch.Tensor, query_manager: QueryManager = None):
     #print(len(query_updates), generated_tokens.size(0), generated_tokens)
+    generated_tokens_cpu = generated_tokens.tolist()
     for i in range(generated_tokens.size(0)):
         #print(generated_tokens[i].item())
-        query_updates[i].generated_token = generated_tokens[i].item()
+        query_updates[i].generated_token = generated_tokens_cpu[i]
         if not query_manager.query_map[query_updates[i].id].is_prefill:
             pos = query_updates[i].active_position
             query_manager.query_map[query_updates[i].id].query_tokens[pos] = generated_tokens[i]
+            query_manager.query_map[query_updates[i].id].query_tokens_cpu[pos] = generated_tokens_cpu[i]
 
 def report_last_time_performance(profiler: Profiler):
         try:
@@ -104,10 +112,10 @@ class Engine:
     updates : list[sched_ext.QueryUpdate]
     batch : sched_ext.BatchQueryTodo
     model_runner: ModelRunner
-    sampler: Sampler
+    sampler: BatchSampler
     query_manager: QueryManager
     cache: KDeepSeekV3Cache
-    def __init__(self, args: ConfigArgs = default_args, generated_token_queue:Queue = None, broadcast_endpoint: str = None):
+    def __init__(self, args: ConfigArgs = default_args, token_endpoint: str = None, broadcast_endpoint: str = None):
         self.args = args
 
         # 子进程和父进程无法共享 config 变量
@@ -118,15 +126,18 @@ class Engine:
         self.device = self.args.device
         self.sched_client = SchedulerClient(args.sched_port)
         self.updates = []
+        self.step_count = 0
         config = AutoConfig.from_pretrained(args.model_dir, trust_remote_code=True) 
         self.cache = KDeepSeekV3Cache(config, self.args.page_size)
             
-        self.gen_queue = generated_token_queue
-            
-        print(f"Getting inference context from sched_client.")
-        inference_context = self.sched_client.get_inference_context_raw()
-        print(f"Got inference context, sending it to subscribers.")
-        inference_context = self.sched_client.rebuild_inferece_context(inference_context)
+        context = zmq.Context()
+
+        # generated tokens of a whole step are pushed to the web process as one message
+        self.token_socket = context.socket(zmq.PUSH)
+        self.token_socket.connect(f"ipc://{token_endpoint}")
+
+        # maps the kv pool of this device from the page table the scheduler published
+        inference_context = KVBrokerClient(args.sched_port).attach(self.device)
         self.cache.load(inference_context)
         print(f"kv_cache loaded successfully.")
 
@@ -138,9 +149,6 @@ class Engine:
                 self.model = KDeepseekV2ForCausalLM(config, self.cache)
         # print(self.block_num)
 
-        context = zmq.Context()
-
-            
         self.pub_socket = context.socket(zmq.PUB)
         self.pub_socket.bind(f"ipc://{broadcast_endpoint}") 
         # time.sleep(1) # make sure all subscribers are ready
@@ -176,29 +184,12 @@ class Engine:
         #@TODO add config
         self.model.init_wrapper(self.args.use_cuda_graph, self.device, args.max_batch_size, self.block_num)
 
-        self.model_runner = ModelRunner(self.model, self.device, self.args.use_cuda_graph, page_size = args.page_size)
-        self.sampler = Sampler()
+        # slots also cover queries between prefill chunks and ones not released yet, a query whose slot is
+        # reclaimed gets it rebuilt from its tokens when it runs again
+        self.sampler = BatchSampler(SAMPLING_SLOTS_PER_BATCH_ROW * Config().max_batch_size, config.vocab_size, self.device, self.model.generation_config)
+        self.model_runner = ModelRunner(self.model, self.device, self.args.use_cuda_graph, page_size = args.page_size, sampler = self.sampler)
         self.query_manager = QueryManager(device = self.device, page_size = args.page_size)
 
-            
-    def sampling(self, forward_output: ForwardBatchOutput):
-        generated_tokens = torch.empty(0, device=self.device, dtype=torch.int32)
-        for i in range(forward_output.num_batchs):
-            logit = forward_output.logits[i]
-            if hasattr(forward_output, "temperatures"):
-                temperatures = forward_output.temperatures[i]
-            else:
-                temperatures = None
-            
-            if hasattr(forward_output, "top_ps"):
-                top_ps = forward_output.top_ps[i]
-            else:
-                top_ps = None
-
-            sample_options = SamplingOptions(logit.size(0), self.device, pretrained_config=self.model.generation_config, temperatures=temperatures, top_ps=top_ps)
-            generated_tokens, probs=self.sampler(logit, sample_options)
-        return generated_tokens, probs
-    
     def loop(self):
 
         next_batch = None
@@ -216,20 +207,31 @@ class Engine:
             if self.batch is not None:
                 self.model_runner.run(self.batch, self.query_manager)
 
+            # the scheduler builds the next batch while this one runs on the GPU and the tokens are published
+            update_request = self.sched_client.update_last_batch_async(self.updates)
+
             if len(self.updates) > 0:
+                query_ids = []
+                tokens = []
                 for q in self.updates:
                     if q.is_prefill == True:
                         continue
-                    # print(f"Putting token {q.generated_token} into queue for query id: {q.id}")
-                    try:
-                        self.gen_queue.put((q.id, q.generated_token if q.decode_done == False else None), timeout=5)
-                    except queue.Full:
-                        pass#print("Queue is full after timeout; unable to put more items.")
-                
-            next_batch = self.sched_client.update_last_batch(self.updates)
-            if next_batch.query_ids == []:
+                    query_ids.append(q.id)
+                    tokens.append(q.generated_token if q.decode_done == False else -1)
+                if len(query_ids) > 0:
+                    self.token_socket.send(sched_wire.encode_tokens(query_ids, tokens), copy=False)
+
+            next_batch = self.sched_client.wait_last_batch(update_request)
+            if next_batch is not None and next_batch.query_ids == []:
                 next_batch = None
-            self.pub_socket.send_pyobj(next_batch)  
+            self.pub_socket.send(self.sched_client.last_batch_payload)
+
+            if self.batch is not None:
+                self.step_count += 1
+                if self.step_count % SCHED_LATENCY_REPORT_STEPS == 0:
+                    for line in self.sched_client.latency_report():
+                        logger.info(f"sched rpc {line}")
+                    self.sched_client.reset_latency()
 
             if next_batch is not None:
                 self.query_manager.add_query(next_batch)
@@ -240,10 +242,14 @@ class Engine:
                 #print(f"Model execution time (GPU): {self.model_runner.model_time:.3f} ms")
                 # if self.rank == 0:
                 
-                generated_tokens, probs = self.sampling( self.model_runner.output)
+                # sampled on the device together with the forward pass
+                generated_tokens = self.model_runner.output.generated_tokens
                 
                 self.updates = self.query_manager.update(self.batch)
                 fill_generated_tokens(self.updates, generated_tokens, self.query_manager)
+                for update in self.updates:
+                    if update.decode_done:
+                        self.sampler.release(update.id)
             else:
                 self.updates = []
 
@@ -256,8 +262,8 @@ class BalanceServeThreadContext(ThreadContext):
         return local_messages
     
 
-def run_engine(args, token_queue, broadcast_endpoint, event):
-    engine = Engine(args, token_queue, broadcast_endpoint)
+def run_engine(args, token_endpoint, broadcast_endpoint, event):
+    engine = Engine(args, token_endpoint, broadcast_endpoint)
     if args.use_cuda_graph:
         engine.model_runner.warmup()
         
@@ -283,18 +289,21 @@ class BalanceServeInterface(BackendInterfaceBase):
     def __init__(self, args: ConfigArgs = default_args):
         self.args = args
         self.queue_map:dict[int,asyncio.Queue] = {}
+        self.streamer_map: dict[int, TextStreamer] = {}
         self.thread_map: dict[int, int] = {}
         processes = []
         self.broadcast_endpoint = tempfile.NamedTemporaryFile(delete=False).name # @TODO add to config
         ctx = mp.get_context("spawn")
-        self.token_queue = ctx.Queue(maxsize=1000) 
+        self.token_endpoint = tempfile.NamedTemporaryFile(delete=False).name
+        self.token_socket = zmq.asyncio.Context().socket(zmq.PULL)
+        self.token_socket.bind(f"ipc://{self.token_endpoint}")
         self.tokenizer = AutoTokenizer.from_pretrained(args.model_dir, trust_remote_code=True)
         self.sched_client = SchedulerClient(args.sched_port)
         self.streamer = TextStreamer(self.tokenizer)
 
         start_event = ctx.Event()
 
-        p = ctx.Process(target=run_engine, args=(self.args, self.token_queue, self.broadcast_endpoint, start_event))
+        p = ctx.Process(target=run_engine, args=(self.args, self.token_endpoint, self.broadcast_endpoint, start_event))
         p.start()
         processes.append(p)
         start_event.wait()
@@ -309,23 +318,40 @@ class BalanceServeInterface(BackendInterfaceBase):
         asyncio.create_task(self.queue_proxy())
         yield
 
+    def get_query_queue(self, query_id: int) -> asyncio.Queue:
+        # tokens may arrive before inference() registers the query
+        if query_id not in self.queue_map:
+            self.queue_map[query_id] = asyncio.Queue(maxsize=self.args.max_new_tokens + 2)
+            self.streamer_map[query_id] = TextStreamer(self.tokenizer)
+        return self.queue_map[query_id]
+
+    async def put_text(self, queue: asyncio.Queue, text: Optional[str]):
+        try:
+            queue.put_nowait(text)
+        except asyncio.QueueFull:
+            #print(f"Queue is full, waiting to put: {text}")
+            await queue.put(text)
+
     async def queue_proxy(self):
         print("Queue Proxy Started")
         while True:
-            try:
-                query_id, token = self.token_queue.get_nowait()
-                try:
-                    # query id might not be allocated yet
-                    self.queue_map[query_id].put_nowait(token)
-                    #print(f"Proxy Put token: {token} to queue for query id: {query_id}")
-                except asyncio.QueueFull:
-                    #print(f"Queue for query id: {query_id} is full, waiting to put: {token}")
-                    await self.queue_map[query_id].put(token)
-
-            except queue.Empty:
-                # print("no new token")
-                # await asyncio.sleep(1)
-                await asyncio.sleep(0.01)
+            # wakes up only when the engine pushes a step of tokens
+            data = await self.token_socket.recv(copy=False)
+            query_ids, tokens = sched_wire.decode_tokens(data.buffer)
+            for query_id in query_ids:
+                self.get_query_queue(query_id)
+
+            # detokenize every stream of this step with one batch_decode
+            live = [i for i, token in enumerate(tokens) if token >= 0]
+            texts = TextStreamer.put_batch([self.streamer_map[query_ids[i]] for i in live], [tokens[i] for i in live])
+            for i, text in zip(live, texts):
+                await self.put_text(self.queue_map[query_ids[i]], text)
+
+            for query_id, token in zip(query_ids, tokens):
+                if token < 0:
+                    streamer = self.streamer_map.pop(query_id)
+                    await self.put_text(self.queue_map[query_id], streamer.end())
+                    await self.put_text(self.queue_map[query_id], None)
     def tokenize_prompt(self, prompt: str):
         input_ids = self.tokenizer.encode(prompt, return_tensors="pt").to(self.args.device)
         return input_ids
@@ -351,7 +377,10 @@ class BalanceServeInterface(BackendInterfaceBase):
         logger.debug(f"get input ids of shape {input_ids.shape}")
         return input_ids
     
-    async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None):
+    async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None,
+                        top_k: Optional[int] = None, min_p: Optional[float] = None, repetition_penalty: Optional[float] = None,
+                        frequency_penalty: Optional[float] = None, presence_penalty: Optional[float] = None, seed: Optional[int] = None,
+                        user: Optional[str] = None):
         profiler = Profiler()
         profiler.create_and_start_timer("tokenize")
         
@@ -403,10 +432,29 @@ class BalanceServeInterface(BackendInterfaceBase):
         if top_p == 0:
             top_p = 0.0001
         query_add.sample_options.top_p = top_p
+        # unset options keep the SampleOptions defaults: model top_k, no min_p, no penalties, unseeded
+        if top_k is not None:
+            query_add.sample_options.top_k = top_k
+        if min_p is not None:
+            query_add.sample_options.min_p = min_p
+        if repetition_penalty is not None:
+            query_add.sample_options.repetition_penalty = repetition_penalty
+        if frequency_penalty is not None:
+            query_add.sample_options.frequency_penalty = frequency_penalty
+        if presence_penalty is not None:
+            query_add.sample_options.presence_penalty = presence_penalty
+        if seed is not None:
+            query_add.sample_options.seed = seed
         query_add.estimated_length = min(self.args.cache_lens, query_length+self.args.max_new_tokens)
+        # read by the SLO and fair share scheduling strategies
+        if user is not None:
+            query_add.user_id = user_id_of(user)
+        if self.args.slo_ttft_ms is not None:
+            query_add.SLO_TTFT_ms = self.args.slo_ttft_ms
+        if self.args.slo_tbt_ms is not None:
+            query_add.SLO_TBT_ms = self.args.slo_tbt_ms
         query_id = self.sched_client.add_query(query_add)
-        queue = asyncio.Queue(maxsize=self.args.max_new_tokens)
-        self.queue_map[query_id] = queue
+        self.get_query_queue(query_id)
         self.thread_map[thread_id] = query_id
         is_first_token = True
 
@@ -414,7 +462,7 @@ class BalanceServeInterface(BackendInterfaceBase):
         print(f'YIELD_THRESHOLD = {YIELD_THRESHOLD}')
         last_tokens = ''
 
-        async for token in chat_stream(self.queue_map[query_id], self.tokenizer):
+        async for token in chat_stream(self.queue_map[query_id]):
             if is_first_token:
                 is_first_token=False
                 profiler.pause_timer("prefill")
@@ -434,6 +482,7 @@ class BalanceServeInterface(BackendInterfaceBase):
                     last_tokens = ''
                     last_reason = None
         profiler.pause_timer("decode")
+        self.queue_map.pop(query_id, None)
         if last_tokens:
             print(last_tokens, end="", flush=True)
             yield last_tokens, None
@@ -1,5 +1,10 @@
+import os
+import copy
+import time
 import torch
 import asyncio
+import numpy as np
+from collections import deque
 from transformers import AutoTokenizer, AutoConfig, GenerationConfig
 from ktransformers.server.backend.interfaces.transformers import (
     TransformersInterface,
@@ -13,10 +18,16 @@ from ktransformers.optimize.optimize import optimize_and_load_gguf
 from ktransformers.models.custom_cache import StaticCache
 from ktransformers.util.cuda_graph_runner import CUDAGraphRunner
 from ktransformers.local_chat import custom_models, default_optimize_rules
-from ktransformers.util.utils import get_device
-from typing import Optional
+from ktransformers.util.utils import get_device, get_compute_capability
+from ktransformers.util.vendors import device_manager, GPUVendor
+from ktransformers.operators.experts import cuda_graphs
+from typing import List, Optional
 from ktransformers.operators.flashinfer_wrapper import flashinfer_enabled, MLAWrapperSingleton
 from ktransformers.server.schemas.endpoints.chat import RawUsage
+from ktransformers.server.config.config import Config
+from ktransformers.util.prefix_cache import PrefixCache
+from ktransformers.util.kv_snapshot import KVSnapshot, KVSnapshotStore
+from ktransformers.operators.models import KLlamaModel
 
 warm_uped = False
 
@@ -24,6 +35,49 @@ class KTransformersThreadContext(TransformersThreadContext):
     pass
 
 
+class SlotRequest:
+    """A request waiting for or holding a decode slot, its text pieces are handed to the caller through outputs."""
+
+    def __init__(self, input_ids: torch.Tensor, temperature: Optional[float], top_p: Optional[float]):
+        self.input_ids = input_ids
+        self.temperature = temperature
+        self.top_p = top_p
+        self.outputs = asyncio.Queue()
+        self.cancelled = False
+        self.max_new_tokens = 0
+        self.tokenize_time = 0.0
+        self.prefill_time = 0.0
+        self.decode_time = 0.0
+        self.prefill_count = 0
+        self.decode_count = 0
+
+
+class DecodeSlot:
+    """Decoding state of one batch row of the StaticCache, the token history stays after retire for prefix reuse."""
+
+    def __init__(self, slot_id: int, streamer: TextStreamer):
+        self.slot_id = slot_id
+        self.request: Optional[SlotRequest] = None
+        self.generated_ids: Optional[torch.Tensor] = None
+        self.seq_length = 0
+        self.streamer = streamer
+        self.logits_warper = None
+        self.inputs = None
+        self.ever_generated_ids = set()
+        self.last_used = 0
+        # prefill generator of the request while its prompt is still being prefilled chunk by chunk
+        self.prefill = None
+
+    def common_prefix(self, input_ids: torch.Tensor) -> int:
+        if self.generated_ids is None:
+            return 0
+        prev_ids = self.generated_ids[0, :self.seq_length]
+        flat_input_ids = input_ids.flatten().to(prev_ids.device)
+        n = min(prev_ids.shape[0], flat_input_ids.shape[0])
+        unequal = torch.nonzero(prev_ids[:n] != flat_input_ids[:n])
+        return n if unequal.shape[0] == 0 else unequal[0, 0].item()
+
+
 class KTransformersInterface(TransformersInterface):
     def __init__(self, args: ConfigArgs = default_args):
         self.args = args
@@ -63,6 +117,12 @@ class KTransformersInterface(TransformersInterface):
         self.model.generation_config = generation_config
         self.device_map = self.model.gguf_loader.tensor_device_map
         # logger.info(f"{args.model_name} loaded from {args.model_dir} to {self.device_map}")
+        self.continuous_batching = args.batch_size > 1 and self.batch_decode_supported(config)
+        if args.batch_size > 1 and not self.continuous_batching:
+            logger.warning(f"batched decode is not supported for {config.architectures[0]} on this platform, "
+                           f"requests are served one at a time")
+            # the serialized path decodes one sequence, the cache only needs its row
+            args.batch_size = 1
         self.cache = StaticCache(
             config=self.model.config,
             max_batch_size=args.batch_size,
@@ -71,6 +131,16 @@ class KTransformersInterface(TransformersInterface):
             dtype=self.model.dtype,
         )
         # logger.info(f"StaticCache (length={args.cache_lens}), batch size:{args.batch_size}")
+        cfg = Config()
+        if cfg.prefix_cache:
+            self.prefix_cache = PrefixCache(
+                namespace=f"{gguf_path}|{optimize_config_path}|{config.architectures[0]}",
+                dtype=self.model.dtype,
+                block_size=cfg.prefix_cache_block_size,
+                ram_bytes=int(cfg.prefix_cache_ram_gb * (1 << 30)),
+                disk_dir=cfg.prefix_cache_dir,
+                disk_bytes=int(cfg.prefix_cache_disk_gb * (1 << 30)),
+            )
 
         if self.model.generation_config.pad_token_id is None:
             self.model.generation_config.pad_token_id = self.model.generation_config.eos_token_id
@@ -78,6 +148,35 @@ class KTransformersInterface(TransformersInterface):
 
         self._infer_lock = asyncio.Lock()
 
+        if self.continuous_batching:
+            self.slots = [DecodeSlot(i, TextStreamer(self.tokenizer)) for i in range(args.batch_size)]
+            self.pending = deque()
+            self.batch_loop = None
+            self.slot_clock = 0
+            # the cpu experts stage decode batches in buffers sized by cuda_graphs, graphs can only use those sizes
+            self.graph_batch_sizes = [size for size in cuda_graphs if size <= args.batch_size] if args.use_cuda_graph else []
+            self.batch_graph_runners = {}
+            self.warm_batch_sizes = set()
+            logger.info(f"continuous batching over {args.batch_size} slots, cuda graph batch sizes {self.graph_batch_sizes}")
+
+        # long-context models keep their kv in the CPU kvcache of KLlamaModel, sessions snapshot it to disk
+        self.sessions = None
+        if KLlamaModel.dynamic_sdpa is not None and not self.continuous_batching:
+            self.sessions = KVSnapshotStore(cfg.session_dir, disk_bytes=int(cfg.session_disk_gb * (1 << 30)))
+            logger.info(f"{len(self.sessions.snapshots)} session snapshots in {cfg.session_dir}")
+
+    @staticmethod
+    def batch_decode_supported(config) -> bool:
+        # batched decode runs the triton MLA kernel over per slot page table rows, StaticCache pages MLA models only
+        if config.architectures[0] not in ("DeepseekV2ForCausalLM", "DeepseekV3ForCausalLM"):
+            return False
+        return os.name != 'nt' and get_compute_capability() >= 8 and device_manager.gpu_vendor == GPUVendor.NVIDIA
+
+    @property
+    def main_device(self) -> str:
+        torch_device = get_device("blk.0.self_attn", self.model.gguf_loader.tensor_device_map)
+        return "cuda:0" if torch_device == "cuda" else torch_device
+
     def decode_one_tokens(self):
         global warm_uped
 
@@ -140,27 +239,17 @@ class KTransformersInterface(TransformersInterface):
 
         if is_new:
             self.ever_generated_ids.clear()
-            same_prefix = 0
-            flat_input_ids = input_ids.flatten()
-
             if getattr(self, 'generated_ids', None) is None:
+                # one sequence per interface (or per decode slot), batch_size counts the slots
                 self.generated_ids = torch.zeros(
-                    self.args.batch_size,
+                    1,
                     input_ids.shape[-1] + self.args.max_new_tokens + 1,
                     dtype=torch.int,
                     device=self.args.device,
                 )
                 self.seq_length = 1            
-            
-            flat_prev_ids = self.generated_ids.flatten()
-            for i in range(min(self.seq_length, flat_input_ids.shape[0]) - 1):
-                if flat_input_ids[i] == flat_prev_ids[i]:
-                    same_prefix += 1
-                else:
-                    break
-            
-            logger.debug(f"same prefix len: {same_prefix}")
-            self.cache.remove_suffix(same_prefix)
+
+            same_prefix = self.reuse_prefix(input_ids)
             self.seq_length = same_prefix
             self.generated_ids = self.generated_ids[..., :same_prefix]
             input_ids = input_ids[..., same_prefix:]
@@ -177,7 +266,7 @@ class KTransformersInterface(TransformersInterface):
         delta_length = expected_length - self.generated_ids.shape[-1]
         if delta_length > 0:
             new_generate_ids = torch.zeros(
-                self.args.batch_size, delta_length, dtype=torch.int, device=self.args.device
+                1, delta_length, dtype=torch.int, device=self.args.device
             )
             self.generated_ids = torch.cat([self.generated_ids, new_generate_ids], dim=-1)
         else:
@@ -216,6 +305,9 @@ class KTransformersInterface(TransformersInterface):
                 self.cache.cur_idx=cache_position[chunk_start:chunk_end]
             logits = chunk_prefill(input_ids[:, chunk_start:chunk_end], cache_position[chunk_start:chunk_end])
             chunk_start += self.args.chunk_size
+            if chunk_start < input_ids_length:
+                # lets the batch loop run decode steps of the other slots between two chunks
+                yield None
             
         if flashinfer_enabled:
             MLAWrapperSingleton.reset_buffer()
@@ -228,8 +320,270 @@ class KTransformersInterface(TransformersInterface):
         device = self.device_map.get("blk.0.self_attn", {}).get("generate_device", "cuda:0")
         return torch.tensor([self.seq_length - 1], device=device)
     
-    async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None):
+    SLOT_STATE = ("generated_ids", "seq_length", "streamer", "logits_warper", "inputs", "ever_generated_ids")
+
+    def bind_slot(self, slot: DecodeSlot):
+        """Point the single sequence state (prefill, sampling, streaming) and the cache at a slot."""
+        for name in self.SLOT_STATE:
+            setattr(self, name, getattr(slot, name))
+        self.cache.set_active_slot(slot.slot_id)
+
+    def save_slot(self, slot: DecodeSlot):
+        for name in self.SLOT_STATE:
+            setattr(slot, name, getattr(self, name))
+
+    def pick_slot(self, request: SlotRequest) -> Optional[DecodeSlot]:
+        """Free slot sharing the longest prefix with the request, least recently used on ties."""
+        free = [slot for slot in self.slots if slot.request is None]
+        if not free:
+            return None
+        return max(free, key=lambda slot: (slot.common_prefix(request.input_ids), -slot.last_used))
+
+    def finish_slot(self, slot: DecodeSlot, finish_reason: str):
+        self.bind_slot(slot)
+        self.store_prefix()
+        slot.request.outputs.put_nowait((slot.streamer.end(), None))
+        slot.request.outputs.put_nowait(("", finish_reason))
+        slot.request = None
+        self.slot_clock += 1
+        slot.last_used = self.slot_clock
+
+    def admit(self, request: SlotRequest, slot: DecodeSlot):
+        slot.request = request
+        self.bind_slot(slot)
+        self.streamer.reset()
+        self.save_slot(slot)
+        slot.prefill = self.prefill(request.input_ids, True, request.temperature, request.top_p)
+
+    def prefill_step(self, slot: DecodeSlot):
+        """Run the next chunk_size tokens of the prompt of a slot, the slot joins the decode batch once it is done."""
+        request = slot.request
+        self.bind_slot(slot)
+        begin = time.perf_counter()
+        t = next(slot.prefill, StopIteration)
+        request.prefill_time += time.perf_counter() - begin
+        if t is not StopIteration:
+            if t is not None:
+                request.outputs.put_nowait((t, None))
+            self.save_slot(slot)
+            return
+        slot.prefill = None
+        request.prefill_count = self.profiler.get_counter("prefill")
+        request.max_new_tokens = min(self.args.max_new_tokens, self.args.cache_lens - self.seq_length) - 1
+        self.save_slot(slot)
+        if request.max_new_tokens <= 1:
+            self.finish_slot(slot, "length")
+
+    def decode_batch(self, slots: List[DecodeSlot]) -> torch.Tensor:
+        """Run one decode step for every slot, returns the last token logits with one row per slot."""
+        torch_device = self.main_device
+        torch.cuda.set_device(torch_device)
+        batch_size = len(slots)
+        graph_size = next((size for size in self.graph_batch_sizes if size >= batch_size), None)
+        padded_size = batch_size if graph_size is None else graph_size
+        # padding rows repeat the first slot, they write the same kv at the same place and their logits are dropped
+        rows = slots + [slots[0]] * (padded_size - batch_size)
+        slot_ids = [slot.slot_id for slot in rows]
+        cur_token = torch.stack([slot.generated_ids[0, slot.seq_length - 1] for slot in rows]).view(-1, 1).to("cpu")
+        cache_position = torch.tensor([slot.seq_length - 1 for slot in rows], device=torch_device)
+        position_ids = cache_position.unsqueeze(1)
+
+        self.cache.begin_batch_decode(slot_ids)
+        try:
+            runner = self.batch_graph_runners.get(padded_size)
+            if runner is None and graph_size is not None and padded_size in self.warm_batch_sizes:
+                runner = CUDAGraphRunner()
+                runner.capture(
+                    self.model,
+                    cur_token,
+                    position_ids,
+                    cache_position,
+                    self.cache,
+                    main_device=torch_device,
+                    return_dict=False,
+                    use_cache=True,
+                )
+                self.batch_graph_runners[padded_size] = runner
+            if runner is not None:
+                logits = runner(cur_token, position_ids, cache_position)
+            else:
+                # first step of a batch size runs eagerly, so triton kernels are compiled before a capture
+                inputs_embeds = self.model.model.embed_tokens(cur_token).to(torch_device)
+                logits = self.model(
+                    inputs_embeds=inputs_embeds,
+                    position_ids=position_ids,
+                    cache_position=cache_position,
+                    past_key_values=self.cache,
+                    return_dict=False,
+                    use_cache=True,
+                )[0]
+                self.warm_batch_sizes.add(padded_size)
+        finally:
+            self.cache.end_batch_decode(slot_ids)
+        return logits[:batch_size, -1, :]
+
+    def decode_step(self, slots: List[DecodeSlot]):
+        requests = [slot.request for slot in slots]
+        begin = time.perf_counter()
+        logits = self.decode_batch(slots)
+        for slot, slot_logits in zip(slots, logits):
+            request = slot.request
+            self.bind_slot(slot)
+            next_token = self.logits_to_token(slot_logits)
+            request.decode_count += 1
+            if next_token == self.tokenizer.eos_token_id or "<|im_end|>" == self.tokenizer.decode(next_token):
+                self.save_slot(slot)
+                self.finish_slot(slot, "stop")
+                continue
+            text = self.append_new_tokens(next_token)
+            self.save_slot(slot)
+            if text:
+                request.outputs.put_nowait((text, None))
+            if request.decode_count >= request.max_new_tokens - 1:
+                self.finish_slot(slot, "length")
+        elapsed = time.perf_counter() - begin
+        for request in requests:
+            request.decode_time += elapsed
+
+    async def run_batch_loop(self):
+        """
+        Admit waiting requests into free slots and decode all occupied slots together, one step at a time. Prompts
+        are prefilled one at a time, chunk_size tokens between two decode steps, so a long prompt does not stall
+        the requests that are already streaming.
+        """
+        while True:
+            for slot in self.slots:
+                if slot.request is not None and slot.request.cancelled:
+                    # the client went away, free the slot without finishing the stream
+                    slot.request = None
+                    slot.prefill = None
+            while self.pending and self.pending[0].cancelled:
+                self.pending.popleft()
+            occupied = [slot for slot in self.slots if slot.request is not None]
+            if not occupied and not self.pending:
+                break
+            try:
+                prefilling = next((slot for slot in occupied if slot.prefill is not None), None)
+                if prefilling is None and self.pending:
+                    prefilling = self.pick_slot(self.pending[0])
+                    if prefilling is not None:
+                        self.admit(self.pending.popleft(), prefilling)
+                if prefilling is not None:
+                    self.prefill_step(prefilling)
+                active = [slot for slot in self.slots if slot.request is not None and slot.prefill is None]
+                if active:
+                    self.decode_step(active)
+            except Exception as e:
+                logger.exception("batched decode failed")
+                for slot in self.slots:
+                    if slot.request is not None:
+                        slot.request.outputs.put_nowait(e)
+                        slot.request = None
+                        slot.prefill = None
+                for request in self.pending:
+                    request.outputs.put_nowait(e)
+                self.pending.clear()
+            # let the callers stream out and new requests queue up
+            await asyncio.sleep(0)
+
+    async def batched_inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None):
+        begin = time.perf_counter()
+        input_ids, think = self.tokenize_messages(local_messages, thread_id)
+        request = SlotRequest(input_ids, temperature, top_p)
+        request.tokenize_time = time.perf_counter() - begin
+        self.pending.append(request)
+        if self.batch_loop is None or self.batch_loop.done():
+            self.batch_loop = asyncio.get_running_loop().create_task(self.run_batch_loop())
+
+        try:
+            if think is not None:
+                yield think, None
+            finish_reason = None
+            while finish_reason is None:
+                items = [await request.outputs.get()]
+                # everything decoded while this caller was busy goes out as one piece
+                while not request.outputs.empty() and not isinstance(items[-1], BaseException) and items[-1][1] is None:
+                    items.append(request.outputs.get_nowait())
+                for item in items:
+                    if isinstance(item, BaseException):
+                        raise item
+                text = "".join(t for t, _ in items if t is not None)
+                finish_reason = items[-1][1]
+                yield text, finish_reason
+        finally:
+            request.cancelled = True
+
+        yield RawUsage(
+            tokenize_time = request.tokenize_time,
+            prefill_time = request.prefill_time,
+            decode_time = request.decode_time,
+            prefill_count = request.prefill_count,
+            decode_count = request.decode_count,
+        )
+
+    async def create_session(self, session_id: str, messages: list) -> KVSnapshot:
+        """Prefill messages from scratch and snapshot their kvcache under session_id."""
+        async with self._infer_lock:
+            # a full prefill, so the recorded prefill time is what a restore saves
+            self.last_request_id = None
+            self.seq_length = 0
+            self.streamer.reset()
+            input_ids = self.format_and_tokenize_input_ids(session_id, copy.deepcopy(messages))
+            begin = time.perf_counter()
+            for _ in self.prefill(input_ids, True, None, None):
+                pass
+            torch.cuda.synchronize()
+            prefill_time = time.perf_counter() - begin
+            length = input_ids.shape[-1]
+            snapshot = self.sessions.add(
+                session_id, input_ids[0].cpu().numpy(), messages, prefill_time,
+                lambda path: KLlamaModel.dynamic_sdpa.save(path, length),
+            )
+            logger.info(f"session {session_id}: prefilled {length} tokens in {prefill_time:.2f}s, "
+                        f"snapshot of {snapshot.nbytes / 2**30:.2f} GB")
+            return snapshot
+
+    def restore_session(self, session_id: str) -> list:
+        """
+        Load the kvcache snapshot of a session, unless the cache still starts with its tokens. The prefill of the
+        request then only runs the tokens after the shared prefix. Returns the session messages.
+        """
+        snapshot = self.sessions.get(session_id)
+        if snapshot is None:
+            raise KeyError(f"no session {session_id}")
+        length = snapshot.length
+        tokens = torch.from_numpy(np.array(self.sessions.tokens(session_id))).to(self.args.device).to(torch.int)
+        resident = (
+            getattr(self, "generated_ids", None) is not None
+            and self.seq_length >= length
+            and torch.equal(self.generated_ids[0, :length], tokens)
+        )
+        if resident:
+            self.sessions.touch(session_id)
+        else:
+            begin = time.perf_counter()
+            KLlamaModel.dynamic_sdpa.load(self.sessions.kv_path(session_id), length)
+            self.generated_ids = torch.zeros(1, length, dtype=torch.int, device=self.args.device)
+            self.generated_ids[0] = tokens
+            self.seq_length = length
+            self.last_request_id = None
+            self.sessions.touch(session_id, restore_time=time.perf_counter() - begin)
+            logger.info(self.sessions.report_string(session_id))
+        return copy.deepcopy(snapshot.messages)
+
+    async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None,
+                        session_id: Optional[str] = None):
+        if session_id is not None and self.sessions is None:
+            raise ValueError("sessions need a long-context model and no continuous batching")
+        if self.continuous_batching:
+            async for v in self.batched_inference(local_messages, thread_id, temperature, top_p):
+                yield v
+            return
+
         async with self._infer_lock:
+            if session_id is not None:
+                # the request continues the session prompt
+                local_messages = self.restore_session(session_id) + local_messages
             async for v in super().inference(local_messages, thread_id, temperature, top_p):
                 yield v
             
@@ -20,90 +20,8 @@ from ..base import ThreadContext, BackendInterfaceBase
 from ktransformers.server.config.log import logger
 from ..args import ConfigArgs, default_args
 from ktransformers.operators.flashinfer_wrapper import flashinfer_enabled, MLAWrapperSingleton
-
-# This TextStreamer is a modified version from https://github.com/huggingface/transformers/blob/main/src/transformers/generation/streamers.py
-class TextStreamer:
-
-    def __init__(self, tokenizer: "AutoTokenizer", skip_prompt: bool = False, **decode_kwargs):
-        self.tokenizer = tokenizer
-        self.skip_prompt = skip_prompt
-        self.decode_kwargs = decode_kwargs
-
-        # variables used in the streaming process
-        self.token_cache = []
-        self.print_len = 0
-        self.next_tokens_are_prompt = True
-
-    def reset(self):
-        self.token_cache = []
-        self.print_len = 0
-
-    def put(self, value) -> Optional[str]:
-        """
-        Receives tokens, decodes them, and prints them to stdout as soon as they form entire words.
-        """
-        if not isinstance(value, int):
-            raise ValueError("TextStreamer only supports batch size 1, and int type input")
-
-        if self.skip_prompt and self.next_tokens_are_prompt:
-            self.next_tokens_are_prompt = False
-            return None
-
-        # Add the new token to the cache and decodes the entire thing.
-        self.token_cache.append(value)
-        text = self.tokenizer.decode(self.token_cache, skip_special_tokens=True, **self.decode_kwargs)
-
-        # After the symbol for a new line, we flush the cache.
-        if text.endswith("\n"):
-            printable_text = text[self.print_len :]
-            self.reset()
-        # If the last token is a CJK character, we print the characters.
-        elif len(text) > 0 and self._is_chinese_char(ord(text[-1])):
-            printable_text = text[self.print_len :]
-            self.print_len += len(printable_text)
-        # Otherwise, prints until the last space char (simple heuristic to avoid printing incomplete words,
-        # which may change with the subsequent token -- there are probably smarter ways to do this!)
-        else:
-            printable_text = text[self.print_len : text.rfind(" ") + 1]
-            self.print_len += len(printable_text)
-        return printable_text
-
-    def end(self) -> Optional[str]:
-        """Flushes any remaining cache and prints a newline to stdout."""
-        # Flush the cache, if it exists
-        if len(self.token_cache) > 0:
-            text = self.tokenizer.decode(self.token_cache, skip_special_tokens=True, **self.decode_kwargs)
-            printable_text = text[self.print_len :]
-            self.reset()
-        else:
-            printable_text = ""
-
-        self.next_tokens_are_prompt = True
-        return printable_text
-
-    def _is_chinese_char(self, cp):
-        """Checks whether CP is the codepoint of a CJK character."""
-        # This defines a "chinese character" as anything in the CJK Unicode block:
-        #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
-        #
-        # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
-        # despite its name. The modern Korean Hangul alphabet is a different block,
-        # as is Japanese Hiragana and Katakana. Those alphabets are used to write
-        # space-separated words, so they are not treated specially and handled
-        # like the all of the other languages.
-        if (
-            (cp >= 0x4E00 and cp <= 0x9FFF)
-            or (cp >= 0x3400 and cp <= 0x4DBF)  #
-            or (cp >= 0x20000 and cp <= 0x2A6DF)  #
-            or (cp >= 0x2A700 and cp <= 0x2B73F)  #
-            or (cp >= 0x2B740 and cp <= 0x2B81F)  #
-            or (cp >= 0x2B820 and cp <= 0x2CEAF)  #
-            or (cp >= 0xF900 and cp <= 0xFAFF)
-            or (cp >= 0x2F800 and cp <= 0x2FA1F)  #
-        ):  #
-            return True
-
-        return False
+from ktransformers.util.textstream import TextStreamer
+from ktransformers.util.prefix_cache import PrefixCache
 
 
 class TransformersThreadContext(ThreadContext):
@@ -126,6 +44,7 @@ class TransformersInterface(BackendInterfaceBase):
     seq_length: int
 
     streamer: TextStreamer
+    prefix_cache: Optional[PrefixCache] = None
 
     # thread_related
     last_request_id: Optional[str] = None
@@ -258,6 +177,40 @@ class TransformersInterface(BackendInterfaceBase):
 
         return self.logits_to_token(logits)
 
+    def reuse_prefix(self, input_ids: torch.Tensor) -> int:
+        """
+        Number of leading input_ids whose KV stays in the cache: the part shared with the sequence already there, or
+        a longer prefix restored from the prefix cache. The cache is cut after it. The last input token is always
+        left to prefill, its logits give the first new token.
+        """
+        flat_input_ids = input_ids.flatten()
+        limit = max(min(self.seq_length, flat_input_ids.shape[0]) - 1, 0)
+        flat_prev_ids = self.generated_ids.flatten()[:limit].to(flat_input_ids.device)
+        unequal = torch.nonzero(flat_prev_ids != flat_input_ids[:limit])
+        same_prefix = limit if unequal.shape[0] == 0 else unequal[0, 0].item()
+        logger.debug(f"same prefix len: {same_prefix}")
+
+        if self.prefix_cache is not None:
+            restored = self.prefix_cache.restore(self.cache, flat_input_ids[:-1], skip_tokens=same_prefix)
+            if restored > same_prefix:
+                logger.debug(f"restored prefix len: {restored}")
+                if self.generated_ids.shape[-1] < restored:
+                    pad = torch.zeros(
+                        self.generated_ids.shape[0], restored - self.generated_ids.shape[-1],
+                        dtype=self.generated_ids.dtype, device=self.generated_ids.device,
+                    )
+                    self.generated_ids = torch.cat([self.generated_ids, pad], dim=-1)
+                self.generated_ids[:, :restored] = flat_input_ids[:restored].to(self.generated_ids.device).to(torch.int)
+                same_prefix = restored
+        self.cache.remove_suffix(same_prefix)
+        return same_prefix
+
+    def store_prefix(self):
+        """Save the KV of the current sequence in the prefix cache, the last token has no KV yet."""
+        if self.prefix_cache is None or getattr(self, "generated_ids", None) is None:
+            return
+        self.prefix_cache.insert(self.cache, self.generated_ids[0, :self.seq_length - 1])
+
     @torch.no_grad
     def prefill(self, input_ids: torch.Tensor, is_new: bool, temperature: Optional[float] = None, top_p: Optional[float] = None):
         input_ids_length = input_ids.shape[-1]
@@ -265,9 +218,6 @@ class TransformersInterface(BackendInterfaceBase):
 
         if is_new:
             self.ever_generated_ids.clear()
-            same_prefix = 0
-            flat_input_ids = input_ids.flatten()
-
             if getattr(self, 'generated_ids', None) is None:
                 self.generated_ids = torch.zeros(
                     self.args.batch_size,
@@ -276,16 +226,8 @@ class TransformersInterface(BackendInterfaceBase):
                     device=self.args.device,
                 )
                 self.seq_length = 1            
-            
-            flat_prev_ids = self.generated_ids.flatten()
-            for i in range(min(self.seq_length, flat_input_ids.shape[0]) - 1):
-                if flat_input_ids[i] == flat_prev_ids[i]:
-                    same_prefix += 1
-                else:
-                    break
-            
-            logger.debug(f"same prefix len: {same_prefix}")
-            self.cache.remove_suffix(same_prefix)
+
+            same_prefix = self.reuse_prefix(input_ids)
             self.seq_length = same_prefix
             self.generated_ids = self.generated_ids[..., :same_prefix]
             input_ids = input_ids[..., same_prefix:]
@@ -375,9 +317,8 @@ class TransformersInterface(BackendInterfaceBase):
                 self.last_request_id = thread_id
                 return True
 
-    async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None):
-        self.streamer.reset()
-        self.profiler.create_and_start_timer("tokenize")
+    def tokenize_messages(self, local_messages, thread_id: str):
+        """Prompt ids of a request and the forced think text appended to it (None when force think is off)."""
         if isinstance(local_messages, List):
             input_ids = self.format_and_tokenize_input_ids(thread_id, local_messages)
         elif isinstance(local_messages, str):
@@ -387,6 +328,7 @@ class TransformersInterface(BackendInterfaceBase):
         else:
             raise ValueError("local_messages should be List or str")
         
+        think = None
         if Config().user_force_think:
             suffix = os.getenv("KT_CONF_SUFFIX")
             if not suffix:
@@ -408,6 +350,13 @@ class TransformersInterface(BackendInterfaceBase):
             input_ids = torch.cat(
                 [input_ids, token_thinks], dim=1
             )
+            think = '<think>\n' + think_prefix
+        return input_ids, think
+
+    async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None):
+        self.streamer.reset()
+        self.profiler.create_and_start_timer("tokenize")
+        input_ids, think = self.tokenize_messages(local_messages, thread_id)
 
         self.profiler.pause_timer("tokenize")
 
@@ -416,8 +365,7 @@ class TransformersInterface(BackendInterfaceBase):
 
         self.profiler.create_and_start_timer("prefill")
 
-        if Config().user_force_think:
-            think = '<think>\n' + think_prefix
+        if think is not None:
             print(think, end="",flush=True)
             yield think, None
         
@@ -446,4 +394,5 @@ class TransformersInterface(BackendInterfaceBase):
             yield last_tokens, last_reason
         print("")
         self.profiler.pause_timer("decode")
+        self.store_prefix()
         self.report_last_time_performance()
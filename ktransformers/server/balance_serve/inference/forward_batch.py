@@ -4,6 +4,7 @@ LastEditors: Xie Weiyu ervinxie@qq.com
 LastEditTime: 2024-11-26 08:12:49
 '''
 import torch
+import numpy as np
 from ktransformers.server.balance_serve.settings import sched_ext
 from ktransformers.server.balance_serve.inference.query_manager import QueryManager, QueryInfo
 import time
@@ -18,6 +19,9 @@ class ForwardBatchInput:
         kv_len: torch.Tensor
         position_ids: torch.Tensor
         tokens: torch.Tensor
+        tokens_cpu: torch.Tensor
+        page_idx: torch.Tensor
+        page_offset: torch.Tensor
         batch_indices: torch.Tensor
         positions: torch.Tensor
         chunk_size: int
@@ -25,140 +29,162 @@ class ForwardBatchInput:
         is_last_prefill_chunk: bool
         logits_start: list
 
-        temperatures: torch.Tensor
-        top_ps: torch.Tensor
-
         def __init__(self, prefill_querys_info: list[QueryInfo], decode_querys_info: list[QueryInfo], prefill_s: list[int] = None, prefill_l: list[int] = None, device = torch.device('cuda'), page_size = 256):
-            batch_decode = len(decode_querys_info)
-            batch_prefill = len(prefill_querys_info)
-
-            self.q_indptr = torch.tensor([0], device=device, dtype=torch.int32)
-            self.kv_indptr = torch.tensor([0], device=device, dtype=torch.int32)
-            self.kv_indices = torch.tensor([], device=device, dtype=torch.int32)
-            self.kv_len = torch.tensor([], device=device, dtype=torch.int32)
-            self.kv_last_page_len = torch.tensor([], device=device, dtype=torch.int32)
-            self.position_ids = torch.tensor([], device=device, dtype=torch.int32)
-            self.tokens = torch.tensor([], device=device, dtype=torch.int32)
-
-            self.temperatures = torch.tensor([], device=device, dtype=torch.float32)
-            self.top_ps = torch.tensor([], device=device, dtype=torch.float32)
-
-            self.logits_start = []
-            self.decode_batch = batch_decode
-            self.num_tokens = batch_decode + sum(prefill_l)
-            self.batch_size = batch_decode + batch_prefill
-            
-            for i, prefill_query_info in enumerate(prefill_querys_info):
-                if prefill_query_info != None:
-                    prefill_kv_block_len = (prefill_query_info.active_position + prefill_l[i] + page_size - 1) // page_size if prefill_query_info is not None else 0
-                    # print(f"block_len: {prefill_kv_block_len}, page_size: {page_size}")
-                    self.q_indptr = torch.concat((self.q_indptr, torch.tensor([prefill_l[i] + self.q_indptr[-1]], device=device, dtype=torch.int32)), dim=0)
-                    self.kv_indptr = torch.concat((self.kv_indptr, torch.tensor([prefill_kv_block_len + self.kv_indptr[-1]], device=device, dtype=torch.int32)), dim=0)
-                    self.kv_indices = torch.concat((self.kv_indices, prefill_query_info.block_index[:prefill_kv_block_len]), dim=0)
-                    self.kv_last_page_len = torch.concat((self.kv_last_page_len, torch.tensor([(prefill_query_info.active_position + prefill_l[i]) % page_size if (prefill_query_info.active_position + prefill_l[i]) % page_size != 0 else page_size], device=device, dtype=torch.int32)), dim=0)
-                    self.kv_len = torch.concat((self.kv_len, torch.tensor([(prefill_query_info.active_position + prefill_l[i])], device=device, dtype=torch.int32)), dim=0)
-                    self.position_ids = torch.concat((self.position_ids, torch.arange(prefill_s[i], prefill_l[i] + prefill_s[i], device=device, dtype=torch.int32)), dim=0)
-                    self.tokens = torch.concat((self.tokens, prefill_query_info.query_tokens[prefill_s[i]:prefill_s[i] + prefill_l[i]]), dim=0)
-                    self.logits_start.append(prefill_l[i] - 1 if len(self.logits_start) == 0 else sum(prefill_l[:i+1])-1)
-
-                    self.temperatures = torch.concat((self.temperatures, torch.tensor([prefill_query_info.temperature], device=device, dtype=torch.float32)), dim=0)
-                    self.top_ps = torch.concat((self.top_ps, torch.tensor([prefill_query_info.top_p], device=device, dtype=torch.float32)), dim=0)
-
-            for decode_query_info in decode_querys_info:
-                decode_kv_block_len = (decode_query_info.active_position + 1 + page_size - 1) // page_size
-                self.q_indptr = torch.concat((self.q_indptr, torch.tensor([1 + self.q_indptr[-1]], device=device, dtype=torch.int32)), dim=0)
-                self.kv_indptr = torch.concat((self.kv_indptr, torch.tensor([decode_kv_block_len+self.kv_indptr[-1]], device=device, dtype=torch.int32)), dim=0)
-                self.kv_indices = torch.concat((self.kv_indices, decode_query_info.block_index[:decode_kv_block_len]), dim=0)
-                self.kv_last_page_len = torch.concat((self.kv_last_page_len, torch.tensor([(decode_query_info.active_position + 1) % page_size if (decode_query_info.active_position + 1) % page_size != 0 else page_size], device=device, dtype=torch.int32)), dim=0)
-                self.kv_len = torch.concat((self.kv_len, torch.tensor([(decode_query_info.active_position + 1)], device=device, dtype=torch.int32)), dim=0)
-                self.position_ids = torch.concat((self.position_ids, torch.arange(decode_query_info.active_position, decode_query_info.active_position + 1, device=device, dtype=torch.int32)), dim=0)
-                if decode_query_info.active_position > 0:
-                    self.tokens = torch.concat((self.tokens, decode_query_info.query_tokens[decode_query_info.active_position:decode_query_info.active_position+1]), dim=0)
-                else: 
-                    self.tokens = torch.concat((self.tokens, torch.tensor([0], device=device, dtype=torch.int32)), dim=0)
-                self.logits_start.append(0 if len(self.logits_start) == 0 else self.logits_start[-1]+1)
-
-                self.temperatures = torch.concat((self.temperatures, torch.tensor([decode_query_info.temperature], device=device, dtype=torch.float32)), dim=0)
-                self.top_ps = torch.concat((self.top_ps, torch.tensor([decode_query_info.top_p], device=device, dtype=torch.float32)), dim=0)
-
-            self.q_indptr = self.q_indptr.contiguous()
-            self.kv_indptr = self.kv_indptr.contiguous()
-            self.kv_indices = self.kv_indices.contiguous()
-            self.kv_len = self.kv_len.contiguous()
-            self.kv_last_page_len = self.kv_last_page_len.contiguous()
-            self.position_ids = self.position_ids.contiguous()
-            self.tokens = self.tokens.contiguous()
-
-            self.bsz_tensor = torch.tensor([self.batch_size], device=device, dtype=torch.int32)
-
-        def fill(self, prefill_querys_info: list[QueryInfo], decode_querys_info: list[QueryInfo], prefill_s: list[int] = None, prefill_l: list[int] = None, device = torch.device('cuda'), page_size = 256):
-            batch_decode = len(decode_querys_info)
-            batch_prefill = len(prefill_querys_info)
-
-            self.q_indptr = torch.tensor([0], device=device, dtype=torch.int32)
-            self.kv_indptr = torch.tensor([0], device=device, dtype=torch.int32)
-            self.kv_indices = torch.tensor([], device=device, dtype=torch.int32)
-            self.kv_len = torch.tensor([], device=device, dtype=torch.int32)
-            self.kv_last_page_len = torch.tensor([], device=device, dtype=torch.int32)
-            new_position_ids = torch.tensor([], device=device, dtype=torch.int32)
-            new_tokens = torch.tensor([], device=device, dtype=torch.int32)
-
-            self.temperatures = torch.tensor([], device=device, dtype=torch.float32)
-            self.top_ps = torch.tensor([], device=device, dtype=torch.float32)
-
-            self.logits_start = []
-            self.decode_batch = batch_decode
-            self.num_tokens = batch_decode + sum(prefill_l)
-            self.batch_size = batch_decode + batch_prefill
-
+            self.device = torch.device(device)
+            self.page_size = page_size
+            self.host_buf = None
+            self.device_buf = None
+            self.copy_event = None
+            self.assemble(prefill_querys_info, decode_querys_info, prefill_s, prefill_l, keep_shape=False)
+
+        def fill(self, prefill_querys_info: list[QueryInfo], decode_querys_info: list[QueryInfo], prefill_s: list[int] = None, prefill_l: list[int] = None, device = torch.device('cuda'), page_size = 256, keep_shape = True):
+            self.page_size = page_size
+            self.assemble(prefill_querys_info, decode_querys_info, prefill_s, prefill_l, keep_shape=keep_shape)
+
+        def reserve(self, max_tokens: int, max_batch_size: int, max_pages: int):
+            """
+            (Re)allocate the pinned host staging buffer and its device twin. All index arrays are views into
+            these two int32 buffers, so a step uploads with one non-blocking copy. position_ids and tokens keep
+            a fixed address for the lifetime of the buffers because CUDA graphs capture them.
+            """
+            if self.device_buf is not None and max_tokens <= self.max_tokens and max_batch_size <= self.max_batch_size and max_pages <= self.max_pages:
+                return
+            if self.device_buf is not None:
+                # growing moves position_ids, which would invalidate a captured graph
+                max_tokens = max(max_tokens, self.max_tokens)
+                max_batch_size = max(max_batch_size, self.max_batch_size)
+                max_pages = max(max_pages, self.max_pages)
+            self.max_tokens = max_tokens
+            self.max_batch_size = max_batch_size
+            self.max_pages = max_pages
+
+            sections = [
+                ("position_ids", max_tokens),
+                ("tokens", max_tokens),
+                ("page_idx", max_tokens),
+                ("page_offset", max_tokens),
+                ("q_indptr", max_batch_size + 1),
+                ("kv_indptr", max_batch_size + 1),
+                ("kv_len", max_batch_size),
+                ("kv_last_page_len", max_batch_size),
+                ("bsz_tensor", 1),
+                ("kv_indices", max_pages),
+            ]
+            self.offsets = {}
+            total = 0
+            for name, size in sections:
+                self.offsets[name] = total
+                total += size
+            pin_memory = self.device.type == "cuda"
+            self.host_buf = torch.zeros((total,), dtype=torch.int32, pin_memory=pin_memory)
+            self.host_np = self.host_buf.numpy()
+            self.device_buf = torch.zeros((total,), dtype=torch.int32, device=self.device)
+            self.copy_event = torch.cuda.Event() if pin_memory else None
+
+        def host_view(self, name: str, size: int, dtype=torch.int32) -> torch.Tensor:
+            return self.host_buf[self.offsets[name]:self.offsets[name] + size].view(dtype)
+
+        def device_view(self, name: str, size: int, dtype=torch.int32) -> torch.Tensor:
+            return self.device_buf[self.offsets[name]:self.offsets[name] + size].view(dtype)
+
+        def assemble(self, prefill_querys_info: list[QueryInfo], decode_querys_info: list[QueryInfo], prefill_s: list[int], prefill_l: list[int], keep_shape: bool = False):
+            """
+            Compute every index array of the minibatch on the host from the QueryInfo host mirrors, then
+            upload them with a single pinned non-blocking copy. With keep_shape, position_ids and tokens stay
+            full-capacity (zero padded) views, as needed by CUDA graph replay.
+            """
+            page_size = self.page_size
+            q_starts = []
+            q_lens = []
+            kv_lens = []
+            token_slices = []
+            block_indexes = []
             for i, prefill_query_info in enumerate(prefill_querys_info):
-                prefill_kv_block_len = (prefill_query_info.active_position + prefill_l[i] + page_size - 1) // page_size if prefill_query_info is not None else 0
-            # print(f"block_len: {prefill_kv_block_len}, page_size: {page_size}")
-                self.q_indptr = torch.concat((self.q_indptr, torch.tensor([prefill_l[i] + self.q_indptr[-1]], device=device, dtype=torch.int32)), dim=0)
-                self.kv_indptr = torch.concat((self.kv_indptr, torch.tensor([prefill_kv_block_len + self.kv_indptr[-1]], device=device, dtype=torch.int32)), dim=0)
-                self.kv_indices = torch.concat((self.kv_indices, prefill_query_info.block_index[:prefill_kv_block_len]), dim=0)
-                self.kv_last_page_len = torch.concat((self.kv_last_page_len, torch.tensor([(prefill_query_info.active_position + prefill_l[i]) % page_size if (prefill_query_info.active_position + prefill_l[i]) % page_size != 0 else page_size], device=device, dtype=torch.int32)), dim=0)
-                self.kv_len = torch.concat((self.kv_len, torch.tensor([(prefill_query_info.active_position + prefill_l[i])], device=device, dtype=torch.int32)), dim=0)
-                new_position_ids = torch.concat((new_position_ids, torch.arange(prefill_s[i], prefill_l[i] + prefill_s[i], device=device, dtype=torch.int32)), dim=0)
-                new_tokens = torch.concat((new_tokens, prefill_query_info.query_tokens[prefill_s[i]:prefill_s[i] + prefill_l[i]]), dim=0)
-                self.logits_start.append(prefill_l[i] - 1 if len(self.logits_start) == 0 else sum(prefill_l[:i+1])-1)
-
-                self.temperatures = torch.concat((self.temperatures, torch.tensor([prefill_query_info.temperature], device=device, dtype=torch.float32)), dim=0)
-                self.top_ps = torch.concat((self.top_ps, torch.tensor([prefill_query_info.top_p], device=device, dtype=torch.float32)), dim=0)
-
+                if prefill_query_info is None:
+                    continue
+                q_starts.append(prefill_s[i])
+                q_lens.append(prefill_l[i])
+                kv_lens.append(prefill_query_info.active_position + prefill_l[i])
+                token_slices.append(prefill_query_info.query_tokens_cpu.numpy()[prefill_s[i]:prefill_s[i] + prefill_l[i]])
+                block_indexes.append(prefill_query_info.block_index_cpu.numpy())
 
             for decode_query_info in decode_querys_info:
-                decode_kv_block_len = (decode_query_info.active_position + 1 + page_size - 1) // page_size
-                self.q_indptr = torch.concat((self.q_indptr, torch.tensor([1 + self.q_indptr[-1]], device=device, dtype=torch.int32)), dim=0)
-                self.kv_indptr = torch.concat((self.kv_indptr, torch.tensor([decode_kv_block_len+self.kv_indptr[-1]], device=device, dtype=torch.int32)), dim=0)
-                self.kv_indices = torch.concat((self.kv_indices, decode_query_info.block_index[:decode_kv_block_len]), dim=0)
-                self.kv_last_page_len = torch.concat((self.kv_last_page_len, torch.tensor([(decode_query_info.active_position + 1) % page_size if (decode_query_info.active_position + 1) % page_size != 0 else page_size], device=device, dtype=torch.int32)), dim=0)
-                self.kv_len = torch.concat((self.kv_len, torch.tensor([(decode_query_info.active_position + 1)], device=device, dtype=torch.int32)), dim=0)
-                new_position_ids = torch.concat((new_position_ids, torch.arange(decode_query_info.active_position, decode_query_info.active_position + 1, device=device, dtype=torch.int32)), dim=0)
-                if decode_query_info.active_position > 0:
-                    new_tokens = torch.concat((new_tokens, decode_query_info.query_tokens[decode_query_info.active_position:decode_query_info.active_position+1]), dim=0)
-                else: 
-                    new_tokens = torch.concat((new_tokens, torch.tensor([0], device=device, dtype=torch.int32)), dim=0)
-                self.logits_start.append(0 if len(self.logits_start) == 0 else self.logits_start[-1]+1)
-
-                self.temperatures = torch.concat((self.temperatures, torch.tensor([decode_query_info.temperature], device=device, dtype=torch.float32)), dim=0)
-                self.top_ps = torch.concat((self.top_ps, torch.tensor([decode_query_info.top_p], device=device, dtype=torch.float32)), dim=0)
-
-
-            self.q_indptr = self.q_indptr.contiguous()
-            self.kv_indptr = self.kv_indptr.contiguous()
-            self.kv_indices = self.kv_indices.contiguous()
-            self.kv_len = self.kv_len.contiguous()
-            self.kv_last_page_len = self.kv_last_page_len.contiguous()
-
-            self.bsz_tensor = torch.tensor([self.batch_size], device=device, dtype=torch.int32)
-            
-            # copy new_position_ids and new_tokens to self.position_ids and self.tokens
-            # print("new_position_ids: ", new_position_ids)
-            # self.print()
-            self.position_ids[:new_position_ids.size(0)].copy_(new_position_ids)
-            self.position_ids[new_position_ids.size(0):].zero_()
-            self.tokens[:new_tokens.size(0)].copy_(new_tokens)
+                active_position = decode_query_info.active_position
+                q_starts.append(active_position)
+                q_lens.append(1)
+                kv_lens.append(active_position + 1)
+                if active_position > 0:
+                    token_slices.append(decode_query_info.query_tokens_cpu.numpy()[active_position:active_position + 1])
+                else:
+                    token_slices.append(np.zeros((1,), dtype=np.int32))
+                block_indexes.append(decode_query_info.block_index_cpu.numpy())
+
+            batch_size = len(q_lens)
+            q_starts = np.asarray(q_starts, dtype=np.int64)
+            q_lens = np.asarray(q_lens, dtype=np.int64)
+            kv_lens = np.asarray(kv_lens, dtype=np.int64)
+            kv_blocks = (kv_lens + page_size - 1) // page_size
+
+            q_indptr = np.zeros((batch_size + 1,), dtype=np.int64)
+            np.cumsum(q_lens, out=q_indptr[1:])
+            kv_indptr = np.zeros((batch_size + 1,), dtype=np.int64)
+            np.cumsum(kv_blocks, out=kv_indptr[1:])
+            num_tokens = int(q_indptr[-1])
+            num_pages = int(kv_indptr[-1])
+
+            self.reserve(num_tokens, batch_size, max(num_pages, Config().cache_lens // page_size + batch_size))
+            self.batch_size = batch_size
+            self.decode_batch = len(decode_querys_info)
+            self.num_tokens = num_tokens
+            self.logits_start = (q_indptr[1:] - 1).tolist()
+
+            if self.copy_event is not None:
+                # the previous upload may still be reading the staging buffer
+                self.copy_event.synchronize()
+
+            off = self.offsets
+            buf = self.host_np
+            query_ids = np.repeat(np.arange(batch_size), q_lens)
+            position_ids = np.arange(num_tokens) - q_indptr[query_ids] + q_starts[query_ids]
+            buf[off["position_ids"]:off["position_ids"] + num_tokens] = position_ids
+            buf[off["position_ids"] + num_tokens:off["position_ids"] + self.max_tokens] = 0
+            if num_tokens > 0:
+                buf[off["tokens"]:off["tokens"] + num_tokens] = np.concatenate(token_slices)
+            kv_indices = buf[off["kv_indices"]:off["kv_indices"] + num_pages]
+            for i in range(batch_size):
+                kv_indices[kv_indptr[i]:kv_indptr[i + 1]] = block_indexes[i][:kv_blocks[i]]
+
+            # page table of every token, replacing the per-token device loop of KDeepSeekV3Cache.get_page_table
+            local_block = position_ids // page_size
+            in_range = local_block < kv_blocks[query_ids]
+            page_idx = np.zeros((num_tokens,), dtype=np.int64)
+            page_idx[in_range] = kv_indices[(kv_indptr[query_ids] + local_block)[in_range]]
+            buf[off["page_idx"]:off["page_idx"] + num_tokens] = page_idx
+            buf[off["page_offset"]:off["page_offset"] + num_tokens] = position_ids % page_size
+
+            buf[off["q_indptr"]:off["q_indptr"] + batch_size + 1] = q_indptr
+            buf[off["kv_indptr"]:off["kv_indptr"] + batch_size + 1] = kv_indptr
+            buf[off["kv_len"]:off["kv_len"] + batch_size] = kv_lens
+            buf[off["kv_last_page_len"]:off["kv_last_page_len"] + batch_size] = (kv_lens - 1) % page_size + 1
+            buf[off["bsz_tensor"]] = batch_size
+
+            upload_len = off["kv_indices"] + num_pages
+            self.device_buf[:upload_len].copy_(self.host_buf[:upload_len], non_blocking=True)
+            if self.copy_event is not None:
+                self.copy_event.record()
+
+            self.q_indptr = self.device_view("q_indptr", batch_size + 1)
+            self.kv_indptr = self.device_view("kv_indptr", batch_size + 1)
+            self.kv_indices = self.device_view("kv_indices", num_pages)
+            self.kv_len = self.device_view("kv_len", batch_size)
+            self.kv_last_page_len = self.device_view("kv_last_page_len", batch_size)
+            self.page_idx = self.device_view("page_idx", num_tokens)
+            self.page_offset = self.device_view("page_offset", num_tokens)
+            self.bsz_tensor = self.device_view("bsz_tensor", 1)
+            shape_tokens = self.max_tokens if keep_shape else num_tokens
+            self.position_ids = self.device_view("position_ids", shape_tokens)
+            self.tokens = self.device_view("tokens", shape_tokens)
+            self.tokens_cpu = self.host_view("tokens", shape_tokens)
 
 
     forward_minibatchs: list[ForwardMiniBatch]
@@ -226,7 +252,8 @@ class ForwardBatchInput:
             query_info = QueryInfo(i+Config().max_prefill_batch_size, prefill_query_length, max_seq_length, page_size, device, is_prefill=False, offset=offset)
             offset += max_seq_length // page_size
             if tokens is not None:
-                query_info.query_tokens[prefill_active_length:prefill_active_length + 1].copy_(tokens)            
+                query_info.query_tokens[prefill_active_length:prefill_active_length + 1].copy_(tokens)
+                query_info.query_tokens_cpu[prefill_active_length:prefill_active_length + 1].copy_(tokens)
             if decode_active_position is None:
                 query_info.active_position = prefill_active_length
             else: 
@@ -241,7 +268,7 @@ class ForwardBatchInput:
         
         return instance
 
-    def fill(self, batch : sched_ext.BatchQueryTodo = None, query_manager: QueryManager = None, page_size = 256):
+    def fill(self, batch : sched_ext.BatchQueryTodo = None, query_manager: QueryManager = None, page_size = 256, keep_shape = True):
         if batch is None:
             return
         prefill_minibatches = batch.prefill_mini_batches
@@ -261,7 +288,7 @@ class ForwardBatchInput:
                 query_manager.query_map[decode_batch_idx].decode_start_time =time.time()
             decode_querys_info.append(query_manager.query_map[decode_batch_idx])
 
-        self.minibatch.fill(prefill_querys_info, decode_querys_info, prefill_s, prefill_l, device=query_manager.device, page_size=page_size)
+        self.minibatch.fill(prefill_querys_info, decode_querys_info, prefill_s, prefill_l, device=query_manager.device, page_size=page_size, keep_shape=keep_shape)
 
 
 
@@ -271,14 +298,12 @@ class ForwardBatchOutput:
     batch_sizes: list[int]
     generated_tokens_num: list[int]
     lm_start: list[int]
-    
-    temperatures: list[torch.Tensor]
-    top_ps: list[torch.Tensor]
+
+    generated_tokens: torch.Tensor
 
     def __init__(self):
         self.logits = []
         self.batch_sizes = []
         self.generated_tokens_num = []
-        self.top_ps = []
-        self.temperatures = []
+        self.generated_tokens = None
         pass
\ No newline at end of file
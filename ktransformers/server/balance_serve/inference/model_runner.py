@@ -5,6 +5,7 @@ LastEditTime: 2024-12-10 08:48:32
 """
 
 import torch
+import numpy as np
 from torch import nn
 import queue
 import signal
@@ -28,6 +29,8 @@ from ktransformers.server.config.config import Config
 from ktransformers.models.custom_modeling_deepseek_v3 import KDeepseekV3ForCausalLM
 from ktransformers.models.custom_modeling_deepseek_v2 import KDeepseekV2ForCausalLM
 from ktransformers.server.balance_serve.inference.query_manager import QueryManager
+from ktransformers.server.balance_serve.inference.sampling.sampler import BatchSampler
+from ktransformers.operators.cpuinfer import CPUInfer
 from ktransformers.server.balance_serve.settings import sched_ext
 
 
@@ -43,8 +46,9 @@ class ModelRunner:
     model: KDeepseekV3ForCausalLM
     input: ForwardBatchInput | list[ForwardBatchInput]
     output: ForwardBatchOutput
+    sampler: BatchSampler
     
-    def __init__(self, model = None, device = None, use_cuda_graph = False, max_decode_batch_size = 1, max_chunk_size = 4096, num_mini_batches: int = 1, page_size = 256):
+    def __init__(self, model = None, device = None, use_cuda_graph = False, max_decode_batch_size = 1, max_chunk_size = 4096, num_mini_batches: int = 1, page_size = 256, sampler: BatchSampler = None):
         
         self.stream = torch.cuda.Stream(device=device)
         # 先注释掉
@@ -58,6 +62,8 @@ class ModelRunner:
         self.use_cuda_graph = use_cuda_graph
         self.model_time = 0
         self.page_size = page_size
+        # sampling runs right after the model, inside the same graph when graphs are used
+        self.sampler = sampler
         # GPU timing for model execution
         self.start_model_event = torch.cuda.Event(enable_timing=True)
         self.end_model_event = torch.cuda.Event(enable_timing=True)
@@ -65,26 +71,59 @@ class ModelRunner:
             self.graphs = [torch.cuda.CUDAGraph() for _ in range(len(self.cuda_graphs))]
             self.page_idx_buf = [torch.zeros([self.cuda_graphs[i]], dtype=torch.int32, device = self.device) for i in range(len(self.cuda_graphs))]
             self.page_offset_buf = [torch.zeros([self.cuda_graphs[i]], dtype=torch.int32, device = self.device) for i in range(len(self.cuda_graphs))]
+            # a graph over n tokens has at most min(n, max_batch_size) logits rows to sample
+            self.sample_index_buf = [self.empty_sample_index(min(self.cuda_graphs[i], Config().max_batch_size)) for i in range(len(self.cuda_graphs))]
+            self.tokens_buf = [None for _ in range(len(self.cuda_graphs))]
         else:
             self.graphs = torch.cuda.CUDAGraph()
             self.page_idx_buf = torch.zeros([self.cuda_graphs], dtype=torch.int32, device = self.device)
             self.page_offset_buf = torch.zeros([self.cuda_graphs], dtype=torch.int32, device = self.device)
+            self.sample_index_buf = self.empty_sample_index(Config().max_batch_size)
+            self.tokens_buf = None
         self.num_mini_batches = num_mini_batches
 
         self.max_chunk_size = max_chunk_size
 
         self.bsz_tensor_buf = torch.empty((1, ),dtype=torch.int32, device=device)
         self.num_tokens_tensor_buf = torch.empty((1, ),dtype=torch.int32, device=device)
+
+    def empty_sample_index(self, num_rows: int) -> torch.Tensor:
+        # every row reads logits row 0 with the scratch slot until a batch fills it
+        sample_index = torch.zeros((3, num_rows), dtype=torch.int64, device=self.device)
+        if self.sampler is not None:
+            sample_index[1].fill_(self.sampler.scratch_slot)
+        return sample_index
+
+    def sample_index(self, batch: sched_ext.BatchQueryTodo, query_manager: QueryManager, logits_start: list[int], num_rows: int) -> np.ndarray:
+        query_infos = []
+        positions = []
+        keep = []
+        for (id, s, l) in batch.prefill_mini_batches:
+            query_info = query_manager.query_map[id]
+            query_infos.append(query_info)
+            positions.append(s + l)
+            # only the last chunk of a prompt produces a token
+            keep.append(s + l >= query_info.query_length)
+        for ids in batch.decode_mini_batches:
+            for id in ids:
+                query_info = query_manager.query_map[id]
+                query_infos.append(query_info)
+                positions.append(query_info.active_position + 1)
+                keep.append(True)
+        return self.sampler.make_index(query_infos, logits_start, positions, keep, num_rows)
+
     def warmup(self):
 
         def capture_graphs(cuda_graph_idx=-1):
             if cuda_graph_idx != -1:
-                with torch.cuda.graph(self.graphs[cuda_graph_idx], pool=self.graph_memory_pool, stream=self.stream):
+                with CPUInfer.task_graph(), torch.cuda.graph(self.graphs[cuda_graph_idx], pool=self.graph_memory_pool, stream=self.stream):
                     self.outputs_buf[cuda_graph_idx] = self.model(self.input[cuda_graph_idx], self.features_buf[cuda_graph_idx], self.bsz_tensor_buf, self.num_tokens_tensor_buf, self.page_idx_buf[cuda_graph_idx], self.page_offset_buf[cuda_graph_idx], cuda_graph_idx=cuda_graph_idx)   
+                    self.tokens_buf[cuda_graph_idx] = self.sampler(self.outputs_buf[cuda_graph_idx].logits[0], self.sample_index_buf[cuda_graph_idx])
                 self.graph_memory_pool = self.graphs[cuda_graph_idx].pool()
             else:
-                with torch.cuda.graph(self.graphs, pool=self.graph_memory_pool, stream=self.stream):
+                with CPUInfer.task_graph(), torch.cuda.graph(self.graphs, pool=self.graph_memory_pool, stream=self.stream):
                     self.outputs_buf = self.model(self.input, self.features_buf, self.bsz_tensor_buf, self.num_tokens_tensor_buf, self.page_idx_buf, self.page_offset_buf)   
+                    self.tokens_buf = self.sampler(self.outputs_buf.logits[0], self.sample_index_buf)
                 self.graph_memory_pool = self.graphs.pool()
 
         if isinstance(self.cuda_graphs, list):
@@ -109,7 +148,7 @@ class ModelRunner:
                                                     head_dim_kpe=self.model.config.qk_rope_head_dim, page_size=self.model.cache.page_size, causal=True,
                                                     sm_scale=self.model.model.layers[0].self_attn.softmax_scale, q_data_type=torch.bfloat16, kv_data_type=torch.bfloat16)
             
-                page_idx, page_offset = self.model.cache.get_page_table(self.input[i].minibatch.position_ids, self.input[i].minibatch.q_indptr, self.input[i].minibatch.kv_indptr, self.input[i].minibatch.kv_indices, self.num_tokens_tensor_buf)
+                page_idx, page_offset = self.input[i].minibatch.page_idx, self.input[i].minibatch.page_offset
 
                 self.page_idx_buf[i][:num_tokens].copy_(page_idx[:num_tokens])
                 self.page_offset_buf[i][:num_tokens].copy_(page_offset[:num_tokens])
@@ -121,6 +160,7 @@ class ModelRunner:
                 for warm_up_iters in range(11):
                     with torch.cuda.stream(self.stream):
                         self.outputs_buf[i] = self.model(self.input[i], self.features_buf[i], self.bsz_tensor_buf, self.num_tokens_tensor_buf, self.page_idx_buf[i], self.page_offset_buf[i])
+                        self.tokens_buf[i] = self.sampler(self.outputs_buf[i].logits[0], self.sample_index_buf[i])
                 torch.cuda.synchronize()
 
                 capture_graphs(i)
@@ -147,7 +187,7 @@ class ModelRunner:
                                                 head_dim_kpe=self.model.config.qk_rope_head_dim, page_size=self.model.cache.page_size, causal=True,
                                                 sm_scale=self.model.model.layers[0].self_attn.softmax_scale, q_data_type=torch.bfloat16, kv_data_type=torch.bfloat16)
             
-            page_idx, page_offset = self.model.cache.get_page_table(self.input.minibatch.position_ids, self.input.minibatch.q_indptr, self.input.minibatch.kv_indptr, self.input.minibatch.kv_indices, self.num_tokens_tensor_buf)
+            page_idx, page_offset = self.input.minibatch.page_idx, self.input.minibatch.page_offset
             self.page_idx_buf[:num_tokens].copy_(page_idx[:num_tokens])
             self.page_offset_buf[:num_tokens].copy_(page_offset[:num_tokens])
             self.page_idx_buf[num_tokens:].fill_(self.model.cache.max_cache_len // self.model.cache.page_size - 1) 
@@ -157,11 +197,13 @@ class ModelRunner:
             for warm_up_iters in range(11):
                 with torch.cuda.stream(self.stream):
                     self.outputs_buf = self.model(self.input, self.features_buf, self.bsz_tensor_buf, self.num_tokens_tensor_buf, self.page_idx_buf, self.page_offset_buf)
+                    self.tokens_buf = self.sampler(self.outputs_buf.logits[0], self.sample_index_buf)
             torch.cuda.synchronize()
 
             def capture_graphs():
-                with torch.cuda.graph(self.graphs,  stream=self.stream):
+                with CPUInfer.task_graph(), torch.cuda.graph(self.graphs,  stream=self.stream):
                     self.outputs_buf = self.model(self.input, self.features_buf, self.bsz_tensor_buf, self.num_tokens_tensor_buf, self.page_idx_buf, self.page_offset_buf)   
+                    self.tokens_buf = self.sampler(self.outputs_buf.logits[0], self.sample_index_buf)
                     # self.graph_memory_pool = self.graphs.pool()
 
 
@@ -202,8 +244,11 @@ class ModelRunner:
                     self.input[cuda_graph_idx].fill(batch, query_manager, self.page_size)
                 else:
                     self.input.fill(batch, query_manager, self.page_size)
-            else:
+            elif self.input is None:
                 self.input = ForwardBatchInput(batch=batch, query_manager=query_manager, device=self.device)
+            else:
+                # reuse the pinned staging buffers of the previous step
+                self.input.fill(batch, query_manager, self.page_size, keep_shape=False)
                     
 
             if cuda_graph_idx != -1 and self.use_cuda_graph:
@@ -212,8 +257,8 @@ class ModelRunner:
                 self.features = self.model.batch_embeddings(self.input, device=self.device)
                 
 
-            self.bsz_tensor_buf.copy_(batch_size)
-            self.num_tokens_tensor_buf.copy_(torch.tensor([num_tokens], dtype=torch.int32, device=self.device))
+            self.bsz_tensor_buf.fill_(batch_size)
+            self.num_tokens_tensor_buf.fill_(num_tokens)
 
             if self.use_cuda_graph:
                 if cuda_graph_idx != -1:
@@ -244,21 +289,24 @@ class ModelRunner:
                                                 head_dim_kpe=self.model.config.qk_rope_head_dim, page_size=self.model.cache.page_size, causal=True,
                                                 sm_scale=self.model.model.layers[0].self_attn.softmax_scale, q_data_type=torch.bfloat16, kv_data_type=torch.bfloat16)
                 self.start_model_event.record(self.stream)
-                page_idx, page_offset = self.model.cache.get_page_table(self.input[cuda_graph_idx].minibatch.position_ids, self.input[cuda_graph_idx].minibatch.q_indptr, self.input[cuda_graph_idx].minibatch.kv_indptr, self.input[cuda_graph_idx].minibatch.kv_indices, self.num_tokens_tensor_buf)
+                # page table is assembled on the host together with the other index arrays
+                page_idx, page_offset = self.input[cuda_graph_idx].minibatch.page_idx, self.input[cuda_graph_idx].minibatch.page_offset
+                logits_start = self.input[cuda_graph_idx].minibatch.logits_start
                 if self.use_cuda_graph:
                     self.page_idx_buf[cuda_graph_idx][:num_tokens].copy_(page_idx[:num_tokens])
                     self.page_offset_buf[cuda_graph_idx][:num_tokens].copy_(page_offset[:num_tokens])
                     self.page_idx_buf[cuda_graph_idx][num_tokens:].fill_(self.model.cache.max_cache_len // self.model.cache.page_size - 1)
+                    sample_index = self.sample_index(batch, query_manager, logits_start, self.sample_index_buf[cuda_graph_idx].size(1))
+                    self.sample_index_buf[cuda_graph_idx].copy_(torch.from_numpy(sample_index), non_blocking=True)
                     self.replay(cuda_graph_idx)
                     self.output = ForwardBatchOutput()
-                    
-                    self.output.top_ps.append(self.input[cuda_graph_idx].minibatch.top_ps)
-                    self.output.temperatures.append(self.input[cuda_graph_idx].minibatch.temperatures)
-
-                    self.output.logits.append(self.outputs_buf[cuda_graph_idx].logits[0][self.input[cuda_graph_idx].minibatch.logits_start].clone())
+                    # views of the graph outputs, valid until the next replay
+                    self.output.logits.append(self.outputs_buf[cuda_graph_idx].logits[0])
+                    self.output.generated_tokens = self.tokens_buf[cuda_graph_idx][:len(logits_start)]
                 else:
                     self.output = self.model(self.input[cuda_graph_idx], self.features, self.bsz_tensor_buf, self.num_tokens_tensor_buf, page_idx, page_offset)
-                    self.output.logits[0] = self.output.logits[0][self.input[cuda_graph_idx].minibatch.logits_start]
+                    sample_index = torch.from_numpy(self.sample_index(batch, query_manager, logits_start, len(logits_start))).to(self.device, non_blocking=True)
+                    self.output.generated_tokens = self.sampler(self.output.logits[0], sample_index)
                 self.end_model_event.record(self.stream)
             else:
                 self.model.flash_infer_attn_plan(self.input, self.bsz_tensor_buf, self.num_tokens_tensor_buf,
@@ -266,23 +314,22 @@ class ModelRunner:
                                                 head_dim_kpe=self.model.config.qk_rope_head_dim, page_size=self.model.cache.page_size, causal=True,
                                                 sm_scale=self.model.model.layers[0].self_attn.softmax_scale, q_data_type=torch.bfloat16, kv_data_type=torch.bfloat16)
                 self.start_model_event.record(self.stream)
-                page_idx, page_offset = self.model.cache.get_page_table(self.input.minibatch.position_ids, self.input.minibatch.q_indptr, self.input.minibatch.kv_indptr, self.input.minibatch.kv_indices, self.num_tokens_tensor_buf)
+                page_idx, page_offset = self.input.minibatch.page_idx, self.input.minibatch.page_offset
+                logits_start = self.input.minibatch.logits_start
                 if self.use_cuda_graph:
                     self.page_idx_buf[:num_tokens].copy_(page_idx[:num_tokens])
                     self.page_offset_buf[:num_tokens].copy_(page_offset[:num_tokens])
                     self.page_idx_buf[num_tokens:].fill_(self.model.cache.max_cache_len // self.model.cache.page_size - 1) 
+                    sample_index = self.sample_index(batch, query_manager, logits_start, self.sample_index_buf.size(1))
+                    self.sample_index_buf.copy_(torch.from_numpy(sample_index), non_blocking=True)
                     self.replay(cuda_graph_idx)
                     self.output = ForwardBatchOutput()
-
-                    self.output.top_ps.append(self.input.minibatch.top_ps)
-                    self.output.temperatures.append(self.input.minibatch.temperatures)
-
-                    self.output.logits.append(self.outputs_buf.logits[0][self.input.minibatch.logits_start].clone())
+                    self.output.logits.append(self.outputs_buf.logits[0])
+                    self.output.generated_tokens = self.tokens_buf[:len(logits_start)]
                 else:
                     self.output = self.model(self.input, self.features, self.bsz_tensor_buf, self.num_tokens_tensor_buf, page_idx, page_offset)
-                    self.output.logits[0] = self.output.logits[0][self.input.minibatch.logits_start]
-                    self.output.top_ps.append(self.input.minibatch.top_ps)
-                    self.output.temperatures.append(self.input.minibatch.temperatures)
+                    sample_index = torch.from_numpy(self.sample_index(batch, query_manager, logits_start, len(logits_start))).to(self.device, non_blocking=True)
+                    self.output.generated_tokens = self.sampler(self.output.logits[0], sample_index)
 
                 self.end_model_event.record(self.stream)
 
@@ -15,21 +15,33 @@ class QueryInfo:
     is_prefill: int
     block_index: torch.Tensor
     query_tokens: torch.Tensor
+    # host mirrors of block_index / query_tokens, read by ForwardBatchInput to assemble batches without device syncs
+    block_index_cpu: torch.Tensor
+    query_tokens_cpu: torch.Tensor
     stop_criteria: list[torch.Tensor]
 
     temperature: float
     top_p: float
+    top_k: int
+    min_p: float
+    repetition_penalty: float
+    frequency_penalty: float
+    presence_penalty: float
+    seed: int
 
     max_length: int 
 
-    def __init__(self, id, query_length: int, max_length: int, page_size: int, device: torch.device, is_prefill: bool = True, offset: int = 0, active_position: int = 0, temperature: float = 0.01, top_p: float = 1.0):
+    def __init__(self, id, query_length: int, max_length: int, page_size: int, device: torch.device, is_prefill: bool = True, offset: int = 0, active_position: int = 0, temperature: float = 0.01, top_p: float = 1.0,
+                 top_k: int = -1, min_p: float = 0.0, repetition_penalty: float = 1.0, frequency_penalty: float = 0.0, presence_penalty: float = 0.0, seed: int = -1):
         self.id = id
         self.is_prefill = is_prefill
         self.active_position = active_position
         self.max_length = max_length - 1
-        self.query_tokens = torch.zeros((max_length,), dtype=torch.int, device = device)
+        self.query_tokens_cpu = torch.zeros((max_length,), dtype=torch.int)
+        self.query_tokens = self.query_tokens_cpu.to(device)
         self.stop_criteria = []
-        self.block_index = torch.arange(offset, offset + (max_length + active_position + page_size - 1) // page_size, dtype=torch.int, device = device)
+        self.block_index_cpu = torch.arange(offset, offset + (max_length + active_position + page_size - 1) // page_size, dtype=torch.int)
+        self.block_index = self.block_index_cpu.to(device)
         self.query_length = query_length
         self.enqueue_time = time.time()
         self.decode_start_time = None
@@ -37,6 +49,12 @@ class QueryInfo:
 
         self.temperature = temperature
         self.top_p = top_p
+        self.top_k = top_k
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty
+        self.frequency_penalty = frequency_penalty
+        self.presence_penalty = presence_penalty
+        self.seed = seed
 
     def check_stop(self):
         if self.active_position >= self.max_length - 2:
@@ -88,14 +106,20 @@ class QueryManager:
             if id not in self.query_map:
                 print(f"add query id: {id}, batch.query_lengths: {batch.query_lengths[i]}, batch_query_tokens: {batch.query_tokens[i].shape}, batch.block_indexes: {batch.block_indexes[i]}")
                 assert batch.query_tokens[i].size(0) < self.max_length, "query max length in batchquerytodo exceeds internal max_length"
-                query_info = QueryInfo(id=id, query_length=batch.query_lengths[i], max_length=batch.query_tokens[i].size(0) + 1, page_size=self.page_size, device=self.device, temperature=batch.sample_options[i].temperature, top_p=batch.sample_options[i].top_p)
-                query_info.query_tokens[:query_info.query_length].copy_(batch.query_tokens[i][:query_info.query_length].to(self.device))
+                sample_options = batch.sample_options[i]
+                query_info = QueryInfo(id=id, query_length=batch.query_lengths[i], max_length=batch.query_tokens[i].size(0) + 1, page_size=self.page_size, device=self.device,
+                                       temperature=sample_options.temperature, top_p=sample_options.top_p, top_k=sample_options.top_k, min_p=sample_options.min_p,
+                                       repetition_penalty=sample_options.repetition_penalty, frequency_penalty=sample_options.frequency_penalty,
+                                       presence_penalty=sample_options.presence_penalty, seed=sample_options.seed)
+                query_info.query_tokens_cpu[:query_info.query_length].copy_(batch.query_tokens[i][:query_info.query_length])
+                query_info.query_tokens[:query_info.query_length].copy_(query_info.query_tokens_cpu[:query_info.query_length], non_blocking=True)
                 
                 for stop_token_list in batch.stop_criteria[i]:
                     query_info.stop_criteria.append(torch.tensor(stop_token_list, dtype=torch.int, device = self.device))
 
                 block_num = batch.block_indexes[i].size(0)
-                query_info.block_index[:block_num].copy_(batch.block_indexes[i].to(self.device))
+                query_info.block_index_cpu[:block_num].copy_(batch.block_indexes[i])
+                query_info.block_index[:block_num].copy_(query_info.block_index_cpu[:block_num], non_blocking=True)
 
                 self.query_map[id] = query_info
                 
@@ -103,6 +127,13 @@ class QueryManager:
                 for (prefill_id, s, l) in prefill_mini_batches:
                     if prefill_id == id:
                         self.query_map[prefill_id].active_position = s
+            else:
+                # the scheduler moves the pages of a query swapped out to host memory and back
+                query_info = self.query_map[id]
+                block_num = batch.block_indexes[i].size(0)
+                if not torch.equal(query_info.block_index_cpu[:block_num], batch.block_indexes[i]):
+                    query_info.block_index_cpu[:block_num].copy_(batch.block_indexes[i])
+                    query_info.block_index[:block_num].copy_(query_info.block_index_cpu[:block_num], non_blocking=True)
 
 
     def update(self, batch: sched_ext.BatchQueryTodo) -> list[sched_ext.QueryUpdate]:
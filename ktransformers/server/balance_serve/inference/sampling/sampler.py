@@ -4,97 +4,175 @@ LastEditors: Xie Weiyu ervinxie@qq.com
 LastEditTime: 2024-11-25 08:59:23
 '''
 import logging
+import random
+import numpy as np
 import torch
 from torch import nn
 from transformers import GenerationConfig
 
 from flashinfer.sampling import (
-	min_p_sampling_from_probs,
 	top_k_renorm_probs,
-	top_k_top_p_sampling_from_logits,
 	top_p_renorm_probs,
 )
 
 logger = logging.getLogger(__name__)
 
-class SamplingOptions():
-	# Batched sampling params
-	temperatures: torch.Tensor
-	top_ps: torch.Tensor
-	top_ks: torch.Tensor
-	min_ps: torch.Tensor
-
-	# All requests use greedy sampling
-	is_all_greedy: bool
-
-	# Dispatch in CUDA graph
-	need_min_p_sampling: bool
-	
-	def __init__(self, bsz = 1, device = torch.device('cuda'), pretrained_config:GenerationConfig = None, temperatures: torch.Tensor = None, top_ps: torch.Tensor = None):
-		if pretrained_config is None and temperatures is None:
-			self.temperatures = torch.full((bsz, 1), 0, device=device, dtype=torch.float32)
-			self.top_ps = torch.ones((bsz, 1), device=device, dtype=torch.float32)
-			self.top_ks = torch.ones((bsz, 1), device=device, dtype=torch.float32)
-			self.need_min_p_sampling = False
-			self.is_all_greedy = True
-		else:
-			if temperatures is not None:
-				self.temperatures = temperatures.unsqueeze(-1)
-			else:
-				self.temperatures = torch.full((bsz, 1), pretrained_config.temperature, device=device, dtype=torch.float32)
-			
-			if top_ps is not None:
-				self.top_ps = top_ps.unsqueeze(-1)
-			else:	
-				self.top_ps = torch.full((bsz, 1), pretrained_config.top_p, device=device, dtype=torch.float32)
-			self.top_ks = torch.full((bsz, 1), pretrained_config.top_k, device=device, dtype=torch.float32)
-			self.need_min_p_sampling = False
-			self.is_all_greedy = False
-
-class Sampler(nn.Module):
-	def __init__(self):
+# columns of BatchSampler.float_params / int_params
+TEMPERATURE, TOP_P, MIN_P, REPETITION_PENALTY, FREQUENCY_PENALTY, PRESENCE_PENALTY = range(6)
+TOP_K, SEED = range(2)
+
+# lowbias32 multipliers and the golden ratio, as wrapped int32
+_HASH_MUL_1 = 0x7feb352d
+_HASH_MUL_2 = 0x846ca68b - (1 << 32)
+_GOLDEN = 0x9e3779b1 - (1 << 32)
+
+
+def hash32(x: torch.Tensor) -> torch.Tensor:
+	# lowbias32 on int32 tensors, the shifts are masked so they act as logical shifts
+	x = x ^ ((x >> 16) & 0xffff)
+	x = x * _HASH_MUL_1
+	x = x ^ ((x >> 15) & 0x1ffff)
+	x = x * _HASH_MUL_2
+	return x ^ ((x >> 16) & 0xffff)
+
+
+class BatchSampler(nn.Module):
+	"""
+	Sampling stage of the balance_serve engine with the parameters and penalty state of every query kept in
+	persistent per-slot buffers. A step only uploads a (3, rows) index of logits row, slot and position, so
+	forward has fixed shapes, no host sync and no branch on the batch content, and is captured in the same
+	CUDA graph as the model.
+	Penalties follow penaltylib: repetition over prompt and output tokens, frequency and presence over output
+	tokens, with the output counts updated by the step that samples them.
+	Randomness is a counter based hash of (seed, position, token), a seeded request draws the same tokens
+	whatever batch it runs in.
+	"""
+
+	max_slots: int
+	vocab_size: int
+
+	def __init__(self, max_slots: int, vocab_size: int, device = torch.device('cuda'), generation_config: GenerationConfig = None):
 		super().__init__()
-	
-	def forward(
-		self,
-		logits: torch.Tensor,
-		sampling_config: SamplingOptions = None,
-	):
-		if sampling_config == None:
-			sampling_config = SamplingOptions()
-
-		logits = logits.contiguous()
-		origin_logits = logits.clone()
-		if sampling_config.is_all_greedy:
-			# Use torch.argmax if all requests use greedy sampling
-			probs = logits
-			batch_next_token_ids = torch.argmax(logits, -1)
+		self.max_slots = max_slots
+		self.vocab_size = vocab_size
+		self.device = device
+		# padding rows and rows whose token is thrown away (not last prefill chunk) sample with this slot
+		self.scratch_slot = max_slots
+		self.default_top_k = generation_config.top_k if generation_config is not None and generation_config.top_k else 0
+
+		num_slots = max_slots + 1
+		self.float_params = torch.zeros((num_slots, 6), dtype=torch.float32, device=device)
+		self.float_params[:, TOP_P] = 1.0
+		self.float_params[:, REPETITION_PENALTY] = 1.0
+		self.int_params = torch.zeros((num_slots, 2), dtype=torch.int32, device=device)
+		self.int_params[:, TOP_K] = vocab_size
+		self.prompt_mask = torch.zeros((num_slots, vocab_size), dtype=torch.bool, device=device)
+		self.output_counts = torch.zeros((num_slots, vocab_size), dtype=torch.int32, device=device)
+		self.vocab_keys = torch.arange(vocab_size, dtype=torch.int32, device=device) * _GOLDEN
+
+		self.slot_map = {}  # query id -> slot
+		self.slot_owner = [None] * max_slots
+		self.slot_last_use = [0] * max_slots
+		self.free_slots = list(range(max_slots - 1, -1, -1))
+		self.step = 0
+
+	def set_params(self, slot: int, query_info):
+		temperature = max(query_info.temperature, 0.0)
+		top_k = query_info.top_k if query_info.top_k >= 0 else self.default_top_k
+		if top_k <= 0 or top_k > self.vocab_size:
+			top_k = self.vocab_size
+		seed = query_info.seed if query_info.seed >= 0 else random.getrandbits(31)
+		float_params = torch.tensor([temperature, query_info.top_p, query_info.min_p, query_info.repetition_penalty,
+								query_info.frequency_penalty, query_info.presence_penalty], dtype=torch.float32)
+		int_params = torch.tensor([top_k, seed & 0x7fffffff], dtype=torch.int32)
+		self.float_params[slot].copy_(float_params, non_blocking=True)
+		self.int_params[slot].copy_(int_params, non_blocking=True)
+
+	def reset_history(self, slot: int, query_info):
+		# rebuilt from the host token mirror, so a reclaimed slot is restored exactly when its query comes back
+		prompt = query_info.query_tokens_cpu[:query_info.query_length].to(self.device, dtype=torch.int64, non_blocking=True)
+		self.prompt_mask[slot].zero_()
+		self.prompt_mask[slot].index_fill_(0, prompt, True)
+		self.output_counts[slot].zero_()
+		if query_info.active_position > query_info.query_length:
+			generated = query_info.query_tokens_cpu[query_info.query_length:query_info.active_position]
+			generated = generated.to(self.device, dtype=torch.int64, non_blocking=True)
+			self.output_counts[slot].index_add_(0, generated, torch.ones_like(generated, dtype=torch.int32))
+
+	def alloc(self, query_info) -> int:
+		if self.free_slots:
+			slot = self.free_slots.pop()
 		else:
-			# Post process logits
-			logits.div_(sampling_config.temperatures)
-			max_top_k_round, batch_size = 32, logits.shape[0]
-			if sampling_config.need_min_p_sampling:
-				probs = torch.softmax(logits, dim=-1)
-				logits = None
-				del logits
-				probs = top_k_renorm_probs(probs, sampling_config.top_ks)
-				probs = top_p_renorm_probs(probs, sampling_config.top_ps)
-				batch_next_token_ids = min_p_sampling_from_probs(
-					probs, sampling_config.min_ps
-				)
-				temperature_0_idx = torch.where(sampling_config.temperatures == 0)[0]
-				batch_next_token_ids[temperature_0_idx] = torch.argmax(origin_logits[temperature_0_idx], -1).to(torch.int32)
-			else:
-				# TODO: use different kernel when don't need top_k or top_p
-				# @TODO get probs
-				probs = logits
-				batch_next_token_ids = top_k_top_p_sampling_from_logits(
-					logits,
-					sampling_config.top_ks,
-					sampling_config.top_ps,
-					filter_apply_order="joint",
-				)
-				temperature_0_idx = torch.where(sampling_config.temperatures == 0)[0]
-				batch_next_token_ids[temperature_0_idx] = torch.argmax(origin_logits[temperature_0_idx], -1).to(torch.int32)
-			
-		return batch_next_token_ids.to(torch.int32), probs
\ No newline at end of file
+			slot = min(range(self.max_slots), key=self.slot_last_use.__getitem__)
+			assert self.slot_last_use[slot] < self.step, "more queries in one batch than sampling slots"
+			logger.debug(f"sampling slot {slot} of query {self.slot_owner[slot]} reclaimed by query {query_info.id}")
+			del self.slot_map[self.slot_owner[slot]]
+		self.slot_owner[slot] = query_info.id
+		self.slot_map[query_info.id] = slot
+		self.set_params(slot, query_info)
+		self.reset_history(slot, query_info)
+		return slot
+
+	def release(self, query_id: int):
+		slot = self.slot_map.pop(query_id, None)
+		if slot is not None:
+			self.slot_owner[slot] = None
+			self.free_slots.append(slot)
+
+	def bind(self, query_infos: list) -> list[int]:
+		"""Slots of the queries of a batch, allocating (or reclaiming the least recently used) as needed."""
+		self.step += 1
+		slots = []
+		for query_info in query_infos:
+			slot = self.slot_map.get(query_info.id)
+			if slot is None:
+				slot = self.alloc(query_info)
+			self.slot_last_use[slot] = self.step
+			slots.append(slot)
+		return slots
+
+	def make_index(self, query_infos: list, logits_rows: list[int], positions: list[int], keep: list[bool], num_rows: int) -> np.ndarray:
+		"""
+		Host side sample index of a batch, padded to num_rows.
+		positions are the positions of the sampled tokens, rows with keep False sample with the scratch slot.
+		"""
+		slots = self.bind(query_infos)
+		batch_size = len(slots)
+		assert batch_size <= num_rows, f"{batch_size} rows to sample, the sample index has {num_rows}"
+		index = np.zeros((3, num_rows), dtype=np.int64)
+		index[1, :] = self.scratch_slot
+		index[0, :batch_size] = logits_rows
+		index[1, :batch_size] = np.where(keep, slots, self.scratch_slot)
+		index[2, :batch_size] = positions
+		return index
+
+	def forward(self, logits: torch.Tensor, sample_index: torch.Tensor) -> torch.Tensor:
+		rows, slots, positions = sample_index.unbind(0)
+		logits = logits.index_select(0, rows).float()
+		temperatures, top_ps, min_ps, repetition_penalties, frequency_penalties, presence_penalties = self.float_params.index_select(0, slots).unbind(1)
+		top_ks, seeds = self.int_params.index_select(0, slots).unbind(1)
+
+		counts = self.output_counts.index_select(0, slots)
+		generated = counts > 0
+		seen = self.prompt_mask.index_select(0, slots) | generated
+		repetition = torch.where(seen, repetition_penalties.unsqueeze(1), 1.0)
+		logits.mul_(torch.where(logits > 0, repetition.reciprocal(), repetition))
+		logits.sub_(counts * frequency_penalties.unsqueeze(1)).sub_(generated * presence_penalties.unsqueeze(1))
+
+		# greedy rows keep only their argmax through top-k, so they take the same path as the sampled ones
+		greedy = temperatures <= 0
+		logits.div_(torch.where(greedy, 1.0, temperatures).unsqueeze(1))
+		probs = torch.softmax(logits, dim=-1)
+		probs = top_k_renorm_probs(probs, torch.where(greedy, 1, top_ks))
+		probs = top_p_renorm_probs(probs, top_ps)
+		probs.masked_fill_(probs < min_ps.unsqueeze(1) * probs.amax(dim=-1, keepdim=True), 0)
+
+		# exponential race: argmax(p / E) with E ~ Exp(1) is a draw from p, no renormalization needed
+		keys = hash32(seeds ^ hash32(positions.to(torch.int32)))
+		noise = hash32(self.vocab_keys ^ keys.unsqueeze(1))
+		uniform = ((noise >> 8) & 0xffffff).float().add_(0.5).mul_(1.0 / (1 << 24))
+		batch_next_token_ids = probs.div_(uniform.log_().neg_()).argmax(dim=-1)
+
+		self.output_counts.view(-1).index_add_(0, slots * self.vocab_size + batch_next_token_ids,
+											  torch.ones_like(batch_next_token_ids, dtype=torch.int32))
+		return batch_next_token_ids.to(torch.int32)
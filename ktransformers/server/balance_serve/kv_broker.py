@@ -0,0 +1,154 @@
+'''
+Description  :  Shared memory broker of the kvc2 GPU page pool. The scheduler exports the CUDA IPC handles of the
+                pool once into a shared memory segment next to its rpc socket; any number of engine processes
+                (one per GPU, restarted ones) attach to it without a round trip to the scheduler and without the
+                pool being serialized again.
+
+                Segment layout: header (magic, version, page table bytes), page table. The version is odd while
+                the page table is being written and while the segment is retired, an engine only reads it even.
+                Engines attach once: a scheduler restart allocates a new pool and its engines have to be restarted.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import os
+import pickle
+import struct
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import torch
+from torch.multiprocessing.reductions import reduce_tensor
+
+from ktransformers.server.balance_serve.settings import sched_ext
+
+MAGIC = b"KTKVPG01"
+HEADER = struct.Struct("<8sQQ")  # magic, version, page table bytes
+PAGE_TABLE_BYTES = 1 << 16
+PAGE_TABLE_OFFSET = HEADER.size
+SEGMENT_BYTES = PAGE_TABLE_OFFSET + PAGE_TABLE_BYTES
+
+
+def segment_name(sched_port) -> str:
+    return f"kt-{sched_port}-kv"
+
+
+def open_segment(name: str, create: bool = False) -> shared_memory.SharedMemory:
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, create=create, size=SEGMENT_BYTES if create else 0, track=False)
+    shm = shared_memory.SharedMemory(name, create=create, size=SEGMENT_BYTES if create else 0)
+    # the resource tracker would unlink the segment when any process using it exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class KVSegment:
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        self.buf = shm.buf
+
+    def header(self) -> tuple[bytes, int, int]:
+        return HEADER.unpack_from(self.buf, 0)
+
+    def version(self) -> int:
+        return self.header()[1]
+
+    def set_version(self, version: int, table_bytes: int):
+        HEADER.pack_into(self.buf, 0, MAGIC, version, table_bytes)
+
+    def read_table(self, timeout: float = 10.0) -> dict:
+        """Consistent copy of the page table, waits out a concurrent publish."""
+        deadline = time.monotonic() + timeout
+        while True:
+            magic, version, table_bytes = self.header()
+            if magic == MAGIC and version % 2 == 0 and version > 0:
+                payload = bytes(self.buf[PAGE_TABLE_OFFSET:PAGE_TABLE_OFFSET + table_bytes])
+                if self.version() == version:
+                    return pickle.loads(payload)
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"no kv page table published in {self.shm.name}")
+            time.sleep(0.01)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+
+class KVBroker(KVSegment):
+    """Scheduler side, owns the pool and publishes its page table."""
+    def __init__(self, sched_port, inference_context, page_size: int):
+        name = segment_name(sched_port)
+        try:
+            shm = open_segment(name, create=True)
+        except FileExistsError:
+            # left by a scheduler that died, its pool is gone with it
+            shared_memory.SharedMemory(name).unlink()
+            shm = open_segment(name, create=True)
+        super().__init__(shm)
+        self.context = inference_context
+        self.page_size = page_size
+        self.publish()
+
+    def publish(self):
+        """Export the IPC handles of the pool."""
+        pools = []
+        for i, k_cache in enumerate(self.context.k_cache):
+            v_cache = self.context.v_cache[i] if i < len(self.context.v_cache) else None
+            pools.append({
+                "device": k_cache.get_device(),
+                "shape": tuple(k_cache.shape),
+                "dtype": str(k_cache.dtype),
+                "k_cache": reduce_tensor(k_cache),
+                "v_cache": reduce_tensor(v_cache) if v_cache is not None else None,
+            })
+        payload = pickle.dumps({"page_size": self.page_size, "pools": pools, "scheduler_pid": os.getpid()})
+        if len(payload) > PAGE_TABLE_BYTES:
+            raise ValueError(f"kv page table of {len(payload)} bytes doesn't fit the shared memory segment")
+        self.set_version(1, 0)
+        self.buf[PAGE_TABLE_OFFSET:PAGE_TABLE_OFFSET + len(payload)] = payload
+        self.set_version(2, len(payload))
+        print(f"Published kv page table in {self.shm.name}, "
+              f"{len(pools)} pools of {pools[0]['shape'] if pools else ()}")
+
+    def retire(self):
+        """Mark the page table stale for engines still to attach and remove the segment."""
+        self.set_version(3, 0)
+        name = self.shm.name
+        self.close()
+        try:
+            shared_memory.SharedMemory(name).unlink()
+        except FileNotFoundError:
+            pass
+
+
+class KVBrokerClient(KVSegment):
+    """Engine side, maps the pool of its device."""
+    def __init__(self, sched_port, timeout: float = 600.0):
+        # the scheduler process may still be allocating the pool
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                shm = open_segment(segment_name(sched_port))
+                break
+            except FileNotFoundError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        super().__init__(shm)
+
+    def attach(self, device):
+        """Inference context of the pool on device. The segment is closed after, the mapped tensors stay valid."""
+        device = torch.device(device)
+        table = self.read_table()
+        self.close()
+        pools = table["pools"]
+        pool = next((p for p in pools if p["device"] == device.index), pools[0] if device.index is None else None)
+        if pool is None:
+            raise ValueError(f"no kv pool on {device}, the scheduler serves devices {[p['device'] for p in pools]}")
+        inference_context = sched_ext.InferenceContext()
+        fn, args = pool["k_cache"]
+        inference_context.k_cache = [fn(*args)]
+        if pool["v_cache"] is not None:
+            fn, args = pool["v_cache"]
+            inference_context.v_cache = [fn(*args)]
+        print(f"Attached to kv page table, pool {pool['shape']} on cuda:{pool['device']}")
+        return inference_context
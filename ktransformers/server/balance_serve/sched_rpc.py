@@ -10,7 +10,12 @@ current_file_path = os.path.abspath(__file__)
 # sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", ".."))
 import pickle
 import argparse
+import time
+from collections import defaultdict
 from ktransformers.server.balance_serve.settings import sched_ext, create_sched_settings
+from ktransformers.server.balance_serve import sched_wire
+from ktransformers.server.balance_serve.kv_broker import KVBroker
+from ktransformers.server.utils.multi_timer import LatencyHistogram
 
 
 
@@ -21,20 +26,32 @@ else:
     print(f'start method already set to {mp.get_start_method(allow_none=True)}')
 
 
+# update_last_batch busy waits inside the scheduler, the other workers keep serving add_query meanwhile
+RPC_WORKER_NUM = 4
+
+
 class SchedulerServer:
     def __init__(self, settings, main_args):
         # 创建 Scheduler 实例并初始化
         self.sched = sched_ext.create_scheduler(settings)
+        # engines map the kv pool from the shared memory page table, it is exported once here
+        self.kv_broker = KVBroker(main_args.sched_port, self.sched.get_inference_context(), settings.page_size)
     
         # 初始化 ZeroMQ 上下文和套接字
         self.context = zmq.Context()
-        self.frontend = self.context.socket(zmq.REP) #(zmq.ROUTER)
+        self.frontend = self.context.socket(zmq.ROUTER)
         print(f"sched zmq rpc server on port {main_args.sched_port}")
         self.frontend.bind(f"ipc:///tmp/kt-{main_args.sched_port}.sock")
 
         # 创建内部的 DEALER 套接字，用于与工作线程通信
-        #self.backend = self.context.socket(zmq.DEALER)
-        #self.backend.bind("inproc://backend")
+        self.backend = self.context.socket(zmq.DEALER)
+        self.backend.bind("inproc://backend")
+
+        self.handlers = {
+            b'add_query': self.handle_add_query,
+            b'cancel_query': self.handle_cancel_query,
+            b'update_last_batch': self.handle_update_last_batch,
+        }
 
     # 启动调度器
     def run_scheduler(self):
@@ -47,75 +64,38 @@ class SchedulerServer:
     # 处理客户端请求
     def start_proxy(self):
         # 使用 ZMQ 的内置代理，将前端请求分发给后端工作线程
-        #zmq.proxy(self.frontend, self.backend)
-        self.worker_routine()
+        zmq.proxy(self.frontend, self.backend)
+
+    def handle_add_query(self, payload: bytes) -> bytes:
+        query_add = sched_wire.decode_query_add(payload)
+        query_id = self.sched.add_query(query_add)
+        return sched_wire.encode_u64(query_id)
+
+    def handle_cancel_query(self, payload: bytes) -> bytes:
+        self.sched.cancel_query(sched_wire.decode_u64(payload))
+        return b''
+
+    def handle_update_last_batch(self, payload: bytes) -> bytes:
+        updates = sched_wire.decode_updates(payload)
+        batch_todo = self.sched.update_last_batch(updates)
+        return sched_wire.encode_batch(batch_todo)
 
     # 工作线程处理请求
     def worker_routine(self):
-        #worker = self.context.socket(zmq.REP)
-        #worker.connect("inproc://backend")
-        worker = self.frontend
+        worker = self.context.socket(zmq.REP)
+        worker.connect("inproc://backend")
         while True:
+            # REP strips the routing envelope, frames are [request id, method, payload]
+            request_id, method, payload = worker.recv_multipart()
             try:
-                # 接收客户端请求
-                message = worker.recv()
-                data = pickle.loads(message)
-
-                method = data.get('method')
-                params = data.get('params', {})
-                # print(f"Received request: {method}")
-
-                if method == 'add_query':
-                    query_add = params.get('query')  # 直接是一个 QueryAdd 对象
-                    # 添加查询
-                    query_id = self.sched.add_query(query_add)
-                    # 发送响应
-                    response = {'status': 'ok', 'query_id': query_id}
-                    worker.send(pickle.dumps(response))
-
-                elif method == 'cancel_query':
-                    query_id = params.get('query_id')
-                    # 假设您的 Scheduler 类实现了 cancel 方法
-                    self.sched.cancel(query_id)
-                    response = {'status': 'ok'}
-                    worker.send(pickle.dumps(response))
-
-                elif method == 'update_last_batch':
-                    updates = params.get('updates')  # 直接是一个列表，包含 QueryUpdate 对象
-
-                    # 更新最后一个批次
-                    batch_todo = self.sched.update_last_batch(updates)
-
-                    # 直接发送 batch_todo 对象
-                    response = {'status': 'ok', 'batch_todo': batch_todo}
-                    # print (batch_todo.query_lengths, batch_todo.query_ids)
-                    worker.send(pickle.dumps(response))
-
-                elif method == 'get_inference_context':
-                    inference_context = self.sched.get_inference_context()
-                    data = {
-                        "k_cache":inference_context.k_cache,
-                        "v_cache":inference_context.v_cache
-                    }
-                    print(f"Serializing KVCache")
-                    data["k_cache"] = [mp.reductions.reduce_tensor(t) for t in data['k_cache']]
-                    data["v_cache"] = [mp.reductions.reduce_tensor(t) for t in data['v_cache']]
-                    # print(data)
-                    response = {'status': 'ok', 'inference_context': data}
-
-                    worker.send(pickle.dumps(response))
-                    # response['inference_context'].k_cache[0][0, 0, 0, 0, 0] = 1 
-                    # print("k_cache update")
-
-                else:
-                    # 未知方法
-                    response = {'status': 'error', 'message': 'Unknown method'}
-                    worker.send(pickle.dumps(response))
-
+                handler = self.handlers.get(method)
+                if handler is None:
+                    worker.send_multipart([request_id, b'error', f'Unknown method {method!r}'.encode()])
+                    continue
+                worker.send_multipart([request_id, b'ok', handler(payload)])
             except Exception as e:
                 # 处理异常并发送错误响应
-                response = {'status': 'error', 'message': str(e)}
-                worker.send(pickle.dumps(response))
+                worker.send_multipart([request_id, b'error', str(e).encode()])
 
     # 启动 RPC 服务
     def start_rpc_service(self):
@@ -126,7 +106,7 @@ class SchedulerServer:
             threading.Thread(target=self.run_scheduler, daemon=True).start()
 
             # 启动工作线程
-            for _ in range(0):  # 根据需要调整线程数
+            for _ in range(RPC_WORKER_NUM):  # 根据需要调整线程数
                 threading.Thread(target=self.worker_routine, daemon=True).start()
 
             # 启动代理，开始监听请求
@@ -139,8 +119,9 @@ class SchedulerServer:
     # 停止 RPC 服务
     def stop_rpc_service(self):
         self.stop_scheduler()
+        self.kv_broker.retire()
         self.frontend.close()
-        #self.backend.close()
+        self.backend.close()
         self.context.term()
 
 def start_server(settings, main_args):
@@ -150,59 +131,73 @@ def start_server(settings, main_args):
 
 # Add async client for webserver
 class SchedulerClient:
+    """
+    Pipelined client of SchedulerServer. Requests carry an id, so several can be in flight on the same
+    DEALER socket, e.g. the engine sends update_last_batch and collects the batch later. Not thread safe.
+    """
     def __init__(self, sched_port):
         address=f'ipc:///tmp/kt-{sched_port}.sock'
         self.address = address
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REQ)
+        self.socket = self.context.socket(zmq.DEALER)
         self.socket.connect(self.address)
+        self.request_counter = 0
+        self.pending = {}  # request id -> (method, send time)
+        self.responses = {}  # request id -> (status, payload), arrived before being waited for
+        self.latency = defaultdict(LatencyHistogram)
+        self.last_batch_payload = None
         print(f"Connected to server at {self.address}")
     
     def __del__(self):
         self.socket.close()
         self.context.term()
-    
-    def send_request(self, method, params=None):
-        if params is None:
-            params = {}
-        request = {
-            'method': method,
-            'params': params
-        }
-        # print(f'send request {request}')
-        self.socket.send(pickle.dumps(request))
-        response = self.socket.recv()
-        # print(response)
-        response = pickle.loads(response)
-        if response.get('status') == 'ok':
-            return response
+
+    def send_request_async(self, method: str, payload: bytes = b'') -> int:
+        self.request_counter += 1
+        request_id = self.request_counter
+        # the empty frame is the delimiter the server side REP expects
+        self.socket.send_multipart([b'', sched_wire.encode_u64(request_id), method.encode(), payload])
+        self.pending[request_id] = (method, time.perf_counter())
+        return request_id
+
+    def wait_response(self, request_id: int) -> bytes:
+        while request_id not in self.responses:
+            _, rid, status, payload = self.socket.recv_multipart()
+            rid = sched_wire.decode_u64(rid)
+            method, send_time = self.pending.pop(rid)
+            self.latency[method].observe(time.perf_counter() - send_time)
+            self.responses[rid] = (status, payload)
+        status, payload = self.responses.pop(request_id)
+        if status == b'ok':
+            return payload
         else:
-            raise Exception(f"Error from server: {response.get('message')}")
+            raise Exception(f"Error from server: {payload.decode()}")
+
+    def send_request(self, method: str, payload: bytes = b'') -> bytes:
+        return self.wait_response(self.send_request_async(method, payload))
     
     def add_query(self, query):
-        response = self.send_request('add_query', {'query': query})
-        return response.get('query_id')
+        return sched_wire.decode_u64(self.send_request('add_query', sched_wire.encode_query_add(query)))
     
     def cancel_query(self, query_id):
-        self.send_request('cancel_query', {'query_id': query_id})
+        self.send_request('cancel_query', sched_wire.encode_u64(query_id))
+
+    def update_last_batch_async(self, updates) -> int:
+        return self.send_request_async('update_last_batch', sched_wire.encode_updates(updates))
+
+    def wait_last_batch(self, request_id: int):
+        self.last_batch_payload = self.wait_response(request_id)
+        return sched_wire.decode_batch(self.last_batch_payload)
     
     def update_last_batch(self, updates):
-        response = self.send_request('update_last_batch', {'updates': updates})
-        # print(f"update_last_batch response {response}")
-        return response.get('batch_todo')
-    
-    def rebuild_inferece_context(self,response):
-        data = response.get('inference_context')
-        inference_context = sched_ext.InferenceContext()
-        print('Rebuilding kvcache')
-        inference_context.k_cache = [fn(*args) for fn,args in data['k_cache']]
-        inference_context.v_cache = [fn(*args) for fn,args in data['v_cache']]
-        return inference_context
-
-    def get_inference_context_raw(self):
-        response = self.send_request('get_inference_context')
-        return response
-       
+        return self.wait_last_batch(self.update_last_batch_async(updates))
+
+    def latency_report(self) -> list[str]:
+        return [hist.report_string(method) for method, hist in self.latency.items()]
+
+    def reset_latency(self):
+        for hist in self.latency.values():
+            hist.reset()
 
 
 if __name__ == '__main__':
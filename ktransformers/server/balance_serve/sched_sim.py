@@ -0,0 +1,338 @@
+'''
+Description  :  Offline replay of an arrival trace against the balance_serve scheduling strategies.
+                The strategies of csrc/balance_serve/sched/scheduler.cpp are modeled step by step on the same
+                rules (ranking, at most two prefills per batch, pausing the active queries that fall out, prefill
+                budget split) and the model is replaced by a linear step time, so a trace is compared under
+                FCFS, SRPF, EDF and FairShare in seconds, without a GPU.
+                A trace is a jsonl file, one request per line:
+                {"arrival_ms": 0, "prompt_tokens": 812, "output_tokens": 256, "user": "a", "slo_ttft_ms": 2000, "slo_tbt_ms": 100}
+                user and the SLOs are optional.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import argparse
+import json
+import math
+import random
+from dataclasses import dataclass, field
+
+import numpy as np
+
+STRATEGIES = ["FCFS", "FCFS-single-prefill", "SRPF", "EDF", "FairShare"]
+# the scheduler's MAX_SLO_TIME, a query without SLO keeps its arrival order
+NO_SLO_MS = 1e9
+MAX_PREFILL_COUNT = 2
+SRPF_AGING_HALF_MS = 10000
+EDF_PREEMPT_SLACK_STEPS = 4
+EDF_MIN_RUN_STEPS = 4
+
+
+@dataclass
+class StepCost:
+    """Linear step time model, fit it on the server's own prefill / decode timings."""
+    base_ms: float = 20.0
+    prefill_token_ms: float = 0.15
+    decode_query_ms: float = 1.0
+
+    def step_ms(self, prefill_tokens: int, decode_queries: int) -> float:
+        return self.base_ms + self.prefill_token_ms * prefill_tokens + self.decode_query_ms * decode_queries
+
+
+@dataclass(eq=False)
+class SimQuery:
+    id: int
+    arrival_ms: float
+    prompt_tokens: int
+    output_tokens: int
+    user: str = ""
+    slo_ttft_ms: float = NO_SLO_MS
+    slo_tbt_ms: float = NO_SLO_MS
+
+    status: str = "waiting"  # waiting, ready, prefill, decode, done
+    plan_position: int = 0
+    active_since: int = -1
+    generated: int = 0
+    first_token_ms: float | None = None
+    last_token_ms: float | None = None
+    token_gaps: list = field(default_factory=list)
+
+    def remaining_prefill(self) -> int:
+        if self.status in ("decode", "done"):
+            return 0
+        return self.prompt_tokens - self.plan_position
+
+    def deadline(self) -> float:
+        if self.last_token_ms is not None and self.slo_tbt_ms < NO_SLO_MS:
+            return self.last_token_ms + self.slo_tbt_ms
+        if self.last_token_ms is None and self.slo_ttft_ms < NO_SLO_MS:
+            return self.arrival_ms + self.slo_ttft_ms
+        return self.arrival_ms + NO_SLO_MS
+
+    def emit_token(self, now: float):
+        if self.last_token_ms is None:
+            self.first_token_ms = now
+        else:
+            self.token_gaps.append(now - self.last_token_ms)
+        self.last_token_ms = now
+        self.generated += 1
+        if self.generated >= self.output_tokens:
+            self.status = "done"
+
+
+class Simulator:
+    """One strategy over one trace, mirrors QueryMaintainer::gen_batch_query_todo and the strategy_schedule of each strategy."""
+
+    def __init__(self, strategy: str, queries: list[SimQuery], max_batch_size: int = 4, chunk_size: int = 256,
+                 cost: StepCost = StepCost()):
+        assert strategy in STRATEGIES, f"unknown strategy {strategy}, one of {STRATEGIES}"
+        self.strategy = strategy
+        self.queries = sorted(queries, key=lambda q: (q.arrival_ms, q.id))
+        self.max_batch_size = max_batch_size
+        self.chunk = (chunk_size - (max_batch_size - 2)) // 2  # recommended_chunk_prefill_token_count
+        self.cost = cost
+        self.now = 0.0
+        self.step_ms = 0.0
+        self.ready: list[SimQuery] = []
+        self.active: list[SimQuery] = []
+        self.paused: list[SimQuery] = []
+        self.served: dict[str, float] = {}
+        self.steps = 0
+        self.preemptions = 0
+
+    # budget and split, as in the scheduler
+
+    def prefill_token_budget(self, prefill_num: int, decode_num: int) -> int:
+        if prefill_num >= 2 or (prefill_num == 1 and self.max_batch_size - 2 < decode_num):
+            return self.chunk * max(prefill_num, 1)
+        return self.chunk * 2
+
+    def split(self, prefills: list[SimQuery], budget: int) -> dict[int, int]:
+        if self.strategy in ("SRPF", "EDF"):
+            floor_share = max(budget // (2 * len(prefills)), 1) if prefills else 1
+            lengths, left = {}, budget
+            for i, q in enumerate(prefills):
+                reserve = floor_share * (len(prefills) - i - 1)
+                length = max(min(q.remaining_prefill(), left - reserve), floor_share)
+                lengths[q.id] = length
+                left -= min(left, length)
+            return lengths
+        share = budget // max(len(prefills), 1)
+        return {q.id: share for q in prefills}
+
+    # priorities, lower runs first
+
+    def served_tokens(self, user: str) -> float:
+        if user not in self.served:
+            active = [self.served[q.user] for q in self.active if q.user in self.served]
+            self.served[user] = min(active) if active else 0.0
+        return self.served[user]
+
+    def priority(self, q: SimQuery) -> float:
+        if self.strategy == "SRPF":
+            return q.remaining_prefill() * SRPF_AGING_HALF_MS / (SRPF_AGING_HALF_MS + self.now - q.arrival_ms)
+        if self.strategy == "EDF":
+            return q.deadline() - self.now
+        if self.strategy == "FairShare":
+            return self.served_tokens(q.user)
+        return q.arrival_ms
+
+    def stickiness(self, q: SimQuery) -> float:
+        if self.strategy in ("SRPF", "FairShare"):
+            return self.chunk
+        if self.strategy == "EDF":
+            just_resumed = q.active_since >= 0 and self.steps - q.active_since < EDF_MIN_RUN_STEPS
+            if q.status == "decode" and (just_resumed or self.priority(q) < EDF_PREEMPT_SLACK_STEPS * self.step_ms):
+                return math.inf
+            return self.step_ms
+        return 0.0
+
+    # schedule
+
+    def schedule_fcfs(self, max_prefill: int):
+        prefill_count = sum(q.status == "prefill" for q in self.active)
+        while prefill_count < max_prefill and self.ready and len(self.active) < self.max_batch_size:
+            q = self.ready.pop(0)
+            q.status = "prefill"
+            self.active.append(q)
+            prefill_count += 1
+        prefills = [q for q in self.active if q.status == "prefill"]
+        decodes = [q for q in self.active if q.status == "decode"]
+        return prefills, decodes, self.prefill_token_budget(len(prefills), len(decodes))
+
+    def schedule_priority(self):
+        self.steps += 1
+        ranked = [(self.priority(q) - self.stickiness(q), q.id, q) for q in self.active]
+        ranked += [(self.priority(q), q.id, q) for q in self.paused + self.ready]
+        ranked.sort(key=lambda r: r[:2])
+        chosen, prefills, decodes = [], [], []
+        for _, _, q in ranked:
+            if len(chosen) >= self.max_batch_size:
+                break
+            is_prefill = q.status != "decode"
+            if is_prefill and len(prefills) >= MAX_PREFILL_COUNT:
+                continue
+            chosen.append(q)
+            (prefills if is_prefill else decodes).append(q)
+        self.preemptions += sum(q not in chosen for q in self.active)
+        self.paused = [q for q in self.paused + self.active if q not in chosen]
+        for q in chosen:
+            if q.status == "ready":
+                self.ready.remove(q)
+                q.status = "prefill"
+            if q not in self.active:
+                q.active_since = self.steps
+        self.active = chosen
+        budget = self.prefill_token_budget(len(prefills), len(decodes))
+        if self.strategy == "EDF" and any(q.last_token_ms is not None and self.priority(q) < self.step_ms for q in decodes):
+            budget = min(budget, self.chunk)
+        return prefills, decodes, budget
+
+    def step(self) -> bool:
+        if self.strategy == "FCFS-single-prefill":
+            prefills, decodes, budget = self.schedule_fcfs(1)
+        elif self.strategy == "FCFS":
+            prefills, decodes, budget = self.schedule_fcfs(MAX_PREFILL_COUNT)
+        else:
+            prefills, decodes, budget = self.schedule_priority()
+        if not prefills and not decodes:
+            return False
+        lengths = self.split(prefills, budget)
+        prefill_tokens = 0
+        chunks = []
+        for q in prefills:
+            length = min(lengths[q.id], q.remaining_prefill())
+            chunks.append((q, length))
+            prefill_tokens += length
+        step_ms = self.cost.step_ms(prefill_tokens, len(decodes))
+        self.step_ms = step_ms if self.step_ms == 0 else 0.9 * self.step_ms + 0.1 * step_ms
+        self.now += step_ms
+        for q, length in chunks:
+            q.plan_position += length
+            self.served[q.user] = self.served_tokens(q.user) + length
+            if q.plan_position >= q.prompt_tokens:
+                q.status = "decode"
+                q.emit_token(self.now)
+        for q in decodes:
+            self.served[q.user] = self.served_tokens(q.user) + 1
+            q.emit_token(self.now)
+        self.active = [q for q in self.active if q.status != "done"]
+        # users with nothing left start again from the floor when they come back
+        users = {q.user for q in self.ready + self.active + self.paused}
+        self.served = {user: tokens for user, tokens in self.served.items() if user in users}
+        return True
+
+    def run(self) -> list[SimQuery]:
+        pending = list(self.queries)
+        while pending or self.ready or self.active or self.paused:
+            while pending and pending[0].arrival_ms <= self.now:
+                q = pending.pop(0)
+                q.status = "ready"
+                self.ready.append(q)
+            if not self.step():
+                # idle until the next arrival
+                self.now = max(self.now, pending[0].arrival_ms)
+        return self.queries
+
+
+def percentile(values: list[float], p: float) -> float:
+    return float(np.percentile(values, p)) if values else math.nan
+
+
+def report(strategy: str, queries: list[SimQuery], preemptions: int) -> dict:
+    ttft = [q.first_token_ms - q.arrival_ms for q in queries]
+    tbt = [gap for q in queries for gap in q.token_gaps]
+    # DistServe style goodput: the first token within its SLO and the mean time between tokens within its SLO
+    good = [q for q in queries
+            if q.first_token_ms - q.arrival_ms <= q.slo_ttft_ms
+            and (not q.token_gaps or float(np.mean(q.token_gaps)) <= q.slo_tbt_ms)]
+    span_s = (max(q.last_token_ms for q in queries) - min(q.arrival_ms for q in queries)) / 1000
+    return {
+        "strategy": strategy,
+        "ttft_mean_ms": float(np.mean(ttft)),
+        "ttft_p50_ms": percentile(ttft, 50),
+        "ttft_p99_ms": percentile(ttft, 99),
+        "tbt_p50_ms": percentile(tbt, 50),
+        "tbt_p99_ms": percentile(tbt, 99),
+        "slo_attainment": len(good) / len(queries),
+        "goodput_rps": len(good) / span_s if span_s > 0 else math.nan,
+        "preemptions": preemptions,
+    }
+
+
+def load_trace(path: str, slo_ttft_ms: float | None = None, slo_tbt_ms: float | None = None) -> list[dict]:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    for r in records:
+        r.setdefault("slo_ttft_ms", slo_ttft_ms)
+        r.setdefault("slo_tbt_ms", slo_tbt_ms)
+    return records
+
+
+def synthetic_trace(num_requests: int, rate: float, num_users: int, seed: int = 0) -> list[dict]:
+    """Poisson arrivals with lognormal prompt / output lengths, user 0 sends half of the requests."""
+    rng = random.Random(seed)
+    now = 0.0
+    records = []
+    for _ in range(num_requests):
+        now += rng.expovariate(rate) * 1000
+        user = 0 if rng.random() < 0.5 else rng.randrange(num_users)
+        records.append({
+            "arrival_ms": now,
+            "prompt_tokens": max(1, min(int(rng.lognormvariate(6.5, 1.0)), 16384)),
+            "output_tokens": max(1, min(int(rng.lognormvariate(5.0, 0.8)), 2048)),
+            "user": str(user),
+        })
+    return records
+
+
+def to_queries(records: list[dict]) -> list[SimQuery]:
+    return [SimQuery(id=i, arrival_ms=float(r["arrival_ms"]), prompt_tokens=int(r["prompt_tokens"]),
+                     output_tokens=int(r["output_tokens"]), user=str(r.get("user", "")),
+                     slo_ttft_ms=float(r.get("slo_ttft_ms") or NO_SLO_MS), slo_tbt_ms=float(r.get("slo_tbt_ms") or NO_SLO_MS))
+            for i, r in enumerate(records)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay an arrival trace against the balance_serve scheduling strategies")
+    parser.add_argument("--trace", type=str, default=None, help="jsonl arrival trace, a synthetic one if not given")
+    parser.add_argument("--strategies", type=str, nargs="+", default=STRATEGIES, choices=STRATEGIES)
+    parser.add_argument("--max_batch_size", type=int, default=4)
+    parser.add_argument("--chunk_size", type=int, default=256)
+    parser.add_argument("--slo_ttft_ms", type=float, default=None, help="SLO of the requests that carry none")
+    parser.add_argument("--slo_tbt_ms", type=float, default=None)
+    parser.add_argument("--base_ms", type=float, default=StepCost.base_ms)
+    parser.add_argument("--prefill_token_ms", type=float, default=StepCost.prefill_token_ms)
+    parser.add_argument("--decode_query_ms", type=float, default=StepCost.decode_query_ms)
+    parser.add_argument("--num_requests", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=1.0, help="synthetic arrivals per second")
+    parser.add_argument("--num_users", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="one json report per line instead of a table")
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        records = load_trace(args.trace, args.slo_ttft_ms, args.slo_tbt_ms)
+    else:
+        records = synthetic_trace(args.num_requests, args.rate, args.num_users, args.seed)
+        for r in records:
+            r["slo_ttft_ms"], r["slo_tbt_ms"] = args.slo_ttft_ms, args.slo_tbt_ms
+    cost = StepCost(args.base_ms, args.prefill_token_ms, args.decode_query_ms)
+
+    header = f"{'strategy':<20} {'TTFT mean':>10} {'TTFT p50':>10} {'TTFT p99':>10} {'TBT p50':>9} {'TBT p99':>9} {'SLO met':>8} {'goodput':>9} {'preempt':>8}"
+    if not args.json:
+        print(f"{len(records)} requests, step {cost.base_ms}ms + {cost.prefill_token_ms}ms/prefill token + {cost.decode_query_ms}ms/decode")
+        print(header)
+    for strategy in args.strategies:
+        sim = Simulator(strategy, to_queries(records), args.max_batch_size, args.chunk_size, cost)
+        r = report(strategy, sim.run(), sim.preemptions)
+        if args.json:
+            print(json.dumps(r))
+        else:
+            print(f"{strategy:<20} {r['ttft_mean_ms']:>8.0f}ms {r['ttft_p50_ms']:>8.0f}ms {r['ttft_p99_ms']:>8.0f}ms {r['tbt_p50_ms']:>7.1f}ms "
+                  f"{r['tbt_p99_ms']:>7.1f}ms {r['slo_attainment'] * 100:>7.1f}% {r['goodput_rps']:>5.2f}r/s {r['preemptions']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+'''
+Fixed-layout binary encoding of the scheduler RPC messages.
+
+BatchQueryTodo, QueryUpdate lists and QueryAdd are exchanged every decode step between the engine, the web
+process and the scheduler, so they are packed into flat little-endian numpy arrays instead of being pickled.
+Only the prompt part of each query_tokens tensor is shipped, the decoder restores a zero padded tensor of the
+original length.
+'''
+import struct
+import numpy as np
+import torch
+from ktransformers.server.balance_serve.settings import sched_ext
+
+WIRE_VERSION = 2
+
+_u32 = struct.Struct("<I")
+_header = struct.Struct("<4sI")
+
+QUERY_UPDATE_DTYPE = np.dtype([
+    ("id", "<u8"),
+    ("active_position", "<u8"),
+    ("generated_token", "<u4"),
+    ("ok", "u1"),
+    ("is_prefill", "u1"),
+    ("decode_done", "u1"),
+])
+
+SAMPLE_OPTIONS_DTYPE = np.dtype([
+    ("temperature", "<f8"),
+    ("top_p", "<f8"),
+    ("min_p", "<f8"),
+    ("repetition_penalty", "<f8"),
+    ("frequency_penalty", "<f8"),
+    ("presence_penalty", "<f8"),
+    ("seed", "<i8"),
+    ("top_k", "<i4"),
+])
+
+
+class _Writer:
+    def __init__(self, magic: bytes):
+        self.parts = [_header.pack(magic, WIRE_VERSION)]
+
+    def u32(self, value: int):
+        self.parts.append(_u32.pack(value))
+
+    def array(self, values, dtype):
+        arr = np.ascontiguousarray(values, dtype=dtype)
+        self.u32(arr.size)
+        self.parts.append(arr.tobytes())
+
+    def getvalue(self) -> bytes:
+        return b"".join(self.parts)
+
+
+class _Reader:
+    def __init__(self, data: bytes, magic: bytes):
+        self.view = memoryview(data)
+        got_magic, version = _header.unpack_from(self.view, 0)
+        if got_magic != magic or version != WIRE_VERSION:
+            raise ValueError(f"unexpected message {got_magic!r} v{version}, expect {magic!r} v{WIRE_VERSION}")
+        self.offset = _header.size
+
+    def u32(self) -> int:
+        (value,) = _u32.unpack_from(self.view, self.offset)
+        self.offset += _u32.size
+        return value
+
+    def array(self, dtype) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        count = self.u32()
+        arr = np.frombuffer(self.view, dtype=dtype, count=count, offset=self.offset)
+        self.offset += count * dtype.itemsize
+        return arr
+
+
+def _write_stop_criteria(w: _Writer, stop_criteria: list[list[list[int]]]):
+    counts = [len(criteria) for criteria in stop_criteria]
+    lens = [len(stop) for criteria in stop_criteria for stop in criteria]
+    tokens = [token for criteria in stop_criteria for stop in criteria for token in stop]
+    w.array(counts, "<u4")
+    w.array(lens, "<u4")
+    w.array(tokens, "<i4")
+
+
+def _read_stop_criteria(r: _Reader) -> list[list[list[int]]]:
+    counts = r.array("<u4").tolist()
+    lens = r.array("<u4").tolist()
+    tokens = r.array("<i4").tolist()
+    re = []
+    stop_idx = 0
+    token_pos = 0
+    for count in counts:
+        criteria = []
+        for _ in range(count):
+            criteria.append(tokens[token_pos:token_pos + lens[stop_idx]])
+            token_pos += lens[stop_idx]
+            stop_idx += 1
+        re.append(criteria)
+    return re
+
+
+def _write_sample_options(w: _Writer, sample_options: list[sched_ext.SampleOptions]):
+    arr = np.empty((len(sample_options),), dtype=SAMPLE_OPTIONS_DTYPE)
+    for i, o in enumerate(sample_options):
+        arr[i] = (o.temperature, o.top_p, o.min_p, o.repetition_penalty, o.frequency_penalty, o.presence_penalty,
+                  o.seed, o.top_k)
+    w.u32(arr.size)
+    w.parts.append(arr.tobytes())
+
+
+def _read_sample_options(r: _Reader) -> list[sched_ext.SampleOptions]:
+    count = r.u32()
+    arr = np.frombuffer(r.view, dtype=SAMPLE_OPTIONS_DTYPE, count=count, offset=r.offset)
+    r.offset += count * SAMPLE_OPTIONS_DTYPE.itemsize
+    sample_options = []
+    for temperature, top_p, min_p, repetition_penalty, frequency_penalty, presence_penalty, seed, top_k in arr.tolist():
+        o = sched_ext.SampleOptions()
+        o.temperature = temperature
+        o.top_p = top_p
+        o.top_k = top_k
+        o.min_p = min_p
+        o.repetition_penalty = repetition_penalty
+        o.frequency_penalty = frequency_penalty
+        o.presence_penalty = presence_penalty
+        o.seed = seed
+        sample_options.append(o)
+    return sample_options
+
+
+def encode_batch(batch: sched_ext.BatchQueryTodo) -> bytes:
+    w = _Writer(b"KBQT")
+    if batch is None:
+        w.u32(0)
+        return w.getvalue()
+    w.u32(1)
+    assert batch.attn_masks is None and batch.rope_ranges is None, "attn_masks/rope_ranges are not supported on the wire"
+    query_lengths = list(batch.query_lengths)
+    w.array(batch.query_ids, "<u8")
+    w.array(query_lengths, "<u8")
+    w.array([t.size(0) for t in batch.query_tokens], "<u8")
+    if len(query_lengths) > 0:
+        w.array(torch.cat([t[:l] for t, l in zip(batch.query_tokens, query_lengths)]).numpy(), "<i4")
+    else:
+        w.array([], "<i4")
+    w.array([b.size(0) for b in batch.block_indexes], "<u4")
+    if len(batch.block_indexes) > 0:
+        w.array(torch.cat(list(batch.block_indexes)).numpy(), "<i4")
+    else:
+        w.array([], "<i4")
+    _write_sample_options(w, batch.sample_options)
+    _write_stop_criteria(w, batch.stop_criteria)
+    w.array([v for task in batch.prefill_mini_batches for v in task], "<u8")
+    w.array([len(ids) for ids in batch.decode_mini_batches], "<u4")
+    w.array([i for ids in batch.decode_mini_batches for i in ids], "<u8")
+    return w.getvalue()
+
+
+def decode_batch(data: bytes) -> sched_ext.BatchQueryTodo | None:
+    r = _Reader(data, b"KBQT")
+    if r.u32() == 0:
+        return None
+    batch = sched_ext.BatchQueryTodo()
+    query_ids = r.array("<u8").tolist()
+    query_lengths = r.array("<u8").tolist()
+    token_lens = r.array("<u8").tolist()
+    prompt_tokens = torch.from_numpy(r.array("<i4").copy())
+    block_lens = r.array("<u4").tolist()
+    block_tokens = torch.from_numpy(r.array("<i4").copy())
+    sample_options = _read_sample_options(r)
+
+    query_tokens = []
+    pos = 0
+    for length, total in zip(query_lengths, token_lens):
+        tokens = torch.zeros((total,), dtype=torch.int32)
+        tokens[:length] = prompt_tokens[pos:pos + length]
+        pos += length
+        query_tokens.append(tokens)
+    block_indexes = list(torch.split(block_tokens, block_lens)) if len(block_lens) > 0 else []
+
+    batch.query_ids = query_ids
+    batch.query_lengths = query_lengths
+    batch.query_tokens = query_tokens
+    batch.block_indexes = [b.contiguous() for b in block_indexes]
+    batch.sample_options = sample_options
+    batch.stop_criteria = _read_stop_criteria(r)
+    prefill = r.array("<u8").tolist()
+    batch.prefill_mini_batches = [tuple(prefill[i:i + 3]) for i in range(0, len(prefill), 3)]
+    decode_sizes = r.array("<u4").tolist()
+    decode_ids = r.array("<u8").tolist()
+    decode_mini_batches = []
+    pos = 0
+    for size in decode_sizes:
+        decode_mini_batches.append(decode_ids[pos:pos + size])
+        pos += size
+    batch.decode_mini_batches = decode_mini_batches
+    return batch
+
+
+def encode_updates(updates: list[sched_ext.QueryUpdate]) -> bytes:
+    w = _Writer(b"KQUP")
+    arr = np.empty((len(updates),), dtype=QUERY_UPDATE_DTYPE)
+    for i, u in enumerate(updates):
+        arr[i] = (u.id, u.active_position, u.generated_token, u.ok, u.is_prefill, u.decode_done)
+    w.u32(arr.size)
+    w.parts.append(arr.tobytes())
+    return w.getvalue()
+
+
+def decode_updates(data: bytes) -> list[sched_ext.QueryUpdate]:
+    r = _Reader(data, b"KQUP")
+    count = r.u32()
+    arr = np.frombuffer(r.view, dtype=QUERY_UPDATE_DTYPE, count=count, offset=r.offset)
+    updates = []
+    for id, active_position, generated_token, ok, is_prefill, decode_done in arr.tolist():
+        u = sched_ext.QueryUpdate()
+        u.id = id
+        u.active_position = active_position
+        u.generated_token = generated_token
+        u.ok = bool(ok)
+        u.is_prefill = bool(is_prefill)
+        u.decode_done = bool(decode_done)
+        updates.append(u)
+    return updates
+
+
+def encode_query_add(query: sched_ext.QueryAdd) -> bytes:
+    w = _Writer(b"KQAD")
+    w.array(query.query_token, "<u4")
+    w.array([query.query_length, query.estimated_length], "<u8")
+    w.array([query.user_id], "<i8")
+    w.array([query.SLO_TTFT_ms, query.SLO_TBT_ms], "<i4")
+    _write_sample_options(w, [query.sample_options])
+    _write_stop_criteria(w, [query.stop_criteria])
+    return w.getvalue()
+
+
+def decode_query_add(data: bytes) -> sched_ext.QueryAdd:
+    r = _Reader(data, b"KQAD")
+    query = sched_ext.QueryAdd()
+    query.query_token = r.array("<u4").tolist()
+    query.query_length, query.estimated_length = r.array("<u8").tolist()
+    (query.user_id,) = r.array("<i8").tolist()
+    query.SLO_TTFT_ms, query.SLO_TBT_ms = r.array("<i4").tolist()
+    query.sample_options = _read_sample_options(r)[0]
+    query.stop_criteria = _read_stop_criteria(r)[0]
+    return query
+
+
+def encode_u64(value: int) -> bytes:
+    return struct.pack("<Q", value)
+
+
+def decode_u64(data: bytes) -> int:
+    return struct.unpack("<Q", data)[0]
+
+
+def encode_tokens(query_ids: list[int], tokens: list[int]) -> bytes:
+    """One engine step of generated tokens, -1 marks a finished query."""
+    return np.asarray(query_ids, dtype="<u8").tobytes() + np.asarray(tokens, dtype="<i8").tobytes()
+
+
+def decode_tokens(data: bytes) -> tuple[list[int], list[int]]:
+    count = len(data) // 16
+    query_ids = np.frombuffer(data, dtype="<u8", count=count).tolist()
+    tokens = np.frombuffer(data, dtype="<i8", count=count, offset=count * 8).tolist()
+    return query_ids, tokens
@@ -55,6 +55,7 @@ def create_sched_settings(args):
     settings.kvc2_config_path = os.path.join(current_dir, "..", "..", "configs")
     print(os.path.join(current_dir, "..", "..", "configs"))
     settings.memory_pool_size_GB = args.cpu_memory_size_GB
+    settings.swap_pool_size_GB = args.swap_pool_size_GB
     settings.evict_count = 40
     settings.kvc2_metrics_port = args.kvc2_metrics_port
     settings.load_from_disk = False
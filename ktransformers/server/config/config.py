@@ -116,6 +116,11 @@ class Config(metaclass=Singleton):
         self.experts_per_token: Optional[int] = self.model.get("experts_per_token", None)
         self.load_q4 = self.model.get("load_q4", False)
         self.fast_safetensors = self.model.get("fast_safetensors", False)
+        # cache of repacked weights, defaults to <gguf_path>/.kt_weight_cache
+        self.weight_cache = self.model.get("weight_cache", True)
+        self.weight_cache_dir: Optional[str] = self.model.get("weight_cache_dir", None)
+        # module -> operator plan of the injection rules, kept in <weight cache dir>/injection_plans
+        self.injection_plan_cache = self.model.get("injection_plan_cache", True)
         self.draft_model_dir: Optional[str] = self.model.get("draft_model_dir", None)
         self.no_draft_scale = self.model.get("no_draft_scale", False)
         self.modes = self.model.get("modes", False)
@@ -143,6 +148,17 @@ class Config(metaclass=Singleton):
         self.amnesia = self.model.get("amnesia", False)
         self.batch_size = self.model.get("batch_size", 1)
         self.cache_lens = self.model.get("cache_lens", 4096)
+        # KV blocks of earlier prompts kept for any later request starting with the same tokens
+        self.prefix_cache = self.model.get("prefix_cache", False)
+        self.prefix_cache_block_size = self.model.get("prefix_cache_block_size", 64)
+        self.prefix_cache_ram_gb = self.model.get("prefix_cache_ram_gb", 8)
+        self.prefix_cache_dir = self.model.get("prefix_cache_dir", None)
+        self.prefix_cache_disk_gb = self.model.get("prefix_cache_disk_gb", 64)
+        # micro-batches a prefill chunk is split into, the cpu experts of one overlap the gpu work of the next
+        self.prefill_micro_batches = self.model.get("prefill_micro_batches", 1)
+        # per-layer expert hit counts, loaded from and saved to expert_stats_path when set
+        self.expert_stats = self.model.get("expert_stats", False)
+        self.expert_stats_path: Optional[str] = self.model.get("expert_stats_path", None)
         self.device = self.model.get("device", "cuda:2")
 
         # web config
@@ -153,6 +169,8 @@ class Config(metaclass=Singleton):
         # ext
         self.ext: dict = cfg.get("ext", {})
         self.cpu_infer = psutil.cpu_count(logical=False) - 3
+        # NUMA builds: each expert on one node instead of a copy per node
+        self.numa_partition: bool = self.ext.get("numa_partition", False)
 
         # file config
         self.local_store_configs: dict = cfg.get("local_store", {})
@@ -178,6 +196,11 @@ class Config(metaclass=Singleton):
         self.preselect_block_count = self.long_context_config.get("preselect_block_count", 32)
         self.layer_step = self.long_context_config.get("layer_step", 1)
         self.token_step = self.long_context_config.get("token_step", 100)
+        # kvcache snapshots of prefilled sessions, restored instead of prefilling their prompt again
+        self.session_dir: str = os.path.join(
+            self.localstore_path, self.long_context_config.get("session_dir", "sessions")
+        )
+        self.session_disk_gb = self.long_context_config.get("session_disk_gb", 256)
 
         # local chat
         self.local_chat_config: dict = cfg.get("local_chat", {})
@@ -189,6 +212,8 @@ class Config(metaclass=Singleton):
         self.sched_metrics_port = cfg["async_server"]["sched_metrics_port"]
         self.kvc2_metrics_port = cfg["async_server"]["kvc2_metrics_port"]
         self.max_batch_size = cfg["async_server"]["max_batch_size"]
+        self.slo_ttft_ms = cfg["async_server"].get("slo_ttft_ms", None)
+        self.slo_tbt_ms = cfg["async_server"].get("slo_tbt_ms", None)
         self.page_size = cfg["attn"]["page_size"]
         self.chunk_size = cfg["attn"]["chunk_size"]
         self.memory_gpu_only = cfg["kvc2"]["gpu_only"]
@@ -196,6 +221,7 @@ class Config(metaclass=Singleton):
         self.gpu_memory_size = 2*576*61*self.cache_lens
         self.utilization_percentage = 1.0 #cfg["kvc2"]["utilization_percentage"]
         self.cpu_memory_size_GB = cfg["kvc2"]["cpu_memory_size_GB"]
+        self.swap_pool_size_GB = cfg["kvc2"].get("swap_pool_size_GB", 0)
         # only support 2 prefill task
         self.max_prefill_batch_size = 2
         self.max_decode_batch_size = self.max_batch_size - self.max_prefill_batch_size 
@@ -21,3 +21,7 @@ def internal_server_error(what):
 
 def request_error(what):
     return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"{what}")
+
+
+def not_found(what):
+    return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"{what} not found")
@@ -10,6 +10,11 @@ from openai.types.completion_usage import CompletionUsage
 from openai.types.chat.chat_completion_chunk import Choice
 
 
+SAMPLING_PARAMS = {"top_k", "min_p", "repetition_penalty", "frequency_penalty", "presence_penalty", "seed"}
+# request fields the balance_serve scheduler reads
+SCHEDULING_PARAMS = {"user"}
+
+
 class Role(Enum):
     system = 'system'
     user = 'user'
@@ -32,10 +37,26 @@ class ChatCompletionCreate(BaseModel):
     stream : bool = False
     temperature: Optional[float] = Field(default=1.0)
     top_p: Optional[float] = Field(default=1.0)
+    top_k: Optional[int] = None
+    min_p: Optional[float] = None
+    repetition_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
+    presence_penalty: Optional[float] = None
+    seed: Optional[int] = None
+    user: Optional[str] = None
+    # continue a session of /v1/sessions, its messages go before these
+    session_id: Optional[str] = None
     
     def get_tokenizer_messages(self):
         return [m.to_tokenizer_message() for m in self.messages]
 
+    def sampling_params(self) -> dict:
+        # sampling options beyond temperature / top_p, only the balance_serve backend takes them
+        return self.model_dump(include=SAMPLING_PARAMS, exclude_none=True)
+
+    def scheduling_params(self) -> dict:
+        return self.model_dump(include=SCHEDULING_PARAMS, exclude_none=True)
+
 
 class ChatCompletionChunk(BaseModel):
     id: str
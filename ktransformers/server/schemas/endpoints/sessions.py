@@ -0,0 +1,34 @@
+from typing import List, Optional
+from typing_extensions import Literal
+
+from pydantic import BaseModel
+
+from ktransformers.server.schemas.base import Object
+from ktransformers.server.schemas.endpoints.chat import Message
+
+
+class SessionCreate(BaseModel):
+    session_id: Optional[str] = None
+    messages: List[Message]
+
+
+class SessionObject(Object):
+    object: Literal["session"] = "session"
+    tokens: int
+    snapshot_bytes: int
+    created: int
+    prefill_time: float
+    restores: int
+    restore_time: float
+
+    @classmethod
+    def from_snapshot(cls, snapshot) -> "SessionObject":
+        return cls(
+            id=snapshot.session_id,
+            tokens=snapshot.length,
+            snapshot_bytes=snapshot.nbytes,
+            created=int(snapshot.created),
+            prefill_time=snapshot.prefill_time,
+            restores=snapshot.restores,
+            restore_time=snapshot.restore_time,
+        )
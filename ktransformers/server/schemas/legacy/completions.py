@@ -4,6 +4,7 @@ from enum import Enum
 from pydantic import BaseModel
 
 from ..base import Object
+from ..endpoints.chat import SAMPLING_PARAMS, SCHEDULING_PARAMS
 
 class CompletionCreate(BaseModel):
     model: str
@@ -11,12 +12,25 @@ class CompletionCreate(BaseModel):
     stream: bool = False
     temperature: Optional[float] = None
     top_p: Optional[float] = None
+    top_k: Optional[int] = None
+    min_p: Optional[float] = None
+    repetition_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
+    presence_penalty: Optional[float] = None
+    seed: Optional[int] = None
+    user: Optional[str] = None
 
     def get_tokenizer_messages(self):
         if isinstance(self.prompt,List):
             self.get_tokenizer_messages('\n'.join(self.prompt))
         return [{'content':self.prompt,'role':'user'}]
 
+    def sampling_params(self) -> dict:
+        return self.model_dump(include=SAMPLING_PARAMS, exclude_none=True)
+
+    def scheduling_params(self) -> dict:
+        return self.model_dump(include=SCHEDULING_PARAMS, exclude_none=True)
+
 
 class FinishReason(Enum):
     stop = 'stop'
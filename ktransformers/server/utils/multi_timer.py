@@ -77,3 +77,48 @@ class Profiler:
 
     def get_counter(self,key:str):
         return self.counters.get(key,0)
+
+
+class LatencyHistogram:
+    """Log2-bucketed latency histogram, bucket i counts samples in [2^(i-1), 2^i) microseconds."""
+
+    def __init__(self, num_buckets: int = 32):
+        self.buckets = [0] * num_buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        us = int(seconds * 1e6)
+        idx = min(us.bit_length(), len(self.buckets) - 1)
+        self.buckets[idx] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p: float) -> float:
+        """Upper bound in seconds of the bucket holding the p-th percentile."""
+        if self.count == 0:
+            return 0.0
+        target = p / 100 * self.count
+        seen = 0
+        for idx, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min((1 << idx) * 1e-6, self.max)
+        return self.max
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def reset(self):
+        self.buckets = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def report_string(self, name: str) -> str:
+        return (
+            f"{name}: n={self.count} mean={format_time(self.mean())} p50={format_time(self.percentile(50))} "
+            f"p99={format_time(self.percentile(99))} max={format_time(self.max)}"
+        )
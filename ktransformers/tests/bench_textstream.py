@@ -0,0 +1,54 @@
+import argparse
+import time
+from transformers import AutoTokenizer
+from ktransformers.util.textstream import TextStreamer
+
+sample_text = """def fibonacci(n: int) -> int:
+    return n if n < 2 else fibonacci(n - 1) + fibonacci(n - 2)
+在遥远的翡翠森林里，住着各种各样的神奇生物。其中，有一只名叫露露的小狐狸，她与其他狐狸不同，天生长着一双晶莹剔透的翅膀。
+Streaming detokenization must keep the per-token cost flat even when a line never ends 🦊🌲✨ """
+
+
+def bench_stream(tokenizer, tokens, window):
+    streamer = TextStreamer(tokenizer)
+    pieces = []
+    costs = []
+    start = time.perf_counter()
+    for i, token in enumerate(tokens):
+        pieces.append(streamer.put(token))
+        if (i + 1) % window == 0:
+            now = time.perf_counter()
+            costs.append((now - start) / window)
+            start = now
+    pieces.append(streamer.end())
+    return "".join(pieces), costs
+
+
+def bench_batch(tokenizer, tokens, num_streams):
+    streamers = [TextStreamer(tokenizer) for _ in range(num_streams)]
+    start = time.perf_counter()
+    for token in tokens:
+        TextStreamer.put_batch(streamers, [token] * num_streams)
+    return (time.perf_counter() - start) / len(tokens)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TextStreamer per-token cost over long outputs")
+    parser.add_argument("--model_dir", type=str, required=True)
+    parser.add_argument("--num_tokens", type=int, default=32768)
+    parser.add_argument("--window", type=int, default=4096)
+    parser.add_argument("--num_streams", type=int, default=64)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_dir, trust_remote_code=True)
+    # no newline inside, the old streamer never flushed its cache on such text
+    text = sample_text.replace("\n", " ")
+    tokens = tokenizer.encode(text, add_special_tokens=False)
+    tokens = (tokens * (args.num_tokens // len(tokens) + 1))[: args.num_tokens]
+
+    streamed, costs = bench_stream(tokenizer, tokens, args.window)
+    assert streamed == tokenizer.decode(tokens, skip_special_tokens=True), "streamed text differs from full decode"
+    for i, cost in enumerate(costs):
+        print(f"tokens {i * args.window:>6}-{(i + 1) * args.window:>6}: {cost * 1e6:8.2f} us/token")
+    per_step = bench_batch(tokenizer, tokens[: args.window], args.num_streams)
+    print(f"put_batch of {args.num_streams} streams: {per_step * 1e6:8.2f} us/step")
@@ -0,0 +1,54 @@
+# Input GB/s of the CPU dequantizer against the dequantize_* functions of custom_gguf (plus the cast to the target
+# dtype they need), per GGML type, on one thread and on all of them.
+#   python dequant_cpu.py [num_elements=16777216] [target_dtype=bfloat16]
+import os
+import sys
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import time
+import warnings
+import numpy as np
+import torch
+from ktransformers.util.custom_gguf import GGML_BLOCK_SIZES, GGML_ELEMENTS_PER_BLOCK, GGML_DEQUANTIZE
+from ktransformers.util.cpu_dequant import CPUDequantizer, GGML_DEQUANTIZE_CPU_INTO, GGML_CPU_RAW_DTYPES
+
+num_elements = int(sys.argv[1]) if len(sys.argv) > 1 else 1 << 24
+target_dtype = getattr(torch, sys.argv[2]) if len(sys.argv) > 2 else torch.bfloat16
+rounds = 3
+# random scales are sometimes inf/NaN, the kernels run on pool threads where np.seterr does not reach
+warnings.filterwarnings("ignore", category=RuntimeWarning)
+
+
+def bench(fn) -> float:
+    fn()
+    begin = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - begin) / rounds
+
+
+def reference(ggml_name: str, data: np.ndarray) -> torch.Tensor:
+    values = torch.from_numpy(np.array(GGML_DEQUANTIZE[ggml_name](data)))
+    if ggml_name == "BF16":
+        values = values.view(torch.bfloat16)
+    return values.to(target_dtype)
+
+
+num_threads = os.cpu_count()
+single = CPUDequantizer(num_threads=1)
+threaded = CPUDequantizer(num_threads=num_threads)
+print(f"{num_elements} elements per tensor, {target_dtype}, {num_threads} threads")
+print(f"{'type':<7} {'MB':>8} {'reference':>10} {'1 thread':>10} {f'{num_threads} threads':>11}   GB/s of input")
+for ggml_name in list(GGML_DEQUANTIZE_CPU_INTO) + list(GGML_CPU_RAW_DTYPES):
+    block_size = GGML_BLOCK_SIZES[ggml_name]
+    elements_per_block = GGML_ELEMENTS_PER_BLOCK[ggml_name]
+    num_blocks = num_elements // elements_per_block
+    data = np.random.randint(0, 256, num_blocks * block_size, dtype=np.uint8)
+    out = torch.empty((num_blocks, elements_per_block), dtype=target_dtype)
+    ref_time = bench(lambda: reference(ggml_name, data))
+    single_time = bench(lambda: single.dequantize(data, ggml_name, block_size, elements_per_block, target_dtype, out))
+    threaded_time = bench(lambda: threaded.dequantize(data, ggml_name, block_size, elements_per_block, target_dtype, out))
+    print(f"{ggml_name:<7} {data.nbytes / 2**20:>8.1f} {data.nbytes / ref_time / 1e9:>10.2f} "
+          f"{data.nbytes / single_time / 1e9:>10.2f} {data.nbytes / threaded_time / 1e9:>11.2f}")
+single.close()
+threaded.close()
@@ -0,0 +1,52 @@
+# Parity of the CPU dequantizer with the reference dequantize_* functions of custom_gguf, bit for bit in float32
+# and after the same cast for bf16/fp16 outputs.
+import os
+import sys
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import numpy as np
+import torch
+from ktransformers.util.custom_gguf import GGML_BLOCK_SIZES, GGML_ELEMENTS_PER_BLOCK, GGML_DEQUANTIZE
+from ktransformers.util.cpu_dequant import CPUDequantizer, GGML_DEQUANTIZE_CPU_INTO, GGML_CPU_RAW_DTYPES
+
+rng = np.random.default_rng(0)
+
+
+def random_blocks(ggml_name: str, num_blocks: int) -> np.ndarray:
+    data = rng.integers(0, 256, num_blocks * GGML_BLOCK_SIZES[ggml_name], dtype=np.uint8)
+    if ggml_name in ("F32", "F16", "BF16"):
+        # finite floats only, NaN payloads are not preserved by every cast
+        dtype = {"F32": np.float32, "F16": np.float16, "BF16": np.float16}[ggml_name]
+        data = rng.standard_normal(data.nbytes // np.dtype(dtype).itemsize).astype(dtype).view(np.uint8)
+    return data
+
+
+def reference(ggml_name: str, data: np.ndarray, target_dtype: torch.dtype) -> torch.Tensor:
+    values = torch.from_numpy(np.array(GGML_DEQUANTIZE[ggml_name](data)))
+    if ggml_name == "BF16":
+        values = values.view(torch.bfloat16)
+    return values.reshape(-1).to(target_dtype)
+
+
+def same_bits(a: torch.Tensor, b: torch.Tensor) -> bool:
+    if a.dtype != b.dtype or a.shape != b.shape:
+        return False
+    int_dtype = {4: torch.int32, 2: torch.int16}[a.element_size()]
+    return torch.equal(a.view(int_dtype), b.view(int_dtype))
+
+
+failed = 0
+# a scratch of a few blocks so that tensors are split into many shards, one of them partial
+dequantizer = CPUDequantizer(num_threads=4, scratch_bytes=7 * 256 * 4)
+for ggml_name in list(GGML_DEQUANTIZE_CPU_INTO) + list(GGML_CPU_RAW_DTYPES):
+    for num_blocks in (1, 37, 1000):
+        data = random_blocks(ggml_name, num_blocks)
+        for target_dtype in (torch.float32, torch.bfloat16, torch.float16):
+            values = dequantizer.dequantize(data, ggml_name, GGML_BLOCK_SIZES[ggml_name],
+                                            GGML_ELEMENTS_PER_BLOCK[ggml_name], target_dtype)
+            ok = same_bits(values.reshape(-1), reference(ggml_name, data, target_dtype))
+            failed += not ok
+            print(f"{ggml_name:<7} {num_blocks:>5} blocks -> {str(target_dtype):<15}: {'ok' if ok else 'MISMATCH'}")
+dequantizer.close()
+print("all match" if failed == 0 else f"{failed} mismatches")
+sys.exit(failed != 0)
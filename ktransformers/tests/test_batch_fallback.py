@@ -0,0 +1,48 @@
+"""
+batch_size > 1 on a model without batched decode (anything but DeepSeek V2/V3, or no sm80 NVIDIA GPU) falls back
+to serving requests one at a time. Runs two requests through that path until they stop on EOS.
+    python test_batch_fallback.py --model_dir <Qwen2-57B-A14B-Instruct> --gguf_path <gguf dir>
+"""
+import argparse
+import asyncio
+import os
+import sys
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+from ktransformers.server.config.config import Config
+from ktransformers.server.backend.interfaces.ktransformers import KTransformersInterface
+
+prompts = ["Reply with the single word: yes", "What is 1 + 1? Answer with the number only."]
+
+
+async def run(interface: KTransformersInterface):
+    for i, prompt in enumerate(prompts):
+        text = ""
+        finish_reason = None
+        async for v in interface.inference([{"role": "user", "content": prompt}], f"fallback-{i}"):
+            if isinstance(v, tuple):
+                text += v[0]
+                finish_reason = v[1] or finish_reason
+        print(f"{prompt!r} -> {text!r} ({finish_reason})")
+        assert finish_reason == "stop", f"expected the request to end on EOS, got {finish_reason}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", type=str, required=True)
+    parser.add_argument("--gguf_path", type=str, required=True)
+    parser.add_argument("--optimize_config_path", type=str, default=None)
+    parser.add_argument("--batch_size", type=int, default=4)
+    args = parser.parse_args()
+
+    cfg = Config()
+    cfg.model_dir = args.model_dir
+    cfg.gguf_path = args.gguf_path
+    cfg.optimize_config_path = args.optimize_config_path
+    cfg.batch_size = args.batch_size
+    cfg.max_new_tokens = 256
+    interface = KTransformersInterface(cfg)
+    assert not interface.continuous_batching, "this model decodes in batches, pick one without batched decode"
+    assert cfg.batch_size == 1 and interface.cache.max_batch_size == 1
+    asyncio.run(run(interface))
+    print("ok")
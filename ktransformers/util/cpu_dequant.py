@@ -0,0 +1,240 @@
+'''
+Description  :  CPU dequantization of GGUF tensors. Blocks are sharded over a thread pool and every shard is
+                dequantized by vectorized NumPy kernels straight into a preallocated output tensor, through a
+                float32 scratch of bounded size per thread when the output is bf16/fp16. NumPy and the torch
+                casts drop the GIL, so the shards run in parallel. The kernels reproduce the float32 results of
+                the dequantize_* functions of custom_gguf bit for bit.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+QK_K = 256
+
+kvalues_iq4nl = np.array([-127, -104, -83, -65, -49, -35, -22, -10, 1, 13, 25, 38, 53, 69, 89, 113], dtype=np.int8)
+
+# the kernels take the blocks as a (n, block_size) uint8 array and write (n, elements_per_block) float32
+
+
+def dequantize_q2_k_into(blocks: np.ndarray, out: np.ndarray):
+    n = blocks.shape[0]
+    data_f16 = blocks.view(np.float16)
+    dmin = data_f16[:, -1].reshape(n, 1, 1).astype(np.float32)
+    d = data_f16[:, -2].reshape(n, 1, 1).astype(np.float32)
+    scales = blocks[:, :16].reshape(n, 16, 1)
+    # value k * 16 + i of a block is qs[32 * (k // 8) + 16 * (k % 2) + i] >> (2 * (k % 8 // 2))
+    shifts = np.array([0, 2, 4, 6], dtype=np.uint8).reshape(1, 1, 4, 1, 1)
+    q = (blocks[:, 16:80].reshape(n, 2, 1, 2, 16) >> shifts).reshape(n, 16, 16) & 3
+    out = out.reshape(n, 16, 16)
+    np.multiply(d * (scales & 15), q, out=out)
+    np.subtract(out, dmin * (scales >> 4), out=out)
+
+
+def dequantize_q3_k_into(blocks: np.ndarray, out: np.ndarray):
+    n = blocks.shape[0]
+    d = blocks.view(np.float16)[:, -1].reshape(n, 1, 1).astype(np.float32)
+    bits = np.unpackbits(blocks[:, :32].reshape(n, 32, 1), axis=-1, bitorder="little")
+    bits = 4 ^ (bits << 2)
+    qs = blocks[:, 32:32 + 64].astype(np.int16)
+    a, b, c = blocks[:, 96:96 + 12].reshape(n, 3, 4).transpose(1, 0, 2)
+    scales = np.empty((n, 4, 4), dtype=np.uint8)
+    scales[:, 0] = (a & 15) | ((c & 3) << 4)
+    scales[:, 1] = (b & 15) | (((c >> 2) & 3) << 4)
+    scales[:, 2] = (a >> 4) | (((c >> 4) & 3) << 4)
+    scales[:, 3] = (b >> 4) | ((c >> 6) << 4)
+    scales = scales.reshape(n, 16, 1).astype(np.int16)
+    # value k * 16 + i with k = 8h + 2s + c takes the 2 bits at 2s of qs[32h + 16c + i] and hmask bit 4h + s
+    shifts = np.array([0, 2, 4, 6], dtype=np.int16).reshape(1, 1, 4, 1, 1)
+    q = (qs.reshape(n, 2, 1, 2, 16) >> shifts) & 3
+    q = (q - bits.reshape(n, 2, 16, 2, 4).transpose(0, 3, 4, 1, 2)).reshape(n, 16, 16)
+    np.multiply(d * (scales - 32), q, out=out.reshape(n, 16, 16))
+
+
+def dequantize_q4_k_into(blocks: np.ndarray, out: np.ndarray):
+    n = blocks.shape[0]
+    data_f16 = blocks.view(np.float16)
+    scale_factors = data_f16[:, 0].reshape(n, 1, 1).astype(np.float32)
+    scale_offsets = data_f16[:, 1].reshape(n, 1, 1).astype(np.float32)
+    qs1 = blocks[:, 4:16].reshape(n, 12, 1)
+    sc = np.empty((n, 8, 1), dtype=np.uint8)
+    mn = np.empty((n, 8, 1), dtype=np.uint8)
+    sc[:, :4] = qs1[:, 0:4] & 0b111111
+    sc[:, 4:] = (qs1[:, 8:] & 15) | ((qs1[:, 0:4] >> 6) << 4)
+    mn[:, :4] = qs1[:, 4:8] & 0b111111
+    mn[:, 4:] = (qs1[:, 8:] >> 4) | ((qs1[:, 4:8] >> 6) << 4)
+    factors = (scale_factors * sc).reshape(n, 4, 2, 1)
+    offsets = (scale_offsets * mn).reshape(n, 4, 2, 1)
+    qs2 = blocks[:, 16:].reshape(n, 4, 32)
+    # sub-block 2j holds the low nibbles of qs2[j], 2j + 1 the high ones
+    out = out.reshape(n, 4, 2, 32)
+    np.multiply(factors[:, :, 0], qs2 & 0xf, out=out[:, :, 0])
+    np.multiply(factors[:, :, 1], qs2 >> 4, out=out[:, :, 1])
+    np.subtract(out, offsets, out=out)
+
+
+def dequantize_q5_k_into(blocks: np.ndarray, out: np.ndarray):
+    n = blocks.shape[0]
+    data_f16 = blocks.view(np.float16)
+    d = data_f16[:, 0].reshape(n, 1, 1).astype(np.float32)
+    dmin = data_f16[:, 1].reshape(n, 1, 1).astype(np.float32)
+    scales = blocks[:, 4:16]
+    qh = blocks[:, 16:16 + 32].reshape(n, 32, 1)
+    qs = blocks[:, 48:48 + 128].reshape(n, 4, 1, 32)
+    bits = np.unpackbits(qh, axis=-1, bitorder="little")
+
+    sc = np.empty((n, 8, 1), dtype=np.uint8)
+    mn = np.empty((n, 8, 1), dtype=np.uint8)
+    sc[:, :4, 0] = scales[:, :4] & 63
+    sc[:, 4:, 0] = (scales[:, 8:] & 15) | ((scales[:, :4] >> 6) << 4)
+    mn[:, :4, 0] = scales[:, 4:8] & 63
+    mn[:, 4:, 0] = (scales[:, 8:] >> 4) | ((scales[:, 4:8] >> 6) << 4)
+
+    q = np.empty((n, 4, 2, 32), dtype=np.uint8)
+    np.bitwise_and(qs, 15, out=q[:, :, 0:1])
+    np.right_shift(qs, 4, out=q[:, :, 1:2])
+    q = q.reshape(n, 8, 32)
+    q += bits.transpose(0, 2, 1) << 4
+    out = out.reshape(n, 8, 32)
+    np.multiply(d * sc, q, out=out)
+    np.subtract(out, dmin * mn, out=out)
+
+
+def dequantize_q6_k_into(blocks: np.ndarray, out: np.ndarray):
+    n = blocks.shape[0]
+    scales = blocks.view(np.float16)[:, -1].reshape(n, 1, 1).astype(np.float32)
+    ql = blocks[:, :128].astype(np.int16).reshape(n, 2, 1, 2, 32)
+    qh = blocks[:, 128:192].astype(np.int16).reshape(n, 2, 1, 1, 32)
+    sc = blocks[:, 192:208].view(np.int8)[:, :, np.newaxis].astype(np.float32)
+    # q 4g + 2t + p takes the low (t = 0) or high nibble of ql[64g + 32p:] and the 2 bits at 2(2t + p) of qh[32g:],
+    # with the operator precedence of the reference implementation
+    lo = np.empty((n, 2, 2, 2, 32), dtype=np.int16)
+    np.bitwise_and(ql, 0xF, out=lo[:, :, 0:1])
+    np.right_shift(ql, 4, out=lo[:, :, 1:2])
+    shifts = np.array([[0, 2], [4, 6]], dtype=np.int16).reshape(1, 1, 2, 2, 1)
+    q = (lo | (((qh >> shifts) & 3) << 4) - 32).reshape(n, 16, 16)
+    out = out.reshape(n, 16, 16)
+    np.multiply(sc, q, out=out)
+    np.multiply(scales, out, out=out)
+
+
+def dequantize_iq4_xs_into(blocks: np.ndarray, out: np.ndarray):
+    n = blocks.shape[0]
+    d = blocks[:, :2].view(np.float16).astype(np.float32).reshape(n, 1)
+    scales_h = blocks[:, 2:4].view(np.uint16).reshape(n, 1)
+    scales_l = blocks[:, 4:8]
+    qs = blocks[:, 8:].reshape(n, QK_K // 32, 16)
+    ib = np.arange(QK_K // 32)
+    ls = (((scales_l[:, ib // 2] >> (4 * (ib % 2)).astype(np.uint8)) & 0xf)
+          | (((scales_h >> (2 * ib).astype(np.uint16)) & 3) << 4)).astype(np.int8)
+    dl = (d * (ls - 32)).reshape(n, -1, 1)
+    out = out.reshape(n, QK_K // 32, 2, 16)
+    np.multiply(dl, kvalues_iq4nl[qs & 0xf], out=out[:, :, 0])
+    np.multiply(dl, kvalues_iq4nl[qs >> 4], out=out[:, :, 1])
+
+
+def dequantize_q4_0_into(blocks: np.ndarray, out: np.ndarray):
+    scales = blocks[:, :2].view(np.float16).astype(np.float32)
+    qs = blocks[:, 2:]
+    np.multiply(scales, (qs & 0xf).astype(np.int8) - 8, out=out[:, :16])
+    np.multiply(scales, (qs >> 4).astype(np.int8) - 8, out=out[:, 16:])
+
+
+def dequantize_q5_0_into(blocks: np.ndarray, out: np.ndarray):
+    scales = blocks[:, :2].view(np.float16).astype(np.float32)
+    bits = np.unpackbits(blocks[:, 2:2 + 4], axis=-1, bitorder="little")
+    qs = blocks[:, 2 + 4:]
+    np.multiply(scales, ((qs & 0xf).astype(np.int8) | (bits[:, :16] << 4)) - 16, out=out[:, :16])
+    np.multiply(scales, ((qs >> 4).astype(np.int8) | (bits[:, 16:] << 4)) - 16, out=out[:, 16:])
+
+
+def dequantize_q8_0_into(blocks: np.ndarray, out: np.ndarray):
+    scales = blocks[:, :2].view(np.float16).astype(np.float32)
+    np.multiply(scales, blocks[:, 2:].view(np.int8), out=out)
+
+
+GGML_DEQUANTIZE_CPU_INTO = {
+    "Q4_0": dequantize_q4_0_into,
+    "Q5_0": dequantize_q5_0_into,
+    "Q8_0": dequantize_q8_0_into,
+    "Q2_K": dequantize_q2_k_into,
+    "Q3_K": dequantize_q3_k_into,
+    "Q4_K": dequantize_q4_k_into,
+    "Q5_K": dequantize_q5_k_into,
+    "Q6_K": dequantize_q6_k_into,
+    "IQ4_XS": dequantize_iq4_xs_into,
+}
+
+# plain float types are only cast
+GGML_CPU_RAW_DTYPES = {
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+}
+
+
+class CPUDequantizer:
+    """
+    Thread pool dequantizing GGUF tensors into tensors of the target dtype. A shard is at most scratch_bytes of
+    float32 output, so the memory on top of the output is bounded by num_threads * scratch_bytes (plus the
+    temporaries of the kernels, of the same order).
+    """
+    num_threads: int
+    scratch_bytes: int
+
+    def __init__(self, num_threads: int | None = None, scratch_bytes: int = 16 << 20):
+        if num_threads is None:
+            num_threads = min(16, os.cpu_count() or 1)
+        self.num_threads = num_threads
+        self.scratch_bytes = scratch_bytes
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="cpu_dequant")
+        self.local = threading.local()
+
+    def scratch(self, numel: int) -> np.ndarray:
+        buf = getattr(self.local, "scratch", None)
+        if buf is None or buf.size < numel:
+            buf = self.local.scratch = np.empty(numel, dtype=np.float32)
+        return buf[:numel]
+
+    def dequantize(self, data: np.ndarray, ggml_name: str, block_size: int, elements_per_block: int,
+                   target_dtype: torch.dtype = torch.float32, out: torch.Tensor | None = None) -> torch.Tensor:
+        """Dequantize the raw bytes of whole blocks, returns a (num_blocks, elements_per_block) tensor."""
+        data = np.frombuffer(data, dtype=np.uint8)
+        num_blocks = data.nbytes // block_size
+        if out is None:
+            out = torch.empty((num_blocks, elements_per_block), dtype=target_dtype)
+        out = out.view(num_blocks, elements_per_block)
+        if num_blocks == 0:
+            return out
+
+        raw_dtype = GGML_CPU_RAW_DTYPES.get(ggml_name)
+        if raw_dtype is None and ggml_name not in GGML_DEQUANTIZE_CPU_INTO:
+            raise NotImplementedError(f"CPU dequantization of {ggml_name} not implemented")
+        blocks = data[:num_blocks * block_size].reshape(num_blocks, block_size)
+        blocks_per_shard = max(1, self.scratch_bytes // (elements_per_block * 4))
+
+        def work(blocks_begin, blocks_end):
+            src = blocks[blocks_begin:blocks_end]
+            dst = out[blocks_begin:blocks_end]
+            if raw_dtype is not None:
+                dst.copy_(torch.from_numpy(src).view(raw_dtype).view(dst.shape))
+            elif dst.dtype == torch.float32:
+                GGML_DEQUANTIZE_CPU_INTO[ggml_name](src, dst.numpy())
+            else:
+                scratch = self.scratch(dst.numel()).reshape(dst.shape)
+                GGML_DEQUANTIZE_CPU_INTO[ggml_name](src, scratch)
+                dst.copy_(torch.from_numpy(scratch))
+
+        shards = [(b, min(b + blocks_per_shard, num_blocks)) for b in range(0, num_blocks, blocks_per_shard)]
+        if len(shards) == 1:
+            work(*shards[0])
+        else:
+            for future in [self.executor.submit(work, *shard) for shard in shards]:
+                future.result()
+        return out
+
+    def close(self):
+        self.executor.shutdown(wait=True)
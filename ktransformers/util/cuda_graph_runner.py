@@ -6,6 +6,7 @@ Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
 '''
 import torch
 from typing import Dict
+from ktransformers.operators.cpuinfer import CPUInfer
 
 class CUDAGraphRunner:
 
@@ -37,7 +38,7 @@ class CUDAGraphRunner:
         torch.cuda.set_device(main_device)
         self.main_device = main_device
         capture_stream = torch.cuda.Stream()
-        with torch.cuda.graph(self.graph, stream = capture_stream):
+        with CPUInfer.task_graph(), torch.cuda.graph(self.graph, stream = capture_stream):
             logits=model(inputs_embeds=inputs_embeds, 
                          position_ids=position_ids,
                          cache_position=cache_position,
@@ -15,6 +15,7 @@ Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
 # copied from llama.cpp/gguf-py/gguf/constants.py to satisfy dependence of gguf
 # GGUF specification
 # https://github.com/ggerganov/ggml/blob/master/docs/gguf.md
+import mmap
 import struct
 import warnings
 import numpy as np
@@ -26,6 +27,10 @@ from enum import IntEnum
 import torch
 import KTransformersOps
 from .custom_loader import SafeTensorLoader
+from .load_pipeline import GGUFLoadPipeline, GGML_DEQUANTIZE_INTO, GGML_RAW_DTYPES
+from .cpu_dequant import CPUDequantizer, kvalues_iq4nl
+from .weight_cache import WeightCache, CACHE_DIR_NAME
+from .gguf_index import GGUFIndex, LazyTensorInfo, LazyTensorFileMap, LazyMeta, scan_model_dir
 import ctypes
 import math
 
@@ -166,12 +171,83 @@ DATA_TYPES = {
     "FP8": 13,
 }
 
+def tensor_nbytes(info: dict) -> int:
+    return int(np.dtype(info["item_type"]).itemsize) * info["item_count"]
+
+def block_byte_ranges(tensors) -> dict[str, list[tuple[str, int, int]]]:
+    """{"blk.N.": [(file_name, offset, nbytes)]} of (name, file_name, offset, nbytes) tuples, ranges of one block
+    that are adjacent in a file (up to alignment padding) are merged."""
+    spans = {}
+    for name, file_name, offset, nbytes in tensors:
+        if not name.startswith("blk."):
+            continue
+        prefix = name[:name.index(".", 4) + 1]
+        spans.setdefault(prefix, []).append((file_name, offset, offset + nbytes))
+    ranges = {}
+    for prefix, block_spans in spans.items():
+        block_spans.sort()
+        merged = [list(block_spans[0])]
+        for file_name, begin, end in block_spans[1:]:
+            last = merged[-1]
+            if file_name == last[0] and begin - last[2] < mmap.PAGESIZE:
+                last[2] = max(last[2], end)
+            else:
+                merged.append([file_name, begin, end])
+        ranges[prefix] = [(file_name, begin, end - begin) for file_name, begin, end in merged]
+    return ranges
+
+def make_tensor_info(shape: list[int], ggml_type: int, bad_offset: int) -> dict:
+    n_elems = int(math.prod(shape))
+    block_size, type_size = GGML_QUANT_SIZES[ggml_type]
+    n_bytes = n_elems * type_size // block_size
+    np_dims = tuple(reversed(shape))
+
+    item_type: npt.DTypeLike
+    if ggml_type == GGMLQuantizationType.F16:
+        item_count = n_elems
+        item_type = np.float16
+    elif ggml_type == GGMLQuantizationType.F32:
+        item_count = n_elems
+        item_type = np.float32
+    elif ggml_type == GGMLQuantizationType.F64:
+        item_count = n_elems
+        item_type = np.float64
+    elif ggml_type == GGMLQuantizationType.I8:
+        item_count = n_elems
+        item_type = np.int8
+    elif ggml_type == GGMLQuantizationType.I16:
+        item_count = n_elems
+        item_type = np.int16
+    elif ggml_type == GGMLQuantizationType.I32:
+        item_count = n_elems
+        item_type = np.int32
+    elif ggml_type == GGMLQuantizationType.I64:
+        item_count = n_elems
+        item_type = np.int64
+    else:
+        item_count = n_bytes
+        item_type = np.uint8
+        np_dims = quant_shape_to_byte_shape(np_dims, ggml_type)
+
+    return {
+        "ggml_type": ggml_type,
+        "shape": shape,
+        "bad_offset": bad_offset,
+        "item_type": item_type,
+        "item_count": item_count,
+        "np_dims": np_dims
+    }
+
 class GGUFLoader:
     tensor_info: dict
     gguf_path: str
     tensor_file_map: dict # {tensor_name: tensor_file_path}
     gguf_file_meta: dict
     safetensor_loader: SafeTensorLoader
+    pipeline: GGUFLoadPipeline | None
+    weight_cache: WeightCache | None
+    cpu_dequantizer: CPUDequantizer | None
+    block_ranges: dict # {"blk.N.": [(file_path, offset, nbytes)]}
     def __init__(self, gguf_path: str):
         # Check dir exist
         if not os.path.exists(gguf_path):
@@ -180,6 +256,9 @@ class GGUFLoader:
             gguf_path = os.path.dirname(gguf_path)
 
         self.safetensor_loader = None
+        self.pipeline = None
+        self.weight_cache = None
+        self.cpu_dequantizer = None
         
         self.tensor_info = {}
         self.gguf_path = gguf_path
@@ -187,26 +266,36 @@ class GGUFLoader:
         self.file_data_map = {}
         self.gguf_file_meta = {}
         self.tensor_device_map = {}
+        self.block_ranges = {}
 
+        gguf_files, has_safetensors = scan_model_dir(gguf_path)
         # I know this is ugly, but I don't want to change the original code too much
         # TODO: merge gguf load and other loads.
-        safetensor_loader = SafeTensorLoader(gguf_path)
-        if safetensor_loader.tensor_file_map:
-            self.safetensor_loader = safetensor_loader
-            return
-        # Walk through all the .gguf files in the directory
-        found_gguf = False
-        for root, dirs, files in os.walk(gguf_path):
-            for file in files:
-                if file.endswith(".gguf"):
-                    found_gguf = True
-                    file_name = os.path.join(root, file)
-                    with open(file_name, "rb") as f:
-                        self.load_gguf(f)
-                        if file_name not in self.file_data_map:
-                            self.file_data_map[file_name] = np.memmap(file_name, mode = 'r')
-        if not found_gguf:
+        if has_safetensors:
+            safetensor_loader = SafeTensorLoader(gguf_path)
+            if safetensor_loader.tensor_file_map:
+                self.safetensor_loader = safetensor_loader
+                return
+        if not gguf_files:
             raise FileNotFoundError(f"Cannot find any .gguf files in: {gguf_path}")
+
+        index = GGUFIndex.open(gguf_path, gguf_files)
+        if index is not None:
+            self.tensor_info = LazyTensorInfo(index)
+            self.tensor_file_map = LazyTensorFileMap(index)
+            self.gguf_file_meta = LazyMeta(index)
+            self.block_ranges = index.block_ranges()
+        else:
+            for file_name in gguf_files:
+                with open(file_name, "rb") as f:
+                    self.load_gguf(f)
+            self.block_ranges = block_byte_ranges(
+                (name, self.tensor_file_map[name], t["offset"], tensor_nbytes(t)) for name, t in self.tensor_info.items())
+            GGUFIndex.write(gguf_path, gguf_files, self.tensor_info, self.tensor_file_map, self.gguf_file_meta,
+                            self.block_ranges)
+        for file_name in gguf_files:
+            if file_name not in self.file_data_map:
+                self.file_data_map[file_name] = np.memmap(file_name, mode = 'r')
                             
     def load_gguf(self, f):
         f.seek(0)
@@ -231,46 +320,7 @@ class GGUFLoader:
             shape = [read_value(f, DATA_TYPES["uint64"]) for _ in range(shape_len)]
             ggml_type = read_value(f, DATA_TYPES["uint32"])
             bad_offset = read_value(f, DATA_TYPES["uint64"])
-            n_elems = int(math.prod(shape))
-            block_size, type_size = GGML_QUANT_SIZES[ggml_type]
-            n_bytes = n_elems * type_size // block_size
-            np_dims = tuple(reversed(shape))
-        
-            item_type: npt.DTypeLike
-            if ggml_type == GGMLQuantizationType.F16:
-                item_count = n_elems
-                item_type = np.float16
-            elif ggml_type == GGMLQuantizationType.F32:
-                item_count = n_elems
-                item_type = np.float32
-            elif ggml_type == GGMLQuantizationType.F64:
-                item_count = n_elems
-                item_type = np.float64
-            elif ggml_type == GGMLQuantizationType.I8:
-                item_count = n_elems
-                item_type = np.int8
-            elif ggml_type == GGMLQuantizationType.I16:
-                item_count = n_elems
-                item_type = np.int16
-            elif ggml_type == GGMLQuantizationType.I32:
-                item_count = n_elems
-                item_type = np.int32
-            elif ggml_type == GGMLQuantizationType.I64:
-                item_count = n_elems
-                item_type = np.int64
-            else:
-                item_count = n_bytes
-                item_type = np.uint8
-                np_dims = quant_shape_to_byte_shape(np_dims, ggml_type)
-
-            tensor_info[name] = {
-                "ggml_type": ggml_type,
-                "shape": shape,
-                "bad_offset": bad_offset,
-                "item_type": item_type,
-                "item_count": item_count,
-                "np_dims": np_dims
-            }
+            tensor_info[name] = make_tensor_info(shape, ggml_type, bad_offset)
 
         start = f.tell()
         # Alignment is 32 by default.
@@ -290,6 +340,38 @@ class GGUFLoader:
         self.tensor_info.update(tensor_info)
         self.gguf_file_meta.update(info)
     
+    def enable_pipeline(self, **kwargs):
+        # pipelined loading only applies to gguf tensors, safetensors go through their own loader
+        if self.pipeline is None and self.safetensor_loader is None:
+            self.pipeline = GGUFLoadPipeline(**kwargs)
+
+    def disable_pipeline(self, report: bool = True):
+        if self.pipeline is None:
+            return
+        if report:
+            self.pipeline.report()
+        self.pipeline.close()
+        self.pipeline = None
+
+    def enable_weight_cache(self, cache_dir: str | None = None):
+        # post-transform weights are only cached for gguf sources, their bytes are what the entries are keyed by
+        if self.weight_cache is not None or self.safetensor_loader is not None:
+            return
+        if cache_dir is None:
+            cache_dir = os.path.join(self.gguf_path, CACHE_DIR_NAME)
+        try:
+            self.weight_cache = WeightCache(cache_dir)
+        except OSError as e:
+            warnings.warn(f"weight cache disabled, can't create {cache_dir}: {e}")
+
+    def prefetch_prefix(self, prefix: str):
+        # kernel readahead of every tensor under prefix, e.g. "blk.3.", so the next layer is read while this one
+        # is being dequantized
+        if self.pipeline is None:
+            return
+        for file_name, offset, nbytes in self.block_ranges.get(prefix, ()):
+            self.pipeline.prefetch(self.file_data_map[file_name], offset, nbytes)
+
     def get_mmap_tensor(self, name):
         t = self.tensor_info[name]
         mmap_data = self.file_data_map[ self.tensor_file_map[name] ]
@@ -300,6 +382,16 @@ class GGUFLoader:
         itemsize = int(np.empty([], dtype = item_type).itemsize)
         return mmap_data[offset : offset + itemsize * item_count]
     
+    def dequantize_cpu(self, data, ggml_name: str, target_dtype) -> torch.Tensor:
+        # (num_blocks, elements_per_block) in target_dtype, sharded over the threads of the CPU dequantizer
+        if self.cpu_dequantizer is None:
+            self.cpu_dequantizer = CPUDequantizer()
+        block_size = GGML_BLOCK_SIZES[ggml_name]
+        elements_per_block = GGML_ELEMENTS_PER_BLOCK[ggml_name]
+        if self.pipeline is not None:
+            return self.pipeline.load_cpu(data, self.cpu_dequantizer, ggml_name, block_size, elements_per_block, target_dtype)
+        return self.cpu_dequantizer.dequantize(data, ggml_name, block_size, elements_per_block, target_dtype)
+
     def get_undequanted_tensor_and_ggml_type(self, name):
         t = self.tensor_info[name]
         data = self.get_mmap_tensor(name)
@@ -327,12 +419,10 @@ class GGUFLoader:
         
         if "cuda" in device.lower():
             values = GGML_DEQUANTIZE_GPU[ggml_name](data, device, target_dtype)
+            if ggml_name == "BF16":
+                values = values.view(torch.bfloat16)
         else:
-            values = GGML_DEQUANTIZE[ggml_name](data)
-            values = torch.from_numpy(values.copy())
-
-        if ggml_name == "BF16":
-            values = values.view(torch.bfloat16)
+            values = self.dequantize_cpu(data, ggml_name, target_dtype)
         values = values.view(shape[-2::-1])
 
         return values
@@ -360,29 +450,28 @@ class GGUFLoader:
         num_blocks = num_elements // elements_per_block
         
         blocks_per_iter = 16384
-        if num_blocks > blocks_per_iter: # dequant large tensor
+        # everything but the small GPU tensors already comes in target_dtype, BF16 bits are converted inside
+        converted = True
+        if "cuda" not in device.lower():
+            values = self.dequantize_cpu(data, ggml_name, target_dtype)
+        elif self.pipeline is not None and (ggml_name in GGML_DEQUANTIZE_INTO or ggml_name in GGML_RAW_DTYPES):
+            values = self.pipeline.load_cuda(data, ggml_name, block_size, elements_per_block, device, target_dtype)
+        elif num_blocks > blocks_per_iter: # dequant large tensor
             values = torch.empty((num_blocks, elements_per_block), dtype=target_dtype, device=device)
             for i in range( (num_blocks + blocks_per_iter - 1) // blocks_per_iter):
                 blocks_begin = i * blocks_per_iter
                 blocks_end = min(blocks_begin + blocks_per_iter, num_blocks)
-                if "cuda" in device.lower():
-                    cur_values = GGML_DEQUANTIZE_GPU[ggml_name](data[blocks_begin*block_size : blocks_end*block_size], device, target_dtype)
-                else:
-                    cur_values = GGML_DEQUANTIZE[ggml_name](data[blocks_begin*block_size : blocks_end*block_size])
-                    cur_values = torch.from_numpy(cur_values.copy())
+                cur_values = GGML_DEQUANTIZE_GPU[ggml_name](data[blocks_begin*block_size : blocks_end*block_size], device, target_dtype)
                 
                 cur_values = cur_values.view(-1, elements_per_block)
                 if ggml_name == "BF16":
                     cur_values = cur_values.view(torch.bfloat16)
                 values[blocks_begin : blocks_end] = cur_values
         else:
-            if "cuda" in device.lower():
-                values = GGML_DEQUANTIZE_GPU[ggml_name](data, device)
-            else:
-                values = GGML_DEQUANTIZE[ggml_name](data)
-                values = torch.from_numpy(values)
+            converted = False
+            values = GGML_DEQUANTIZE_GPU[ggml_name](data, device)
                 
-        if ggml_name == "BF16":
+        if ggml_name == "BF16" and not converted:
             values = values.view(torch.bfloat16)
             
 
@@ -702,8 +791,6 @@ def dequantize_q6_k_gpu(data: np.ndarray, device:str = "cuda", target_dtype = to
     c_pointer = ctypes.addressof(ctypes.cast(data.ctypes.data, ctypes.POINTER(ctypes.c_int8)).contents)
     return KTransformersOps.dequantize_q6_k(c_pointer, data.size, block_size, ele_per_blk, device, target_dtype)
 
-kvalues_iq4nl = np.array([-127, -104, -83, -65, -49, -35, -22, -10, 1, 13, 25, 38, 53, 69, 89, 113], dtype=np.int8)
-
 def dequantize_iq4_xs(data):
     # C implementation
     # https://github.com/ggerganov/ggml/blob/21d3a308fcb7f31cb9beceaeebad4fb622f3c337/src/ggml-quants.c#L3568
@@ -864,26 +951,29 @@ GGML_DEQUANTIZE_GPU = {
 }
 
 
-def translate_name_to_gguf_mixtral(name):
-    
-    replacement_template = {
-        "w1.weight": "ffn_gate",
-        "w2.weight": "ffn_down",
-        "w3.weight": "ffn_up"
-    }  
+mixtral_replacement_template = {
+    "w1.weight": "ffn_gate",
+    "w2.weight": "ffn_down",
+    "w3.weight": "ffn_up"
+}
+
+mixtral_expert_pattern = re.compile(r"model.layers\.(\d+)\.block_sparse_moe\.experts\.(\d+)\.(w\d\.weight)")
 
-    pattern = re.compile(r"model.layers\.(\d+)\.block_sparse_moe\.experts\.(\d+)\.(w\d\.weight)")
+def translate_name_to_gguf_mixtral(name):
+    # called for every module when the injection rules are matched, most names can't match the pattern
+    if "block_sparse_moe.experts." not in name:
+        return name
 
     def replace_match(match):
         blk_id = match.group(1)
         expert_id = match.group(2)
         weight_type = match.group(3)
-        if weight_type in replacement_template:
-            return f"blk.{blk_id}.{replacement_template[weight_type]}.{expert_id}.weight"
+        if weight_type in mixtral_replacement_template:
+            return f"blk.{blk_id}.{mixtral_replacement_template[weight_type]}.{expert_id}.weight"
         else:
             return match.group(0)
 
-    new_name = re.sub(pattern, replace_match, name)
+    new_name = re.sub(mixtral_expert_pattern, replace_match, name)
     
     return new_name
 
@@ -0,0 +1,104 @@
+'''
+Description  :  Expert activation statistics of MoE layers: per-layer, per-expert hit counts taken from the routing
+                (topk_idx) of every forward. Counts stay on the device of the router and are only read back on demand,
+                so recording is a couple of kernels per layer and is captured into CUDA graphs with the rest of the
+                layer. KExpertsHybrid reads them to pick the experts it keeps on the GPU, and a dump of a real
+                workload is a good start for hand written optimize rules.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import atexit
+import json
+import os
+
+import torch
+
+
+class ExpertStats:
+    """Hit counts by layer key, the key of the experts module of the layer (e.g. blk.3)."""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.counts: dict[str, torch.Tensor] = {}
+        # counts of an earlier run, added to the live ones
+        self.seed: dict[str, torch.Tensor] = {}
+
+    def record(self, key: str, topk_idx: torch.Tensor, n_experts: int, bsz_tensor: torch.Tensor | None = None):
+        """Count the experts routed to by topk_idx [..., k], rows from bsz_tensor on are padding and not counted."""
+        if not self.enabled:
+            return
+        counts = self.counts.get(key)
+        if counts is None:
+            if topk_idx.is_cuda and torch.cuda.is_current_stream_capturing():
+                # allocated from the graph pool it would be zeroed by every replay, wait for an eager forward
+                return
+            counts = self.counts[key] = torch.zeros(n_experts, dtype=torch.int64, device=topk_idx.device)
+        topk_idx = topk_idx.reshape(-1, topk_idx.size(-1))
+        if bsz_tensor is None:
+            hits = torch.ones_like(topk_idx, dtype=torch.int64)
+        else:
+            rows = torch.arange(topk_idx.size(0), device=topk_idx.device)
+            hits = (rows < bsz_tensor.to(topk_idx.device)).to(torch.int64).unsqueeze(1).expand_as(topk_idx)
+        counts.index_add_(0, topk_idx.flatten().to(torch.int64), hits.flatten())
+
+    def get(self, key: str) -> torch.Tensor | None:
+        """Host copy of the counts of a layer, None when nothing was recorded for it."""
+        counts = self.counts.get(key)
+        seed = self.seed.get(key)
+        if counts is None:
+            return None if seed is None else seed.clone()
+        counts = counts.cpu()
+        if seed is not None and seed.shape == counts.shape:
+            counts += seed
+        return counts
+
+    def hottest(self, key: str, n: int) -> list[int]:
+        """Up to n most used experts of a layer, most used first, experts never hit are left out."""
+        counts = self.get(key)
+        if counts is None:
+            return []
+        values, experts = counts.topk(min(n, counts.numel()))
+        return experts[values > 0].tolist()
+
+    def snapshot(self) -> dict[str, list[int]]:
+        return {key: self.get(key).tolist() for key in sorted(set(self.counts) | set(self.seed))}
+
+    def save(self, path: str):
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump({"counts": self.snapshot()}, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str):
+        with open(path) as f:
+            counts = json.load(f)["counts"]
+        self.seed = {key: torch.tensor(value, dtype=torch.int64) for key, value in counts.items()}
+
+    def reset(self):
+        for counts in self.counts.values():
+            counts.zero_()
+        self.seed.clear()
+
+    def report_string(self, top: int = 8) -> str:
+        lines = []
+        for key, counts in self.snapshot().items():
+            total = sum(counts)
+            if total == 0:
+                continue
+            hot = sorted(range(len(counts)), key=counts.__getitem__, reverse=True)[:top]
+            share = sum(counts[i] for i in hot) / total
+            lines.append(f"{key}: {total} hits, top {len(hot)} experts {hot} take {share * 100:.1f}%")
+        return "\n".join(lines)
+
+
+EXPERT_STATS = ExpertStats()
+
+
+def configure_expert_stats(enabled: bool, path: str | None = None):
+    """Turn recording on, with path the counts of an earlier run are loaded and the counts are saved there at exit."""
+    EXPERT_STATS.enabled = EXPERT_STATS.enabled or enabled
+    if path is None:
+        return
+    EXPERT_STATS.enabled = True
+    if os.path.exists(path):
+        EXPERT_STATS.load(path)
+    atexit.register(EXPERT_STATS.save, path)
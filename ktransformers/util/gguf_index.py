@@ -0,0 +1,258 @@
+'''
+Description  :  Binary index sidecar of the GGUF files in a model directory.
+                The first load parses every header and writes name -> file, offset, type and shape into one flat
+                table, later loads memory-map that table and only build the per-tensor dicts that are looked up.
+                The byte ranges of each blk.N. layer, which the load pipeline prefetches, are stored as a second
+                small table so prefetching never touches the per-tensor entries.
+                The key/value metadata (mostly the tokenizer vocab) is kept as a separate blob and unpickled on
+                first access.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import hashlib
+import json
+import os
+import pickle
+import struct
+import sys
+import warnings
+from collections.abc import Mapping
+
+import numpy as np
+
+INDEX_VERSION = 2
+INDEX_FILE_NAME = ".kt_gguf_index"
+MAX_DIMS = 4
+TABLE_ALIGNMENT = 8
+
+_header = struct.Struct("<4sIQQQQQ")  # magic, version, files_len, names_len, n_tensors, n_ranges, meta_len
+
+TENSOR_DTYPE = np.dtype([
+    ("file_idx", "<u4"),
+    ("ggml_type", "<u4"),
+    ("n_dims", "<u4"),
+    ("pad", "<u4"),
+    ("shape", "<u8", (MAX_DIMS,)),
+    ("bad_offset", "<u8"),
+    ("offset", "<u8"),
+])
+
+RANGE_DTYPE = np.dtype([
+    ("block", "<u4"),
+    ("file_idx", "<u4"),
+    ("offset", "<u8"),
+    ("nbytes", "<u8"),
+])
+
+
+def scan_model_dir(path: str) -> tuple[list[str], bool]:
+    """.gguf files under path in os.walk order, and whether any .safetensors file is present."""
+    gguf_files = []
+    has_safetensors = False
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            if file.endswith(".gguf"):
+                gguf_files.append(os.path.join(root, file))
+            elif file.endswith(".safetensors"):
+                has_safetensors = True
+    return gguf_files, has_safetensors
+
+
+def _file_stamps(gguf_path: str, gguf_files: list[str]) -> list:
+    stamps = []
+    for file_name in gguf_files:
+        st = os.stat(file_name)
+        stamps.append([os.path.relpath(file_name, gguf_path), st.st_size, st.st_mtime_ns])
+    return stamps
+
+
+def index_candidates(gguf_path: str) -> list[str]:
+    # next to the model if writable, otherwise under the user's local store
+    user_dir = os.path.join(os.path.expanduser("~"), ".ktransformers", "gguf_index")
+    digest = hashlib.sha1(os.path.abspath(gguf_path).encode()).hexdigest()[:16]
+    return [os.path.join(gguf_path, INDEX_FILE_NAME), os.path.join(user_dir, digest + INDEX_FILE_NAME)]
+
+
+class LazyTensorInfo(Mapping):
+    """tensor_info backed by the index table, entries are materialized on first access and then kept."""
+
+    def __init__(self, index: "GGUFIndex"):
+        self.index = index
+        self.cache = {}
+
+    def __getitem__(self, name: str) -> dict:
+        info = self.cache.get(name)
+        if info is None:
+            info = self.index.tensor_info(self.index.name_to_row[name])
+            self.cache[name] = info
+        return info
+
+    def __contains__(self, name) -> bool:
+        return name in self.index.name_to_row
+
+    def __iter__(self):
+        return iter(self.index.name_to_row)
+
+    def __len__(self) -> int:
+        return len(self.index.name_to_row)
+
+
+class LazyTensorFileMap(Mapping):
+    def __init__(self, index: "GGUFIndex"):
+        self.index = index
+
+    def __getitem__(self, name: str) -> str:
+        return self.index.files[int(self.index.table["file_idx"][self.index.name_to_row[name]])]
+
+    def __contains__(self, name) -> bool:
+        return name in self.index.name_to_row
+
+    def __iter__(self):
+        return iter(self.index.name_to_row)
+
+    def __len__(self) -> int:
+        return len(self.index.name_to_row)
+
+
+class LazyMeta(Mapping):
+    """gguf key/value metadata, unpickled from the index on first access."""
+
+    def __init__(self, index: "GGUFIndex"):
+        self.index = index
+        self.meta = None
+
+    def load(self) -> dict:
+        if self.meta is None:
+            self.meta = pickle.loads(self.index.meta_blob)
+        return self.meta
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self) -> int:
+        return len(self.load())
+
+
+class GGUFIndex:
+    files: list[str]
+    table: np.ndarray
+
+    def __init__(self, path: str, files: list[str], data: np.memmap, names_begin: int, names_len: int,
+                 table_begin: int, n_tensors: int, ranges_begin: int, n_ranges: int, meta_begin: int, meta_len: int):
+        self.path = path
+        self.files = files
+        self.data = data
+        self.names_range = (names_begin, names_begin + names_len)
+        self.table = np.frombuffer(data, dtype=TENSOR_DTYPE, count=n_tensors, offset=table_begin)
+        self.ranges = np.frombuffer(data, dtype=RANGE_DTYPE, count=n_ranges, offset=ranges_begin)
+        self.meta_range = (meta_begin, meta_begin + meta_len)
+        self._name_to_row = None
+
+    @property
+    def name_to_row(self) -> dict:
+        if self._name_to_row is None:
+            begin, end = self.names_range
+            names = bytes(self.data[begin:end]).decode("utf-8").split("\0") if end > begin else []
+            self._name_to_row = {name: i for i, name in enumerate(names)}
+        return self._name_to_row
+
+    @property
+    def meta_blob(self) -> bytes:
+        begin, end = self.meta_range
+        return bytes(self.data[begin:end])
+
+    def block_ranges(self) -> dict:
+        """{"blk.N.": [(file_name, offset, nbytes)]}, see custom_gguf.block_byte_ranges."""
+        ranges = {}
+        for block, file_idx, offset, nbytes in self.ranges.tolist():
+            ranges.setdefault(f"blk.{block}.", []).append((self.files[file_idx], offset, nbytes))
+        return ranges
+
+    def tensor_info(self, row: int) -> dict:
+        from ktransformers.util.custom_gguf import make_tensor_info
+        entry = self.table[row]
+        shape = [int(d) for d in entry["shape"][:int(entry["n_dims"])]]
+        info = make_tensor_info(shape, int(entry["ggml_type"]), int(entry["bad_offset"]))
+        info["offset"] = int(entry["offset"])
+        return info
+
+    @staticmethod
+    def open(gguf_path: str, gguf_files: list[str]) -> "GGUFIndex | None":
+        """Index of gguf_files if a sidecar matching their current size and mtime exists, None otherwise."""
+        stamps = _file_stamps(gguf_path, gguf_files)
+        for path in index_candidates(gguf_path):
+            if not os.path.exists(path):
+                continue
+            try:
+                data = np.memmap(path, mode="r")
+                magic, version, files_len, names_len, n_tensors, n_ranges, meta_len = _header.unpack_from(data, 0)
+                if magic != b"KGIX" or version != INDEX_VERSION:
+                    continue
+                pos = _header.size
+                if json.loads(bytes(data[pos:pos + files_len]).decode("utf-8")) != stamps:
+                    continue
+                pos += files_len
+                names_begin = pos
+                pos += names_len
+                pos += (-pos) % TABLE_ALIGNMENT
+                table_begin = pos
+                pos += n_tensors * TENSOR_DTYPE.itemsize
+                ranges_begin = pos
+                pos += n_ranges * RANGE_DTYPE.itemsize
+                return GGUFIndex(path, gguf_files, data, names_begin, names_len, table_begin, n_tensors,
+                                 ranges_begin, n_ranges, pos, meta_len)
+            except (OSError, ValueError, struct.error) as e:
+                warnings.warn(f"ignoring broken gguf index {path}: {e}")
+        return None
+
+    @staticmethod
+    def write(gguf_path: str, gguf_files: list[str], tensor_info: dict, tensor_file_map: dict, gguf_file_meta: dict,
+              block_ranges: dict) -> str | None:
+        file_idx = {file_name: i for i, file_name in enumerate(gguf_files)}
+        names = list(tensor_info.keys())
+        table = np.zeros((len(names),), dtype=TENSOR_DTYPE)
+        for i, name in enumerate(names):
+            t = tensor_info[name]
+            if len(t["shape"]) > MAX_DIMS:
+                return None
+            table["file_idx"][i] = file_idx[tensor_file_map[name]]
+            table["ggml_type"][i] = int(t["ggml_type"])
+            table["n_dims"][i] = len(t["shape"])
+            table["shape"][i, :len(t["shape"])] = t["shape"]
+            table["bad_offset"][i] = t["bad_offset"]
+            table["offset"][i] = t["offset"]
+        ranges = np.array([(int(prefix[4:-1]), file_idx[file_name], offset, nbytes)
+                           for prefix, spans in block_ranges.items()
+                           for file_name, offset, nbytes in spans], dtype=RANGE_DTYPE)
+        files_blob = json.dumps(_file_stamps(gguf_path, gguf_files)).encode("utf-8")
+        names_blob = "\0".join(names).encode("utf-8")
+        meta_blob = pickle.dumps(dict(gguf_file_meta), protocol=pickle.HIGHEST_PROTOCOL)
+        pos = _header.size + len(files_blob) + len(names_blob)
+        padding = b"\0" * ((-pos) % TABLE_ALIGNMENT)
+        content = b"".join([
+            _header.pack(b"KGIX", INDEX_VERSION, len(files_blob), len(names_blob), len(names), len(ranges),
+                         len(meta_blob)),
+            files_blob, names_blob, padding, table.tobytes(), ranges.tobytes(), meta_blob,
+        ])
+        for path in index_candidates(gguf_path):
+            tmp_path = f"{path}.tmp-{os.getpid()}"
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(tmp_path, "wb") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+                return path
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        warnings.warn(f"can't write gguf index for {gguf_path}")
+        return None
+
+
+if __name__ == "__main__":
+    # prebuild the index of a model directory, e.g. right after downloading it
+    from ktransformers.util.custom_gguf import GGUFLoader
+    loader = GGUFLoader(sys.argv[1])
+    print(f"{len(loader.tensor_info)} tensors indexed")
@@ -0,0 +1,164 @@
+'''
+Description  :  On-disk KV snapshots of long-context sessions. A session is a prompt prefilled once whose CPU kvcache
+                is dumped to a memory-mapped file; later requests of the session load it back instead of prefilling
+                the prompt again. Next to the dump a snapshot keeps its prompt tokens as .npy and a json record.
+                Snapshots are evicted least recently used first once the directory outgrows its budget.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import json
+import os
+import re
+import time
+import warnings
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+
+import numpy as np
+
+# session ids name files, keep them to a safe alphabet
+_SESSION_ID = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+
+
+@dataclass
+class KVSnapshot:
+    session_id: str
+    length: int                     # tokens in the kvcache dump
+    messages: list = field(default_factory=list)
+    nbytes: int = 0
+    prefill_time: float = 0.0
+    created: float = 0.0
+    restores: int = 0
+    restore_time: float = 0.0       # of the last restore
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class KVSnapshotStore:
+    def __init__(self, directory: str, disk_bytes: int = 256 << 30):
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.snapshots = OrderedDict()  # session_id -> KVSnapshot, LRU first
+        self.disk_used = 0
+        os.makedirs(directory, exist_ok=True)
+        self.scan_disk()
+
+    @staticmethod
+    def check_id(session_id: str):
+        if not _SESSION_ID.match(session_id):
+            raise ValueError(f"invalid session id {session_id!r}, use at most 128 of [A-Za-z0-9_.-]")
+
+    def path(self, session_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, session_id + suffix)
+
+    def kv_path(self, session_id: str) -> str:
+        return self.path(session_id, ".kv")
+
+    def scan_disk(self):
+        """Pick up the snapshots left by an earlier process, least recently used first."""
+        records = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    snapshot = KVSnapshot(**json.load(f))
+            except (OSError, ValueError, TypeError):
+                continue
+            if not os.path.exists(self.kv_path(snapshot.session_id)):
+                continue
+            records.append((os.path.getmtime(path), snapshot))
+        for _, snapshot in sorted(records, key=lambda record: record[0]):
+            self.snapshots[snapshot.session_id] = snapshot
+            self.disk_used += snapshot.nbytes
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self.snapshots
+
+    def get(self, session_id: str) -> KVSnapshot | None:
+        return self.snapshots.get(session_id)
+
+    def list(self) -> list[KVSnapshot]:
+        return list(reversed(self.snapshots.values()))
+
+    def tokens(self, session_id: str) -> np.ndarray:
+        return np.load(self.path(session_id, ".tokens.npy"), mmap_mode="r")
+
+    def write_record(self, snapshot: KVSnapshot):
+        # the record mtime orders the snapshots after a restart
+        path = self.path(snapshot.session_id, ".json")
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    def add(self, session_id: str, tokens: np.ndarray, messages: list, prefill_time: float, dump) -> KVSnapshot:
+        """
+        Store a prefilled session. dump(path) writes the kvcache of its tokens to path. Replaces an older snapshot
+        of the same id and evicts the least recently used others when over budget.
+        """
+        self.check_id(session_id)
+        self.remove(session_id)
+        tokens = np.ascontiguousarray(tokens, dtype=np.int32)
+        kv_path = self.kv_path(session_id)
+        tmp_path = f"{kv_path}.tmp-{os.getpid()}"
+        tokens_path = self.path(session_id, ".tokens.npy")
+        try:
+            # dump raises when the file can't be written in full (RuntimeError from the kvcache, OSError here)
+            dump(tmp_path)
+            if os.path.getsize(tmp_path) == 0:
+                raise OSError(f"kvcache dump to {tmp_path} is empty")
+            os.replace(tmp_path, kv_path)
+            np.save(tokens_path, tokens)
+        except BaseException:
+            for path in (tmp_path, kv_path, tokens_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            raise
+        snapshot = KVSnapshot(
+            session_id=session_id,
+            length=int(tokens.shape[0]),
+            messages=messages,
+            nbytes=os.path.getsize(kv_path) + tokens.nbytes,
+            prefill_time=prefill_time,
+            created=time.time(),
+        )
+        self.write_record(snapshot)
+        self.snapshots[session_id] = snapshot
+        self.disk_used += snapshot.nbytes
+        while self.disk_used > self.disk_bytes and len(self.snapshots) > 1:
+            self.remove(next(iter(self.snapshots)))
+        return snapshot
+
+    def touch(self, session_id: str, restore_time: float | None = None):
+        snapshot = self.snapshots[session_id]
+        self.snapshots.move_to_end(session_id)
+        if restore_time is not None:
+            snapshot.restores += 1
+            snapshot.restore_time = restore_time
+        try:
+            self.write_record(snapshot)
+        except OSError as e:
+            warnings.warn(f"can't update session record in {self.directory}: {e}")
+
+    def remove(self, session_id: str) -> bool:
+        snapshot = self.snapshots.pop(session_id, None)
+        if snapshot is None:
+            return False
+        self.disk_used -= snapshot.nbytes
+        for suffix in (".json", ".kv", ".tokens.npy"):
+            try:
+                os.remove(self.path(session_id, suffix))
+            except OSError:
+                pass
+        return True
+
+    def report_string(self, session_id: str) -> str:
+        snapshot = self.snapshots[session_id]
+        speedup = snapshot.prefill_time / max(snapshot.restore_time, 1e-9)
+        return (f"session {session_id}: restored {snapshot.length} tokens in {snapshot.restore_time:.2f}s, "
+                f"prefill took {snapshot.prefill_time:.2f}s ({speedup:.1f}x), "
+                f"{len(self.snapshots)} snapshots / {self.disk_used / 2**30:.2f} GB on disk")
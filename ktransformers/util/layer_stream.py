@@ -0,0 +1,103 @@
+'''
+Description  :  Layer streaming for the per-layer prefill of prompts too long to keep every layer's prefill weights
+                on the GPU. A loader thread brings layer i+1 to the GPU on its own stream while layer i computes.
+                Layers are loaded on the loader stream only, so the blocks freed by evicting layer i-1 go back to that
+                stream's allocator pool and are reused in place by layer i+1: two layer slots rotate with no
+                empty_cache between layers.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+
+
+class LayerStreamStats:
+    """Load time of the loader thread against the time compute waited for it, resolved at report time."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.layers = 0
+        self.load_seconds = 0.0
+        self.stall_events = []
+        self.start = time.perf_counter()
+
+    def stall_seconds(self) -> float:
+        return sum(begin.elapsed_time(end) for begin, end in self.stall_events) / 1000
+
+    def overlap_ratio(self) -> float:
+        """Fraction of the weight loading hidden behind compute."""
+        if self.load_seconds <= 0:
+            return 1.0
+        return min(max(1.0 - self.stall_seconds() / self.load_seconds, 0.0), 1.0)
+
+    def report_string(self) -> str:
+        wall = time.perf_counter() - self.start
+        return (f"streamed {self.layers} layers in {wall:.2f}s: load {self.load_seconds:.2f}s, "
+                f"compute stalled {self.stall_seconds():.2f}s, overlap {self.overlap_ratio() * 100:.1f}%")
+
+
+class LayerStreamer:
+    """
+    Double buffered layer loading: acquire(i) returns once layer i is usable on the current stream and starts
+    loading layer i+1, release(i) evicts layer i once the current stream is done with it.
+    load_fn and unload_fn move one layer to the GPU and back, e.g. load_layer_to with PREFILL / UNLOAD.
+    """
+
+    def __init__(self, layers, load_fn, unload_fn, device: torch.device | str | None = None):
+        self.layers = layers
+        self.load_fn = load_fn
+        self.unload_fn = unload_fn
+        self.device = torch.device("cuda", torch.cuda.current_device()) if device is None else torch.device(device)
+        self.load_stream = torch.cuda.Stream(self.device)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="layer_stream")
+        self.pending: dict[int, Future] = {}
+        self.stats = LayerStreamStats()
+
+    def load(self, idx: int) -> torch.cuda.Event:
+        begin = time.perf_counter()
+        with torch.cuda.device(self.device), torch.cuda.stream(self.load_stream):
+            self.load_fn(self.layers[idx])
+            event = torch.cuda.Event()
+            event.record(self.load_stream)
+        event.synchronize()
+        self.stats.load_seconds += time.perf_counter() - begin
+        return event
+
+    def prefetch(self, idx: int):
+        if idx < len(self.layers) and idx not in self.pending:
+            self.pending[idx] = self.executor.submit(self.load, idx)
+
+    def begin(self):
+        self.stats.reset()
+        self.prefetch(0)
+
+    def acquire(self, idx: int):
+        compute_stream = torch.cuda.current_stream(self.device)
+        waiting, ready = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+        waiting.record(compute_stream)
+        self.prefetch(idx)
+        loaded = self.pending.pop(idx).result()
+        compute_stream.wait_event(loaded)
+        ready.record(compute_stream)
+        # compute idles from the end of layer idx-1 until the weights of layer idx are there
+        self.stats.stall_events.append((waiting, ready))
+        self.stats.layers += 1
+        self.prefetch(idx + 1)
+
+    def release(self, idx: int):
+        done = torch.cuda.Event()
+        done.record(torch.cuda.current_stream(self.device))
+        # the freed blocks are handed out again on the loader stream, whose work is ordered after this wait
+        self.load_stream.wait_event(done)
+        self.unload_fn(self.layers[idx])
+
+    def end(self) -> LayerStreamStats:
+        for future in self.pending.values():
+            future.result()
+        self.pending.clear()
+        torch.cuda.current_stream(self.device).wait_stream(self.load_stream)
+        torch.cuda.current_stream(self.device).synchronize()
+        return self.stats
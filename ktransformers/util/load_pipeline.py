@@ -0,0 +1,236 @@
+'''
+Description  :  Pipelined GGUF tensor loading.
+                Reader threads page-fault tensor byte ranges out of the mmap into a pool of pinned host buffers,
+                a copy stream uploads them and the dequant kernels run on a compute stream, so disk reads, H2D
+                copies and dequantization of consecutive chunks overlap.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import mmap
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import KTransformersOps
+
+
+# quant types with a dequant kernel that works on device resident blocks
+GGML_DEQUANTIZE_INTO = {
+    "Q8_0": KTransformersOps.dequantize_q8_0_into,
+    "Q2_K": KTransformersOps.dequantize_q2_k_into,
+    "Q3_K": KTransformersOps.dequantize_q3_k_into,
+    "Q4_K": KTransformersOps.dequantize_q4_k_into,
+    "Q5_K": KTransformersOps.dequantize_q5_k_into,
+    "Q6_K": KTransformersOps.dequantize_q6_k_into,
+    "IQ4_XS": KTransformersOps.dequantize_iq4_xs_into,
+}
+
+# plain float types only need a cast on the device
+GGML_RAW_DTYPES = {
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+}
+
+
+class LoadStats:
+    """Bytes and busy time per phase. GPU phases are timed with cuda events and resolved lazily."""
+
+    PHASES = ("read", "h2d", "dequant", "cpu_dequant")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.bytes = {phase: 0 for phase in self.PHASES}
+            self.seconds = {phase: 0.0 for phase in self.PHASES}
+            self.pending = deque()
+            self.tensors = 0
+            self.total_bytes = 0
+            self.start = time.perf_counter()
+            self.last_progress = self.start
+
+    def add(self, phase: str, nbytes: int, seconds: float):
+        with self.lock:
+            self.bytes[phase] += nbytes
+            self.seconds[phase] += seconds
+
+    def add_events(self, phase: str, nbytes: int, begin: torch.cuda.Event, end: torch.cuda.Event):
+        with self.lock:
+            self.pending.append((phase, nbytes, begin, end))
+
+    def collect(self, block: bool = False):
+        with self.lock:
+            while self.pending:
+                phase, nbytes, begin, end = self.pending[0]
+                if not block and not end.query():
+                    break
+                end.synchronize()
+                self.pending.popleft()
+                self.bytes[phase] += nbytes
+                self.seconds[phase] += begin.elapsed_time(end) / 1000
+
+    def tensor_done(self, nbytes: int, progress_interval: float):
+        self.collect()
+        self.tensors += 1
+        self.total_bytes += nbytes
+        now = time.perf_counter()
+        if progress_interval > 0 and now - self.last_progress >= progress_interval:
+            self.last_progress = now
+            print(f"loaded {self.tensors} tensors, {self.total_bytes / 1e9:.2f} GB, "
+                  f"{self.total_bytes / 1e9 / (now - self.start):.2f} GB/s")
+
+    def report_string(self) -> str:
+        self.collect(block=True)
+        wall = time.perf_counter() - self.start
+        lines = [f"loaded {self.tensors} tensors, {self.total_bytes / 1e9:.2f} GB in {wall:.2f}s, "
+                 f"{self.total_bytes / 1e9 / max(wall, 1e-9):.2f} GB/s overall"]
+        for phase in self.PHASES:
+            if self.bytes[phase] == 0:
+                continue
+            # busy time is summed over threads/streams, so this is the per-worker throughput
+            lines.append(f"  {phase:<12}: {self.bytes[phase] / 1e9:8.2f} GB, {self.seconds[phase]:8.2f}s busy, "
+                         f"{self.bytes[phase] / 1e9 / max(self.seconds[phase], 1e-9):8.2f} GB/s")
+        return "\n".join(lines)
+
+
+class PinnedBufferPool:
+    """Fixed set of pinned staging buffers, a buffer is reusable once the copy recorded on it has finished."""
+
+    def __init__(self, num_buffers: int, buffer_bytes: int):
+        self.buffer_bytes = buffer_bytes
+        self.free = queue.Queue()
+        for _ in range(num_buffers):
+            self.free.put((torch.empty(buffer_bytes, dtype=torch.uint8, pin_memory=True), None))
+
+    def acquire(self) -> torch.Tensor:
+        buf, event = self.free.get()
+        if event is not None:
+            event.synchronize()
+        return buf
+
+    def release(self, buf: torch.Tensor, event: torch.cuda.Event | None = None):
+        self.free.put((buf, event))
+
+
+class GGUFLoadPipeline:
+    num_threads: int
+    num_buffers: int
+    chunk_bytes: int
+
+    def __init__(self, num_threads: int | None = None, num_buffers: int = 8, chunk_bytes: int = 64 << 20,
+                 progress_interval: float = 10.0):
+        if num_threads is None:
+            num_threads = min(16, os.cpu_count() or 1)
+        self.num_threads = num_threads
+        self.num_buffers = num_buffers
+        self.chunk_bytes = chunk_bytes
+        self.progress_interval = progress_interval
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="gguf_reader")
+        self.stats = LoadStats()
+        self.pool = None
+        self.streams = {}
+
+    def get_streams(self, device: torch.device):
+        if device not in self.streams:
+            self.streams[device] = (torch.cuda.Stream(device), torch.cuda.Stream(device))
+        return self.streams[device]
+
+    def prefetch(self, mmap_data: np.memmap, offset: int, nbytes: int):
+        """Ask the kernel to start reading a byte range ahead of use."""
+        mm = getattr(mmap_data, "_mmap", None)
+        if mm is None or not hasattr(mm, "madvise"):
+            return
+        begin = offset - offset % mmap.PAGESIZE
+        self.executor.submit(mm.madvise, mmap.MADV_WILLNEED, begin, offset + nbytes - begin)
+
+    def read_chunk(self, src: np.ndarray, buf: torch.Tensor):
+        begin = time.perf_counter()
+        # np.copyto drops the GIL, so the page faults of several chunks are served in parallel
+        np.copyto(buf[:src.nbytes].numpy(), src)
+        self.stats.add("read", src.nbytes, time.perf_counter() - begin)
+        return buf
+
+    def load_cuda(self, data: np.ndarray, ggml_name: str, block_size: int, elements_per_block: int,
+                  device: str, target_dtype: torch.dtype) -> torch.Tensor:
+        device = torch.device(device)
+        if device.index is None:
+            device = torch.device("cuda", torch.cuda.current_device())
+        if self.pool is None:
+            self.pool = PinnedBufferPool(self.num_buffers, self.chunk_bytes)
+        copy_stream, compute_stream = self.get_streams(device)
+        raw_dtype = GGML_RAW_DTYPES.get(ggml_name)
+
+        num_blocks = data.nbytes // block_size
+        blocks_per_chunk = max(1, self.chunk_bytes // block_size)
+        assert blocks_per_chunk * block_size <= self.chunk_bytes, f"chunk_bytes is smaller than a {ggml_name} block"
+        chunks = [(b, min(b + blocks_per_chunk, num_blocks)) for b in range(0, num_blocks, blocks_per_chunk)]
+        values = torch.empty((num_blocks, elements_per_block), dtype=target_dtype, device=device)
+        # the output is produced on compute_stream but consumed on the caller's stream
+        compute_stream.wait_stream(torch.cuda.current_stream(device))
+
+        in_flight = deque()
+        next_chunk = 0
+        for _ in range(len(chunks)):
+            while next_chunk < len(chunks) and len(in_flight) < self.num_buffers:
+                # buffers are taken in chunk order here, never inside the readers, so a reader can not wait on a
+                # buffer held by a chunk that is consumed after it
+                blocks_begin, blocks_end = chunks[next_chunk]
+                src = data[blocks_begin * block_size: blocks_end * block_size]
+                in_flight.append((chunks[next_chunk], self.executor.submit(self.read_chunk, src, self.pool.acquire())))
+                next_chunk += 1
+            (blocks_begin, blocks_end), future = in_flight.popleft()
+            buf = future.result()
+            nbytes = (blocks_end - blocks_begin) * block_size
+
+            with torch.cuda.stream(copy_stream):
+                begin, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                begin.record()
+                raw = torch.empty(nbytes, dtype=torch.uint8, device=device)
+                raw.copy_(buf[:nbytes], non_blocking=True)
+                end.record()
+            self.stats.add_events("h2d", nbytes, begin, end)
+            self.pool.release(buf, end)
+
+            compute_stream.wait_event(end)
+            raw.record_stream(compute_stream)
+            with torch.cuda.stream(compute_stream):
+                begin, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                begin.record()
+                out = values[blocks_begin:blocks_end]
+                if raw_dtype is not None:
+                    out.copy_(raw.view(raw_dtype).view(out.shape))
+                else:
+                    GGML_DEQUANTIZE_INTO[ggml_name](raw.view(torch.int8), out, block_size, elements_per_block)
+                end.record()
+            self.stats.add_events("dequant", nbytes, begin, end)
+            del raw
+
+        torch.cuda.current_stream(device).wait_stream(compute_stream)
+        values.record_stream(compute_stream)
+        self.stats.tensor_done(data.nbytes, self.progress_interval)
+        return values
+
+    def load_cpu(self, data: np.ndarray, dequantizer, ggml_name: str, block_size: int, elements_per_block: int,
+                 target_dtype: torch.dtype) -> torch.Tensor:
+        begin = time.perf_counter()
+        # the dequantizer shards the tensor over its own threads and writes straight into the output
+        values = dequantizer.dequantize(data, ggml_name, block_size, elements_per_block, target_dtype)
+        self.stats.add("cpu_dequant", data.nbytes, time.perf_counter() - begin)
+        self.stats.tensor_done(data.nbytes, self.progress_interval)
+        return values
+
+    def report(self):
+        print(self.stats.report_string())
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.stats.collect(block=True)
+        self.pool = None
+        self.streams.clear()
@@ -0,0 +1,188 @@
+'''
+Description  :  Prefix cache of KV blocks shared by all conversations of a StaticCache backend.
+                Prompts are cut into fixed size token blocks, each block is keyed by a hash chained over all blocks
+                before it, so the chain of keys of a prompt walks a token trie and the first missing key ends its
+                longest cached prefix. Blocks live in host RAM and, when a directory is configured, are demoted to
+                disk instead of being dropped; both tiers evict the least recently used block first.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import hashlib
+import os
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+# numpy has no bfloat16, those blocks are stored on disk as int16 and viewed back
+_STORE_DTYPES = {torch.bfloat16: torch.int16}
+
+
+class PrefixCache:
+    block_size: int
+
+    def __init__(self, namespace: str, dtype: torch.dtype, block_size: int = 64, ram_bytes: int = 8 << 30,
+                 disk_dir: str | None = None, disk_bytes: int = 64 << 30):
+        self.dtype = dtype
+        self.block_size = block_size
+        self.ram_bytes = ram_bytes
+        self.disk_bytes = disk_bytes
+        # the root of every hash chain, blocks of other models or layouts never match
+        self.root = hashlib.blake2b(f"{namespace}|{dtype}|{block_size}".encode(), digest_size=16).digest()
+        self.ram = OrderedDict()   # key -> block tensor [num_layers, block_size, ...], LRU first
+        self.ram_used = 0
+        self.disk = OrderedDict()  # key -> nbytes
+        self.disk_used = 0
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.restored_tokens = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.scan_disk()
+
+    def scan_disk(self):
+        """Pick up the blocks left by an earlier process, oldest first."""
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".npy"):
+                path = os.path.join(self.disk_dir, name)
+                files.append((os.path.getmtime(path), name[:-len(".npy")], os.path.getsize(path)))
+        for _, key, nbytes in sorted(files):
+            self.disk[key] = nbytes
+            self.disk_used += nbytes
+
+    def block_keys(self, tokens: torch.Tensor | np.ndarray) -> list[str]:
+        """Chained keys of the full blocks of tokens."""
+        if isinstance(tokens, torch.Tensor):
+            tokens = tokens.flatten().cpu().numpy()
+        tokens = np.ascontiguousarray(tokens, dtype="<i4")
+        keys = []
+        prev = self.root
+        for begin in range(0, tokens.shape[0] - self.block_size + 1, self.block_size):
+            h = hashlib.blake2b(prev, digest_size=16)
+            h.update(tokens[begin:begin + self.block_size].tobytes())
+            prev = h.digest()
+            keys.append(prev.hex())
+        return keys
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.ram or key in self.disk
+
+    def disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + ".npy")
+
+    def touch(self, keys: list[str]):
+        # deepest block first, so a prefix is always more recent than its extensions and leaves are evicted first
+        for key in reversed(keys):
+            if key in self.ram:
+                self.ram.move_to_end(key)
+            elif key in self.disk:
+                self.disk.move_to_end(key)
+
+    def put_ram(self, key: str, block: torch.Tensor):
+        self.ram[key] = block
+        self.ram_used += block.nbytes
+        while self.ram_used > self.ram_bytes and len(self.ram) > 1:
+            old_key, old_block = self.ram.popitem(last=False)
+            self.ram_used -= old_block.nbytes
+            if self.disk_dir is not None:
+                self.put_disk(old_key, old_block)
+
+    def put_disk(self, key: str, block: torch.Tensor):
+        if key in self.disk:
+            return
+        if block.dtype in _STORE_DTYPES:
+            block = block.view(_STORE_DTYPES[block.dtype])
+        path = self.disk_path(key)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, block.numpy())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            warnings.warn(f"can't spill prefix block to {self.disk_dir}: {e}")
+            return
+        self.disk[key] = block.nbytes
+        self.disk_used += block.nbytes
+        while self.disk_used > self.disk_bytes and len(self.disk) > 1:
+            old_key, nbytes = self.disk.popitem(last=False)
+            self.disk_used -= nbytes
+            try:
+                os.remove(self.disk_path(old_key))
+            except OSError:
+                pass
+
+    def get(self, key: str) -> torch.Tensor | None:
+        block = self.ram.get(key)
+        if block is not None:
+            return block
+        if key not in self.disk:
+            return None
+        try:
+            arr = np.load(self.disk_path(key))
+        except (OSError, ValueError):
+            self.disk_used -= self.disk.pop(key)
+            return None
+        block = torch.from_numpy(arr)
+        if self.dtype in _STORE_DTYPES:
+            block = block.view(self.dtype)
+        # promote to RAM, the file stays as a second copy until the disk tier evicts it
+        self.put_ram(key, block)
+        return block
+
+    def match(self, tokens: torch.Tensor | np.ndarray) -> list[str]:
+        """Keys of the longest cached block prefix of tokens."""
+        matched = []
+        for key in self.block_keys(tokens):
+            if key not in self:
+                break
+            matched.append(key)
+        return matched
+
+    def restore(self, cache, tokens: torch.Tensor, skip_tokens: int = 0) -> int:
+        """
+        Copy the longest cached prefix of tokens into the active slot of cache.
+        Positions below skip_tokens already hold the right KV and are not copied again.
+        Returns the restored prefix length, 0 when the cache has nothing longer than skip_tokens.
+        """
+        keys = self.match(tokens)
+        length = len(keys) * self.block_size
+        if length <= skip_tokens:
+            return 0
+        first = skip_tokens // self.block_size
+        blocks = []
+        for key in keys[first:]:
+            block = self.get(key)
+            if block is None:
+                # lost from disk between match and load
+                break
+            blocks.append(block)
+        if not blocks:
+            return 0
+        keys = keys[:first + len(blocks)]
+        length = len(keys) * self.block_size
+        kv = torch.cat(blocks, dim=1)
+        cache.write_tokens(first * self.block_size, [kv[layer_idx] for layer_idx in range(kv.shape[0])])
+        self.touch(keys)
+        self.hits += 1
+        self.restored_tokens += length - first * self.block_size
+        return length
+
+    def insert(self, cache, tokens: torch.Tensor):
+        """Save the KV of the full blocks of tokens, read from the active slot of cache, that are not cached yet."""
+        keys = self.block_keys(tokens)
+        missing = [i for i, key in enumerate(keys) if key not in self]
+        if missing:
+            begin, end = missing[0], missing[-1] + 1
+            kv = torch.stack([t.to("cpu") for t in cache.read_tokens(begin * self.block_size, end * self.block_size)])
+            for i in missing:
+                offset = (i - begin) * self.block_size
+                self.put_ram(keys[i], kv[:, offset:offset + self.block_size].clone())
+        self.touch(keys)
+
+    def report_string(self) -> str:
+        return (f"prefix cache: {len(self.ram)} blocks / {self.ram_used / 2**30:.2f} GB in RAM, "
+                f"{len(self.disk)} blocks / {self.disk_used / 2**30:.2f} GB on disk, "
+                f"{self.hits} hits, {self.restored_tokens} tokens restored")
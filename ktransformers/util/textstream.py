@@ -1,5 +1,14 @@
 from typing import Any, List, Optional, Set
 class TextStreamer:
+    """
+    Incremental detokenizer. Only the tokens after `prefix_offset` are decoded on every put, so the cost per token
+    does not grow with the length of the output. `prefix_offset:read_offset` is a few already emitted tokens that
+    are decoded again to get the context dependent spacing right, text ending with an incomplete UTF-8 sequence
+    (U+FFFD from byte-fallback tokens) is held back until the sequence is complete.
+    """
+
+    # tokens kept in front of the unread ones, enough for SentencePiece/BPE to resolve leading spaces
+    PREFIX_WINDOW = 5
 
     def __init__(self, tokenizer: "AutoTokenizer", skip_prompt: bool = False, **decode_kwargs):
         self.tokenizer = tokenizer
@@ -8,77 +17,86 @@ class TextStreamer:
 
         # variables used in the streaming process
         self.token_cache = []
-        self.print_len = 0
+        self.prefix_offset = 0
+        self.read_offset = 0
         self.next_tokens_are_prompt = True
 
     def reset(self):
         self.token_cache = []
-        self.print_len = 0
+        self.prefix_offset = 0
+        self.read_offset = 0
 
-    def put(self, value)->Optional[str]:
-        """
-        Receives tokens, decodes them, and prints them to stdout as soon as they form entire words.
-        """        
+    def decode(self, tokens: List[int]) -> str:
+        return self.tokenizer.decode(tokens, skip_special_tokens=True, **self.decode_kwargs)
+
+    def prepare(self, value) -> Optional[List[List[int]]]:
+        """Append a token, return the [prefix, prefix + unread] token windows to decode, None for skipped prompt."""
         if not isinstance(value,int):
             raise ValueError("TextStreamer only supports batch size 1, and int type input")
 
-
         if self.skip_prompt and self.next_tokens_are_prompt:
             self.next_tokens_are_prompt = False
             return None
 
-        # Add the new token to the cache and decodes the entire thing.
         self.token_cache.append(value)
-        text = self.tokenizer.decode(self.token_cache, skip_special_tokens=True,**self.decode_kwargs)
+        return [self.token_cache[self.prefix_offset : self.read_offset], self.token_cache[self.prefix_offset :]]
 
-        # After the symbol for a new line, we flush the cache.
-        if text.endswith("\n"):
-            printable_text = text[self.print_len :]
-            self.reset()
-        # If the last token is a CJK character, we print the characters.
-        elif len(text) > 0 and self._is_chinese_char(ord(text[-1])):
-            printable_text = text[self.print_len :]
-            self.print_len += len(printable_text)
-        # Otherwise, prints until the last space char (simple heuristic to avoid printing incomplete words,
-        # which may change with the subsequent token -- there are probably smarter ways to do this!)
-        else:
-            printable_text = text[self.print_len : text.rfind(" ") + 1]
-            self.print_len += len(printable_text)
+    def advance(self, prefix_text: str, new_text: str) -> str:
+        """Consume the decoded windows returned by `prepare` and return the newly printable text."""
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            # incomplete UTF-8 sequence or a token that renders nothing yet
+            return ""
+        printable_text = new_text[len(prefix_text) :]
+        self.read_offset = len(self.token_cache)
+        self.prefix_offset = max(self.read_offset - self.PREFIX_WINDOW, 0)
+        # drop the emitted tokens that are no longer needed as context
+        if self.prefix_offset > 0:
+            self.token_cache = self.token_cache[self.prefix_offset :]
+            self.read_offset -= self.prefix_offset
+            self.prefix_offset = 0
         return printable_text
 
+    def put(self, value)->Optional[str]:
+        """
+        Receives a token and returns the text that became printable with it.
+        """
+        windows = self.prepare(value)
+        if windows is None:
+            return None
+        prefix_tokens, new_tokens = windows
+        return self.advance(self.decode(prefix_tokens), self.decode(new_tokens))
+
+    @staticmethod
+    def put_batch(streamers: List["TextStreamer"], values: List[int]) -> List[Optional[str]]:
+        """
+        `put` for many concurrent streams sharing one tokenizer, all windows are decoded by a single batch_decode.
+        """
+        results: List[Optional[str]] = [None] * len(streamers)
+        pending = []
+        windows = []
+        for i, (streamer, value) in enumerate(zip(streamers, values)):
+            w = streamer.prepare(value)
+            if w is not None:
+                pending.append(i)
+                windows.extend(w)
+        if len(pending) == 0:
+            return results
+        first = streamers[pending[0]]
+        texts = first.tokenizer.batch_decode(windows, skip_special_tokens=True, **first.decode_kwargs)
+        for j, i in enumerate(pending):
+            results[i] = streamers[i].advance(texts[2 * j], texts[2 * j + 1])
+        return results
+
     def end(self)->Optional[str]:
-        """Flushes any remaining cache and prints a newline to stdout."""
+        """Flushes any remaining cache, including a trailing incomplete UTF-8 sequence."""
         # Flush the cache, if it exists
-        if len(self.token_cache) > 0:
-            text = self.tokenizer.decode(self.token_cache, skip_special_tokens=True, **self.decode_kwargs)
-            printable_text = text[self.print_len :]
-            self.reset()
+        if len(self.token_cache) > self.read_offset:
+            prefix_text = self.decode(self.token_cache[self.prefix_offset : self.read_offset])
+            text = self.decode(self.token_cache[self.prefix_offset :])
+            printable_text = text[len(prefix_text) :]
         else:
             printable_text = ""
+        self.reset()
 
         self.next_tokens_are_prompt = True
         return printable_text
-   
-    def _is_chinese_char(self, cp):
-        """Checks whether CP is the codepoint of a CJK character."""
-        # This defines a "chinese character" as anything in the CJK Unicode block:
-        #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
-        #
-        # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
-        # despite its name. The modern Korean Hangul alphabet is a different block,
-        # as is Japanese Hiragana and Katakana. Those alphabets are used to write
-        # space-separated words, so they are not treated specially and handled
-        # like the all of the other languages.
-        if (
-            (cp >= 0x4E00 and cp <= 0x9FFF)
-            or (cp >= 0x3400 and cp <= 0x4DBF)  #
-            or (cp >= 0x20000 and cp <= 0x2A6DF)  #
-            or (cp >= 0x2A700 and cp <= 0x2B73F)  #
-            or (cp >= 0x2B740 and cp <= 0x2B81F)  #
-            or (cp >= 0x2B820 and cp <= 0x2CEAF)  #
-            or (cp >= 0xF900 and cp <= 0xFAFF)
-            or (cp >= 0x2F800 and cp <= 0x2FA1F)  #
-        ):  #
-            return True
-
-        return False
\ No newline at end of file
@@ -7,6 +7,7 @@ Version      : 0.1.0
 Copyright (c) 2024 by KVCache.AI, All Rights Reserved. 
 '''
 import os
+import re
 import random
 import torch
 from torch import nn
@@ -125,8 +126,18 @@ def load_cur_state_dict(module: nn.Module, gguf_loader: GGUFLoader, prefix: str
             #print(load_config.tensor_file_map.keys())
             raise Exception(f"can't find {translated_key} in GGUF file!")
         
+def prefetch_layer_weights(gguf_loader:GGUFLoader, prefix:str):
+    # start kernel readahead of this decoder layer and the next one, so disk reads run ahead of dequant
+    match = re.fullmatch(r"model\.layers\.(\d+)\.", prefix)
+    if match is not None:
+        layer_idx = int(match.group(1))
+        gguf_loader.prefetch_prefix(f"blk.{layer_idx}.")
+        gguf_loader.prefetch_prefix(f"blk.{layer_idx + 1}.")
+
 def load_weights(module:nn.Module, gguf_loader:GGUFLoader, prefix=''):
     #print(f"recursively loading weights {prefix}")
+    if gguf_loader.pipeline is not None:
+        prefetch_layer_weights(gguf_loader, prefix)
     if not isinstance(module, base_operator.BaseInjectedModule):
         load_cur_state_dict(module, gguf_loader, prefix)
         for name, child in module._modules.items():
@@ -0,0 +1,130 @@
+'''
+Description  :  On-disk cache of post-transform operator weights (Marlin repacked linears).
+                Each entry is a directory holding one .npy per tensor plus meta.json, it is memory-mapped on load
+                so a warm start skips the dequant / requant / repack work entirely.
+                Entries are keyed by a digest of the source tensors, the injection rule of the module and the
+                operator's weight layout version.
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import hashlib
+import json
+import os
+import re
+import shutil
+import warnings
+
+import numpy as np
+import torch
+
+import ktransformers
+
+CACHE_FORMAT_VERSION = 1
+CACHE_DIR_NAME = ".kt_weight_cache"
+# bytes hashed from the head, middle and tail of every source tensor
+SAMPLE_BYTES = 1 << 20
+
+# numpy has no bfloat16, those tensors are stored as int16 and viewed back
+_STORE_DTYPES = {torch.bfloat16: torch.int16}
+
+
+class WeightCache:
+    cache_dir: str
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def tensor_fingerprint(gguf_loader, name: str) -> dict:
+        """Identity of a gguf tensor: its file, placement, type and a hash of sampled bytes."""
+        t = gguf_loader.tensor_info[name]
+        data = gguf_loader.get_mmap_tensor(name)
+        file_name = gguf_loader.tensor_file_map[name]
+        h = hashlib.blake2b(digest_size=16)
+        if data.nbytes <= 3 * SAMPLE_BYTES:
+            h.update(data)
+        else:
+            middle = (data.nbytes - SAMPLE_BYTES) // 2
+            for begin in (0, middle, data.nbytes - SAMPLE_BYTES):
+                h.update(data[begin:begin + SAMPLE_BYTES])
+        return {
+            "name": name,
+            "file": os.path.basename(file_name),
+            "file_size": os.path.getsize(file_name),
+            "offset": t["offset"],
+            "nbytes": int(data.nbytes),
+            "ggml_type": int(t["ggml_type"]),
+            "shape": [int(s) for s in t["shape"]],
+            "sample_hash": h.hexdigest(),
+        }
+
+    def digest(self, gguf_loader, key: str, tensor_names: list[str], op_cls: type, layout_version: int, params: dict) -> str:
+        meta = {
+            "format": CACHE_FORMAT_VERSION,
+            "ktransformers": ktransformers.__version__,
+            "op": f"{op_cls.__module__}.{op_cls.__qualname__}",
+            "layout_version": layout_version,
+            "rule": gguf_loader.tensor_device_map.get(key, {}),
+            "params": params,
+            "default_dtype": str(torch.get_default_dtype()),
+            "tensors": [self.tensor_fingerprint(gguf_loader, name) for name in tensor_names],
+        }
+        return hashlib.sha256(json.dumps(meta, sort_keys=True, default=str).encode()).hexdigest()
+
+    def entry_prefix(self, key: str, op_cls: type) -> str:
+        return re.sub(r"[^A-Za-z0-9_.-]", "_", f"{key}.{op_cls.__name__}")
+
+    def entry_dir(self, key: str, op_cls: type, digest: str) -> str:
+        return os.path.join(self.cache_dir, f"{self.entry_prefix(key, op_cls)}.{digest[:24]}")
+
+    def load(self, key: str, op_cls: type, digest: str, device: str = "cpu") -> dict | None:
+        path = self.entry_dir(key, op_cls, digest)
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            self.misses += 1
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["digest"] != digest:
+            self.misses += 1
+            return None
+        tensors = {}
+        for name, dtype in meta["tensors"].items():
+            # copy-on-write mapping: pages are shared with the page cache and never written back
+            tensor = torch.from_numpy(np.load(os.path.join(path, name + ".npy"), mmap_mode="c"))
+            store_dtype = getattr(torch, dtype)
+            if store_dtype in _STORE_DTYPES:
+                tensor = tensor.view(store_dtype)
+            tensors[name] = tensor.to(device) if device != "cpu" else tensor
+        self.hits += 1
+        return tensors
+
+    def store(self, key: str, op_cls: type, digest: str, tensors: dict):
+        path = self.entry_dir(key, op_cls, digest)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        try:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+            dtypes = {}
+            for name, value in tensors.items():
+                dtypes[name] = str(value.dtype).replace("torch.", "")
+                value = value.detach().contiguous().cpu()
+                if value.dtype in _STORE_DTYPES:
+                    value = value.view(_STORE_DTYPES[value.dtype])
+                np.save(os.path.join(tmp_path, name + ".npy"), value.numpy())
+            with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"digest": digest, "key": key, "tensors": dtypes}, f)
+            # drop entries of the same module built from other sources or rules
+            prefix = self.entry_prefix(key, op_cls) + "."
+            for stale in os.listdir(self.cache_dir):
+                if stale.startswith(prefix) and ".tmp-" not in stale:
+                    shutil.rmtree(os.path.join(self.cache_dir, stale), ignore_errors=True)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            warnings.warn(f"can't write weight cache entry for {key}: {e}")
+
+    def report_string(self) -> str:
+        return f"weight cache {self.cache_dir}: {self.hits} hits, {self.misses} misses"